@@ -0,0 +1,147 @@
+"""
+Benchmark: proxied connections/sec versus number of firewall workers.
+
+For each worker count the script starts a fast asyncio echo backend, the
+firewall (`run_firewall.run_workers`) and several load generator
+processes that open a connection, send a short message, read the echo
+and close, as fast as possible.
+
+Usage:
+    python benchmark_workers.py [--workers 1 2 4] [--duration 5] [--clients 4] [--concurrency 50]
+
+Rate limiting is raised out of the way so every connection is proxied.
+Run on a multi-core machine; with a single core the numbers cannot scale.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import time
+
+import config
+
+BENCH_FIREWALL_PORT = 18080
+BENCH_BACKEND_PORT = 19000
+
+# Every load generator connects from 127.0.0.1; keep it from being blocked or shaped
+config.MAX_REQUESTS_PER_WINDOW = 10 ** 9
+config.MAX_CONNECTIONS_PER_IP = None
+config.MAX_UPLOAD_RATE_PER_IP = config.MAX_DOWNLOAD_RATE_PER_IP = None
+config.FIREWALL_PORT = BENCH_FIREWALL_PORT
+config.BACKENDS = [('127.0.0.1', BENCH_BACKEND_PORT)]
+config.WARM_CONNECTIONS = 0
+config.LOG_FILE = 'benchmark_firewall.log'
+
+import run_firewall  # noqa: E402  (reads the overrides above)
+
+
+async def echo(reader, writer):
+    try:
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+def run_backend():
+    async def serve():
+        server = await asyncio.start_server(echo, '127.0.0.1', BENCH_BACKEND_PORT, reuse_port=True, backlog=1024)
+        async with server:
+            await server.serve_forever()
+    asyncio.run(serve())
+
+
+def run_load(duration, concurrency, results):
+    async def one_client(deadline, counts):
+        while time.monotonic() < deadline:
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', BENCH_FIREWALL_PORT)
+                writer.write(b"2+2\n")
+                await writer.drain()
+                if await reader.read(4096):
+                    counts[0] += 1
+                else:
+                    counts[1] += 1
+                writer.close()
+            except OSError:
+                counts[1] += 1
+
+    async def load():
+        counts = [0, 0]
+        deadline = time.monotonic() + duration
+        await asyncio.gather(*(one_client(deadline, counts) for _ in range(concurrency)))
+        results.put(tuple(counts))
+
+    asyncio.run(load())
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Port {port} did not come up")
+
+
+def bench(workers, duration, clients, concurrency):
+    ctx = multiprocessing.get_context('fork')
+    backends = [ctx.Process(target=run_backend, daemon=True) for _ in range(max(2, workers))]
+    firewall = ctx.Process(target=run_firewall.run_workers, args=(workers,))
+    for proc in backends:
+        proc.start()
+    wait_for_port(BENCH_BACKEND_PORT)
+    firewall.start()
+    wait_for_port(BENCH_FIREWALL_PORT)
+    time.sleep(0.5)  # Let every worker bind
+
+    results = ctx.Queue()
+    loaders = [ctx.Process(target=run_load, args=(duration, concurrency, results)) for _ in range(clients)]
+    for proc in loaders:
+        proc.start()
+    ok = failed = 0
+    for _ in loaders:
+        done, errors = results.get()
+        ok += done
+        failed += errors
+    for proc in loaders:
+        proc.join()
+
+    firewall.terminate()
+    firewall.join()
+    for proc in backends:
+        proc.terminate()
+        proc.join()
+    return ok, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--clients', type=int, default=4, help="load generator processes")
+    parser.add_argument('--concurrency', type=int, default=50, help="connections in flight per load process")
+    args = parser.parse_args()
+
+    print(f"CPU cores: {os.cpu_count()}, forwarding mode: {config.FORWARD_MODE}")
+    print(f"{'workers':>8} {'conn/s':>10} {'failed':>8} {'speedup':>8}")
+    baseline = None
+    for workers in args.workers:
+        ok, failed = bench(workers, args.duration, args.clients, args.concurrency)
+        rate = ok / args.duration
+        baseline = baseline or rate
+        print(f"{workers:>8} {rate:>10.0f} {failed:>8} {rate / baseline:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
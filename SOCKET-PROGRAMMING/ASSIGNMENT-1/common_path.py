@@ -0,0 +1,15 @@
+"""
+Puts SOCKET-PROGRAMMING/common on sys.path. The modules both assignments
+share (metrics, log_pipeline, timer_wheel, connection_guard, bandwidth)
+live there; import this before any of them.
+
+The shared modules `import config`, which resolves to this assignment's
+config.py since the assignment's directory comes first on sys.path.
+"""
+
+import os
+import sys
+
+COMMON_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'common')
+if COMMON_DIR not in sys.path:
+    sys.path.append(COMMON_DIR)
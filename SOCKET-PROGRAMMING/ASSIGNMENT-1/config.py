@@ -8,10 +8,83 @@ FIREWALL_PORT = 8080
 BACKEND_HOST = '127.0.0.1'
 BACKEND_PORT = 9000
 
+# Upstream Pool
+# Backends to balance across; add more (host, port) pairs to scale out
+BACKENDS = [(BACKEND_HOST, BACKEND_PORT)]
+LOAD_BALANCING = 'round_robin'  # 'round_robin' or 'least_connections'
+WARM_CONNECTIONS = 2  # Pre-connected sockets kept ready per backend
+HEALTH_CHECK_INTERVAL = 5  # Seconds between backend health checks
+MAX_BACKEND_FAILURES = 3  # Consecutive failures before a backend is ejected
+BACKEND_CONNECT_TIMEOUT = 2  # Seconds
+
+# Forwarding Engine
+# 'streams' (StreamReader/StreamWriter), 'buffered' (BufferedProtocol with
+# reusable buffers) or 'splice' (Linux kernel-side copy, no inspection)
+FORWARD_MODE = 'streams'
+FORWARD_BUFFER_SIZE = 65536  # Bytes per read
+FORWARD_HIGH_WATER = 262144  # Pause reading when the peer has this much unsent data
+
 # DoS Protection Configuration
 TIME_WINDOW = 60  # Sliding window in seconds
 MAX_REQUESTS_PER_WINDOW = 50  # Max requests per IP in the time window
 BLOCK_DURATION = 30  # Duration to block an IP in seconds
+# Rate limit algorithm: 'sliding_log' (exact, one timestamp per request),
+# 'sliding_window' (two weighted counters), 'token_bucket' or 'gcra'.
+# --workers always uses 'gcra' (the shared table holds its state only).
+RATE_LIMIT_ALGORITHM = 'sliding_log'
+
+# Reloadable limits: a JSON file with any of "time_window",
+# "max_requests_per_window" and "block_duration" overrides the values above.
+# It is re-read when it changes or on SIGHUP, keeping all tracked state.
+POLICY_FILE = 'dos_policy.json'
+POLICY_POLL_INTERVAL = 1  # Seconds between checks for changes (0 = reload on SIGHUP only)
+
+# Concurrent Connection Limits (see connection_guard.py; None turns a limit off).
+# With --workers each worker enforces them on its own connections.
+MAX_CONNECTIONS_PER_IP = 32  # Open proxied connections one IP may hold
+MAX_CONNECTIONS = 10000  # Global budget of open proxied connections
+FAIR_SHARE_THRESHOLD = 0.8  # Above this share of the budget, IPs holding their equal share are refused
+IDLE_TIMEOUT = 120  # Seconds without data in either direction before a connection is closed
+REQUEST_TIMEOUT = 10  # Seconds a client has to send its first bytes (and longest request exempt from MIN_TRANSFER_RATE)
+MIN_TRANSFER_RATE = 100  # Bytes/s a request arriving for longer than REQUEST_TIMEOUT must average (slowloris)
+
+# Bandwidth Shaping (see bandwidth.py; None turns a direction off).
+# Per source IP, shared by all of its connections; with --workers, per worker.
+MAX_UPLOAD_RATE_PER_IP = 12500000  # Bytes/s one IP may send to the backends (100 Mbit/s; keep far above MIN_TRANSFER_RATE)
+MAX_DOWNLOAD_RATE_PER_IP = 12500000  # Bytes/s the backends may send to one IP (100 Mbit/s)
+BANDWIDTH_BURST = 1048576  # Bytes an IP may move at full speed before its rate applies
+
+# Memory Bounds
+MAX_TRACKED_IPS = 100000  # Hard cap on IPs with request history (None = unbounded)
+MAX_BLOCKED_IPS = 100000  # Hard cap on simultaneously blocked IPs (None = unbounded)
+TIMER_TICK = 0.1  # Resolution of block and idle expiry timers (seconds)
+TIMER_SLOTS = 2048  # Slots per timer wheel; one revolution = TIMER_TICK * TIMER_SLOTS seconds
+SWEEP_INTERVAL = 5  # Seconds between housekeeping passes (flushing log summaries)
+STATS_INTERVAL = 60  # Seconds between memory usage reports in the log
+
+# Persistent State
+# Blocks and rate limiter counters are snapshotted to this file and
+# restored on startup, so a restart does not reset every IP (None = off)
+SNAPSHOT_FILE = 'dos_state.snapshot'
+SNAPSHOT_INTERVAL = 30  # Seconds between snapshots (one is also written on shutdown)
+
+# Multi-process Workers (run_firewall.py --workers N)
+SHARED_TABLE_SLOTS = 1048576  # Fixed IP slots in shared memory (32 bytes each)
+SHARED_LOCK_STRIPES = 64  # Locks guarding the table's buckets
+SHARED_EXPIRY_SCAN_SLOTS = 2048  # Table slots each sweep checks for ended blocks (1M slots: one pass per ~50 s at TIMER_TICK)
+# Open connections and bandwidth buckets per IP, shared by the workers so the
+# connection and bandwidth limits above hold across all of them, not per worker
+SHARED_CONNECTION_SLOTS = 65536  # IPs with open connections or refilling buckets (64 bytes each)
+
+# Metrics
+# Prometheus text format at http://METRICS_HOST:METRICS_PORT/metrics (None = off).
+# With --workers, worker N listens on METRICS_PORT + N.
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9100
 
 # Logging
 LOG_FILE = 'dos_firewall.log'
+LOG_QUEUE_SIZE = 10000  # Records buffered before new ones are dropped
+LOG_BATCH_SIZE = 256  # Max records written per flush
+LOG_FLUSH_INTERVAL = 0.05  # Seconds a batch may wait to fill before being written
+BLOCK_SUMMARY_INTERVAL = 1  # Seconds between "IP blocked N times" summary lines
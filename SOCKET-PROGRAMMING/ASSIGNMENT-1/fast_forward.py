@@ -0,0 +1,408 @@
+"""
+High-throughput forwarding engines for the DoS proxy.
+
+Two alternatives to the StreamReader/StreamWriter loop in run_firewall.py:
+
+- 'buffered': asyncio.BufferedProtocol endpoints that receive straight into
+  a preallocated buffer (recv_into) and hand a memoryview of it to the peer
+  transport. Backpressure is propagated with pause/resume_reading.
+- 'splice': Linux only. Bytes are moved socket -> pipe -> socket with
+  os.splice and never enter Python at all. Only usable when the payload
+  does not need to be inspected, which is the case for the DoS proxy.
+
+Both take an optional ConnectionGuard (connection_guard.py): each admitted
+connection is counted against its limits and reports the bytes it moves,
+and a connection the guard times out is aborted. With a BandwidthShaper
+(bandwidth.py), a side that goes over its IP's rate stops reading until
+the IP is back within it.
+"""
+
+import asyncio
+import logging
+import os
+import socket
+
+import common_path  # Shared modules, see common_path.py
+from metrics import registry
+
+SPLICE_AVAILABLE = hasattr(os, 'splice')
+
+# Linux default pipe capacity; a single splice never moves more than this
+PIPE_CAPACITY = 65536
+
+# Bytes proxied in each direction, whichever engine moved them
+CLIENT_BYTES = registry.counter('dos_forwarded_bytes_total', "Bytes proxied between clients and backends",
+                                direction='client_to_backend')
+BACKEND_BYTES = registry.counter('dos_forwarded_bytes_total', "Bytes proxied between clients and backends",
+                                 direction='backend_to_client')
+
+
+class ProxyProtocol(asyncio.BufferedProtocol):
+    """
+    One side of a proxied connection. Data received here is written to the
+    peer's transport without being copied into a new bytes object.
+    """
+
+    def __init__(self, buffer_size, high_water, on_lost=None, bytes_counter=BACKEND_BYTES):
+        self.buffer_size = buffer_size
+        self.high_water = high_water
+        self.on_lost = on_lost
+        self.bytes_counter = bytes_counter
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.transport = None
+        self.peer = None
+        # TrackedConnection.client_data or backend_data, when limits apply
+        self.activity = None
+        # ShapedIP.client_data or backend_data, when bandwidth is shaped
+        self.throttle = None
+        # Why reading is paused: over the bandwidth limit, or the peer's
+        # transport is full. Reading resumes when neither holds
+        self.throttled = False
+        self.peer_full = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self.high_water)
+
+    def link(self, peer):
+        self.peer = peer
+        peer.peer = self
+
+    def get_buffer(self, sizehint):
+        return self.view
+
+    def buffer_updated(self, nbytes):
+        self.bytes_counter.inc(nbytes)
+        if self.activity is not None:
+            self.activity(nbytes)
+        peer_transport = self.peer.transport
+        peer_transport.write(self.view[:nbytes])
+        if peer_transport.get_write_buffer_size():
+            # The transport may keep a reference to our memoryview while it
+            # waits for the socket; never overwrite bytes it has not sent.
+            self.buffer = bytearray(self.buffer_size)
+            self.view = memoryview(self.buffer)
+        if self.throttle is not None and not self.throttled:
+            delay = self.throttle(nbytes)
+            if delay:
+                self.throttled = True
+                self.transport.pause_reading()
+                asyncio.get_running_loop().call_later(delay, self.end_throttle)
+
+    def end_throttle(self):
+        self.throttled = False
+        if not self.peer_full:
+            # A no-op once the transport is closing
+            self.transport.resume_reading()
+
+    def pause_writing(self):
+        # Our outgoing buffer is full: stop reading from the other side
+        if self.peer and self.peer.transport:
+            self.peer.peer_full = True
+            self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        if self.peer and self.peer.transport:
+            self.peer.peer_full = False
+            if not self.peer.throttled:
+                self.peer.transport.resume_reading()
+
+    def eof_received(self):
+        # Same behaviour as the stream proxy: one side closing ends the session.
+        # close() still flushes anything buffered for the peer.
+        if self.peer and self.peer.transport:
+            self.peer.transport.close()
+        return False
+
+    def connection_lost(self, exc):
+        if self.peer and self.peer.transport:
+            self.peer.transport.close()
+        if self.on_lost:
+            self.on_lost()
+
+
+class ClientProxyProtocol(ProxyProtocol):
+    """
+    Client-facing side: applies the admission check and the connection
+    limits, then takes a backend connection from the upstream pool.
+    Reading is paused until the backend side is linked.
+    """
+
+    def __init__(self, admit, pool, buffer_size, high_water, connections=None, bandwidth=None):
+        super().__init__(buffer_size, high_water, bytes_counter=CLIENT_BYTES)
+        self.admit = admit
+        self.pool = pool
+        self.connections = connections
+        self.tracked = None
+        self.bandwidth = bandwidth
+        self.shaped = None
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        peername = transport.get_extra_info('peername')
+        client_ip = peername[0] if peername else 'unknown'
+
+        if not self.admit(client_ip):
+            transport.close()
+            return
+        if self.connections is not None:
+            self.tracked = self.connections.open(client_ip, transport.abort)
+            if self.tracked is None:
+                transport.close()
+                return
+            self.activity = self.tracked.client_data
+        if self.bandwidth is not None:
+            self.shaped = self.bandwidth.open(client_ip)
+            self.throttle = self.shaped.client_data
+
+        transport.pause_reading()
+        asyncio.get_running_loop().create_task(self.connect_backend())
+
+    async def connect_backend(self):
+        loop = asyncio.get_running_loop()
+        try:
+            upstream, sock = await self.pool.acquire()
+        except OSError as e:
+            logging.error("Failed to connect to backend server. Error: %s", e)
+            self.transport.close()
+            return
+
+        try:
+            _, backend = await loop.create_connection(
+                lambda: ProxyProtocol(self.buffer_size, self.high_water, lambda: self.pool.release(upstream),
+                                      BACKEND_BYTES),
+                sock=sock
+            )
+        except OSError as e:
+            logging.error("Failed to attach backend %s. Error: %s", upstream.address, e)
+            self.pool.release(upstream)
+            sock.close()
+            self.transport.close()
+            return
+
+        if self.transport.is_closing():
+            backend.transport.close()
+            return
+        self.link(backend)
+        if self.tracked is not None:
+            backend.activity = self.tracked.backend_data
+        if self.shaped is not None:
+            backend.throttle = self.shaped.backend_data
+        self.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        if self.tracked is not None:
+            self.connections.release(self.tracked)
+            self.tracked = None
+        if self.shaped is not None:
+            self.bandwidth.release(self.shaped)
+            self.shaped = None
+
+
+async def start_buffered_server(admit, host, port, pool, buffer_size=65536, high_water=None,
+                                backlog=100, reuse_port=False, connections=None, bandwidth=None):
+    """Start the proxy using BufferedProtocol endpoints."""
+    if high_water is None:
+        high_water = 4 * buffer_size
+    loop = asyncio.get_running_loop()
+    return await loop.create_server(
+        lambda: ClientProxyProtocol(admit, pool, buffer_size, high_water, connections, bandwidth),
+        host, port, backlog=backlog, reuse_port=reuse_port or None
+    )
+
+
+class SplicePump:
+    """
+    Move bytes from src to dst through a pipe with os.splice.
+    Reading from src stops while dst cannot accept more (backpressure),
+    and while `throttle` says the IP is over its bandwidth.
+    """
+
+    def __init__(self, loop, src, dst, chunk_size, bytes_counter, activity=None, throttle=None):
+        self.loop = loop
+        self.src_fd = src.fileno()
+        self.dst_fd = dst.fileno()
+        self.chunk_size = min(chunk_size, PIPE_CAPACITY)
+        self.pipe_r, self.pipe_w = os.pipe()
+        os.set_blocking(self.pipe_r, False)
+        os.set_blocking(self.pipe_w, False)
+        self.flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        self.pending = 0  # Bytes sitting in the pipe
+        self.reading = False
+        self.writing = False
+        self.done = loop.create_future()
+        self.bytes_forwarded = 0
+        self.bytes_counter = bytes_counter
+        self.activity = activity
+        self.throttle = throttle
+        self.resume_handle = None  # Pending end of a bandwidth pause
+
+    def start(self):
+        self.set_reading(True)
+        return self.done
+
+    def set_reading(self, enabled):
+        if enabled and not self.reading:
+            self.loop.add_reader(self.src_fd, self.on_readable)
+        elif not enabled and self.reading:
+            self.loop.remove_reader(self.src_fd)
+        self.reading = enabled
+
+    def set_writing(self, enabled):
+        if enabled and not self.writing:
+            self.loop.add_writer(self.dst_fd, self.on_writable)
+        elif not enabled and self.writing:
+            self.loop.remove_writer(self.dst_fd)
+        self.writing = enabled
+
+    def on_readable(self):
+        try:
+            n = os.splice(self.src_fd, self.pipe_w, self.chunk_size, flags=self.flags)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.finish(e)
+            return
+        if n == 0:
+            self.finish()
+            return
+        if self.activity is not None:
+            self.activity(n)
+        delay = self.throttle(n) if self.throttle is not None else 0
+        if delay:
+            self.set_reading(False)
+            self.resume_handle = self.loop.call_later(delay, self.end_throttle)
+        self.pending += n
+        self.drain()
+
+    def end_throttle(self):
+        self.resume_handle = None
+        if not self.writing:
+            self.set_reading(True)
+
+    def on_writable(self):
+        self.drain()
+
+    def drain(self):
+        while self.pending:
+            try:
+                n = os.splice(self.pipe_r, self.dst_fd, self.pending, flags=self.flags)
+            except (BlockingIOError, InterruptedError):
+                # Destination is full: wait for it before reading more
+                self.set_reading(False)
+                self.set_writing(True)
+                return
+            except OSError as e:
+                self.finish(e)
+                return
+            self.pending -= n
+            self.bytes_forwarded += n
+            self.bytes_counter.inc(n)
+        self.set_writing(False)
+        if not self.done.done() and self.resume_handle is None:
+            self.set_reading(True)
+
+    def finish(self, exc=None):
+        self.close()
+        if not self.done.done():
+            self.done.set_result(exc)
+
+    def close(self):
+        if self.resume_handle is not None:
+            self.resume_handle.cancel()
+            self.resume_handle = None
+        self.set_reading(False)
+        self.set_writing(False)
+        if self.pipe_r is not None:
+            os.close(self.pipe_r)
+            os.close(self.pipe_w)
+            self.pipe_r = self.pipe_w = None
+
+
+async def splice_session(loop, client_sock, admit, pool, chunk_size, connections=None, bandwidth=None):
+    """Admit, connect and splice one client connection until either side closes."""
+    client_ip = client_sock.getpeername()[0]
+    if not admit(client_ip):
+        client_sock.close()
+        return
+
+    # Set when the connection guard times the session out
+    aborted = loop.create_future()
+    tracked = None
+    if connections is not None:
+        def abort():
+            if not aborted.done():
+                aborted.set_result(None)
+        tracked = connections.open(client_ip, abort)
+        if tracked is None:
+            client_sock.close()
+            return
+
+    shaped = bandwidth.open(client_ip) if bandwidth is not None else None
+    try:
+        await splice_to_backend(loop, client_sock, pool, chunk_size, tracked, shaped, aborted)
+    finally:
+        if shaped is not None:
+            bandwidth.release(shaped)
+        if tracked is not None:
+            connections.release(tracked)
+
+
+async def splice_to_backend(loop, client_sock, pool, chunk_size, tracked, shaped, aborted):
+    """Connect a backend and splice until either side closes or `aborted` is set."""
+    try:
+        upstream, backend_sock = await pool.acquire()
+    except OSError as e:
+        logging.error("Failed to connect to backend server. Error: %s", e)
+        client_sock.close()
+        return
+
+    pumps = [
+        SplicePump(loop, client_sock, backend_sock, chunk_size, CLIENT_BYTES,
+                   tracked.client_data if tracked else None, shaped.client_data if shaped else None),
+        SplicePump(loop, backend_sock, client_sock, chunk_size, BACKEND_BYTES,
+                   tracked.backend_data if tracked else None, shaped.backend_data if shaped else None),
+    ]
+    try:
+        await asyncio.wait([pump.start() for pump in pumps] + [aborted], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for pump in pumps:
+            pump.close()
+        backend_sock.close()
+        client_sock.close()
+        pool.release(upstream)
+
+
+async def serve_splice(admit, host, port, pool, buffer_size=65536, backlog=100,
+                       ready=None, reuse_port=False, connections=None, bandwidth=None):
+    """
+    Accept loop for the splice engine. Runs until cancelled.
+    `ready` (optional future) receives the bound address once listening.
+    """
+    loop = asyncio.get_running_loop()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    listener.setblocking(False)
+    if ready is not None:
+        ready.set_result(listener.getsockname())
+
+    sessions = set()
+    try:
+        while True:
+            client_sock, _ = await loop.sock_accept(listener)
+            client_sock.setblocking(False)
+            task = loop.create_task(
+                splice_session(loop, client_sock, admit, pool, buffer_size, connections, bandwidth)
+            )
+            sessions.add(task)
+            task.add_done_callback(sessions.discard)
+    finally:
+        for task in sessions:
+            task.cancel()
+        listener.close()
@@ -1,82 +1,286 @@
+import sys
 import time
 import logging
-from collections import deque, defaultdict
+from collections import OrderedDict
 import config
+from rate_limiters import create_limiter
+from snapshot import Snapshot
+import common_path  # Shared modules, see common_path.py
+from timer_wheel import TimerWheel
+from connection_guard import ConnectionGuard
+from bandwidth import BandwidthShaper
+from log_pipeline import setup_logging, BlockSummary
+from metrics import registry
 
-# Configure logging
-logging.basicConfig(
-    filename=config.LOG_FILE,
+# Configure logging (written in batches by a background thread)
+setup_logging(
+    config.LOG_FILE,
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
+    queue_size=config.LOG_QUEUE_SIZE,
+    batch_size=config.LOG_BATCH_SIZE,
+    flush_interval=config.LOG_FLUSH_INTERVAL,
 )
 
+BLOCKS = registry.counter('dos_blocks_total', "IPs blocked for exceeding the rate limit")
+
 class DoSProtector:
-    def __init__(self):
-        # Stores request timestamps for each IP: {ip: deque([t1, t2, ...])}
-        self.request_history = defaultdict(deque)
-        
+    def __init__(self, clock=time.time):
+        # Stores rate limiter state for each IP: {ip: state}
+        # (a deque of timestamps for 'sliding_log', O(1) counters otherwise).
+        # Kept in least-recently-seen order so idle IPs can be evicted first.
+        self.request_history = OrderedDict()
+        self.limiter = create_limiter(config.RATE_LIMIT_ALGORITHM)
+
         # Stores blocked IPs and their unblock time: {ip: unblock_timestamp}
-        self.blocked_ips = {}
-        
+        self.blocked_ips = OrderedDict()
+
         self.window = config.TIME_WINDOW
         self.max_requests = config.MAX_REQUESTS_PER_WINDOW
         self.block_duration = config.BLOCK_DURATION
-        
+
+        # Memory bounds (None disables the cap)
+        self.max_tracked_ips = config.MAX_TRACKED_IPS
+        self.max_blocked_ips = config.MAX_BLOCKED_IPS
+        self.clock = clock
+
+        # Expiry timers: one per blocked IP (at its unblock time) and one
+        # per tracked IP (when it would go idle). An idle timer is not moved
+        # on every request; when it fires it is re-armed if the IP was seen
+        # since. Driven by sweep(), from process_request and run_firewall.py.
+        self.block_timers = TimerWheel(config.TIMER_TICK, config.TIMER_SLOTS)
+        self.idle_timers = TimerWheel(config.TIMER_TICK, config.TIMER_SLOTS)
+        # Started at the current time, so a block can be set before the first sweep()
+        self.block_timers.advance(self.clock())
+        self.idle_timers.advance(self.clock())
+        self.next_sweep = float('-inf')
+
+        # Called with the IP whenever a block ends
+        self.unblock_listeners = []
+
+        # Open connections per IP, idle and slow-request timeouts;
+        # the proxy opens and releases, sweep() enforces the timeouts
+        self.connections = ConnectionGuard('dos')
+        # Per-IP bandwidth limits for the forwarding loops
+        self.bandwidth = BandwidthShaper('dos')
+
+        # Snapshot from an earlier run (restore_snapshot). IPs are restored
+        # from it one at a time, the first time each is seen again.
+        self.snapshot = None
+
         # Stats for reporting
         self.total_tracked_ips = 0
+        self.evicted_ips = 0
+        self.restored_ips = 0
 
-    def cleanup_old_requests(self, ip, current_time):
-        """Remove timestamps that are outside the sliding window."""
-        timestamps = self.request_history[ip]
-        while timestamps and timestamps[0] < (current_time - self.window):
-            timestamps.popleft()
+        # One summary line per IP per interval instead of one line per drop
+        self.block_summary = BlockSummary("BLOCKED requests (Active Block)", config.BLOCK_SUMMARY_INTERVAL)
+
+    def reconfigure(self, time_window=None, max_requests_per_window=None, block_duration=None):
+        """
+        Change the limits in place. Tracked IPs and active blocks are kept;
+        new limits apply from each IP's next request.
+        """
+        if time_window is not None:
+            self.window = time_window
+        if max_requests_per_window is not None:
+            self.max_requests = max_requests_per_window
+        if block_duration is not None:
+            self.block_duration = block_duration
 
     def is_blocked(self, ip):
         """Check if an IP is currently blocked."""
-        current_time = time.time()
+        current_time = self.clock()
         if ip in self.blocked_ips:
             if current_time < self.blocked_ips[ip]:
                 return True
             else:
-                # Block expired
-                del self.blocked_ips[ip]
-                logging.info(f"Unblocked IP: {ip} (Block expired)")
+                # Block expired (its timer has not fired yet)
+                self.unblock(ip)
         return False
 
+    def unblock(self, ip):
+        del self.blocked_ips[ip]
+        self.block_timers.cancel(ip)
+        logging.info("Unblocked IP: %s (Block expired)", ip)
+        for listener in self.unblock_listeners:
+            listener(ip)
+
     def process_request(self, ip):
         """
         Analyze the request from an IP.
         Returns:
             bool: True if request allowed, False if blocked.
         """
-        current_time = time.time()
+        current_time = self.clock()
+
+        # 0. Fire expiry timers that fell due since the last tick
+        if current_time >= self.next_sweep:
+            self.sweep(current_time)
+
+        # Pick up state saved before a restart
+        if self.snapshot is not None and ip not in self.request_history and ip not in self.blocked_ips:
+            self.adopt(ip, current_time)
 
         # 1. Check if already blocked
         if self.is_blocked(ip):
-            logging.warning(f"BLOCKED request from {ip} (Active Block)")
+            self.block_summary.note(ip)
             return False
 
-        # 2. Cleanup old history for this IP
-        self.cleanup_old_requests(ip, current_time)
-
-        # 3. Add current request
-        self.request_history[ip].append(current_time)
-        request_count = len(self.request_history[ip])
+        # 2. Record the request with the configured algorithm
+        state = self.track(ip, current_time)
+        request_count = self.limiter.hit(state, current_time, self.max_requests, self.window)
 
-        # 4. Check threshold
+        # 3. Check threshold
         if request_count > self.max_requests:
-            self.block_ip(ip, current_time)
+            self.block_ip(ip, current_time, request_count)
             return False
 
-        # 5. Allow request
+        # 4. Allow request
         return True
 
-    def block_ip(self, ip, current_time):
-        """Block the IP for the configured duration."""
-        unblock_time = current_time + self.block_duration
+    def track(self, ip, current_time):
+        """
+        Return the limiter state for an IP, creating it if needed.
+        The IP becomes the most recently seen entry; the least recently
+        seen IP is evicted when the tracking cap is exceeded.
+        """
+        state = self.request_history.get(ip)
+        if state is None:
+            state = self.limiter.new_state(current_time)
+            self.add_state(ip, state, current_time)
+        else:
+            self.request_history.move_to_end(ip)
+        return state
+
+    def add_state(self, ip, state, last_seen):
+        self.request_history[ip] = state
+        self.idle_timers.schedule(ip, last_seen + self.limiter.idle_window(self.window))
+        self.total_tracked_ips += 1
+        if self.max_tracked_ips and len(self.request_history) > self.max_tracked_ips:
+            evicted, _ = self.request_history.popitem(last=False)
+            self.idle_timers.cancel(evicted)
+            self.evicted_ips += 1
+
+    def add_block(self, ip, unblock_time):
         self.blocked_ips[ip] = unblock_time
-        logging.warning(f"DETECTED DoS: Blocking {ip} for {self.block_duration}s. Request count: {len(self.request_history[ip])}")
+        self.blocked_ips.move_to_end(ip)
+        self.block_timers.schedule(ip, unblock_time)
+        if self.max_blocked_ips and len(self.blocked_ips) > self.max_blocked_ips:
+            # Block durations are uniform, so the first entry expires soonest
+            evicted, _ = self.blocked_ips.popitem(last=False)
+            self.block_timers.cancel(evicted)
+
+    def block_ip(self, ip, current_time, request_count=None):
+        """Block the IP for the configured duration."""
+        self.add_block(ip, current_time + self.block_duration)
+        BLOCKS.inc()
+        if request_count is None:
+            request_count = self.max_requests + 1
+        logging.warning("DETECTED DoS: Blocking %s for %ss. Request count: %g", ip, self.block_duration, request_count)
+
+    def restore_snapshot(self, path):
+        """
+        Map a snapshot written by an earlier run (see snapshot.py). Nothing
+        is copied yet; each IP's block and counters are restored when it
+        is next seen.
+        Returns:
+            int: Number of IPs in the snapshot (0 if there is none to use).
+        """
+        try:
+            snapshot = Snapshot(path)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            logging.error("Ignoring DoS state snapshot %s: %s", path, e)
+            return 0
+        if snapshot.expires <= self.clock():
+            logging.info("DoS state snapshot %s has expired", path)
+            return 0
+        if snapshot.algorithm != self.limiter.name:
+            logging.warning("DoS state snapshot %s was taken with '%s', restoring blocks only",
+                            path, snapshot.algorithm)
+        self.snapshot = snapshot
+        logging.info("Restoring up to %d IPs from DoS state snapshot %s", snapshot.count, path)
+        return snapshot.count
+
+    def adopt(self, ip, current_time):
+        """Restore an IP's block and limiter state from the snapshot, if it has any."""
+        if current_time >= self.snapshot.expires:
+            # Everything in it has expired
+            self.snapshot = None
+            return
+        entry = self.snapshot.lookup(ip)
+        if entry is None:
+            return
+        blocked_until, last_seen, values = entry
+        if blocked_until > current_time:
+            self.add_block(ip, blocked_until)
+        if values and self.snapshot.algorithm == self.limiter.name:
+            self.add_state(ip, self.limiter.import_state(values), last_seen)
+        self.restored_ips += 1
+
+    def sweep(self, current_time=None):
+        """
+        Fire the expiry timers that are due: end blocks whose time is up
+        and drop IPs with no requests inside the window. Only timers in the
+        elapsed ticks are looked at, however many IPs are tracked. Open
+        connections that are idle or too slow are aborted, and bandwidth
+        state of IPs that have left is dropped once it has refilled.
+        Returns:
+            int: Number of entries removed.
+        """
+        if current_time is None:
+            current_time = self.clock()
+        tick = self.block_timers.tick
+        self.next_sweep = (current_time // tick + 1) * tick
+        removed = 0
+
+        # add_block re-arms the timer, so a fired timer is always the current block's
+        for ip in self.block_timers.advance(current_time):
+            if ip in self.blocked_ips:
+                self.unblock(ip)
+                removed += 1
+
+        idle_window = self.limiter.idle_window(self.window)
+        for ip in self.idle_timers.advance(current_time):
+            state = self.request_history.get(ip)
+            if state is None:
+                continue
+            idle_at = self.limiter.last_seen(state) + idle_window
+            if idle_at > current_time:
+                # Seen since the timer was set
+                self.idle_timers.schedule(ip, idle_at)
+            else:
+                del self.request_history[ip]
+                removed += 1
+
+        self.connections.sweep()
+        self.bandwidth.sweep()
+        return removed
+
+    def memory_stats(self):
+        """
+        Report approximate memory held by the tracking tables.
+        Returns:
+            dict: Entry counts and byte estimates (including per-IP cost).
+        """
+        history_bytes = sys.getsizeof(self.request_history)
+        for ip, state in self.request_history.items():
+            history_bytes += sys.getsizeof(ip) + self.limiter.state_size(state)
+        blocked_bytes = sys.getsizeof(self.blocked_ips)
+        blocked_bytes += sum(sys.getsizeof(ip) + sys.getsizeof(0.0) for ip in self.blocked_ips)
+
+        tracked = len(self.request_history)
+        return {
+            'algorithm': self.limiter.name,
+            'tracked_ips': tracked,
+            'blocked_ips': len(self.blocked_ips),
+            'evicted_ips': self.evicted_ips,
+            'total_tracked_ips': self.total_tracked_ips,
+            'history_bytes': history_bytes,
+            'blocked_bytes': blocked_bytes,
+            'bytes_per_ip': history_bytes // tracked if tracked else 0,
+        }
 
 # Global instance
 firewall_engine = DoSProtector()
@@ -0,0 +1,422 @@
+"""
+Load generator for the DoS proxy, the MathBC firewall and the chat server.
+
+Targets (--target):
+  dos     run_firewall.py (this assignment). Each connection sends
+          --payload bytes and waits until at least as many come back,
+          --requests times.
+  mathbc  mathbc_firewall.py (Assignment-2): the same exchange, over TLS
+          unless --no-tls.
+  chat    server.py (Assignment-4). Each connection JOINs and waits for its
+          own join notice, then sends --requests messages and LEAVEs. Every
+          message carries its send time, so each copy the other clients
+          receive adds a fan-out (delivery) latency sample.
+
+Connections are closed-loop by default: --concurrency clients each open
+the next connection as soon as the last one finishes. With --rate, new
+connections start at that rate (at most --concurrency in flight) however
+fast the server answers. --processes splits the load over several
+processes when one Python process cannot keep up.
+
+With --sources N, connections are spread over N source addresses
+(127.0.0.1, 127.0.0.2, ...), so the firewall sees N clients. Linux routes
+all of 127.0.0.0/8 to the loopback interface; on macOS add aliases first
+(sudo ifconfig lo0 alias 127.0.0.2).
+
+A connection the server closes or resets before it finishes counts as
+rejected (what a blocked client sees). Reported: connections/sec,
+requests/sec, throughput, and p50/p99/p99.9 connect, request and delivery
+latency. --json writes the result, with the git commit, for comparing
+runs; --compare OLD NEW prints the difference between two such files.
+
+Examples:
+    python load_generator.py --connections 69 --concurrency 1     # the old attack demo
+    python load_generator.py --sources 1000 --concurrency 200 --duration 10 --json before.json
+    python load_generator.py --target chat --concurrency 50 --requests 20 --think 0.05
+    python load_generator.py --compare before.json after.json
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import platform
+import re
+import ssl
+import subprocess
+import sys
+import time
+
+import config
+
+TARGETS = {
+    'dos': {'port': config.FIREWALL_PORT, 'tls': False},
+    'mathbc': {'port': 8000, 'tls': True},
+    'chat': {'port': 9999, 'tls': False},
+}
+
+# Send time embedded in chat messages: "@<unix time>@"
+STAMP = re.compile(rb'@(\d+\.\d+)@')
+
+
+class Rejected(Exception):
+    """The server closed the connection before the exchange finished."""
+
+
+class Stats:
+    def __init__(self):
+        self.started = 0
+        self.completed = 0
+        self.rejected = 0
+        self.requests = 0
+        self.errors = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.connect_latency = []
+        self.request_latency = []
+        self.delivery_latency = []
+
+    def error(self, e):
+        name = type(e).__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def merge(self, other):
+        for name in ('started', 'completed', 'rejected', 'requests', 'bytes_sent', 'bytes_received'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for name, count in other.errors.items():
+            self.errors[name] = self.errors.get(name, 0) + count
+        self.connect_latency += other.connect_latency
+        self.request_latency += other.request_latency
+        self.delivery_latency += other.delivery_latency
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return None
+    # Smallest value with at least `fraction` of the samples at or below it
+    # (the epsilon keeps 0.99 * 1000 from rounding up to rank 991)
+    rank = math.ceil(fraction * len(ordered) - 1e-9)
+    index = max(0, min(len(ordered) - 1, rank - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    """Latency summary in milliseconds."""
+    ordered = sorted(samples)
+    if not ordered:
+        return {'count': 0}
+    ms = lambda value: round(value * 1000, 3)
+    return {
+        'count': len(ordered),
+        'mean': ms(sum(ordered) / len(ordered)),
+        'p50': ms(percentile(ordered, 0.50)),
+        'p99': ms(percentile(ordered, 0.99)),
+        'p999': ms(percentile(ordered, 0.999)),
+        'max': ms(ordered[-1]),
+    }
+
+
+def source_address(index):
+    """The index-th loopback source address: 127.0.0.1, 127.0.0.2, ..."""
+    n = index + 1
+    return f"127.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}"
+
+
+async def read_at_least(reader, count, timeout):
+    received = 0
+    while received < count:
+        chunk = await asyncio.wait_for(reader.read(65536), timeout)
+        if not chunk:
+            raise Rejected()
+        received += len(chunk)
+    return received
+
+
+async def exchange_echo(reader, writer, args, stats, name):
+    payload = b'x' * args.payload
+    for i in range(args.requests):
+        if i and args.think:
+            await asyncio.sleep(args.think)
+        started = time.perf_counter()
+        # Buffered in the transport and sent while we read, so large
+        # payloads cannot deadlock against the server's replies
+        writer.write(payload)
+        received = await read_at_least(reader, len(payload), args.timeout)
+        await writer.drain()
+        stats.request_latency.append(time.perf_counter() - started)
+        stats.requests += 1
+        stats.bytes_sent += len(payload)
+        stats.bytes_received += received
+
+
+async def chat_listener(reader, stats, joined, marker):
+    """Count everything the chat server sends us and time stamped messages."""
+    tail = b''
+    while True:
+        chunk = await reader.read(65536)
+        if not chunk:
+            if not joined.done():
+                joined.set_exception(Rejected())
+            return
+        now = time.time()
+        stats.bytes_received += len(chunk)
+        data = tail + chunk
+        if not joined.done() and marker in data:
+            joined.set_result(None)
+        # Stamps wholly inside the tail were counted with the previous chunk
+        for match in STAMP.finditer(data):
+            if match.end() > len(tail):
+                stats.delivery_latency.append(now - float(match.group(1)))
+        tail = data[-64:]
+
+
+async def exchange_chat(reader, writer, args, stats, name):
+    joined = asyncio.get_running_loop().create_future()
+    listener = asyncio.create_task(chat_listener(reader, stats, joined, f"{name} has joined".encode()))
+    try:
+        started = time.perf_counter()
+        writer.write(f"JOIN|{name}".encode())
+        await asyncio.wait_for(joined, args.timeout)
+        stats.request_latency.append(time.perf_counter() - started)
+        stats.requests += 1
+
+        for _ in range(args.requests):
+            await asyncio.sleep(args.think)
+            content = f"@{time.time():.6f}@".ljust(args.payload, 'x')
+            message = f"MSG|{content}".encode()
+            writer.write(message)
+            await asyncio.wait_for(writer.drain(), args.timeout)
+            stats.requests += 1
+            stats.bytes_sent += len(message)
+        writer.write(b"LEAVE")
+        await writer.drain()
+    finally:
+        listener.cancel()
+
+
+EXCHANGES = {'dos': exchange_echo, 'mathbc': exchange_echo, 'chat': exchange_chat}
+
+
+async def one_connection(args, stats, index, tls_context):
+    stats.started += 1
+    local_addr = (source_address(index % args.sources), 0) if args.sources > 1 else None
+    name = f"load{os.getpid()}-{index}"
+    writer = None
+    try:
+        started = time.perf_counter()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(args.host, args.port, ssl=tls_context, local_addr=local_addr,
+                                    server_hostname='' if tls_context else None),
+            args.timeout
+        )
+        stats.connect_latency.append(time.perf_counter() - started)
+        await EXCHANGES[args.target](reader, writer, args, stats, name)
+        stats.completed += 1
+    except (Rejected, ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError, ssl.SSLError):
+        stats.rejected += 1
+    except (OSError, asyncio.TimeoutError) as e:
+        stats.error(e)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def run_load(args, process_index=0):
+    stats = Stats()
+    tls_context = None
+    if args.tls:
+        tls_context = ssl.create_default_context()
+        tls_context.check_hostname = False
+        tls_context.verify_mode = ssl.CERT_NONE
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + args.duration
+    counter = iter(range(process_index, sys.maxsize, args.processes))
+    budget = args.connections
+
+    def next_index():
+        nonlocal budget
+        if loop.time() >= deadline or budget == 0:
+            return None
+        if budget is not None:
+            budget -= 1
+        return next(counter)
+
+    if args.rate:
+        # Open loop: start connections on schedule, whatever the server does
+        slots = asyncio.Semaphore(args.concurrency)
+        tasks = set()
+
+        async def limited(index):
+            async with slots:
+                await one_connection(args, stats, index, tls_context)
+
+        interval = 1.0 / args.rate
+        scheduled = loop.time()
+        while (index := next_index()) is not None:
+            task = asyncio.create_task(limited(index))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            scheduled += interval
+            await asyncio.sleep(max(0.0, scheduled - loop.time()))
+        if tasks:
+            await asyncio.wait(tasks)
+    else:
+        async def client():
+            while (index := next_index()) is not None:
+                await one_connection(args, stats, index, tls_context)
+
+        await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    return stats
+
+
+def run_process(args, process_index, results):
+    results.put(asyncio.run(run_load(args, process_index)))
+
+
+def split(total, parts, index):
+    """Share of `total` for part `index` (None stays None)."""
+    if total is None:
+        return None
+    return total // parts + (1 if index < total % parts else 0)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(args):
+    """
+    Run the configured load.
+    Returns:
+        dict: The report (what --json writes).
+    """
+    started = time.perf_counter()
+    if args.processes == 1:
+        stats = asyncio.run(run_load(args))
+    else:
+        ctx = multiprocessing.get_context()
+        results = ctx.Queue()
+        procs = []
+        for i in range(args.processes):
+            part = argparse.Namespace(**vars(args))
+            part.concurrency = max(1, split(args.concurrency, args.processes, i))
+            part.connections = split(args.connections, args.processes, i)
+            part.rate = args.rate / args.processes if args.rate else None
+            procs.append(ctx.Process(target=run_process, args=(part, i, results)))
+            procs[-1].start()
+        stats = Stats()
+        for _ in procs:
+            stats.merge(results.get())
+        for proc in procs:
+            proc.join()
+    elapsed = time.perf_counter() - started
+
+    return {
+        'target': args.target,
+        'address': f"{args.host}:{args.port}",
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'settings': {name: getattr(args, name) for name in (
+            'concurrency', 'rate', 'duration', 'connections', 'payload', 'requests', 'think',
+            'sources', 'processes', 'tls')},
+        'elapsed_s': round(elapsed, 3),
+        'connections': {
+            'started': stats.started,
+            'completed': stats.completed,
+            'rejected': stats.rejected,
+            'errors': stats.errors,
+        },
+        'connections_per_s': round(stats.completed / elapsed, 1),
+        'requests_per_s': round(stats.requests / elapsed, 1),
+        'throughput_mb_s': round((stats.bytes_sent + stats.bytes_received) / elapsed / 1e6, 3),
+        'latency_ms': {
+            'connect': summarize(stats.connect_latency),
+            'request': summarize(stats.request_latency),
+            'delivery': summarize(stats.delivery_latency),
+        },
+    }
+
+
+def print_report(report):
+    conns = report['connections']
+    print(f"{report['target']} @ {report['address']} (commit {report['commit'] or 'unknown'}), "
+          f"{report['elapsed_s']:.1f}s")
+    print(f"  connections: {conns['started']} started, {conns['completed']} completed, "
+          f"{conns['rejected']} rejected, errors {conns['errors'] or 'none'}")
+    print(f"  {report['connections_per_s']:.0f} conn/s, {report['requests_per_s']:.0f} req/s, "
+          f"{report['throughput_mb_s']:.2f} MB/s")
+    print(f"  {'latency ms':<10} {'count':>8} {'p50':>9} {'p99':>9} {'p99.9':>9} {'max':>9}")
+    for kind, summary in report['latency_ms'].items():
+        if summary['count']:
+            print(f"  {kind:<10} {summary['count']:>8} {summary['p50']:>9.2f} {summary['p99']:>9.2f} "
+                  f"{summary['p999']:>9.2f} {summary['max']:>9.2f}")
+
+
+def compare(old_path, new_path):
+    """Print the change in the headline numbers between two --json reports."""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    rows = [(name, old[name], new[name]) for name in ('connections_per_s', 'requests_per_s', 'throughput_mb_s')]
+    for kind in ('connect', 'request', 'delivery'):
+        for point in ('p50', 'p99', 'p999'):
+            if old['latency_ms'][kind].get(point) is not None and new['latency_ms'][kind].get(point) is not None:
+                rows.append((f"{kind} {point} ms", old['latency_ms'][kind][point], new['latency_ms'][kind][point]))
+
+    print(f"{'':<22} {old['commit'] or old_path:>12} {new['commit'] or new_path:>12} {'change':>9}")
+    for name, before, after in rows:
+        change = f"{(after - before) / before:+.1%}" if before else "n/a"
+        print(f"{name:<22} {before:>12.2f} {after:>12.2f} {change:>9}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', choices=sorted(TARGETS), default='dos')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help="default: the target's usual port")
+    parser.add_argument('--tls', action=argparse.BooleanOptionalAction, default=None,
+                        help="default: on for mathbc, off otherwise")
+    parser.add_argument('--concurrency', type=int, default=10, help="connections in flight")
+    parser.add_argument('--rate', type=float, help="new connections per second (open loop)")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds to run")
+    parser.add_argument('--connections', type=int, help="stop after this many connections")
+    parser.add_argument('--payload', type=int, default=64, help="bytes per request / chat message")
+    parser.add_argument('--requests', type=int, default=1, help="requests (or chat messages) per connection")
+    parser.add_argument('--think', type=float, default=0.0, help="seconds between requests on a connection")
+    parser.add_argument('--sources', type=int, default=1, help="distinct 127.x.y.z source addresses")
+    parser.add_argument('--processes', type=int, default=1, help="load generating processes")
+    parser.add_argument('--timeout', type=float, default=5.0, help="seconds before a step counts as an error")
+    parser.add_argument('--json', metavar='FILE', help="write the report as JSON")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two --json reports and exit")
+    args = parser.parse_args(argv)
+    if args.port is None:
+        args.port = TARGETS[args.target]['port']
+    if args.tls is None:
+        args.tls = TARGETS[args.target]['tls']
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
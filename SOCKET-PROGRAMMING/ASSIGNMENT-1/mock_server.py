@@ -1,4 +1,5 @@
 import socket
+import sys
 import threading
 import config
 
@@ -17,11 +18,11 @@ def handle_client(client_socket, address):
     finally:
         client_socket.close()
 
-def start_server():
+def start_server(port=config.BACKEND_PORT):
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind((config.BACKEND_HOST, config.BACKEND_PORT))
+    server.bind((config.BACKEND_HOST, port))
     server.listen(5)
-    print(f"[Backend] Math Server running on {config.BACKEND_HOST}:{config.BACKEND_PORT}")
+    print(f"[Backend] Math Server running on {config.BACKEND_HOST}:{port}")
 
     try:
         while True:
@@ -32,4 +33,5 @@ def start_server():
         print("\n[Backend] Server stopped.")
 
 if __name__ == "__main__":
-    start_server()
+    # Optional port argument to run several backends behind one firewall
+    start_server(int(sys.argv[1]) if len(sys.argv) > 1 else config.BACKEND_PORT)
@@ -0,0 +1,227 @@
+"""
+Rate limiting algorithms used by the DoSProtector.
+
+Every limiter keeps a small per-IP state object and exposes the same
+interface, so the protector can switch algorithms without changing its
+allow/deny semantics:
+
+    state = limiter.new_state(now)
+    count = limiter.hit(state, now, max_requests, window)
+    allowed = count <= max_requests
+
+`hit` records the request and returns the number of requests seen in the
+current window (an estimate for the counter based algorithms), including
+the request being processed.
+
+For snapshots (snapshot.py) a state can be flattened to a list of floats
+with `export_state` and rebuilt with `import_state`.
+"""
+
+import math
+import sys
+from collections import deque
+
+
+class SlidingLogLimiter:
+    """
+    Exact sliding window: one timestamp per request.
+    Memory and cleanup cost grow with the number of requests per window.
+    """
+    name = 'sliding_log'
+
+    def new_state(self, now):
+        return deque()
+
+    def cleanup(self, timestamps, now, window):
+        """Remove timestamps that are outside the sliding window."""
+        while timestamps and timestamps[0] < (now - window):
+            timestamps.popleft()
+
+    def hit(self, timestamps, now, max_requests, window):
+        self.cleanup(timestamps, now, window)
+        timestamps.append(now)
+        return len(timestamps)
+
+    def last_seen(self, timestamps):
+        return timestamps[-1] if timestamps else 0.0
+
+    def idle_window(self, window):
+        """Seconds of inactivity after which the state is equivalent to a fresh one."""
+        return window
+
+    def state_size(self, timestamps):
+        return sys.getsizeof(timestamps) + sys.getsizeof(0.0) * len(timestamps)
+
+    def export_state(self, timestamps):
+        return list(timestamps)
+
+    def import_state(self, values):
+        return deque(values)
+
+
+class WindowCounterState:
+    __slots__ = ('bucket', 'previous', 'current', 'last_seen')
+
+    def __init__(self, bucket, last_seen):
+        self.bucket = bucket
+        self.previous = 0
+        self.current = 0
+        self.last_seen = last_seen
+
+
+class SlidingWindowCounterLimiter:
+    """
+    Sliding window approximated with two fixed buckets: the previous
+    bucket's count is weighted by how much of it still overlaps the window.
+    """
+    name = 'sliding_window'
+
+    def new_state(self, now):
+        return WindowCounterState(0, now)
+
+    def hit(self, state, now, max_requests, window):
+        bucket = int(now // window)
+        if bucket != state.bucket:
+            # Roll forward; anything older than one bucket no longer overlaps
+            state.previous = state.current if bucket == state.bucket + 1 else 0
+            state.current = 0
+            state.bucket = bucket
+        state.current += 1
+        state.last_seen = now
+
+        overlap = 1.0 - (now - bucket * window) / window
+        return state.previous * overlap + state.current
+
+    def last_seen(self, state):
+        return state.last_seen
+
+    def idle_window(self, window):
+        # The previous bucket can still overlap for up to one more window
+        return 2 * window
+
+    def state_size(self, state):
+        return sys.getsizeof(state) + sys.getsizeof(0.0) * 2
+
+    def export_state(self, state):
+        return [state.bucket, state.previous, state.current, state.last_seen]
+
+    def import_state(self, values):
+        bucket, previous, current, last_seen = values
+        state = WindowCounterState(int(bucket), last_seen)
+        state.previous = int(previous)
+        state.current = int(current)
+        return state
+
+
+class TokenBucketState:
+    __slots__ = ('tokens', 'last_seen')
+
+    def __init__(self, tokens, last_seen):
+        self.tokens = tokens
+        self.last_seen = last_seen
+
+
+class TokenBucketLimiter:
+    """
+    Token bucket holding `max_requests` tokens, refilled at
+    `max_requests / window` tokens per second. Each allowed request
+    spends one token.
+    """
+    name = 'token_bucket'
+
+    def new_state(self, now):
+        return TokenBucketState(None, now)
+
+    def hit(self, state, now, max_requests, window):
+        if state.tokens is None:
+            tokens = float(max_requests)
+        else:
+            refill = (now - state.last_seen) * max_requests / window
+            tokens = min(float(max_requests), state.tokens + refill)
+        state.last_seen = now
+
+        # Requests already "in the bucket" plus this one
+        count = max_requests - tokens + 1
+        if tokens >= 1.0:
+            tokens -= 1.0
+        state.tokens = tokens
+        return round(count, 9)
+
+    def last_seen(self, state):
+        return state.last_seen
+
+    def idle_window(self, window):
+        # An empty bucket is full again after one window
+        return window
+
+    def state_size(self, state):
+        return sys.getsizeof(state) + sys.getsizeof(0.0) * 2
+
+    def export_state(self, state):
+        # NaN stands for "not used yet" (a full bucket)
+        return [math.nan if state.tokens is None else state.tokens, state.last_seen]
+
+    def import_state(self, values):
+        tokens, last_seen = values
+        return TokenBucketState(None if math.isnan(tokens) else tokens, last_seen)
+
+
+class GCRAState:
+    __slots__ = ('tat', 'last_seen')
+
+    def __init__(self, tat, last_seen):
+        self.tat = tat
+        self.last_seen = last_seen
+
+
+class GCRALimiter:
+    """
+    Generic Cell Rate Algorithm: stores only the theoretical arrival time
+    (TAT). Each request advances the TAT by `window / max_requests`; a
+    request is rejected when the TAT would run more than `window` ahead.
+    """
+    name = 'gcra'
+
+    def new_state(self, now):
+        return GCRAState(now, now)
+
+    def hit(self, state, now, max_requests, window):
+        interval = window / max_requests
+        tat = max(state.tat, now) + interval
+        state.last_seen = now
+
+        count = round((tat - now) / interval, 9)
+        if count <= max_requests:
+            state.tat = tat
+        return count
+
+    def last_seen(self, state):
+        return state.last_seen
+
+    def idle_window(self, window):
+        # The TAT never runs more than one window ahead of the last request
+        return window
+
+    def state_size(self, state):
+        return sys.getsizeof(state) + sys.getsizeof(0.0) * 2
+
+    def export_state(self, state):
+        return [state.tat, state.last_seen]
+
+    def import_state(self, values):
+        tat, last_seen = values
+        return GCRAState(tat, last_seen)
+
+
+LIMITERS = {
+    limiter.name: limiter
+    for limiter in (SlidingLogLimiter, SlidingWindowCounterLimiter, TokenBucketLimiter, GCRALimiter)
+}
+
+
+def create_limiter(name):
+    """Instantiate a limiter by its config name."""
+    try:
+        return LIMITERS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown rate limit algorithm '{name}'. Choose from: {', '.join(LIMITERS)}")
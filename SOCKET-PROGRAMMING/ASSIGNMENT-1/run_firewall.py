@@ -1,24 +1,78 @@
+import argparse
 import asyncio
+import json
 import logging
+import multiprocessing
+import os
+import signal
+import socket
 import sys
+import time
+from multiprocessing.connection import wait
 import config
-from firewall import firewall_engine
+from firewall import DoSProtector, firewall_engine
+import snapshot
+import common_path  # Shared modules, see common_path.py
+from log_pipeline import BlockSummary, stop_logging
+import fast_forward
+from upstream_pool import UpstreamPool
+from shared_limiter import SharedSlotTable, SharedConnectionTable, SharedDoSProtector
+from metrics import registry, start_metrics_server
 
-async def forward(reader, writer):
-    """Forward data from reader to writer."""
+# Rejections are summarised per IP rather than logged one line each
+rejections = BlockSummary("Connections rejected", config.BLOCK_SUMMARY_INTERVAL)
+
+# Allowed connections are spread over the configured backends
+backend_pool = UpstreamPool(
+    config.BACKENDS,
+    strategy=config.LOAD_BALANCING,
+    warm_connections=config.WARM_CONNECTIONS,
+    max_failures=config.MAX_BACKEND_FAILURES,
+    connect_timeout=config.BACKEND_CONNECT_TIMEOUT,
+)
+
+# Hot-path metrics; bytes forwarded are counted by fast_forward's counters
+ACCEPTED = registry.counter('dos_connections_total', "Connections checked against the DoS rules", verdict='accepted')
+REJECTED = registry.counter('dos_connections_total', "Connections checked against the DoS rules", verdict='rejected')
+ADMIT_SECONDS = registry.histogram('dos_rule_evaluation_seconds', "Time to apply the DoS rules to a new connection",
+                                   buckets=(0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.01))
+
+async def forward(reader, writer, bytes_counter, activity, throttle):
+    """
+    Forward data from reader to writer, reporting each chunk to `activity`.
+    `throttle` returns how long to wait before reading the next chunk;
+    meanwhile the socket's buffers fill and TCP slows the sender down.
+    """
     try:
         while True:
-            data = await reader.read(4096)
+            data = await reader.read(config.FORWARD_BUFFER_SIZE)
             if not data:
                 break
+            bytes_counter.inc(len(data))
+            activity(len(data))
             writer.write(data)
             await writer.drain()
+            delay = throttle(len(data))
+            if delay:
+                await asyncio.sleep(delay)
     except Exception as e:
         # Connection issues are expected (client disconnects, etc.)
         pass
     finally:
         writer.close()
 
+def admit(client_ip):
+    """Apply the DoS rules to a new connection. Returns True if allowed."""
+    started = time.perf_counter()
+    allowed = firewall_engine.process_request(client_ip)
+    ADMIT_SECONDS.observe(time.perf_counter() - started)
+    if allowed:
+        ACCEPTED.inc()
+        return True
+    REJECTED.inc()
+    rejections.note(client_ip)
+    return False
+
 async def handle_client(client_reader, client_writer):
     """
     Handle incoming client connection.
@@ -27,60 +81,408 @@ async def handle_client(client_reader, client_writer):
     peername = client_writer.get_extra_info('peername')
     client_ip = peername[0] if peername else 'unknown'
 
-    # Check Firewall Rule
-    if not firewall_engine.process_request(client_ip):
+    # Check Firewall Rule, then the concurrent connection limits
+    tracked = None
+    if admit(client_ip):
+        tracked = firewall_engine.connections.open(client_ip, client_writer.transport.abort)
+    if tracked is None:
         # Blocked
-        logging.warning(f"Connection rejected from {client_ip}")
         client_writer.close()
         await client_writer.wait_closed()
         return
 
-    # Allowed: Connect to Backend
+    shaped = firewall_engine.bandwidth.open(client_ip)
     try:
-        backend_reader, backend_writer = await asyncio.open_connection(
-            config.BACKEND_HOST, config.BACKEND_PORT
-        )
+        await proxy(client_reader, client_writer, tracked, shaped)
+    finally:
+        firewall_engine.bandwidth.release(shaped)
+        firewall_engine.connections.release(tracked)
+
+async def proxy(client_reader, client_writer, tracked, shaped):
+    """Connect to a backend and proxy until one side closes."""
+    try:
+        upstream, backend_sock = await backend_pool.acquire()
     except OSError as e:
-        logging.error(f"Failed to connect to backend server at {config.BACKEND_HOST}:{config.BACKEND_PORT}. Error: {e}")
+        logging.error("Failed to connect to backend server. Error: %s", e)
         client_writer.close()
         await client_writer.wait_closed()
         return
 
-    # Proxy Data Bidirectionally
-    # We run two tasks: client->backend and backend->client
-    task1 = asyncio.create_task(forward(client_reader, backend_writer))
-    task2 = asyncio.create_task(forward(backend_reader, client_writer))
-
-    # Wait for either to finish (one side closes)
-    done, pending = await asyncio.wait(
-        [task1, task2],
-        return_when=asyncio.FIRST_COMPLETED
-    )
-
-    # Cancel the other task
-    for task in pending:
-        task.cancel()
-
-async def main():
-    server = await asyncio.start_server(
-        handle_client, config.FIREWALL_HOST, config.FIREWALL_PORT
-    )
-
-    addr = server.sockets[0].getsockname()
-    print(f"Firewall running on {addr}")
-    print(f"Filtering traffic for backend at {config.BACKEND_HOST}:{config.BACKEND_PORT}")
-    print(f"Rules: Max {config.MAX_REQUESTS_PER_WINDOW} requests / {config.TIME_WINDOW}s")
+    tasks = []
+    try:
+        try:
+            backend_reader, backend_writer = await asyncio.open_connection(sock=backend_sock)
+        except BaseException as e:
+            # The socket was not handed over to a transport: it is still ours to close
+            backend_sock.close()
+            client_writer.close()
+            if not isinstance(e, OSError):
+                raise
+            logging.error("Failed to attach to backend socket. Error: %s", e)
+            return
+
+        # Proxy Data Bidirectionally
+        # We run two tasks: client->backend and backend->client
+        tasks = [
+            asyncio.create_task(forward(client_reader, backend_writer, fast_forward.CLIENT_BYTES,
+                                        tracked.client_data, shaped.client_data)),
+            asyncio.create_task(forward(backend_reader, client_writer, fast_forward.BACKEND_BYTES,
+                                        tracked.backend_data, shaped.backend_data)),
+        ]
+
+        # Wait for either to finish (one side closes)
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        backend_pool.release(upstream)
+        # Cancel the other task
+        for task in tasks:
+            task.cancel()
+
+LIMIT_KEYS = {
+    'time_window': 'TIME_WINDOW',
+    'max_requests_per_window': 'MAX_REQUESTS_PER_WINDOW',
+    'block_duration': 'BLOCK_DURATION',
+}
+
+def load_limits(path):
+    """
+    Read rate limits from a JSON policy file; keys it leaves out get the
+    values from config.py.
+    Returns:
+        dict: keyword arguments for reconfigure().
+    Raises:
+        OSError, ValueError: if the file cannot be read or is invalid.
+    """
+    with open(path) as f:
+        try:
+            data = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"invalid JSON: {e}")
+    if not isinstance(data, dict):
+        raise ValueError("expected a JSON object")
+    unknown = set(data) - set(LIMIT_KEYS)
+    if unknown:
+        raise ValueError(f"unknown keys {sorted(unknown)}")
+    limits = {}
+    for key, setting in LIMIT_KEYS.items():
+        value = data.get(key, getattr(config, setting))
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+            raise ValueError(f"{key} must be a positive number")
+        limits[key] = value
+    return limits
+
+def reload_policy():
+    """
+    Apply config.POLICY_FILE to the running engine (on SIGHUP or when the
+    file changes). Tracked IPs and blocks are kept; an invalid file is
+    logged and the current limits stay.
+    """
+    try:
+        limits = load_limits(config.POLICY_FILE)
+    except (OSError, ValueError) as e:
+        logging.error("Policy reload from %s failed, keeping the current limits: %s", config.POLICY_FILE, e)
+        return False
+    firewall_engine.reconfigure(**limits)
+    logging.info("Policy loaded from %s: max %s requests / %ss, block %ss", config.POLICY_FILE,
+                 limits['max_requests_per_window'], limits['time_window'], limits['block_duration'])
+    return True
+
+def policy_signature():
+    try:
+        st = os.stat(config.POLICY_FILE)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+async def watch_policy():
+    """Reload the policy file whenever it changes."""
+    signature = policy_signature()
+    while True:
+        await asyncio.sleep(config.POLICY_POLL_INTERVAL)
+        current = policy_signature()
+        if current != signature:
+            signature = current
+            if current is not None:
+                reload_policy()
+
+def write_state(entries, previous):
+    """Write captured DoS state to config.SNAPSHOT_FILE (safe to run on a worker thread)."""
+    started = time.perf_counter()
+    try:
+        count = snapshot.write_snapshot(
+            config.SNAPSHOT_FILE, entries, firewall_engine.limiter.name,
+            firewall_engine.limiter.idle_window(firewall_engine.window),
+            previous=previous, now=firewall_engine.clock()
+        )
+    except OSError as e:
+        logging.error("Failed to write DoS state snapshot %s: %s", config.SNAPSHOT_FILE, e)
+        return
+    logging.info("DoS state snapshot: %d IPs written to %s in %.1f ms",
+                 count, config.SNAPSHOT_FILE, (time.perf_counter() - started) * 1000)
+
+async def snapshot_loop():
+    """Periodically snapshot blocks and counters so a restart can restore them."""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(config.SNAPSHOT_INTERVAL)
+        # Only the copy runs on the loop; sorting and writing happen on a thread
+        entries = snapshot.capture(firewall_engine)
+        await loop.run_in_executor(None, write_state, entries, firewall_engine.snapshot)
+
+def save_table(table):
+    """Snapshot the workers' shared rate-limit table."""
+    try:
+        snapshot.write_table_snapshot(config.SNAPSHOT_FILE, table)
+    except OSError as e:
+        logging.error("Failed to write shared table snapshot %s: %s", config.SNAPSHOT_FILE, e)
+
+async def expire_timers():
+    """
+    Advance the engine's expiry timers every tick, so blocks end (and
+    unblock listeners run) on time and idle IPs are dropped even when no
+    traffic arrives.
+    """
+    while True:
+        await asyncio.sleep(config.TIMER_TICK)
+        firewall_engine.sweep()
+
+async def housekeeping():
+    """Periodically flush log summaries and report tracker memory usage."""
+    last_report = 0
+    while True:
+        await asyncio.sleep(config.SWEEP_INTERVAL)
+        # Flush summaries for IPs that stopped sending mid-interval
+        firewall_engine.block_summary.flush()
+        rejections.flush()
+        now = asyncio.get_running_loop().time()
+        if now - last_report >= config.STATS_INTERVAL:
+            last_report = now
+            stats = firewall_engine.memory_stats()
+            logging.info(
+                "Tracker memory: %d IPs tracked, %d blocked, %d evicted, ~%d bytes (%d bytes/IP)",
+                stats['tracked_ips'], stats['blocked_ips'], stats['evicted_ips'],
+                stats['history_bytes'], stats['bytes_per_ip']
+            )
+            connections = firewall_engine.connections.stats()
+            logging.info("Open connections: %d from %d IPs (most from one IP: %d)",
+                         connections['open_connections'], connections['ips'], connections['largest_per_ip'])
+            bandwidth = firewall_engine.bandwidth.stats()
+            busiest = ', '.join(f"{ip} {up / 1000:.1f}/{down / 1000:.1f}" for ip, (up, down) in bandwidth['top'])
+            logging.info("Throughput: %.1f KB/s to backends, %.1f KB/s to clients; busiest IPs (KB/s up/down): %s",
+                         bandwidth['total'][0] / 1000, bandwidth['total'][1] / 1000, busiest or 'none')
+            for upstream in backend_pool.stats():
+                logging.info(
+                    "Backend %s: %s, %d active, %d connects (%d warm), %d failures, connect latency avg %.2fms max %.2fms",
+                    upstream['address'], 'healthy' if upstream['healthy'] else 'EJECTED',
+                    upstream['active'], upstream['connects'], upstream['warm_hits'], upstream['failures'],
+                    upstream['latency_avg_ms'], upstream['latency_max_ms']
+                )
+
+def register_gauges():
+    """Gauges read at scrape time: table sizes and backend state."""
+    if isinstance(firewall_engine, DoSProtector):
+        registry.gauge('dos_tracked_ips', "IPs with rate limiter state",
+                       lambda: len(firewall_engine.request_history))
+        registry.gauge('dos_blocked_ips', "IPs currently blocked", lambda: len(firewall_engine.blocked_ips))
+    else:
+        # The shared table keeps counters, so workers report it without a scan
+        registry.gauge('dos_tracked_ips', "IPs with rate limiter state",
+                       lambda: firewall_engine.table.occupancy()[0])
+        registry.gauge('dos_blocked_ips', "IPs currently blocked", lambda: firewall_engine.table.occupancy()[1])
+    registry.gauge('dos_open_connections', "Proxied connections counted against the connection limits",
+                   lambda: firewall_engine.connections.total)
+    registry.gauge('dos_shaped_ips', "IPs with per-IP bandwidth state (open connections or refilling buckets)",
+                   lambda: len(firewall_engine.bandwidth.ips))
+    for upstream in backend_pool.upstreams:
+        registry.gauge('dos_backend_active_sessions', "Proxied sessions using a backend",
+                       lambda upstream=upstream: upstream.active, backend=upstream.address)
+        registry.gauge('dos_backend_healthy', "1 while a backend passes health checks",
+                       lambda upstream=upstream: int(upstream.healthy), backend=upstream.address)
+
+async def serve_metrics(port):
+    """Start the metrics endpoint; a port in use is logged, not fatal."""
+    register_gauges()
+    try:
+        return await start_metrics_server(config.METRICS_HOST, port)
+    except OSError as e:
+        logging.error("Metrics endpoint on %s:%s not started: %s", config.METRICS_HOST, port, e)
+        return None
+
+async def main(reuse_port=False, metrics_offset=0):
+    # Limits from the policy file, if there is one; SIGHUP re-reads it
+    if os.path.exists(config.POLICY_FILE):
+        reload_policy()
+    if hasattr(signal, 'SIGHUP'):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload_policy)
+
+    # Blocks and counters from before a restart (workers share the parent's table instead)
+    persist = bool(config.SNAPSHOT_FILE) and isinstance(firewall_engine, DoSProtector)
+    restored = firewall_engine.restore_snapshot(config.SNAPSHOT_FILE) if persist else 0
+
+    mode = config.FORWARD_MODE
+    if mode == 'splice' and not fast_forward.SPLICE_AVAILABLE:
+        logging.warning("os.splice is not available on this platform, using 'buffered' forwarding")
+        mode = 'buffered'
+
+    server = None
+    splice_task = None
+    if mode == 'splice':
+        ready = asyncio.get_running_loop().create_future()
+        splice_task = asyncio.create_task(fast_forward.serve_splice(
+            admit, config.FIREWALL_HOST, config.FIREWALL_PORT, backend_pool,
+            buffer_size=config.FORWARD_BUFFER_SIZE, ready=ready, reuse_port=reuse_port,
+            connections=firewall_engine.connections, bandwidth=firewall_engine.bandwidth
+        ))
+        addr = await ready
+    elif mode == 'buffered':
+        server = await fast_forward.start_buffered_server(
+            admit, config.FIREWALL_HOST, config.FIREWALL_PORT, backend_pool,
+            buffer_size=config.FORWARD_BUFFER_SIZE, high_water=config.FORWARD_HIGH_WATER,
+            reuse_port=reuse_port, connections=firewall_engine.connections,
+            bandwidth=firewall_engine.bandwidth
+        )
+        addr = server.sockets[0].getsockname()
+    else:
+        server = await asyncio.start_server(
+            handle_client, config.FIREWALL_HOST, config.FIREWALL_PORT,
+            reuse_port=reuse_port or None
+        )
+        addr = server.sockets[0].getsockname()
+
+    print(f"Firewall running on {addr} ({mode} forwarding, {config.FORWARD_BUFFER_SIZE}-byte buffers)")
+    backends = ', '.join(f"{host}:{port}" for host, port in config.BACKENDS)
+    print(f"Filtering traffic for backends at {backends} ({config.LOAD_BALANCING})")
+    print(f"Rules: Max {firewall_engine.max_requests} requests / {firewall_engine.window}s ({config.RATE_LIMIT_ALGORITHM})")
+    print(f"Tracking at most {config.MAX_TRACKED_IPS} IPs (expiry every {config.TIMER_TICK}s)")
+    print(f"Connections: at most {config.MAX_CONNECTIONS_PER_IP} per IP, {config.MAX_CONNECTIONS} in total; "
+          f"idle timeout {config.IDLE_TIMEOUT}s, request timeout {config.REQUEST_TIMEOUT}s, "
+          f"min rate {config.MIN_TRANSFER_RATE} B/s")
+    print(f"Bandwidth per IP: {config.MAX_UPLOAD_RATE_PER_IP} B/s up, {config.MAX_DOWNLOAD_RATE_PER_IP} B/s down "
+          f"(burst {config.BANDWIDTH_BURST} bytes)")
+    if restored:
+        print(f"Restoring state for up to {restored} IPs from {config.SNAPSHOT_FILE}")
+    metrics_server = None
+    if config.METRICS_PORT is not None:
+        metrics_server = await serve_metrics(config.METRICS_PORT + metrics_offset)
+        if metrics_server:
+            print(f"Metrics on http://{config.METRICS_HOST}:{config.METRICS_PORT + metrics_offset}/metrics")
     print("Press Ctrl+C to stop.")
 
-    async with server:
-        await server.serve_forever()
+    housekeeping_task = asyncio.create_task(housekeeping())
+    expiry_task = asyncio.create_task(expire_timers())
+    health_task = asyncio.create_task(backend_pool.health_check_loop(config.HEALTH_CHECK_INTERVAL))
+    policy_task = asyncio.create_task(watch_policy()) if config.POLICY_POLL_INTERVAL else None
+    snapshot_task = asyncio.create_task(snapshot_loop()) if persist and config.SNAPSHOT_INTERVAL else None
+    try:
+        if splice_task:
+            await splice_task
+        else:
+            async with server:
+                await server.serve_forever()
+    finally:
+        housekeeping_task.cancel()
+        expiry_task.cancel()
+        health_task.cancel()
+        if policy_task:
+            policy_task.cancel()
+        if snapshot_task:
+            snapshot_task.cancel()
+        if metrics_server:
+            metrics_server.close()
+        if persist:
+            write_state(snapshot.capture(firewall_engine), firewall_engine.snapshot)
+        backend_pool.close()
+
+def run_worker(worker_id, table, connection_table):
+    """Entry point of a forked worker: same proxy, shared rate-limit and connection state."""
+    global firewall_engine
+    firewall_engine = SharedDoSProtector(table, connection_table)
+    print(f"[Worker {worker_id}] pid {multiprocessing.current_process().pid}")
+    try:
+        asyncio.run(main(reuse_port=True, metrics_offset=worker_id))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Forked processes exit without running atexit handlers
+        stop_logging()
+
+def run_workers(count):
+    """
+    Fork `count` worker processes that all accept on FIREWALL_PORT using
+    SO_REUSEPORT, with rate, connection and bandwidth limits enforced
+    through shared memory tables.
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        sys.exit("--workers requires SO_REUSEPORT (Linux/BSD/macOS)")
+
+    ctx = multiprocessing.get_context('fork')
+    table = SharedSlotTable(config.SHARED_TABLE_SLOTS, config.SHARED_LOCK_STRIPES, ctx)
+    print(f"Shared rate-limit table: {table.slots} slots ({table.size // 1024} KiB)")
+    connection_table = SharedConnectionTable(config.SHARED_CONNECTION_SLOTS, config.SHARED_LOCK_STRIPES, ctx)
+    print(f"Shared connection table: {connection_table.slots} slots ({connection_table.size // 1024} KiB)")
+    if config.RATE_LIMIT_ALGORITHM != 'gcra':
+        # A shared slot only has room for GCRA's state
+        logging.warning("RATE_LIMIT_ALGORITHM %r is not supported with --workers; the workers use 'gcra'",
+                        config.RATE_LIMIT_ALGORITHM)
+        print(f"Warning: RATE_LIMIT_ALGORITHM '{config.RATE_LIMIT_ALGORITHM}' is ignored with --workers, using 'gcra'")
+    if config.SNAPSHOT_FILE and os.path.exists(config.SNAPSHOT_FILE):
+        try:
+            snapshot.load_table_snapshot(config.SNAPSHOT_FILE, table)
+        except (OSError, ValueError) as e:
+            logging.error("Ignoring shared table snapshot %s: %s", config.SNAPSHOT_FILE, e)
+
+    # Turn SIGTERM into a normal exit so the workers are cleaned up
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    workers = [ctx.Process(target=run_worker, args=(i, table, connection_table)) for i in range(count)]
+
+    def forward_sighup(signum, frame):
+        # Each worker re-reads the policy file itself
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGHUP)
+
+    try:
+        for worker in workers:
+            worker.start()
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, forward_sighup)
+        # Wait for the workers, snapshotting the shared table as we go
+        alive = workers
+        while alive:
+            wait([worker.sentinel for worker in alive], timeout=config.SNAPSHOT_INTERVAL or None)
+            alive = [worker for worker in alive if worker.is_alive()]
+            if config.SNAPSHOT_FILE:
+                save_table(table)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+        if config.SNAPSHOT_FILE:
+            save_table(table)
+        table.close()
+        table.unlink()
+        connection_table.close()
+        connection_table.unlink()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="DoS firewall reverse proxy")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of worker processes sharing the port (SO_REUSEPORT)")
+    args = parser.parse_args()
+
     # Ensure logging is set up to print key info to console as well if desired,
     # but the assignment asks for a log file. We will print startup info to stdout.
     try:
-        if sys.platform == 'win32':
-             asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-        asyncio.run(main())
+        if args.workers > 1:
+            run_workers(args.workers)
+        else:
+            if sys.platform == 'win32':
+                 asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+            asyncio.run(main())
     except KeyboardInterrupt:
-        print("\nFirewall stopped.")
+        pass
+    print("\nFirewall stopped.")
@@ -0,0 +1,530 @@
+"""
+Rate limit state shared by forked firewall workers.
+
+With `run_firewall.py --workers N` every worker process accepts connections
+on the same port (SO_REUSEPORT). If each kept its own DoSProtector, an
+attacker spread over N workers would get N times the quota, so the
+counters live in one shared memory table instead.
+
+Table layout: a fixed number of 32-byte slots, each holding
+    key (uint64 hash of the IP), tat, blocked_until, last_seen (doubles)
+grouped into small buckets (set-associative). An IP can only live in its
+own bucket, so a bucket lock is all that is needed to update it, and a
+full bucket evicts its least recently seen IP. Memory is fixed at
+creation time regardless of how many sources connect. After the slots,
+counters of the slots in use and of those holding a block are kept up to
+date as slots change, so reporting them never scans the table.
+
+The per-IP state is a GCRA theoretical arrival time (see rate_limiters.py),
+which gives the same allow/deny behaviour as the other algorithms in a
+single float.
+
+The concurrent connection limits and the per-IP bandwidth buckets are
+shared the same way, through a SharedConnectionTable: otherwise each
+worker would allow MAX_CONNECTIONS_PER_IP, MAX_CONNECTIONS and the
+bandwidth rates on its own, N times the configured limits in total.
+"""
+
+import hashlib
+import logging
+import multiprocessing
+import time
+from multiprocessing import shared_memory
+
+import config
+import common_path  # Shared modules, see common_path.py
+from log_pipeline import BlockSummary
+from connection_guard import ConnectionGuard
+from bandwidth import BandwidthShaper, TokenBucket
+from metrics import registry
+
+SLOT_FIELDS = 4  # key, tat, blocked_until, last_seen
+SLOT_SIZE = SLOT_FIELDS * 8
+BUCKET_SLOTS = 8
+BUCKET_FIELDS = BUCKET_SLOTS * SLOT_FIELDS
+
+# Counters after the slots: used slots, slots holding a block, next bucket the expiry scan checks
+USED, BLOCKED, SCAN = range(3)
+COUNTERS_SIZE = 3 * 8
+
+# key, connections, shapers, last_used, then tokens and updated for each direction
+CONNECTION_FIELDS = 8
+CONNECTION_SLOT_SIZE = CONNECTION_FIELDS * 8
+
+# The same counter as DoSProtector's (the registry returns the existing one)
+BLOCKS = registry.counter('dos_blocks_total', "IPs blocked for exceeding the rate limit")
+
+
+def ip_key(ip):
+    """Stable 64-bit key for an IP (0 marks an empty slot)."""
+    key = int.from_bytes(hashlib.blake2b(ip.encode(), digest_size=8).digest(), 'little')
+    return key or 1
+
+
+class SharedSlotTable:
+    """
+    Fixed-size hashed slot table in shared memory. Create it in the parent
+    before forking; children inherit the mapping and the bucket locks.
+
+    A block that has ended stays in its slot (and in the BLOCKED count)
+    until the IP's next request, an eviction or expire_blocks() clears it.
+    """
+
+    def __init__(self, slots, lock_stripes=64, mp_context=None):
+        ctx = mp_context or multiprocessing.get_context('fork')
+        self.buckets = max(1, slots // BUCKET_SLOTS)
+        self.slots = self.buckets * BUCKET_SLOTS
+        # `size` covers the slots only: that is what a snapshot holds
+        self.size = self.slots * SLOT_SIZE
+        self.shm = shared_memory.SharedMemory(create=True, size=self.size + COUNTERS_SIZE)
+        self.shm.buf[:self.size + COUNTERS_SIZE] = bytes(self.size + COUNTERS_SIZE)
+
+        # Two views of the same bytes: keys as uint64, state as doubles
+        self.keys = self.shm.buf[:self.size].cast('Q')
+        self.values = self.shm.buf[:self.size].cast('d')
+        self.counters = self.shm.buf[self.size:self.size + COUNTERS_SIZE].cast('q')
+        self.locks = [ctx.Lock() for _ in range(lock_stripes)]
+        # Guards the counters; taken while holding a bucket lock, never the other way round
+        self.counter_lock = ctx.Lock()
+
+        # Local (per-process) stats
+        self.evictions = 0
+
+    def bucket_of(self, key):
+        bucket = key % self.buckets
+        return bucket * BUCKET_FIELDS, self.locks[bucket % len(self.locks)]
+
+    def count(self, counter, delta):
+        with self.counter_lock:
+            self.counters[counter] += delta
+
+    def find(self, start, key):
+        """Offset of the slot holding key inside the bucket, or -1."""
+        keys = self.keys
+        for offset in range(start, start + BUCKET_FIELDS, SLOT_FIELDS):
+            if keys[offset] == key:
+                return offset
+        return -1
+
+    def claim(self, start, key):
+        """
+        Take a slot for key: the first empty one, otherwise the least
+        recently seen IP in the bucket is evicted.
+        """
+        keys = self.keys
+        values = self.values
+        victim = start
+        for offset in range(start, start + BUCKET_FIELDS, SLOT_FIELDS):
+            if keys[offset] == 0:
+                victim = offset
+                self.count(USED, 1)
+                break
+            if values[offset + 3] < values[victim + 3]:
+                victim = offset
+        else:
+            self.evictions += 1
+            if values[victim + 2]:
+                self.count(BLOCKED, -1)
+        keys[victim] = key
+        values[victim + 1] = 0.0
+        values[victim + 2] = 0.0
+        values[victim + 3] = 0.0
+        return victim
+
+    def set_block(self, offset, until):
+        """Block the slot's IP until `until` (bucket lock held)."""
+        if not self.values[offset + 2]:
+            self.count(BLOCKED, 1)
+        self.values[offset + 2] = until
+
+    def clear_block(self, offset):
+        """Forget the slot's ended block (bucket lock held)."""
+        if self.values[offset + 2]:
+            self.values[offset + 2] = 0.0
+            self.count(BLOCKED, -1)
+
+    def expire_blocks(self, now, slots):
+        """
+        Clear the blocks that have ended in the next `slots` slots. A cursor
+        shared by all workers walks the table, so between them they check
+        every slot once per table size / `slots` calls. Nothing is read
+        while no block is counted.
+        Returns:
+            int: blocks cleared.
+        """
+        if not self.counters[BLOCKED]:
+            return 0
+        buckets = min(self.buckets, max(1, slots // BUCKET_SLOTS))
+        with self.counter_lock:
+            first = self.counters[SCAN]
+            self.counters[SCAN] = (first + buckets) % self.buckets
+        last = first + buckets
+        spans = [(first, min(last, self.buckets))]
+        if last > self.buckets:
+            spans.append((0, last - self.buckets))
+
+        cleared = 0
+        values = self.values
+        for low, high in spans:
+            # The blocked_until fields in one C-level copy; most are 0
+            raw = values[low * BUCKET_FIELDS + 2:high * BUCKET_FIELDS:SLOT_FIELDS].tobytes()
+            if raw.count(0) == len(raw):
+                continue
+            stamps = memoryview(raw).cast('d').tolist()
+            for index in [i for i, until in enumerate(stamps) if 0 < until <= now]:
+                offset = low * BUCKET_FIELDS + index * SLOT_FIELDS
+                with self.locks[(offset // BUCKET_FIELDS) % len(self.locks)]:
+                    if 0 < values[offset + 2] <= now:
+                        self.clear_block(offset)
+                        cleared += 1
+        return cleared
+
+    def occupancy(self):
+        """
+        Returns:
+            tuple: (used slots, slots holding a block), from the counters.
+        """
+        with self.counter_lock:
+            return self.counters[USED], self.counters[BLOCKED]
+
+    def recount(self):
+        """
+        Set the counters from the slots, after they were filled from a
+        snapshot (scans the table; call before forking workers).
+        """
+        used = sum(1 for key in self.keys[::SLOT_FIELDS].tolist() if key)
+        blocked = sum(1 for until in self.values[2::SLOT_FIELDS].tolist() if until)
+        with self.counter_lock:
+            self.counters[USED] = used
+            self.counters[BLOCKED] = blocked
+
+    def close(self):
+        self.keys.release()
+        self.values.release()
+        self.counters.release()
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    TokenBucket whose balance lives in a SharedConnectionTable slot, so
+    every worker draws on the same one. An `updated` of 0 marks a bucket
+    nobody has used yet, which is full.
+    """
+
+    __slots__ = ('values', 'offset', 'lock')
+
+    def __init__(self, rate, burst, values, offset, lock):
+        self.rate = rate
+        self.burst = burst
+        self.values = values
+        self.offset = offset
+        self.lock = lock
+
+    @property
+    def tokens(self):
+        return self.values[self.offset] if self.values[self.offset + 1] else self.burst
+
+    @tokens.setter
+    def tokens(self, tokens):
+        self.values[self.offset] = tokens
+
+    @property
+    def updated(self):
+        return self.values[self.offset + 1]
+
+    @updated.setter
+    def updated(self, updated):
+        self.values[self.offset + 1] = updated
+
+    def take(self, nbytes, now):
+        with self.lock:
+            return TokenBucket.take(self, nbytes, now)
+
+    def refilled_at(self):
+        with self.lock:
+            return TokenBucket.refilled_at(self)
+
+
+class SharedConnectionTable:
+    """
+    Open connections and bandwidth buckets per IP in shared memory. It is
+    the ConnectionCounts of every worker's ConnectionGuard and the bucket
+    store of every worker's BandwidthShaper, so the limits hold across
+    workers. Create it in the parent before forking.
+
+    Layout: a header slot (open connections in total, IPs holding any),
+    then 64-byte slots of
+        key, connections, shapers, last_used,
+        tokens and updated for client_to_backend, then backend_to_client
+    in buckets of BUCKET_SLOTS, as in SharedSlotTable. A slot is in use
+    while its IP has open connections or a worker's shaper holds its
+    buckets, and only slots not in use are reclaimed. A new IP whose
+    bucket has no free slot is refused as over the budget, and its
+    bandwidth is shaped by each worker alone.
+    """
+
+    def __init__(self, slots, lock_stripes=64, mp_context=None):
+        ctx = mp_context or multiprocessing.get_context('fork')
+        self.buckets = max(1, slots // BUCKET_SLOTS)
+        self.slots = self.buckets * BUCKET_SLOTS
+        self.size = (self.slots + 1) * CONNECTION_SLOT_SIZE
+        self.shm = shared_memory.SharedMemory(create=True, size=self.size)
+        self.shm.buf[:self.size] = bytes(self.size)
+
+        self.keys = self.shm.buf[:self.size].cast('Q')
+        self.values = self.shm.buf[:self.size].cast('d')
+        self.locks = [ctx.Lock() for _ in range(lock_stripes)]
+        # Guards the header; taken while holding a bucket lock, never the other way round
+        self.header_lock = ctx.Lock()
+        self.clock = time.monotonic
+
+        # Local (per-process) stats
+        self.full = 0
+
+    def bucket_of(self, ip):
+        key = ip_key(ip)
+        bucket = key % self.buckets
+        return key, CONNECTION_FIELDS * (1 + bucket * BUCKET_SLOTS), self.locks[bucket % len(self.locks)]
+
+    def find(self, start, key):
+        """Offset of the slot holding key inside the bucket, or -1."""
+        keys = self.keys
+        for offset in range(start, start + BUCKET_SLOTS * CONNECTION_FIELDS, CONNECTION_FIELDS):
+            if keys[offset] == key:
+                return offset
+        return -1
+
+    def slot(self, start, key):
+        """
+        Offset of key's slot, claiming one if it has none: an empty slot,
+        else the least recently used one not in use (bucket lock held).
+        Returns:
+            int: the offset, or -1 if every slot in the bucket is in use.
+        """
+        keys = self.keys
+        values = self.values
+        empty = idle = -1
+        for offset in range(start, start + BUCKET_SLOTS * CONNECTION_FIELDS, CONNECTION_FIELDS):
+            if keys[offset] == key:
+                return offset
+            if keys[offset] == 0:
+                if empty < 0:
+                    empty = offset
+            elif not values[offset + 1] and not values[offset + 2] \
+                    and (idle < 0 or values[offset + 3] < values[idle + 3]):
+                idle = offset
+        victim = empty if empty >= 0 else idle
+        if victim < 0:
+            self.full += 1
+            return -1
+        keys[victim] = key
+        for field in range(1, CONNECTION_FIELDS):
+            values[victim + field] = 0.0
+        return victim
+
+    def acquire(self, ip, refusal):
+        """
+        Count a connection from `ip`, unless refusal(held, total, ips)
+        names a limit that refuses it (see ConnectionCounts).
+        Returns:
+            str: the refusing limit, or None if the connection was counted.
+        """
+        key, start, lock = self.bucket_of(ip)
+        values = self.values
+        with lock:
+            offset = self.slot(start, key)
+            if offset < 0:
+                return 'budget'
+            held = int(values[offset + 1])
+            with self.header_lock:
+                reason = refusal(held, int(values[0]), int(values[1]))
+                if reason is None:
+                    values[0] += 1
+                    if not held:
+                        values[1] += 1
+            if reason is None:
+                values[offset + 1] = held + 1
+                values[offset + 3] = self.clock()
+        return reason
+
+    def release(self, ip):
+        key, start, lock = self.bucket_of(ip)
+        values = self.values
+        with lock:
+            offset = self.find(start, key)
+            values[offset + 1] -= 1
+            values[offset + 3] = self.clock()
+            with self.header_lock:
+                values[0] -= 1
+                if not values[offset + 1]:
+                    values[1] -= 1
+
+    @property
+    def total(self):
+        """Open connections in all workers."""
+        return int(self.values[0])
+
+    def stats(self):
+        """Scans the table for the largest count (slow; for periodic stats only)."""
+        with self.header_lock:
+            total, ips = int(self.values[0]), int(self.values[1])
+        counts = self.values[CONNECTION_FIELDS + 1::CONNECTION_FIELDS]
+        return {
+            'open_connections': total,
+            'ips': ips,
+            'largest_per_ip': int(max(counts, default=0)),
+        }
+
+    def open_buckets(self, ip, rates, burst, now):
+        """
+        The IP's buckets, one per direction (None where `rates` has no
+        limit), held until close_buckets().
+        Returns:
+            list: SharedTokenBuckets, or this worker's own TokenBuckets if
+            the IP's table bucket is full.
+        """
+        if not any(rates):
+            return [None] * len(rates)
+        key, start, lock = self.bucket_of(ip)
+        with lock:
+            offset = self.slot(start, key)
+            if offset >= 0:
+                self.values[offset + 2] += 1
+                self.values[offset + 3] = self.clock()
+        if offset < 0:
+            return [TokenBucket(rate, burst, now) if rate else None for rate in rates]
+        return [SharedTokenBucket(rate, burst, self.values, offset + 4 + 2 * direction, lock) if rate else None
+                for direction, rate in enumerate(rates)]
+
+    def close_buckets(self, ip, buckets):
+        """This worker no longer uses the IP's buckets; they stay until the slot is reclaimed."""
+        if not any(isinstance(bucket, SharedTokenBucket) for bucket in buckets):
+            return
+        key, start, lock = self.bucket_of(ip)
+        with lock:
+            offset = self.find(start, key)
+            self.values[offset + 2] -= 1
+            self.values[offset + 3] = self.clock()
+
+    def close(self):
+        self.keys.release()
+        self.values.release()
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+class SharedDoSProtector:
+    """
+    DoSProtector counterpart backed by a SharedSlotTable, so limits are
+    enforced globally across worker processes.
+    """
+
+    def __init__(self, table, connection_table=None):
+        """
+        With a SharedConnectionTable the connection and bandwidth limits
+        are global too; without one each worker applies them on its own.
+        """
+        self.table = table
+        self.window = config.TIME_WINDOW
+        self.max_requests = config.MAX_REQUESTS_PER_WINDOW
+        self.block_duration = config.BLOCK_DURATION
+        self.clock = time.time
+
+        # One summary line per IP per interval instead of one line per drop
+        self.block_summary = BlockSummary("BLOCKED requests (Active Block)", config.BLOCK_SUMMARY_INTERVAL)
+
+        # Each worker times out its own connections; the counts and buckets may be shared
+        self.connections = ConnectionGuard('dos', counts=connection_table)
+        self.bandwidth = BandwidthShaper('dos', store=connection_table)
+
+    def reconfigure(self, time_window=None, max_requests_per_window=None, block_duration=None):
+        """Change the limits in place; the shared table is untouched."""
+        if time_window is not None:
+            self.window = time_window
+        if max_requests_per_window is not None:
+            self.max_requests = max_requests_per_window
+        if block_duration is not None:
+            self.block_duration = block_duration
+
+    def is_blocked(self, ip):
+        """Check if an IP is currently blocked (in any worker)."""
+        key = ip_key(ip)
+        start, lock = self.table.bucket_of(key)
+        with lock:
+            offset = self.table.find(start, key)
+            return offset >= 0 and self.clock() < self.table.values[offset + 2]
+
+    def process_request(self, ip):
+        """
+        Analyze the request from an IP.
+        Returns:
+            bool: True if request allowed, False if blocked.
+        """
+        current_time = self.clock()
+        interval = self.window / self.max_requests
+        key = ip_key(ip)
+        start, lock = self.table.bucket_of(key)
+        values = self.table.values
+
+        with lock:
+            offset = self.table.find(start, key)
+            if offset < 0:
+                offset = self.table.claim(start, key)
+            values[offset + 3] = current_time
+
+            # 1. Check if already blocked
+            if current_time < values[offset + 2]:
+                blocked = True
+                request_count = None
+            else:
+                self.table.clear_block(offset)
+                # 2. GCRA: advance the theoretical arrival time
+                tat = max(values[offset + 1], current_time) + interval
+                request_count = round((tat - current_time) / interval, 9)
+                blocked = request_count > self.max_requests
+                if blocked:
+                    self.table.set_block(offset, current_time + self.block_duration)
+                else:
+                    values[offset + 1] = tat
+
+        # Logging happens outside the lock
+        if blocked:
+            if request_count is None:
+                self.block_summary.note(ip)
+            else:
+                BLOCKS.inc()
+                logging.warning("DETECTED DoS: Blocking %s for %ss. Request count: %g", ip, self.block_duration, request_count)
+            return False
+        return True
+
+    def sweep(self, current_time=None):
+        """
+        Slots are reused in place; only ended blocks are cleared, a part
+        of the table per call, so the blocked count catches up.
+        Returns:
+            int: blocks cleared.
+        """
+        if current_time is None:
+            current_time = self.clock()
+        self.connections.sweep()
+        self.bandwidth.sweep()
+        return self.table.expire_blocks(current_time, config.SHARED_EXPIRY_SCAN_SLOTS)
+
+    def memory_stats(self):
+        tracked, blocked = self.table.occupancy()
+        return {
+            'algorithm': 'gcra (shared)',
+            'tracked_ips': tracked,
+            'blocked_ips': blocked,
+            'evicted_ips': self.table.evictions,
+            'total_tracked_ips': tracked,
+            'history_bytes': self.table.size,
+            'blocked_bytes': 0,
+            'bytes_per_ip': SLOT_SIZE,
+        }
@@ -0,0 +1,208 @@
+"""
+Snapshots of the DoS tracking state, so a restart does not hand every
+blocked attacker a fresh quota.
+
+The firewall writes a snapshot every SNAPSHOT_INTERVAL seconds and on
+shutdown, and maps the latest one on startup. Loading does not rebuild
+the tables: the file is memory-mapped, and an IP's entry is looked up
+(binary search over the sorted records) the first time that IP is seen
+again. Restoring a million IPs costs the same few milliseconds as
+restoring ten.
+
+File layout (little endian):
+    header   magic, limiter algorithm, created, expires (doubles),
+             record count, value count (uint64)
+    records  sorted by address, RECORD.size bytes each:
+             address (16 bytes, IPv4 as v4-mapped IPv6), blocked_until,
+             last_seen (doubles), first value, value count (uint32)
+    values   limiter state as doubles (export_state in rate_limiters.py)
+
+Snapshots are written to a temporary file, fsynced, then renamed over the
+old one, so a crash mid-write leaves the previous snapshot intact.
+
+With --workers the shared memory table is already a flat array of slots;
+the parent copies it to disk as-is and back into a fresh table.
+"""
+
+import array
+import logging
+import mmap
+import os
+import socket
+import struct
+import sys
+import time
+
+MAGIC = b'DOSSNAP1'
+HEADER = struct.Struct('<8s16sddQQ')
+RECORD = struct.Struct('<16sddII')
+
+SHARED_MAGIC = b'DOSSHRD1'
+SHARED_HEADER = struct.Struct('<8sdQ')
+
+V4_MAPPED = b'\0' * 10 + b'\xff\xff'
+
+
+def pack_address(ip):
+    """16-byte key for an IP address, or None if `ip` is not one."""
+    try:
+        if ':' in ip:
+            return socket.inet_pton(socket.AF_INET6, ip)
+        return V4_MAPPED + socket.inet_pton(socket.AF_INET, ip)
+    except (OSError, ValueError):
+        return None
+
+
+def write_atomically(path, chunks):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class Snapshot:
+    """A snapshot file mapped read-only; entries are read on demand."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            # Raises ValueError for an empty file
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < HEADER.size:
+            raise ValueError("truncated snapshot")
+        magic, algorithm, self.created, self.expires, self.count, values = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError("not a DoS state snapshot")
+        self.algorithm = algorithm.rstrip(b'\0').decode()
+        self.values_offset = HEADER.size + self.count * RECORD.size
+        if len(self.map) != self.values_offset + values * 8:
+            raise ValueError("truncated snapshot")
+
+    def read(self, index):
+        address, blocked_until, last_seen, first, count = RECORD.unpack_from(self.map, HEADER.size + index * RECORD.size)
+        values = struct.unpack_from(f'<{count}d', self.map, self.values_offset + first * 8)
+        return address, blocked_until, last_seen, values
+
+    def lookup(self, ip):
+        """
+        Find an IP's entry.
+        Returns:
+            tuple: (blocked_until, last_seen, limiter values), or None.
+        """
+        address = pack_address(ip)
+        if address is None:
+            return None
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = HEADER.size + mid * RECORD.size
+            key = self.map[start:start + 16]
+            if key < address:
+                lo = mid + 1
+            elif key > address:
+                hi = mid
+            else:
+                return self.read(mid)[1:]
+        return None
+
+    def entries(self):
+        for index in range(self.count):
+            yield self.read(index)
+
+
+def capture(protector):
+    """
+    Copy a DoSProtector's tables. This is the only part of taking a
+    snapshot that has to run on the event loop; write_snapshot can run on
+    another thread.
+    Returns:
+        list: (ip, blocked_until, last_seen, limiter values) tuples.
+    """
+    limiter = protector.limiter
+    history = protector.request_history
+    blocked = protector.blocked_ips
+    entries = [(ip, blocked.get(ip, 0.0), limiter.last_seen(state), limiter.export_state(state))
+               for ip, state in history.items()]
+    entries.extend((ip, until, 0.0, ()) for ip, until in blocked.items() if ip not in history)
+    return entries
+
+
+def write_snapshot(path, entries, algorithm, keep_for, previous=None, now=None):
+    """
+    Write captured entries to `path`. Entries of a `previous` Snapshot that
+    were never picked up again are carried over while still live. An entry
+    is live while it is blocked, or for `keep_for` seconds after its last
+    request (the limiter's idle window).
+    Returns:
+        int: Number of IPs written.
+    """
+    if now is None:
+        now = time.time()
+    records = {}
+    for ip, blocked_until, last_seen, values in entries:
+        address = pack_address(ip)
+        if address is not None and (blocked_until > now or last_seen + keep_for > now):
+            records[address] = (blocked_until, last_seen, values)
+    if previous is not None:
+        for address, blocked_until, last_seen, values in previous.entries():
+            if address not in records and (blocked_until > now or last_seen + keep_for > now):
+                if previous.algorithm != algorithm:
+                    values = ()
+                records[address] = (blocked_until, last_seen, values)
+
+    packed = bytearray(len(records) * RECORD.size)
+    pack_into = RECORD.pack_into
+    values_out = array.array('d')
+    offset = 0
+    for address in sorted(records):
+        blocked_until, last_seen, values = records[address]
+        pack_into(packed, offset, address, blocked_until, last_seen, len(values_out), len(values))
+        values_out.extend(values)
+        offset += RECORD.size
+    expires = max([now] + [max(blocked_until, last_seen + keep_for)
+                           for blocked_until, last_seen, _ in records.values()])
+    if sys.byteorder != 'little':
+        values_out.byteswap()
+
+    header = HEADER.pack(MAGIC, algorithm.encode(), now, expires, len(records), len(values_out))
+    write_atomically(path, (header, packed, values_out.tobytes()))
+    return len(records)
+
+
+def write_table_snapshot(path, table):
+    """
+    Copy a SharedSlotTable to disk. Every bucket lock is held while the
+    slots are copied (a single memory copy), then released before writing.
+    """
+    for lock in table.locks:
+        lock.acquire()
+    try:
+        data = bytes(table.shm.buf[:table.size])
+    finally:
+        for lock in table.locks:
+            lock.release()
+    write_atomically(path, (SHARED_HEADER.pack(SHARED_MAGIC, time.time(), table.slots), data))
+
+
+def load_table_snapshot(path, table):
+    """
+    Fill a freshly created SharedSlotTable from a table snapshot.
+    Raises:
+        OSError, ValueError: if the file cannot be read, is not a table
+        snapshot, or was taken with a different number of slots.
+    """
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with data:
+        if len(data) < SHARED_HEADER.size:
+            raise ValueError("truncated snapshot")
+        magic, created, slots = SHARED_HEADER.unpack_from(data)
+        if magic != SHARED_MAGIC:
+            raise ValueError("not a shared table snapshot")
+        if slots != table.slots or len(data) != SHARED_HEADER.size + table.size:
+            raise ValueError(f"snapshot has {slots} slots, the table has {table.slots}")
+        table.shm.buf[:table.size] = data[SHARED_HEADER.size:]
+    table.recount()
+    logging.info("Restored shared rate-limit table from %s (taken %.0fs ago)", path, time.time() - created)
@@ -2,12 +2,32 @@ import unittest
 import time
 import sys
 import os
+import io
+import queue
+import logging
+import multiprocessing
+import asyncio
+import json
+import signal
+import socket
+import tempfile
 
 # Add parent directory to path so we can import firewall
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from firewall import DoSProtector
 import config
+# Keep test runs from writing a log file into the source tree
+config.LOG_FILE = os.devnull
+
+from firewall import DoSProtector
+from rate_limiters import LIMITERS, create_limiter
+import common_path  # Shared modules, see common_path.py
+from log_pipeline import LazyQueueHandler, BatchingQueueListener, BlockSummary, setup_logging, stop_logging
+from shared_limiter import SharedSlotTable, SharedConnectionTable, SharedDoSProtector, SharedTokenBucket, BUCKET_SLOTS
+import snapshot
+from timer_wheel import TimerWheel
+from connection_guard import ConnectionGuard
+from bandwidth import BandwidthShaper
 
 class TestDoSProtector(unittest.TestCase):
     def setUp(self):
@@ -62,5 +82,759 @@ class TestDoSProtector(unittest.TestCase):
         
         self.assertFalse(self.firewall.is_blocked(ip), "IP should be unblocked after duration")
 
+    def test_cold_ip_not_tracked(self):
+        ip = "172.16.0.9"
+        self.assertFalse(self.firewall.is_blocked(ip))
+        self.assertNotIn(ip, self.firewall.request_history)
+
+    def test_tracked_ip_cap(self):
+        self.firewall.max_tracked_ips = 100
+        for i in range(1000):
+            self.firewall.process_request(f"10.1.{i // 256}.{i % 256}")
+
+        self.assertEqual(len(self.firewall.request_history), 100)
+        self.assertEqual(self.firewall.evicted_ips, 900)
+        # Most recently seen IPs survive eviction
+        self.assertIn("10.1.3.231", self.firewall.request_history)
+        self.assertNotIn("10.1.0.0", self.firewall.request_history)
+
+    def test_sweep_idle_ips_and_expired_blocks(self):
+        for i in range(10):
+            self.firewall.process_request(f"10.2.0.{i}")
+        ip = "10.2.1.1"
+        for _ in range(6):
+            self.firewall.process_request(ip)
+        self.assertIn(ip, self.firewall.blocked_ips)
+
+        # Past both the window and the block duration everything is reclaimed
+        removed = self.firewall.sweep(time.time() + 10)
+        self.assertEqual(removed, 12)
+        self.assertEqual(len(self.firewall.request_history), 0)
+        self.assertEqual(len(self.firewall.blocked_ips), 0)
+
+    def test_memory_stats(self):
+        for i in range(10):
+            self.firewall.process_request(f"10.3.0.{i}")
+        stats = self.firewall.memory_stats()
+        self.assertEqual(stats['tracked_ips'], 10)
+        self.assertGreater(stats['bytes_per_ip'], 0)
+
+    def test_reconfigure_keeps_state(self):
+        ip = "10.4.0.1"
+        for _ in range(6):
+            self.firewall.process_request(ip)
+        other = "10.4.0.2"
+        for _ in range(4):
+            self.assertTrue(self.firewall.process_request(other))
+
+        self.firewall.reconfigure(max_requests_per_window=3, block_duration=60)
+        # The block survives, and the earlier requests still count
+        self.assertTrue(self.firewall.is_blocked(ip))
+        self.assertFalse(self.firewall.process_request(other))
+        self.assertEqual(self.firewall.max_requests, 3)
+
+    def test_block_on_a_new_instance(self):
+        firewall = DoSProtector()
+        firewall.block_ip("10.5.0.1", time.time())
+        self.assertTrue(firewall.is_blocked("10.5.0.1"))
+        self.assertEqual(len(firewall.block_timers), 1)
+
+class FakeClock:
+    def __init__(self, start=1000.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+class TestRateLimitAlgorithms(unittest.TestCase):
+    """Every algorithm must give the same allow/deny answers for these scenarios."""
+
+    def make_firewall(self, algorithm):
+        firewall = DoSProtector(clock=FakeClock())
+        firewall.limiter = create_limiter(algorithm)
+        firewall.max_requests = 5
+        firewall.window = 2
+        firewall.block_duration = 3
+        return firewall
+
+    def test_burst_up_to_limit_then_block(self):
+        for algorithm in LIMITERS:
+            with self.subTest(algorithm=algorithm):
+                firewall = self.make_firewall(algorithm)
+                ip = "192.168.2.1"
+                for _ in range(5):
+                    self.assertTrue(firewall.process_request(ip))
+                self.assertFalse(firewall.process_request(ip))
+                self.assertTrue(firewall.is_blocked(ip))
+
+    def test_allowed_again_after_idle(self):
+        for algorithm in LIMITERS:
+            with self.subTest(algorithm=algorithm):
+                firewall = self.make_firewall(algorithm)
+                ip = "192.168.2.2"
+                for _ in range(5):
+                    self.assertTrue(firewall.process_request(ip))
+                firewall.clock.advance(2 * firewall.window)
+                for _ in range(5):
+                    self.assertTrue(firewall.process_request(ip))
+
+    def test_steady_rate_below_limit(self):
+        for algorithm in LIMITERS:
+            with self.subTest(algorithm=algorithm):
+                firewall = self.make_firewall(algorithm)
+                ip = "192.168.2.3"
+                # 4 requests per window, spread evenly, never exceeds 5
+                for _ in range(40):
+                    self.assertTrue(firewall.process_request(ip))
+                    firewall.clock.advance(0.5)
+
+    def test_block_expires(self):
+        for algorithm in LIMITERS:
+            with self.subTest(algorithm=algorithm):
+                firewall = self.make_firewall(algorithm)
+                ip = "192.168.2.4"
+                for _ in range(6):
+                    firewall.process_request(ip)
+                self.assertTrue(firewall.is_blocked(ip))
+                firewall.clock.advance(firewall.block_duration + 2 * firewall.window)
+                self.assertFalse(firewall.is_blocked(ip))
+                self.assertTrue(firewall.process_request(ip))
+
+    def test_constant_state_size(self):
+        for algorithm in ('sliding_window', 'token_bucket', 'gcra'):
+            with self.subTest(algorithm=algorithm):
+                firewall = self.make_firewall(algorithm)
+                firewall.max_requests = 10000
+                ip = "192.168.2.5"
+                firewall.process_request(ip)
+                size = firewall.limiter.state_size(firewall.request_history[ip])
+                for _ in range(5000):
+                    firewall.process_request(ip)
+                self.assertEqual(firewall.limiter.state_size(firewall.request_history[ip]), size)
+
+    def test_unblock_fires_on_time_without_traffic(self):
+        for algorithm in LIMITERS:
+            with self.subTest(algorithm=algorithm):
+                firewall = self.make_firewall(algorithm)
+                unblocked = []
+                firewall.unblock_listeners.append(lambda ip: unblocked.append((ip, firewall.clock())))
+                for _ in range(6):
+                    firewall.process_request("192.168.2.6")
+                started = firewall.clock()
+
+                # Nobody sends anything; only the timer loop runs
+                while firewall.clock() < started + 2 * firewall.window + firewall.block_duration + 1:
+                    firewall.clock.advance(0.05)
+                    firewall.sweep()
+                self.assertEqual(len(unblocked), 1)
+                ip, when = unblocked[0]
+                self.assertEqual(ip, "192.168.2.6")
+                self.assertGreaterEqual(when, started + firewall.block_duration)
+                self.assertLessEqual(when, started + firewall.block_duration + firewall.block_timers.tick + 0.05)
+                # The departed attacker's history is gone too
+                self.assertEqual(len(firewall.request_history), 0)
+                self.assertEqual((len(firewall.block_timers), len(firewall.idle_timers)), (0, 0))
+
+    def test_unknown_algorithm(self):
+        with self.assertRaises(ValueError):
+            create_limiter('leaky')
+
+class TestTimerWheel(unittest.TestCase):
+    def setUp(self):
+        self.wheel = TimerWheel(tick=0.1, slots=16)
+        self.wheel.advance(100.0)
+
+    def test_never_early_at_most_one_tick_late(self):
+        for i in range(50):
+            self.wheel.schedule(i, 100.0 + i * 0.037)
+        fired = {}
+        now = 100.0
+        while len(self.wheel):
+            now += 0.01
+            for key in self.wheel.advance(now):
+                fired[key] = now
+        for i in range(50):
+            deadline = 100.0 + i * 0.037
+            self.assertGreaterEqual(fired[i], deadline)
+            self.assertLessEqual(fired[i], deadline + 0.1 + 0.011)
+
+    def test_reschedule_and_cancel(self):
+        self.wheel.schedule('a', 100.5)
+        self.wheel.schedule('b', 100.5)
+        self.wheel.schedule('a', 101.0)
+        self.wheel.cancel('b')
+        self.assertEqual(self.wheel.advance(100.7), [])
+        self.assertEqual(self.wheel.advance(101.1), ['a'])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_timers_beyond_one_revolution(self):
+        # 16 slots of 0.1s: a 10s timer goes round several times first
+        self.wheel.schedule('far', 110.0)
+        self.wheel.schedule('past', 50.0)
+        self.assertEqual(self.wheel.advance(100.1), ['past'])
+        now = 100.1
+        while now < 109.95:
+            now += 0.1
+            self.assertEqual(self.wheel.advance(now), [])
+        self.assertEqual(self.wheel.advance(110.1), ['far'])
+        # Jumping far ahead visits each slot once
+        self.wheel.schedule('jump', 111.0)
+        self.assertEqual(self.wheel.advance(500.0), ['jump'])
+
+class TestConnectionGuard(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.aborted = []
+
+    def guard(self, **limits):
+        # 0 turns a limit off
+        settings = dict(max_per_ip=0, max_total=0, fair_share_threshold=0,
+                        idle_timeout=0, request_timeout=0, min_transfer_rate=0)
+        settings.update(limits)
+        return ConnectionGuard('dos', clock=self.clock, **settings)
+
+    def open(self, guard, ip):
+        return guard.open(ip, lambda: self.aborted.append(ip))
+
+    def test_per_ip_cap_counts_open_connections(self):
+        guard = self.guard(max_per_ip=2)
+        refused = guard.rejected['per_ip'].value
+        first, second = self.open(guard, '10.0.0.1'), self.open(guard, '10.0.0.1')
+        self.assertIsNone(self.open(guard, '10.0.0.1'))
+        self.assertIsNotNone(self.open(guard, '10.0.0.2'))
+        guard.release(first)
+        self.assertIsNotNone(self.open(guard, '10.0.0.1'))
+        self.assertEqual(guard.rejected['per_ip'].value - refused, 1)
+        self.assertEqual(guard.stats(), {'open_connections': 3, 'ips': 2, 'largest_per_ip': 2})
+
+    def test_fair_share_near_the_budget(self):
+        guard = self.guard(max_total=10, fair_share_threshold=0.5)
+        for _ in range(4):
+            self.open(guard, 'heavy')
+        self.open(guard, 'light')
+        # 5 of 10 in use: 'heavy' may grow to its share of 10 / 2 IPs
+        self.assertIsNotNone(self.open(guard, 'heavy'))
+        self.assertIsNone(self.open(guard, 'heavy'))
+        for i in range(4):
+            self.assertIsNotNone(self.open(guard, f'new{i}'))
+        # Budget spent: nobody gets in
+        self.assertIsNone(self.open(guard, 'another'))
+        self.assertEqual(guard.total, 10)
+
+    def test_silent_and_idle_connections_time_out(self):
+        guard = self.guard(idle_timeout=60, request_timeout=10, min_transfer_rate=100)
+        silent = self.open(guard, 'silent')
+        chatty = self.open(guard, 'chatty')
+        self.clock.advance(1)
+        chatty.client_data(200)
+        chatty.backend_data(500)
+
+        self.clock.advance(9.5)
+        guard.sweep()
+        self.assertEqual(self.aborted, ['silent'])
+        guard.release(silent)
+
+        self.clock.advance(55)
+        guard.sweep()
+        self.assertEqual(self.aborted, ['silent', 'chatty'])
+
+    def test_trickled_request_is_too_slow(self):
+        guard = self.guard(idle_timeout=60, request_timeout=10, min_transfer_rate=100)
+        trickler = self.open(guard, 'trickler')
+        upload = self.open(guard, 'upload')
+        slow_backend = self.open(guard, 'slow_backend')
+        slow_backend.client_data(300)
+        closed = guard.timed_out['too_slow'].value
+        for _ in range(15):
+            self.clock.advance(1)
+            trickler.client_data(1)
+            upload.client_data(1000)
+            guard.sweep()
+        self.assertEqual(self.aborted, ['trickler'])
+        self.assertEqual(guard.timed_out['too_slow'].value - closed, 1)
+        # The backend taking its time is not the client's fault
+        self.clock.advance(40)
+        guard.sweep()
+        self.assertEqual(self.aborted, ['trickler'])
+
+class TestBandwidthShaper(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.shaper = BandwidthShaper('dos', upload_rate=1000, download_rate=0, burst=2000, clock=self.clock)
+
+    def test_over_the_rate_waits_until_the_debt_is_paid(self):
+        shaped = self.shaper.open('10.0.0.1')
+        throttled = self.shaper.throttled[0].value
+        # The burst goes through, then every byte costs 1 ms
+        self.assertEqual(shaped.client_data(2000), 0.0)
+        self.assertAlmostEqual(shaped.client_data(500), 0.5)
+        self.clock.advance(0.5)
+        self.assertAlmostEqual(shaped.client_data(1000), 1.0)
+        self.assertEqual(self.shaper.throttled[0].value - throttled, 2)
+        # No download limit: counted, never throttled
+        self.assertEqual(shaped.backend_data(10 ** 6), 0.0)
+
+    def test_connections_of_one_ip_share_its_buckets(self):
+        first, second = self.shaper.open('10.0.0.1'), self.shaper.open('10.0.0.1')
+        other = self.shaper.open('10.0.0.2')
+        self.assertIs(first, second)
+        first.client_data(2000)
+        self.assertAlmostEqual(second.client_data(1000), 1.0)
+        self.assertEqual(other.client_data(1000), 0.0)
+
+    def test_departed_ip_is_kept_until_its_buckets_refill(self):
+        shaped = self.shaper.open('10.0.0.1')
+        shaped.client_data(3000)
+        self.shaper.release(shaped)
+        # Reconnecting at once does not buy a new burst
+        again = self.shaper.open('10.0.0.1')
+        self.assertIs(again, shaped)
+        self.assertAlmostEqual(again.client_data(0), 1.0)
+        self.shaper.release(again)
+        self.clock.advance(2.5)
+        self.assertEqual(self.shaper.sweep(), 0)
+        self.clock.advance(0.6)
+        self.assertEqual(self.shaper.sweep(), 1)
+        self.assertEqual(self.shaper.ips, {})
+        # An IP that never used its burst is dropped on release
+        self.shaper.release(self.shaper.open('10.0.0.2'))
+        self.assertEqual(self.shaper.ips, {})
+
+    def test_throughput_stats(self):
+        busy, quiet = self.shaper.open('10.0.0.1'), self.shaper.open('10.0.0.2')
+        busy.backend_data(8000)
+        busy.client_data(2000)
+        quiet.backend_data(1000)
+        self.shaper.release(quiet)
+        self.clock.advance(10)
+        stats = self.shaper.stats()
+        self.assertEqual(stats['total'], [200.0, 900.0])
+        self.assertEqual(stats['top'], [('10.0.0.1', [200.0, 800.0])])
+        self.clock.advance(10)
+        self.assertEqual(self.shaper.stats(), {'total': [0.0, 0.0], 'top': []})
+
+def hit_from_child(table, ip, count):
+    protector = SharedDoSProtector(table)
+    protector.max_requests = 5
+    protector.window = 2
+    for _ in range(count):
+        protector.process_request(ip)
+
+def use_from_child(connection_table, ip, connections, upload):
+    # Connections and buckets the child holds stay counted after it exits
+    guard = ConnectionGuard('dos', max_per_ip=0, max_total=0, counts=connection_table)
+    for _ in range(connections):
+        guard.open(ip, lambda: None)
+    shaper = BandwidthShaper('dos', upload_rate=1000, download_rate=0, burst=2000,
+                             clock=FakeClock(), store=connection_table)
+    shaper.open(ip).client_data(upload)
+
+@unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(), "requires fork")
+class TestSharedLimiter(unittest.TestCase):
+    def setUp(self):
+        self.table = SharedSlotTable(64, lock_stripes=4)
+        self.firewall = self.make_protector()
+
+    def tearDown(self):
+        self.table.close()
+        self.table.unlink()
+
+    def make_protector(self):
+        protector = SharedDoSProtector(self.table)
+        protector.clock = FakeClock()
+        protector.max_requests = 5
+        protector.window = 2
+        protector.block_duration = 3
+        return protector
+
+    def test_burst_then_block_then_expiry(self):
+        ip = "10.5.0.1"
+        for _ in range(5):
+            self.assertTrue(self.firewall.process_request(ip))
+        self.assertFalse(self.firewall.process_request(ip))
+        self.assertTrue(self.firewall.is_blocked(ip))
+        self.firewall.clock.advance(3 + 2)
+        self.assertFalse(self.firewall.is_blocked(ip))
+        self.assertTrue(self.firewall.process_request(ip))
+
+    def test_limits_are_global_across_processes(self):
+        ip = "10.5.0.2"
+        ctx = multiprocessing.get_context('fork')
+        child = ctx.Process(target=hit_from_child, args=(self.table, ip, 3))
+        child.start()
+        child.join()
+
+        # The child used 3 of the 5 requests; only 2 are left here
+        protector = self.make_protector()
+        protector.clock = time.time
+        self.assertTrue(protector.process_request(ip))
+        self.assertTrue(protector.process_request(ip))
+        self.assertFalse(protector.process_request(ip))
+
+    def test_fixed_memory_with_many_sources(self):
+        for i in range(1000):
+            self.firewall.process_request(f"10.6.{i // 256}.{i % 256}")
+        stats = self.firewall.memory_stats()
+        self.assertEqual(stats['tracked_ips'], self.table.slots)
+        self.assertEqual(self.table.evictions, 1000 - self.table.slots)
+        self.assertEqual(self.table.slots % BUCKET_SLOTS, 0)
+
+    def test_counters_follow_the_slots(self):
+        # More IPs than slots (evictions); every other one gets blocked
+        for i in range(200):
+            for _ in range(6 if i % 2 else 1):
+                self.firewall.process_request(f"10.8.0.{i}")
+        counted = self.table.occupancy()
+        self.table.recount()
+        self.assertEqual(self.table.occupancy(), counted)
+        self.assertEqual(counted[0], self.table.slots)
+        self.assertGreater(counted[1], 0)
+
+        # Ended blocks are cleared a part of the table per sweep
+        self.firewall.clock.advance(self.firewall.block_duration)
+        scan, config.SHARED_EXPIRY_SCAN_SLOTS = config.SHARED_EXPIRY_SCAN_SLOTS, 16
+        try:
+            cleared = [self.firewall.sweep() for _ in range(self.table.slots // 16)]
+        finally:
+            config.SHARED_EXPIRY_SCAN_SLOTS = scan
+        self.assertEqual(sum(cleared), counted[1])
+        self.assertEqual(self.table.occupancy(), (self.table.slots, 0))
+
+    def test_table_snapshot_round_trip(self):
+        ip = "10.5.0.3"
+        for _ in range(6):
+            self.firewall.process_request(ip)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'state')
+            snapshot.write_table_snapshot(path, self.table)
+            restored = SharedSlotTable(64, lock_stripes=4)
+            try:
+                snapshot.load_table_snapshot(path, restored)
+                self.assertEqual(bytes(restored.shm.buf[:restored.size]), bytes(self.table.shm.buf[:self.table.size]))
+                self.assertEqual(restored.occupancy(), (1, 1))
+                with self.assertRaises(ValueError):
+                    bigger = SharedSlotTable(128, lock_stripes=4)
+                    try:
+                        snapshot.load_table_snapshot(path, bigger)
+                    finally:
+                        bigger.close()
+                        bigger.unlink()
+            finally:
+                restored.close()
+                restored.unlink()
+
+@unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(), "requires fork")
+class TestSharedConnectionTable(unittest.TestCase):
+    def setUp(self):
+        self.table = SharedConnectionTable(64, lock_stripes=4)
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        self.table.close()
+        self.table.unlink()
+
+    def guard(self, **limits):
+        settings = dict(max_per_ip=0, max_total=0, fair_share_threshold=0,
+                        idle_timeout=0, request_timeout=0, min_transfer_rate=0)
+        settings.update(limits)
+        return ConnectionGuard('dos', clock=self.clock, counts=self.table, **settings)
+
+    def test_limits_are_global_across_processes(self):
+        ip = "10.7.0.1"
+        ctx = multiprocessing.get_context('fork')
+        child = ctx.Process(target=use_from_child, args=(self.table, ip, 2, 2500))
+        child.start()
+        child.join()
+
+        # The child holds 2 of the 3 connections and took the whole burst
+        guard = self.guard(max_per_ip=3, max_total=10)
+        conn = guard.open(ip, lambda: None)
+        self.assertIsNotNone(conn)
+        self.assertIsNone(guard.open(ip, lambda: None))
+        self.assertEqual(guard.stats(), {'open_connections': 3, 'ips': 1, 'largest_per_ip': 3})
+        shaper = BandwidthShaper('dos', upload_rate=1000, download_rate=0, burst=2000,
+                                 clock=self.clock, store=self.table)
+        shaped = shaper.open(ip)
+        self.assertIsInstance(shaped.buckets[0], SharedTokenBucket)
+        self.assertAlmostEqual(shaped.client_data(500), 1.0)
+
+        guard.release(conn)
+        self.assertEqual(guard.total, 2)
+
+    def test_full_bucket_refuses_new_ips(self):
+        # One table bucket: eight IPs with open connections fill it
+        self.table.close()
+        self.table.unlink()
+        self.table = SharedConnectionTable(BUCKET_SLOTS, lock_stripes=1)
+        guard = self.guard(max_total=100)
+        held = [guard.open(f"10.7.1.{i}", lambda: None) for i in range(BUCKET_SLOTS)]
+        refused = guard.rejected['budget'].value
+        self.assertIsNone(guard.open("10.7.2.1", lambda: None))
+        self.assertEqual(guard.rejected['budget'].value - refused, 1)
+        shaper = BandwidthShaper('dos', upload_rate=1000, download_rate=0, burst=2000,
+                                 clock=self.clock, store=self.table)
+        self.assertNotIsInstance(shaper.open("10.7.2.1").buckets[0], SharedTokenBucket)
+
+        # A slot whose IP has nothing open is reused
+        guard.release(held[0])
+        self.assertIsNotNone(guard.open("10.7.2.2", lambda: None))
+
+    def test_buckets_outlive_the_shaper_that_used_them(self):
+        shaper = BandwidthShaper('dos', upload_rate=1000, download_rate=0, burst=2000,
+                                 clock=self.clock, store=self.table)
+        shaped = shaper.open("10.7.3.1")
+        shaped.client_data(3000)
+        shaper.release(shaped)
+        shaper.sweep(self.clock() + 60)
+        self.assertEqual(shaper.ips, {})
+
+        # Another worker's shaper finds the IP still in debt, a second later
+        other = BandwidthShaper('dos', upload_rate=1000, download_rate=0, burst=2000,
+                                clock=self.clock, store=self.table)
+        self.assertAlmostEqual(other.open("10.7.3.1").client_data(0), 1.0)
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'dos_state.snapshot')
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def make_firewall(self, algorithm='sliding_log'):
+        firewall = DoSProtector()
+        firewall.limiter = create_limiter(algorithm)
+        firewall.clock = self.clock
+        firewall.max_requests = 5
+        firewall.window = 10
+        firewall.block_duration = 30
+        return firewall
+
+    def save(self, firewall):
+        return snapshot.write_snapshot(self.path, snapshot.capture(firewall), firewall.limiter.name,
+                                       firewall.limiter.idle_window(firewall.window),
+                                       previous=firewall.snapshot, now=self.clock())
+
+    def test_restart_keeps_blocks_and_counters(self):
+        for algorithm in LIMITERS:
+            with self.subTest(algorithm=algorithm):
+                firewall = self.make_firewall(algorithm)
+                for _ in range(6):
+                    firewall.process_request("10.7.0.1")
+                for _ in range(3):
+                    firewall.process_request("2001:db8::7")
+                firewall.process_request("unknown")
+                self.assertEqual(self.save(firewall), 2)
+
+                restarted = self.make_firewall(algorithm)
+                self.assertEqual(restarted.restore_snapshot(self.path), 2)
+                self.assertEqual(len(restarted.request_history), 0)
+                self.assertFalse(restarted.process_request("10.7.0.1"))
+                # 3 of the 5 requests were used before the restart
+                self.assertTrue(restarted.process_request("2001:db8::7"))
+                self.assertTrue(restarted.process_request("2001:db8::7"))
+                self.assertFalse(restarted.process_request("2001:db8::7"))
+                self.assertTrue(restarted.process_request("10.7.0.2"))
+
+    def test_unvisited_entries_carry_over_until_they_expire(self):
+        firewall = self.make_firewall()
+        for _ in range(6):
+            firewall.process_request("10.7.0.1")
+        self.save(firewall)
+
+        # Restart twice without the IP coming back: the block is kept
+        for _ in range(2):
+            restarted = self.make_firewall()
+            restarted.restore_snapshot(self.path)
+            self.assertEqual(self.save(restarted), 1)
+        self.assertFalse(restarted.process_request("10.7.0.1"))
+
+        self.clock.advance(31)
+        restarted = self.make_firewall()
+        self.assertEqual(restarted.restore_snapshot(self.path), 0)
+        self.assertTrue(restarted.process_request("10.7.0.1"))
+
+    def test_algorithm_change_restores_blocks_only(self):
+        firewall = self.make_firewall('gcra')
+        for _ in range(6):
+            firewall.process_request("10.7.0.1")
+        for _ in range(5):
+            firewall.process_request("10.7.0.2")
+        self.save(firewall)
+        restarted = self.make_firewall('token_bucket')
+        restarted.restore_snapshot(self.path)
+        self.assertFalse(restarted.process_request("10.7.0.1"))
+        self.assertTrue(restarted.process_request("10.7.0.2"))
+
+    def test_invalid_snapshot_is_ignored(self):
+        firewall = self.make_firewall()
+        self.assertEqual(firewall.restore_snapshot(self.path), 0)
+        for content in [b'', b'DOSSNAP1', b'x' * 200]:
+            with open(self.path, 'wb') as f:
+                f.write(content)
+            self.assertEqual(firewall.restore_snapshot(self.path), 0)
+        self.assertIsNone(firewall.snapshot)
+
+    def test_restore_does_not_scale_with_size(self):
+        now = self.clock()
+        entries = [(f"10.{i >> 16}.{(i >> 8) & 255}.{i & 255}", 0.0, now, [now, now]) for i in range(200000)]
+        snapshot.write_snapshot(self.path, entries, 'gcra', 10, now=now)
+        firewall = self.make_firewall('gcra')
+        started = time.perf_counter()
+        self.assertEqual(firewall.restore_snapshot(self.path), 200000)
+        self.assertTrue(firewall.process_request("10.1.2.3"))
+        self.assertLess(time.perf_counter() - started, 0.05)
+        self.assertIn("10.1.2.3", firewall.request_history)
+
+class TestPolicyReload(unittest.TestCase):
+    def setUp(self):
+        import run_firewall
+        self.run_firewall = run_firewall
+        self.dir = tempfile.TemporaryDirectory()
+        self.saved = (config.POLICY_FILE, run_firewall.firewall_engine)
+        config.POLICY_FILE = os.path.join(self.dir.name, 'dos_policy.json')
+
+    def tearDown(self):
+        config.POLICY_FILE, self.run_firewall.firewall_engine = self.saved
+        self.dir.cleanup()
+
+    def write(self, content):
+        with open(config.POLICY_FILE, 'w') as f:
+            f.write(content)
+
+    def test_load_limits(self):
+        self.write(json.dumps({'max_requests_per_window': 7}))
+        limits = self.run_firewall.load_limits(config.POLICY_FILE)
+        self.assertEqual(limits['max_requests_per_window'], 7)
+        self.assertEqual(limits['time_window'], config.TIME_WINDOW)
+        for content in ['{', '[]', '{"max_requests": 5}', '{"block_duration": -1}', '{"time_window": "60"}']:
+            self.write(content)
+            with self.assertRaises(ValueError, msg=content):
+                self.run_firewall.load_limits(config.POLICY_FILE)
+
+    @unittest.skipUnless(hasattr(signal, 'SIGHUP'), "needs SIGHUP")
+    def test_sighup_reconfigures_running_engine(self):
+        engine = self.run_firewall.firewall_engine = DoSProtector()
+        for _ in range(3):
+            engine.process_request("10.5.0.1")
+        self.write(json.dumps({'max_requests_per_window': 2, 'block_duration': 5}))
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            loop.add_signal_handler(signal.SIGHUP, self.run_firewall.reload_policy)
+            try:
+                os.kill(os.getpid(), signal.SIGHUP)
+                await asyncio.sleep(0.1)
+            finally:
+                loop.remove_signal_handler(signal.SIGHUP)
+
+        asyncio.run(run())
+        self.assertEqual((engine.max_requests, engine.block_duration), (2, 5))
+        # History from before the reload counts against the new limit
+        self.assertFalse(engine.process_request("10.5.0.1"))
+
+class FakePool:
+    """Hands out one pre-made backend socket, like UpstreamPool.acquire()."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.released = []
+
+    async def acquire(self):
+        return 'upstream', self.sock
+
+    def release(self, upstream):
+        self.released.append(upstream)
+
+class FakeWriter:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class TestProxySetup(unittest.IsolatedAsyncioTestCase):
+    async def test_backend_attach_failure_closes_both_sides(self):
+        import run_firewall
+        # A datagram socket cannot back a stream: open_connection() refuses it
+        backend_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        pool, client_writer = FakePool(backend_sock), FakeWriter()
+        saved, run_firewall.backend_pool = run_firewall.backend_pool, pool
+        try:
+            with self.assertRaises(ValueError):
+                await run_firewall.proxy(None, client_writer, None, None)
+        finally:
+            run_firewall.backend_pool = saved
+        self.assertEqual(backend_sock.fileno(), -1)
+        self.assertTrue(client_writer.closed)
+        self.assertEqual(pool.released, ['upstream'])
+
+class TestLogPipeline(unittest.TestCase):
+    def setUp(self):
+        self.stream = io.StringIO()
+        handler = logging.StreamHandler(self.stream)
+        handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        self.queue = queue.Queue(maxsize=100)
+        self.queue_handler = LazyQueueHandler(self.queue)
+        self.listener = BatchingQueueListener(self.queue, [handler], batch_size=50)
+        self.logger = logging.getLogger('test_log_pipeline')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.queue_handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.queue_handler)
+
+    def test_batched_write(self):
+        self.listener.start()
+        for i in range(100):
+            self.logger.warning("event %d", i)
+        self.listener.stop()
+
+        lines = self.stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 100)
+        self.assertEqual(lines[99], "WARNING event 99")
+        self.assertLess(self.listener.batches_written, 100)
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        # Listener not started: the queue fills up and extra records are dropped
+        for i in range(150):
+            self.logger.warning("event %d", i)
+        self.assertEqual(self.queue_handler.dropped, 50)
+
+    def test_block_summary_aggregates(self):
+        summary = BlockSummary("BLOCKED", interval=60)
+        with self.assertLogs(level='WARNING') as logs:
+            for _ in range(500):
+                summary.note("10.9.9.9")
+            summary.note("10.9.9.10")
+            summary.flush()
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn("10.9.9.9 blocked 500 times", logs.output[0])
+
+    def test_stop_logging_drains_before_closing(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'firewall.log')
+            queue_handler, listener = setup_logging(path)
+            for i in range(1000):
+                logging.info("event %d", i)
+            stop_logging()
+
+            self.assertNotIn(queue_handler, logging.getLogger().handlers)
+            self.assertTrue(all(handler.stream is None for handler in listener.handlers))
+            with open(path) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(len(lines), 1000)
+            self.assertTrue(lines[-1].endswith("event 999"))
+
+def tearDownModule():
+    # Drain the logging pipeline before the test runner closes its streams
+    stop_logging()
+
+
 if __name__ == "__main__":
     unittest.main()
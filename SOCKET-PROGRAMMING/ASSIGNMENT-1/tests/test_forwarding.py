@@ -0,0 +1,215 @@
+import unittest
+import asyncio
+import sys
+import os
+import time
+
+# Add parent directory to path so we can import fast_forward
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fast_forward
+import common_path  # Shared modules, see common_path.py
+from bandwidth import BandwidthShaper
+from connection_guard import ConnectionGuard
+from upstream_pool import UpstreamPool
+
+PAYLOAD = os.urandom(1024 * 1024)
+
+async def echo(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    finally:
+        writer.close()
+
+class ForwardingTestMixin:
+    """Runs the same checks against each forwarding engine."""
+
+    async def asyncSetUp(self):
+        self.backend = await asyncio.start_server(echo, '127.0.0.1', 0)
+        self.backend_port = self.backend.sockets[0].getsockname()[1]
+        self.pool = UpstreamPool([('127.0.0.1', self.backend_port)], warm_connections=2)
+        self.denied = set()
+        self.connections = None
+        self.bandwidth = None
+
+    async def asyncTearDown(self):
+        self.pool.close()
+        self.backend.close()
+        await self.backend.wait_closed()
+
+    def admit(self, client_ip):
+        return client_ip not in self.denied
+
+    async def round_trip(self, port, payload):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+        async def send():
+            writer.write(payload)
+            await writer.drain()
+
+        sender = asyncio.create_task(send())
+        received = await reader.readexactly(len(payload))
+        await sender
+        writer.close()
+        return received
+
+    async def test_bulk_transfer(self):
+        port = await self.start_proxy()
+        sent_before = fast_forward.CLIENT_BYTES.value
+        echoed_before = fast_forward.BACKEND_BYTES.value
+        received = await asyncio.wait_for(self.round_trip(port, PAYLOAD), 10)
+        self.assertEqual(received, PAYLOAD)
+        self.assertEqual(fast_forward.CLIENT_BYTES.value - sent_before, len(PAYLOAD))
+        self.assertEqual(fast_forward.BACKEND_BYTES.value - echoed_before, len(PAYLOAD))
+
+    async def test_concurrent_sessions(self):
+        port = await self.start_proxy()
+        payloads = [os.urandom(200000) for _ in range(5)]
+        results = await asyncio.wait_for(
+            asyncio.gather(*(self.round_trip(port, p) for p in payloads)), 10
+        )
+        self.assertEqual(results, payloads)
+
+    async def test_rejected_client_is_closed(self):
+        self.denied.add('127.0.0.1')
+        port = await self.start_proxy()
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        data = await asyncio.wait_for(reader.read(), 5)
+        self.assertEqual(data, b'')
+        writer.close()
+
+    async def test_connection_limits(self):
+        self.connections = ConnectionGuard('dos', max_per_ip=2, request_timeout=0.3)
+        port = await self.start_proxy()
+
+        async def sweep():
+            while True:
+                await asyncio.sleep(0.05)
+                self.connections.sweep()
+
+        sweeper = asyncio.create_task(sweep())
+        try:
+            silent_reader, silent_writer = await asyncio.open_connection('127.0.0.1', port)
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'ping')
+            self.assertEqual(await asyncio.wait_for(reader.readexactly(4), 5), b'ping')
+
+            # Third connection from the same IP: refused
+            refused_reader, refused_writer = await asyncio.open_connection('127.0.0.1', port)
+            self.assertEqual(await asyncio.wait_for(refused_reader.read(), 5), b'')
+            refused_writer.close()
+
+            # The one that never sent anything is closed after the request timeout
+            self.assertEqual(await asyncio.wait_for(silent_reader.read(), 5), b'')
+            silent_writer.close()
+            await asyncio.sleep(0.1)
+            self.assertEqual(self.connections.total, 1)
+
+            writer.close()
+            await asyncio.sleep(0.1)
+            self.assertEqual(self.connections.total, 0)
+        finally:
+            sweeper.cancel()
+
+    async def test_bandwidth_limit(self):
+        self.bandwidth = BandwidthShaper('dos', upload_rate=2000000, download_rate=1000000, burst=65536)
+        port = await self.start_proxy()
+        payload = PAYLOAD[:400000]
+        throttled = self.bandwidth.throttled[1].value
+        started = time.monotonic()
+        received = await asyncio.wait_for(self.round_trip(port, payload), 10)
+        elapsed = time.monotonic() - started
+        self.assertEqual(received, payload)
+        # The echo comes back at the download rate, after the burst
+        self.assertGreater(elapsed, (len(payload) - 65536) / 1000000 - 0.05)
+        self.assertGreater(self.bandwidth.throttled[1].value, throttled)
+        stats = self.bandwidth.stats()
+        self.assertEqual(stats['top'][0][0], '127.0.0.1')
+        self.assertEqual(self.bandwidth.bytes, [len(payload), len(payload)])
+
+class TestBufferedForwarding(ForwardingTestMixin, unittest.IsolatedAsyncioTestCase):
+    async def start_proxy(self):
+        self.proxy = await fast_forward.start_buffered_server(
+            self.admit, '127.0.0.1', 0, self.pool,
+            buffer_size=16384, high_water=65536, connections=self.connections, bandwidth=self.bandwidth
+        )
+        return self.proxy.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.proxy.close()
+        await super().asyncTearDown()
+
+@unittest.skipUnless(fast_forward.SPLICE_AVAILABLE, "os.splice requires Linux")
+class TestSpliceForwarding(ForwardingTestMixin, unittest.IsolatedAsyncioTestCase):
+    async def start_proxy(self):
+        ready = asyncio.get_running_loop().create_future()
+        self.proxy = asyncio.create_task(fast_forward.serve_splice(
+            self.admit, '127.0.0.1', 0, self.pool,
+            buffer_size=16384, ready=ready, connections=self.connections, bandwidth=self.bandwidth
+        ))
+        return (await ready)[1]
+
+    async def asyncTearDown(self):
+        self.proxy.cancel()
+        await super().asyncTearDown()
+
+class TestUpstreamPool(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.backends = [await asyncio.start_server(echo, '127.0.0.1', 0) for _ in range(3)]
+        self.addresses = [('127.0.0.1', b.sockets[0].getsockname()[1]) for b in self.backends]
+
+    async def asyncTearDown(self):
+        for backend in self.backends:
+            backend.close()
+            await backend.wait_closed()
+
+    async def test_round_robin(self):
+        pool = UpstreamPool(self.addresses)
+        used = []
+        for _ in range(6):
+            upstream, sock = await pool.acquire()
+            used.append(upstream.port)
+            pool.release(upstream)
+            sock.close()
+        ports = [port for _, port in self.addresses]
+        self.assertEqual(used, ports + ports)
+
+    async def test_least_connections(self):
+        pool = UpstreamPool(self.addresses, strategy='least_connections')
+        held = [await pool.acquire() for _ in range(3)]
+        self.assertEqual(sorted(u.active for u in pool.upstreams), [1, 1, 1])
+        upstream, sock = held[1]
+        pool.release(upstream)
+        chosen, extra = await pool.acquire()
+        self.assertIs(chosen, upstream)
+        for _, s in held + [(chosen, extra)]:
+            s.close()
+
+    async def test_dead_backend_is_ejected_and_skipped(self):
+        self.backends[0].close()
+        await self.backends[0].wait_closed()
+        pool = UpstreamPool(self.addresses, max_failures=1)
+        for _ in range(4):
+            upstream, sock = await pool.acquire()
+            self.assertNotEqual(upstream.port, self.addresses[0][1])
+            pool.release(upstream)
+            sock.close()
+        self.assertFalse(pool.upstreams[0].healthy)
+
+    async def test_warm_connections_are_used(self):
+        pool = UpstreamPool(self.addresses[:1], warm_connections=2)
+        self.assertTrue(await pool.check(pool.upstreams[0]))
+        await asyncio.sleep(0.1)
+        upstream, sock = await pool.acquire()
+        self.assertEqual(upstream.warm_hits, 1)
+        self.assertGreater(upstream.stats()['latency_avg_ms'], 0)
+        sock.close()
+        pool.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import unittest
+import asyncio
+import contextlib
+import io
+import json
+import socketserver
+import sys
+import os
+import tempfile
+import threading
+
+# Add parent directory to path so we can import load_generator
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import load_generator
+from load_generator import parse_args, percentile, run_load, summarize
+
+class TestLatencySummary(unittest.TestCase):
+    def test_percentiles(self):
+        samples = [i / 1000 for i in range(1, 1001)]
+        self.assertEqual(percentile(samples, 0.5), 0.5)
+        self.assertEqual(percentile(samples, 0.99), 0.99)
+        self.assertEqual(percentile(samples, 0.999), 0.999)
+        self.assertEqual(percentile([0.2], 0.999), 0.2)
+        summary = summarize(reversed(samples))
+        self.assertEqual((summary['count'], summary['p50'], summary['max']), (1000, 500.0, 1000.0))
+        self.assertEqual(summarize([]), {'count': 0})
+
+class TestLoadGenerator(unittest.IsolatedAsyncioTestCase):
+    async def start(self, handler):
+        server = await asyncio.start_server(handler, '127.0.0.1', 0)
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        return server.sockets[0].getsockname()[1]
+
+    async def test_echo_from_many_sources(self):
+        peers = set()
+
+        async def echo(reader, writer):
+            peers.add(writer.get_extra_info('peername')[0])
+            while data := await reader.read(65536):
+                writer.write(data)
+                await writer.drain()
+            writer.close()
+
+        port = await self.start(echo)
+        args = parse_args(['--port', str(port), '--connections', '30', '--concurrency', '5',
+                           '--sources', '3', '--requests', '2', '--payload', '100000'])
+        stats = await run_load(args)
+        self.assertEqual((stats.started, stats.completed, stats.rejected, stats.errors), (30, 30, 0, {}))
+        self.assertEqual(len(stats.request_latency), 60)
+        self.assertEqual(stats.bytes_received, 60 * 100000)
+        self.assertEqual(peers, {'127.0.0.1', '127.0.0.2', '127.0.0.3'})
+
+    async def test_closed_connections_count_as_rejected(self):
+        async def reject(reader, writer):
+            writer.close()
+
+        port = await self.start(reject)
+        args = parse_args(['--port', str(port), '--connections', '10', '--concurrency', '2'])
+        stats = await run_load(args)
+        self.assertEqual((stats.completed, stats.rejected), (0, 10))
+
+    async def test_chat_fan_out_latency(self):
+        clients = set()
+
+        async def chat(reader, writer):
+            # Just enough of the chat server: join notice to all, messages to the others
+            clients.add(writer)
+            try:
+                while data := await reader.read(65536):
+                    text = data.decode()
+                    if text.startswith('JOIN|'):
+                        for client in clients:
+                            client.write(f"INFO|{text[5:]} has joined the chat.".encode())
+                    elif text.startswith('MSG|'):
+                        for client in clients - {writer}:
+                            client.write(f"MSG|someone|{text[4:]}".encode())
+            finally:
+                clients.discard(writer)
+                writer.close()
+
+        port = await self.start(chat)
+        args = parse_args(['--target', 'chat', '--port', str(port), '--connections', '4',
+                           '--concurrency', '4', '--requests', '5', '--think', '0.02'])
+        stats = await run_load(args)
+        self.assertEqual(stats.completed, 4)
+        self.assertEqual(len(stats.request_latency), 4)
+        self.assertGreater(len(stats.delivery_latency), 0)
+        self.assertTrue(all(0 <= latency < 5 for latency in stats.delivery_latency))
+
+class EchoHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while data := self.request.recv(65536):
+            self.request.sendall(data)
+
+class TestReport(unittest.TestCase):
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), EchoHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.dir.cleanup()
+
+    def test_json_report_and_compare(self):
+        port = str(self.server.server_address[1])
+        paths = []
+        for rate in ('0', '200'):
+            args = parse_args(['--port', port, '--connections', '20', '--rate', rate])
+            report = load_generator.run(args)
+            self.assertEqual(report['connections']['completed'], 20)
+            self.assertEqual(report['latency_ms']['request']['count'], 20)
+            paths.append(os.path.join(self.dir.name, f'rate{rate}.json'))
+            with open(paths[-1], 'w') as f:
+                json.dump(report, f)
+
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            load_generator.compare(*paths)
+        self.assertIn('connections_per_s', out.getvalue())
+        self.assertIn('request p999 ms', out.getvalue())
+
+if __name__ == "__main__":
+    unittest.main()
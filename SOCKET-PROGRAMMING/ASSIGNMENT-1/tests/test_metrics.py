@@ -0,0 +1,77 @@
+import unittest
+import asyncio
+import sys
+import os
+import threading
+
+# Add parent directory to path so we can import metrics
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import common_path  # Shared modules, see common_path.py
+from metrics import Registry, start_metrics_server
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counters_from_many_threads(self):
+        counter = self.registry.counter('requests_total', "Requests")
+        threads = [threading.Thread(target=lambda: [counter.inc() for _ in range(1000)]) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.inc(5)
+        self.assertEqual(counter.value, 8005)
+        # Cells of finished threads are folded into one total
+        self.assertEqual(len(counter.cells), 1)
+        self.assertEqual(counter.value, 8005)
+
+    def test_same_name_and_labels_is_the_same_metric(self):
+        a = self.registry.counter('bytes_total', "Bytes", direction='in')
+        self.assertIs(self.registry.counter('bytes_total', "Bytes", direction='in'), a)
+        self.assertIsNot(self.registry.counter('bytes_total', "Bytes", direction='out'), a)
+        with self.assertRaises(ValueError):
+            self.registry.histogram('bytes_total', "Bytes", direction='in')
+
+    def test_text_format(self):
+        self.registry.counter('bytes_total', "Bytes", direction='in').inc(10)
+        self.registry.counter('bytes_total', "Bytes", direction='out').inc(3)
+        histogram = self.registry.histogram('latency_seconds', "Latency", buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+        self.registry.gauge('tracked', "Tracked \"IPs\"", lambda: 7, pool='a"b')
+        lines = self.registry.render().splitlines()
+        self.assertEqual(lines[:4], ['# HELP bytes_total Bytes', '# TYPE bytes_total counter',
+                                     'bytes_total{direction="in"} 10', 'bytes_total{direction="out"} 3'])
+        self.assertIn('latency_seconds_bucket{le="0.1"} 2', lines)
+        self.assertIn('latency_seconds_bucket{le="1"} 3', lines)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 4', lines)
+        self.assertIn('latency_seconds_sum 2.65', lines)
+        self.assertIn('latency_seconds_count 4', lines)
+        self.assertIn('tracked{pool="a\\"b"} 7', lines)
+
+class TestEndpoint(unittest.IsolatedAsyncioTestCase):
+    async def get(self, port, path):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+        response = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        return response
+
+    async def test_scrape(self):
+        registry = Registry()
+        registry.counter('up_total', "Up").inc()
+        server = await start_metrics_server('127.0.0.1', 0, registry)
+        self.addCleanup(server.close)
+        port = server.sockets[0].getsockname()[1]
+
+        response = await self.get(port, '/metrics')
+        head, body = response.split(b'\r\n\r\n', 1)
+        self.assertTrue(head.startswith(b'HTTP/1.0 200 OK'))
+        self.assertIn(b'Content-Type: text/plain; version=0.0.4', head)
+        self.assertIn(b'\nup_total 1\n', body)
+        self.assertTrue((await self.get(port, '/other')).startswith(b'HTTP/1.0 404'))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,211 @@
+"""
+Backend (upstream) selection for the DoS proxy.
+
+The pool spreads allowed connections over several backends, keeps a few
+pre-connected ("warm") sockets per backend so clients do not wait for the
+backend handshake, and health-checks backends so dead ones are ejected
+until they recover.
+
+Warm sockets are handed out once and never reused: each proxied client
+gets its own backend TCP stream, exactly as with a fresh connection.
+"""
+
+import asyncio
+import logging
+import socket
+import time
+from collections import deque
+
+import common_path  # Shared modules, see common_path.py
+from metrics import registry
+
+
+class Upstream:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.active = 0  # Sessions currently using this backend
+        self.warm = deque()  # Pre-connected sockets
+
+        # Stats for reporting
+        self.connects = 0
+        self.failures = 0
+        self.warm_hits = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_ewma = 0.0
+        self.connect_seconds = registry.histogram(
+            'dos_backend_connect_seconds', "Time to open a TCP connection to a backend", backend=self.address
+        )
+
+    @property
+    def address(self):
+        return f"{self.host}:{self.port}"
+
+    def record_latency(self, seconds):
+        self.connect_seconds.observe(seconds)
+        self.connects += 1
+        self.latency_total += seconds
+        self.latency_max = max(self.latency_max, seconds)
+        if self.connects == 1:
+            self.latency_ewma = seconds
+        else:
+            self.latency_ewma = 0.8 * self.latency_ewma + 0.2 * seconds
+
+    def stats(self):
+        return {
+            'address': self.address,
+            'healthy': self.healthy,
+            'active': self.active,
+            'warm': len(self.warm),
+            'connects': self.connects,
+            'failures': self.failures,
+            'warm_hits': self.warm_hits,
+            'latency_avg_ms': 1000 * self.latency_total / self.connects if self.connects else 0.0,
+            'latency_ewma_ms': 1000 * self.latency_ewma,
+            'latency_max_ms': 1000 * self.latency_max,
+        }
+
+
+def socket_is_open(sock):
+    """True if a connected (non-blocking) socket has not been closed by the peer."""
+    try:
+        return sock.recv(1, socket.MSG_PEEK) != b''
+    except (BlockingIOError, InterruptedError):
+        return True
+    except OSError:
+        return False
+
+
+class UpstreamPool:
+    def __init__(self, backends, strategy='round_robin', warm_connections=0,
+                 max_failures=3, connect_timeout=2.0):
+        if strategy not in ('round_robin', 'least_connections'):
+            raise ValueError(f"Unknown load balancing strategy '{strategy}'")
+        self.upstreams = [Upstream(host, port) for host, port in backends]
+        self.strategy = strategy
+        self.warm_connections = warm_connections
+        self.max_failures = max_failures
+        self.connect_timeout = connect_timeout
+        self.next_index = 0
+        self.refilling = set()
+
+    def candidates(self):
+        """Healthy upstreams in selection order (all of them if none are healthy)."""
+        healthy = [u for u in self.upstreams if u.healthy] or self.upstreams
+        if self.strategy == 'least_connections':
+            return sorted(healthy, key=lambda u: u.active)
+        start = self.next_index % len(healthy)
+        self.next_index += 1
+        return healthy[start:] + healthy[:start]
+
+    async def open_socket(self, upstream):
+        """Open a new non-blocking connection, recording the connect latency."""
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, (upstream.host, upstream.port)), self.connect_timeout)
+        except (OSError, asyncio.TimeoutError):
+            sock.close()
+            raise
+        upstream.record_latency(time.perf_counter() - started)
+        return sock
+
+    def take_warm(self, upstream):
+        while upstream.warm:
+            sock = upstream.warm.popleft()
+            if socket_is_open(sock):
+                upstream.warm_hits += 1
+                return sock
+            sock.close()
+        return None
+
+    async def acquire(self):
+        """
+        Get a connected backend socket.
+        Returns:
+            tuple: (upstream, socket). Call release(upstream) when done.
+        Raises:
+            OSError: if no backend accepted the connection.
+        """
+        last_error = None
+        for upstream in self.candidates():
+            sock = self.take_warm(upstream)
+            if sock is None:
+                try:
+                    sock = await self.open_socket(upstream)
+                except (OSError, asyncio.TimeoutError) as e:
+                    self.mark_failed(upstream, e)
+                    last_error = e
+                    continue
+                self.mark_ok(upstream)
+            upstream.active += 1
+            self.schedule_refill(upstream)
+            return upstream, sock
+        raise OSError(f"No backend available: {last_error}")
+
+    def release(self, upstream):
+        upstream.active -= 1
+
+    def mark_failed(self, upstream, error):
+        upstream.failures += 1
+        upstream.consecutive_failures += 1
+        if upstream.healthy and upstream.consecutive_failures >= self.max_failures:
+            upstream.healthy = False
+            logging.warning("Backend %s ejected after %d failures: %s", upstream.address, upstream.consecutive_failures, error)
+            while upstream.warm:
+                upstream.warm.popleft().close()
+
+    def mark_ok(self, upstream):
+        upstream.consecutive_failures = 0
+        if not upstream.healthy:
+            upstream.healthy = True
+            logging.info("Backend %s is healthy again", upstream.address)
+
+    def schedule_refill(self, upstream):
+        if self.warm_connections and upstream.healthy and upstream not in self.refilling:
+            self.refilling.add(upstream)
+            asyncio.get_running_loop().create_task(self.refill(upstream))
+
+    async def refill(self, upstream):
+        """Top up the warm sockets for one upstream."""
+        try:
+            while upstream.healthy and len(upstream.warm) < self.warm_connections:
+                try:
+                    sock = await self.open_socket(upstream)
+                except (OSError, asyncio.TimeoutError) as e:
+                    self.mark_failed(upstream, e)
+                    return
+                self.mark_ok(upstream)
+                upstream.warm.append(sock)
+        finally:
+            self.refilling.discard(upstream)
+
+    async def check(self, upstream):
+        """Health check: a backend is healthy if it accepts a TCP connection."""
+        try:
+            sock = await self.open_socket(upstream)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.mark_failed(upstream, e)
+            return False
+        sock.close()
+        self.mark_ok(upstream)
+        self.schedule_refill(upstream)
+        return True
+
+    async def health_check_loop(self, interval):
+        while True:
+            await asyncio.gather(*(self.check(u) for u in self.upstreams))
+            await asyncio.sleep(interval)
+
+    def stats(self):
+        return [u.stats() for u in self.upstreams]
+
+    def close(self):
+        for upstream in self.upstreams:
+            while upstream.warm:
+                upstream.warm.popleft().close()
@@ -1,29 +1,267 @@
 
+import codecs
 import re
 import logging
+import time
 import config
+import common_path  # Shared modules, see common_path.py
+from metrics import registry
+
+# Inspection cost is reported per KB so small and large chunks compare
+INSPECTION_SECONDS_PER_KB = registry.histogram(
+    'mathbc_sqli_inspection_seconds_per_kb', "SQL injection scan time per KB of payload",
+    buckets=(0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.01)
+)
+DETECTIONS = registry.counter('mathbc_sqli_detections_total', "Payloads dropped for matching an SQL injection pattern")
+
+def record_inspection(seconds, nbytes):
+    if nbytes:
+        INSPECTION_SECONDS_PER_KB.observe(seconds * 1024 / nbytes)
+
+# Patterns were written for decoded text, where \s also matched the
+# \x1c-\x1f separators and Unicode spaces; on bytes it does not. \s is
+# rewritten to this class: ASCII whitespace plus the UTF-8 encodings of
+# U+0085, U+00A0, U+1680, U+2000-U+200A, U+2028, U+2029, U+202F, U+205F
+# and U+3000. Inside [...] only the ASCII part fits.
+ASCII_SPACE = r'\t\n\v\f\r\x1c-\x1f '
+TEXT_SPACE = (r'(?:[' + ASCII_SPACE + r']|\xc2[\x85\xa0]|\xe1\x9a\x80|'
+              r'\xe2\x80[\x80-\x8a\xa8\xa9\xaf]|\xe2\x81\x9f|\xe3\x80\x80)')
+# The same Unicode spaces, each as its UTF-8 bytes
+WIDE_SPACES = tuple(chr(c).encode() for c in (0x85, 0xa0, 0x1680, *range(0x2000, 0x200b),
+                                               0x2028, 0x2029, 0x202f, 0x205f, 0x3000))
+
+def bytes_pattern(pattern):
+    """
+    Translate a pattern written for str to one with the same whitespace
+    semantics on raw bytes.
+    Returns:
+        bytes: the pattern, ready for re.compile().
+    """
+    out = []
+    in_class = False
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\' and i + 1 < len(pattern):
+            escape = pattern[i:i + 2]
+            if escape == r'\s':
+                escape = ASCII_SPACE if in_class else TEXT_SPACE
+            out.append(escape)
+            i += 2
+            continue
+        if char == '[' and not in_class:
+            # A ']' right after '[' or '[^' is a literal, not the end
+            end = i + 1
+            if pattern[end:end + 1] == '^':
+                end += 1
+            if pattern[end:end + 1] == ']':
+                end += 1
+            out.append(pattern[i:end])
+            in_class = True
+            i = end
+            continue
+        if char == ']' and in_class:
+            in_class = False
+        out.append(char)
+        i += 1
+    return ''.join(out).encode()
+
+def text_bytes(data, final=True):
+    """
+    The payload as the patterns see it. They were written for text decoded
+    with errors='ignore', so bytes that are not valid UTF-8 are dropped.
+    With final=False an incomplete sequence at the end is kept as it is,
+    for the next chunk to complete.
+    Returns:
+        bytes: `data` itself when it is valid UTF-8 (the common case).
+    """
+    data = data if isinstance(data, bytes) else bytes(data)
+    if data.isascii():
+        return data
+    try:
+        codecs.utf_8_decode(data, 'strict', final)
+        return data
+    except UnicodeDecodeError:
+        text, consumed = codecs.utf_8_decode(data, 'ignore', final)
+        return text.encode() + data[consumed:]
+
+class SQLiRule:
+    def __init__(self, index, pattern, anchors=None):
+        self.index = index
+        self.pattern = pattern
+        self.regex = re.compile(bytes_pattern(pattern), re.IGNORECASE)
+        self.anchors = [a.lower().encode() for a in anchors] if anchors else None
+
+    def first_anchor(self, lowered):
+        """Offset of the earliest anchor in the lowercased payload, or -1."""
+        if self.anchors is None:
+            return 0
+        first = -1
+        for anchor in self.anchors:
+            pos = lowered.find(anchor)
+            if pos >= 0 and (first < 0 or pos < first):
+                first = pos
+        return first
+
+class SQLiMatcher:
+    """
+    Matches all SQL injection rules against raw bytes.
+
+    The payload is lowercased once and searched for each rule's literal
+    anchors (fast C-level substring search). A rule's regex only runs when
+    one of its anchors is present, starting at the first anchor. Rules are
+    tried in config order, so the rule reported is the same one the old
+    one-regex-at-a-time loop would have reported.
+    """
+
+    def __init__(self, patterns, anchors=None):
+        anchors = list(anchors or [])
+        anchors += [None] * (len(patterns) - len(anchors))
+        self.rules = [SQLiRule(i, p, a) for i, (p, a) in enumerate(zip(patterns, anchors))]
+        # Hashable description, so worker processes can rebuild the same matcher
+        self.spec = (tuple(patterns), tuple(tuple(a) if a else None for a in anchors))
+
+    def search(self, data, lowered=None):
+        """
+        Search `data`, already passed through text_bytes().
+        Returns:
+            SQLiRule: the first rule matching the payload, or None.
+        """
+        if lowered is None:
+            lowered = (data if isinstance(data, (bytes, bytearray)) else bytes(data)).lower()
+        for rule in self.rules:
+            start = rule.first_anchor(lowered)
+            if start >= 0 and rule.regex.search(data, start):
+                return rule
+        return None
+
+# Whitespace and '+' runs may be any length inside a match ("UNION    SELECT").
+# A run is counted in characters, so runs of Unicode spaces collapse too.
+RUN_UNITS = [rb'[\t\n\v\f\r\x1c-\x1f +]'] + [re.escape(space) for space in WIDE_SPACES]
+RUN = re.compile(b'(?:' + b'|'.join(RUN_UNITS) + b'){2,}')
+# A run read backwards, from where it ends
+RUN_BACKWARDS = re.compile(b'(?:' + b'|'.join(RUN_UNITS[:1] + [re.escape(space[::-1]) for space in WIDE_SPACES]) + b')*')
+
+def collapse_run(match):
+    """Shortest run every pattern treats the same way as the original run."""
+    run = match.group()
+    return (b'+' if b'+' in run else b'') + (b'\n' if b'\n' in run else b' ')
+
+class StreamInspector:
+    """
+    Per-connection SQL injection inspection across recv() boundaries.
+
+    Each chunk is searched together with a short tail of the bytes before
+    it, so a pattern split over two reads ("UNI" | "ON SELECT") is still
+    found. The tail is bounded: whitespace runs in it are collapsed (the
+    patterns accept runs of any length) and, for the "=" pattern that may
+    span a whole line, only whether an opener is pending on the current
+    line is remembered. Work per chunk is O(chunk + overlap).
+    """
+
+    def __init__(self, matcher, overlap, line_openers=()):
+        self.matcher = matcher
+        self.overlap = overlap
+        self.line_openers = [o.lower().encode() for o in line_openers]
+        self.max_opener = max((len(o) for o in self.line_openers), default=1)
+        self.tail = b''
+        self.bytes_inspected = 0
+
+    def feed(self, data):
+        """
+        Inspect the next chunk of the stream.
+        Returns:
+            SQLiRule: the rule that fired, or None if the stream is clean so far.
+        """
+        # The tail may end in part of a character that this chunk completes
+        window = text_bytes(self.tail + bytes(data), final=False)
+        self.bytes_inspected += len(data)
+
+        rule = self.matcher.search(window)
+        if rule is not None:
+            return rule
+        self.tail = self.next_tail(window)
+        return None
+
+    def next_tail(self, window):
+        # Walk back until the collapsed suffix holds `overlap` bytes, so a
+        # long run cannot push the start of a match out of the tail. Steps
+        # never end inside a character or a run, so the collapsed pieces
+        # join up exactly.
+        backwards = window[::-1]
+        start = len(window)
+        tail = b''
+        while start > 0 and len(tail) < self.overlap:
+            end = start
+            start = max(0, start - self.overlap)
+            while start > 0 and 0x80 <= window[start] < 0xc0:  # UTF-8 continuation byte
+                start -= 1
+            start = len(window) - RUN_BACKWARDS.match(backwards, len(window) - start).end()
+            tail = RUN.sub(collapse_run, window[start:end]) + tail
+
+        # An opener cut off before the tail still pairs with a terminator
+        # later on the same line. Nothing after it on this line can be a
+        # terminator (that would have matched), so one opener stands in for it.
+        line_start = window.rfind(b'\n') + 1
+        if line_start < start:
+            line = window[line_start:start + self.max_opener - 1].lower()
+            if any(0 <= line.find(o) < start - line_start for o in self.line_openers):
+                tail = self.line_openers[0] + tail
+        return tail
 
 class AppLayerFilter:
     def __init__(self):
-        self.sqli_regexes = [re.compile(p, re.IGNORECASE) for p in config.SQLI_PATTERNS]
+        self.matcher = SQLiMatcher(config.SQLI_PATTERNS, getattr(config, 'SQLI_ANCHORS', None))
+
+    def new_stream(self):
+        """
+        Scanning state for one direction of one connection. A stream keeps
+        the patterns it started with, even if they are replaced later.
+        """
+        return StreamInspector(self.matcher, config.SQLI_STREAM_OVERLAP, config.SQLI_LINE_OPENERS)
+
+    def set_patterns(self, patterns, anchors=None):
+        """Compile a new pattern set, then swap it in for new connections."""
+        matcher = SQLiMatcher(patterns, anchors)
+        self.matcher = matcher
 
-    def check_payload(self, data: bytes) -> bool:
+    def inspect(self, data):
         """
         Inspect the payload for SQL injection patterns.
+        Returns:
+            SQLiRule: the rule that fired, or None if the payload is clean.
+        """
+        return self.matcher.search(text_bytes(data))
+
+    def check_payload(self, data: bytes, stream=None) -> bool:
+        """
+        Inspect the payload for SQL injection patterns. With a stream from
+        new_stream(), data is treated as the next chunk of that stream.
         Returns:
             bool: True if safe, False if malicious pattern detected.
         """
+        started = time.perf_counter()
         try:
-            # Decode bytes to string for regex matching
-            # Best effort decoding; if binary, might fail or look garbage, but checking text protocols (HTTP)
-            content = data.decode('utf-8', errors='ignore')
-            
-            for regex in self.sqli_regexes:
-                if regex.search(content):
-                    logging.warning(f"SQL INJECTION DETECTED: Pattern {regex.pattern} matched in payload.")
-                    return False
-            return True
+            # Matching runs on the raw bytes, minus any that are not UTF-8
+            rule = stream.feed(data) if stream is not None else self.inspect(data)
         except Exception as e:
-            logging.error(f"Error inspecting payload: {e}")
-            return True # Fail open or closed? Let's fail open for stability in assignment, but log error.
+            self.log_error(e)
+            return True
+        record_inspection(time.perf_counter() - started, len(data))
+        return self.verdict(rule)
+
+    def verdict(self, rule):
+        """
+        Log a detection.
+        Returns:
+            bool: True if safe (no rule fired), False otherwise.
+        """
+        if rule is not None:
+            DETECTIONS.inc()
+            logging.warning("SQL INJECTION DETECTED: Rule %d (%s) matched in payload.", rule.index, rule.pattern)
+            return False
+        return True
 
+    def log_error(self, error):
+        logging.error("Error inspecting payload: %s", error)
+        # Fail open or closed? Let's fail open for stability in assignment, but log error.
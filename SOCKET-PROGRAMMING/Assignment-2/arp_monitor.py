@@ -1,31 +1,253 @@
+"""
+ARP table monitoring.
 
+Backends (config.ARP_BACKEND):
+  procfs  - reads /proc/net/arp (Linux). No process is started, and only
+            lines that changed since the previous poll are parsed, so a
+            poll of a 100k-entry table costs one file read and a set
+            difference.
+  command - runs `arp -a` and parses its output with regexes. Works on
+            Windows and macOS as well; used when /proc is not available.
+  auto    - procfs where it exists, else command.
+
+On Linux the monitor can also subscribe to rtnetlink neighbour events
+(config.ARP_NEIGHBOR_EVENTS). The kernel then pushes every new, changed
+or deleted entry as it happens, so a MAC change between two polls is still seen.
+The poll keeps running as a safety net, and after the kernel drops events
+(the socket buffer overflowed) the next poll re-checks the whole table.
+
+Detection. Every MAC change of an IP is recorded in that IP's MacHistory,
+a fixed-size ring. After each batch of entries, three checks decide which
+source IPs get a verdict:
+  flapping      - an IP changed MAC ARP_FLAP_LIMIT times within
+                  ARP_FLAP_WINDOW seconds
+  duplicate MAC - one MAC answers for more than ARP_DUPLICATE_MAC_LIMIT
+                  IPs (the expected gateway MAC is exempt)
+  gateway       - the gateway's MAC is not EXPECTED_GATEWAY_MAC; the
+                  gateway IP and every IP using the impostor MAC are flagged
+Entries that leave the ARP table (or fail to resolve) are forgotten, so
+the tables above only hold IPs the host currently knows. A verdict stays
+while its check still holds. The flagged IPs are handed to
+FirewallCore.set_arp_blocked(), which swaps in a new frozenset, so the
+connection path checks them without a lock.
+"""
+
+import errno
 import logging
+import os
+import select
+import socket
+import struct
 import time
 import threading
+from array import array
 import config
 import platform
 import subprocess
 import re
+import common_path  # Shared modules, see common_path.py
+from metrics import registry
+
+PROC_ARP = '/proc/net/arp'
+PROC_ROUTE = '/proc/net/route'
+ATF_COM = 0x2 # /proc/net/arp flag: entry is complete (has a MAC)
+RTF_GATEWAY = 0x2 # /proc/net/route flag: route goes through a gateway
+
+ALERTS = {kind: registry.counter('mathbc_arp_alerts_total', "Source IPs given an ARP spoofing verdict", kind=kind)
+          for kind in ('flapping', 'duplicate_mac', 'gateway')}
+
+# rtnetlink (linux/rtnetlink.h, linux/neighbour.h)
+RTMGRP_NEIGH = 0x4
+RTM_NEWNEIGH = 28
+RTM_DELNEIGH = 29
+NLMSG_HEADER = struct.Struct('=IHHII') # length, type, flags, seq, pid
+NDMSG = struct.Struct('=BxxxiHBB') # family, ifindex, state, flags, type
+RTATTR = struct.Struct('=HH') # length, type
+NDA_DST = 1
+NDA_LLADDR = 2
+NUD_INCOMPLETE = 0x01
+NUD_FAILED = 0x20
+
+def parse_proc_arp_line(line):
+    """
+    Parses one line of /proc/net/arp:
+    IP address  HW type  Flags  HW address  Mask  Device
+    Returns:
+        tuple: (ip, mac), or None for an incomplete entry or a malformed line.
+    """
+    fields = line.split()
+    if len(fields) < 4:
+        return None
+    try:
+        flags = int(fields[2], 16)
+    except ValueError:
+        return None
+    if not flags & ATF_COM:
+        return None
+    return fields[0], fields[3]
+
+def default_gateway(path=PROC_ROUTE):
+    """
+    The IPv4 default gateway from the routing table (Linux).
+    Returns:
+        str: its address, or None if there is none or the table cannot be read.
+    """
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()[1:]
+    except OSError:
+        return None
+    for line in lines:
+        fields = line.split()
+        if len(fields) >= 4 and fields[1] == '00000000' and int(fields[3], 16) & RTF_GATEWAY:
+            # Addresses are hex in host (little-endian) byte order
+            return socket.inet_ntoa(struct.pack('<I', int(fields[2], 16)))
+    return None
+
+def mac_to_int(mac):
+    return int(mac.replace(':', '').replace('-', ''), 16)
+
+def int_to_mac(value):
+    return ':'.join(f'{b:02X}' for b in value.to_bytes(6, 'big'))
+
+class MacHistory:
+    """
+    The last `size` MAC changes of one IP, oldest overwritten first. Times
+    and MACs (as 48-bit integers) live in two fixed arrays, 16 bytes per
+    change, so an IP's history never grows.
+    """
+    __slots__ = ('times', 'macs', 'next', 'count')
+
+    def __init__(self, size):
+        self.times = array('d', bytes(8 * size))
+        self.macs = array('Q', bytes(8 * size))
+        self.next = 0 # Slot the next change goes into
+        self.count = 0
+
+    def record(self, mac, when):
+        self.times[self.next] = when
+        self.macs[self.next] = mac
+        self.next = (self.next + 1) % len(self.times)
+        self.count = min(self.count + 1, len(self.times))
+
+    @property
+    def latest(self):
+        return self.times[self.next - 1] if self.count else 0.0
+
+    def changes_since(self, cutoff):
+        """Number of recorded changes at or after `cutoff`."""
+        return sum(1 for when in self.times[:self.count] if when >= cutoff)
+
+    def recent(self):
+        """
+        Returns:
+            list: (time, MAC string) of the recorded changes, oldest first.
+        """
+        start = self.next if self.count == len(self.times) else 0
+        order = [(start + i) % len(self.times) for i in range(self.count)]
+        return [(self.times[i], int_to_mac(self.macs[i])) for i in order]
+
+def align(length):
+    return (length + 3) & ~3
+
+def parse_neighbor_message(data, start, end, deleted=False):
+    """
+    Parses the ndmsg and attributes of one RTM_NEWNEIGH or RTM_DELNEIGH message.
+    Returns:
+        tuple: (ip, mac) for a resolved IPv4 neighbour, (ip, None) for one
+        that was deleted or failed to resolve, else None.
+    """
+    if end - start < NDMSG.size:
+        return None
+    family, _, state, _, _ = NDMSG.unpack_from(data, start)
+    if family != socket.AF_INET or (state & NUD_INCOMPLETE and not deleted):
+        return None
+    gone = deleted or bool(state & NUD_FAILED)
+    ip = mac = None
+    pos = start + NDMSG.size
+    while pos + RTATTR.size <= end:
+        attr_len, attr_type = RTATTR.unpack_from(data, pos)
+        if attr_len < RTATTR.size:
+            break
+        value = data[pos + RTATTR.size:pos + attr_len]
+        if attr_type == NDA_DST and len(value) == 4:
+            ip = socket.inet_ntoa(value)
+        elif attr_type == NDA_LLADDR and len(value) == 6:
+            mac = ':'.join(f'{b:02x}' for b in value)
+        pos += align(attr_len)
+    if ip and gone:
+        return ip, None
+    if ip and mac:
+        return ip, mac
+    return None
+
+def parse_neighbor_messages(data):
+    """
+    Parses a datagram from an rtnetlink socket (several messages may share one).
+    Returns:
+        list: (ip, mac) of every new or changed IPv4 neighbour in it, and
+        (ip, None) of every one that is gone.
+    """
+    entries = []
+    offset = 0
+    while offset + NLMSG_HEADER.size <= len(data):
+        length, msg_type, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+        if length < NLMSG_HEADER.size:
+            break
+        if msg_type in (RTM_NEWNEIGH, RTM_DELNEIGH):
+            entry = parse_neighbor_message(data, offset + NLMSG_HEADER.size, min(offset + length, len(data)),
+                                           deleted=msg_type == RTM_DELNEIGH)
+            if entry:
+                entries.append(entry)
+        offset += align(length)
+    return entries
 
 class ARPMonitor:
-    def __init__(self):
+    def __init__(self, backend=None, proc_path=PROC_ARP, firewall_core=None, gateway_ip=None):
         self.running = False
         self.known_macs = {} # IP -> MAC
+        self.mac_counts = {} # MAC -> number of IPs using it
+        self.history = {} # IP -> MacHistory, for IPs whose MAC has changed
+        self.crowded = {} # MAC used by too many IPs -> frozenset of those IPs
+        self.verdicts = {} # Flagged IP -> (kind, reason)
+        # Receives the flagged IPs (set_arp_blocked); None = detect and log only
+        self.firewall_core = firewall_core
+        self.gateway_ip = gateway_ip or config.ARP_GATEWAY_IP or default_gateway()
+        self.gateway_mac = config.EXPECTED_GATEWAY_MAC.upper() if config.EXPECTED_GATEWAY_MAC else None
+        self.proc_path = proc_path
+        backend = backend or config.ARP_BACKEND
+        if backend == 'auto':
+            backend = 'procfs' if os.path.exists(proc_path) else 'command'
+        if backend not in ('procfs', 'command'):
+            raise ValueError(f"Unknown ARP backend '{backend}' (use 'procfs', 'command' or 'auto')")
+        self.backend = backend
+        self.seen_lines = frozenset() # procfs lines already checked
+        self.events = None # rtnetlink socket, while monitoring
 
     def get_arp_table(self):
         """
         Retrieves ARP table from OS.
         Returns list of (ip, mac) tuples.
         """
+        if self.backend == 'procfs':
+            lines = self.read_proc_lines()
+            return [entry for entry in map(parse_proc_arp_line, lines or []) if entry]
+        return self.get_arp_table_command() or []
+
+    def get_arp_table_command(self):
+        """
+        Retrieves ARP table by running `arp -a`.
+        Returns list of (ip, mac) tuples, or None if the command failed.
+        """
         entries = []
         try:
             # Command varies by OS. Linux/Mac 'arp -a', Windows 'arp -a'
             output = subprocess.check_output(['arp', '-a']).decode()
-            
+
             # Simple parsing for standard output formats
             # Windows: 192.168.1.1           00-11-22-33-44-55     dynamic
             # Linux: ? (192.168.1.1) at 00:11:22:33:44:55 [ether] on eth0
-            
+
             lines = output.split('\n')
             for line in lines:
                 # Find IP and MAC
@@ -33,41 +255,230 @@ class ARPMonitor:
                 ip_match = re.search(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}', line)
                 # Regex for MAC
                 mac_match = re.search(r'([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})', line)
-                
+
                 if ip_match and mac_match:
                     entries.append((ip_match.group(0), mac_match.group(0)))
         except Exception as e:
             logging.error(f"Failed to fetch ARP table: {e}")
+            return None
         return entries
 
-    def detect_conflicts(self, arp_entries):
+    def read_proc_lines(self):
+        """
+        Returns:
+            list: the entry lines of /proc/net/arp (header skipped), or None if it cannot be read.
+        """
+        try:
+            with open(self.proc_path) as f:
+                return f.read().splitlines()[1:]
+        except OSError as e:
+            logging.error("Failed to read %s: %s", self.proc_path, e)
+            return None
+
+    def changed_entries(self):
+        """
+        The entries that are new or changed since the previous call, then
+        the IPs that left the table as (ip, None). With the procfs backend,
+        unchanged lines are skipped without parsing; the command backend
+        returns the whole table every time.
+        Returns:
+            list: (ip, mac) tuples.
+        """
+        if self.backend != 'procfs':
+            entries = self.get_arp_table_command()
+            if entries is None:
+                return []
+            gone = self.known_macs.keys() - {ip for ip, _ in entries}
+            return entries + [(ip, None) for ip in sorted(gone)]
+        lines = self.read_proc_lines()
+        if lines is None:
+            return []
+        current = frozenset(lines)
+        entries = [entry for entry in map(parse_proc_arp_line, current - self.seen_lines) if entry]
+        if self.seen_lines:
+            # Only IPs whose line changed can have left
+            removed = {entry[0] for entry in map(parse_proc_arp_line, self.seen_lines - current) if entry}
+        else:
+            # A full check: every IP not in the table has left
+            removed = set(self.known_macs)
+        self.seen_lines = current
+        gone = removed - {ip for ip, _ in entries}
+        return entries + [(ip, None) for ip in sorted(gone)]
+
+    def detect_conflicts(self, arp_entries, now=None):
         """
         Analyzes ARP entries for conflicts (same IP, different MAC changing frequently)
-        or Duplicate MACs (Simulating ARP Spoofing detection).
+        or Duplicate MACs, then updates the verdicts. Called after every poll,
+        even with no entries, so verdicts whose check no longer holds expire.
+        An entry with no MAC removes its IP.
         """
-        current_map = {}
+        now = time.monotonic() if now is None else now
+        touched_macs = set()
         for ip, mac in arp_entries:
+            if mac is None:
+                last_mac = self.known_macs.pop(ip, None)
+                if last_mac is not None:
+                    self.forget_mac(last_mac)
+                    touched_macs.add(last_mac)
+                continue
             # Normalization
             mac = mac.replace('-', ':').upper()
-            
-            if ip in self.known_macs:
-                last_mac = self.known_macs[ip]
-                if last_mac != mac:
-                    # MAC changed for the same IP! Possible Spoofing.
-                    logging.warning(f"ARP SPOOFING ALERT: IP {ip} changed MAC from {last_mac} to {mac}")
-                    # In a real IPS, we would block this MAC or IP.
-            
-            current_map[ip] = mac
-        
-        # Update state
-        self.known_macs.update(current_map)
+
+            last_mac = self.known_macs.get(ip)
+            if last_mac == mac:
+                continue
+            if last_mac is not None:
+                # MAC changed for the same IP! Possible Spoofing.
+                logging.warning("ARP SPOOFING ALERT: IP %s changed MAC from %s to %s", ip, last_mac, mac)
+                history = self.history.get(ip)
+                if history is None:
+                    history = self.history[ip] = MacHistory(config.ARP_HISTORY_SIZE)
+                history.record(mac_to_int(mac), now)
+                self.forget_mac(last_mac)
+                touched_macs.add(last_mac)
+            self.known_macs[ip] = mac
+            self.mac_counts[mac] = self.mac_counts.get(mac, 0) + 1
+            touched_macs.add(mac)
+
+        self.update_crowded(touched_macs)
+        self.update_verdicts(now)
+
+    def forget_mac(self, mac):
+        """One IP fewer uses `mac`."""
+        self.mac_counts[mac] -= 1
+        if not self.mac_counts[mac]:
+            del self.mac_counts[mac]
+
+    def update_crowded(self, touched_macs):
+        """Re-check the duplicate-MAC condition for MACs whose IPs changed."""
+        stale = set()
+        for mac in touched_macs:
+            if self.mac_counts.get(mac, 0) > config.ARP_DUPLICATE_MAC_LIMIT and mac != self.gateway_mac:
+                stale.add(mac)
+            else:
+                self.crowded.pop(mac, None)
+        if stale:
+            # One pass over the table finds the IPs of every crowded MAC
+            owners = {mac: [] for mac in stale}
+            for ip, mac in self.known_macs.items():
+                if mac in owners:
+                    owners[mac].append(ip)
+            for mac, ips in owners.items():
+                self.crowded[mac] = frozenset(ips)
+
+    def find_verdicts(self, now):
+        """
+        Returns:
+            dict: IP -> (kind, reason) for every IP a check currently flags.
+        """
+        verdicts = {}
+        cutoff = now - config.ARP_FLAP_WINDOW
+        departed = []
+        for ip, history in self.history.items():
+            if history.latest < cutoff:
+                if ip not in self.known_macs:
+                    departed.append(ip)
+                continue
+            changes = history.changes_since(cutoff)
+            if changes >= config.ARP_FLAP_LIMIT:
+                macs = ', '.join(mac for _, mac in history.recent()[-changes:])
+                verdicts[ip] = ('flapping', f"MAC changed {changes} times in {config.ARP_FLAP_WINDOW}s: {macs}")
+        # The history of an IP that left stays until it can no longer flag it
+        for ip in departed:
+            del self.history[ip]
+        for mac, ips in self.crowded.items():
+            for ip in ips:
+                verdicts.setdefault(ip, ('duplicate_mac', f"MAC {mac} answers for {len(ips)} IPs"))
+        current = self.known_macs.get(self.gateway_ip)
+        if self.gateway_mac and current and current != self.gateway_mac:
+            reason = f"gateway {self.gateway_ip} is at {current}, expected {self.gateway_mac}"
+            verdicts[self.gateway_ip] = ('gateway', reason)
+            for ip, mac in self.known_macs.items():
+                if mac == current:
+                    verdicts.setdefault(ip, ('gateway', reason))
+        return verdicts
+
+    def update_verdicts(self, now):
+        verdicts = self.find_verdicts(now)
+        if verdicts.keys() == self.verdicts.keys():
+            self.verdicts = verdicts
+            return
+        for ip, (kind, reason) in verdicts.items():
+            if ip not in self.verdicts:
+                ALERTS[kind].inc()
+                logging.warning("ARP VERDICT: denying %s (%s)", ip, reason)
+        for ip in self.verdicts.keys() - verdicts.keys():
+            logging.info("ARP verdict for %s cleared", ip)
+        self.verdicts = verdicts
+        if self.firewall_core is not None and config.ARP_BLOCK_SPOOFED:
+            self.firewall_core.set_arp_blocked(verdicts)
+
+    def open_neighbor_events(self):
+        """
+        Subscribes to rtnetlink neighbour events.
+        Returns:
+            socket.socket: non-blocking netlink socket, or None where unsupported.
+        """
+        if not config.ARP_NEIGHBOR_EVENTS or not hasattr(socket, 'AF_NETLINK'):
+            return None
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        except OSError as e:
+            logging.warning("ARP neighbour events unavailable, polling only: %s", e)
+            return None
+        try:
+            sock.bind((0, RTMGRP_NEIGH))
+            sock.setblocking(False)
+        except OSError as e:
+            sock.close()
+            logging.warning("ARP neighbour events unavailable, polling only: %s", e)
+            return None
+        return sock
+
+    def read_neighbor_events(self):
+        """
+        Drains the netlink socket.
+        Returns:
+            list: (ip, mac) of the neighbours the kernel reported, (ip, None) for deletions.
+        """
+        entries = []
+        while True:
+            try:
+                data = self.events.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                return entries
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                # Events were lost: have the next poll check every entry
+                logging.warning("ARP neighbour events overflowed; re-checking the whole table")
+                self.seen_lines = frozenset()
+                return entries
+            entries.extend(parse_neighbor_messages(data))
 
     def monitor_loop(self):
-        logging.info("ARP Monitor started.")
-        while self.running:
-            entries = self.get_arp_table()
-            self.detect_conflicts(entries)
-            time.sleep(config.ARP_CHECK_INTERVAL)
+        self.events = self.open_neighbor_events()
+        logging.info("ARP Monitor started (%s backend, %s, gateway %s).", self.backend,
+                     "neighbour events" if self.events else "polling only", self.gateway_ip or "unknown")
+        next_poll = 0
+        try:
+            while self.running:
+                now = time.monotonic()
+                if now >= next_poll:
+                    self.detect_conflicts(self.changed_entries())
+                    next_poll = now + config.ARP_CHECK_INTERVAL
+                wait = max(0, next_poll - time.monotonic())
+                if self.events is None:
+                    time.sleep(wait)
+                    continue
+                # Events arrive as they happen; the poll runs when select times out
+                readable, _, _ = select.select([self.events], [], [], wait)
+                if readable:
+                    self.detect_conflicts(self.read_neighbor_events())
+        finally:
+            if self.events is not None:
+                self.events.close()
+                self.events = None
 
     def start(self):
         self.running = True
@@ -0,0 +1,257 @@
+"""
+Benchmark: many idle connections plus a set of active ones, per engine.
+
+For each engine the script starts an asyncio echo backend and the
+firewall in separate processes, then
+  1. opens --idle connections that send nothing and stay open,
+  2. runs --active connections that each send a request and wait for the
+     echo, back to back, for --duration seconds,
+and reports the request rate, latency percentiles and the firewall
+process's memory, thread and file descriptor counts.
+
+Usage:
+    python benchmark_concurrency.py [--engines asyncio threads] [--idle 10000] [--active 1000]
+
+Every connection costs the firewall two file descriptors, so 11k
+connections need `ulimit -n` above 22k. Lower --idle if the limit is
+smaller. Pass --ssl to measure with TLS (needs server.crt/server.key).
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import resource
+import socket
+import ssl
+import sys
+import time
+
+import config
+
+BENCH_FIREWALL_PORT = 18000
+BENCH_BACKEND_PORT = 19100
+OP_TIMEOUT = 5  # Seconds before a connect or reply counts as failed
+
+config.FIREWALL_HOST = '127.0.0.1'
+config.FIREWALL_PORT = BENCH_FIREWALL_PORT
+config.BACKEND_PORT = BENCH_BACKEND_PORT
+config.LOG_FILE = 'benchmark_firewall.log'
+# Every connection comes from 127.0.0.1 and the idle ones never send
+config.MAX_CONNECTIONS_PER_IP = None
+config.MAX_CONNECTIONS = None
+config.REQUEST_TIMEOUT = None
+config.MAX_UPLOAD_RATE_PER_IP = config.MAX_DOWNLOAD_RATE_PER_IP = None
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+async def echo(reader, writer):
+    try:
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+def run_backend():
+    raise_fd_limit()
+
+    async def serve():
+        server = await asyncio.start_server(echo, '127.0.0.1', BENCH_BACKEND_PORT, backlog=4096)
+        async with server:
+            await server.serve_forever()
+    asyncio.run(serve())
+
+
+def run_firewall(engine):
+    raise_fd_limit()
+    import logging
+    import mathbc_firewall
+    # Per-connection INFO lines would dominate the measurement
+    logging.getLogger().setLevel(logging.WARNING)
+    fw = mathbc_firewall.MathBCFirewall()
+    if engine == 'asyncio':
+        asyncio.run(fw.start_async())
+    else:
+        fw.start()
+
+
+def process_stats(pid):
+    """RSS (MB), threads and open file descriptors of a process (Linux)."""
+    stats = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    stats['rss_mb'] = int(line.split()[1]) / 1024
+                elif line.startswith('Threads:'):
+                    stats['threads'] = int(line.split()[1])
+        stats['fds'] = len(os.listdir(f'/proc/{pid}/fd'))
+    except OSError:
+        pass
+    return stats
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Port {port} did not come up")
+
+
+async def open_idle(count, ssl_context, parallel=200):
+    """Open `count` connections that stay silent. Returns (writers, failures)."""
+    writers = []
+    failures = 0
+    sem = asyncio.Semaphore(parallel)
+
+    async def one():
+        nonlocal failures
+        async with sem:
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_connection(
+                    '127.0.0.1', BENCH_FIREWALL_PORT, ssl=ssl_context,
+                    server_hostname='localhost' if ssl_context else None), OP_TIMEOUT)
+                writers.append(writer)
+            except (OSError, asyncio.TimeoutError):
+                failures += 1
+
+    await asyncio.gather(*(one() for _ in range(count)))
+    return writers, failures
+
+
+async def run_active(count, duration, payload, ssl_context):
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + duration
+
+    async def one():
+        nonlocal errors
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(
+                '127.0.0.1', BENCH_FIREWALL_PORT, ssl=ssl_context,
+                server_hostname='localhost' if ssl_context else None), OP_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            errors += 1
+            return
+        try:
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                writer.write(payload)
+                await writer.drain()
+                await asyncio.wait_for(reader.readexactly(len(payload)), OP_TIMEOUT)
+                latencies.append(time.perf_counter() - started)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            errors += 1
+        finally:
+            writer.close()
+
+    await asyncio.gather(*(one() for _ in range(count)))
+    return latencies, errors
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+async def measure(firewall_pid, idle, active, duration, payload, ssl_context):
+    started = time.monotonic()
+    idle_writers, idle_failures = await open_idle(idle, ssl_context)
+    open_time = time.monotonic() - started
+    await asyncio.sleep(1)  # Let the firewall finish its backend connects
+    at_idle = process_stats(firewall_pid)
+
+    latencies, errors = await run_active(active, duration, payload, ssl_context)
+    under_load = process_stats(firewall_pid)
+    for writer in idle_writers:
+        writer.close()
+
+    latencies.sort()
+    return {
+        'idle_open': len(idle_writers),
+        'idle_failed': idle_failures,
+        'idle_open_s': open_time,
+        'requests_per_s': len(latencies) / duration,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'active_errors': errors,
+        'rss_mb_idle': at_idle.get('rss_mb', 0),
+        'rss_mb_load': under_load.get('rss_mb', 0),
+        'threads': under_load.get('threads', 0),
+        'fds': under_load.get('fds', 0),
+    }
+
+
+def bench(engine, args):
+    ctx = multiprocessing.get_context('fork')
+    backend = ctx.Process(target=run_backend, daemon=True)
+    firewall = ctx.Process(target=run_firewall, args=(engine,), daemon=True)
+    backend.start()
+    wait_for_port(BENCH_BACKEND_PORT)
+    firewall.start()
+    wait_for_port(BENCH_FIREWALL_PORT)
+
+    ssl_context = None
+    if args.ssl:
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+
+    payload = b"3+3 " * (args.payload // 4) + b"\n"
+    try:
+        return asyncio.run(measure(firewall.pid, args.idle, args.active, args.duration, payload, ssl_context))
+    finally:
+        firewall.terminate()
+        backend.terminate()
+        firewall.join()
+        backend.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--engines', nargs='+', choices=['asyncio', 'threads'], default=['asyncio', 'threads'])
+    parser.add_argument('--idle', type=int, default=10000, help="connections held open without traffic")
+    parser.add_argument('--active', type=int, default=1000, help="connections sending requests back to back")
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--payload', type=int, default=64, help="request size in bytes")
+    parser.add_argument('--ssl', action='store_true', help="connect with TLS")
+    args = parser.parse_args()
+
+    config.ENABLE_SSL = args.ssl
+    limit = raise_fd_limit()
+    needed = 2 * (args.idle + args.active) + 100
+    if limit < needed:
+        sys.exit(f"Need about {needed} file descriptors per process, limit is {limit}: lower --idle/--active")
+
+    print(f"CPU cores: {os.cpu_count()}, {args.idle} idle + {args.active} active connections, "
+          f"{args.payload}-byte requests, TLS {'on' if args.ssl else 'off'}")
+    header = (f"{'engine':<8} {'idle ok':>8} {'failed':>7} {'open s':>7} {'req/s':>9} {'p50 ms':>8} "
+              f"{'p99 ms':>8} {'errors':>7} {'RSS MB':>7} {'threads':>8} {'fds':>6}")
+    print(header)
+    for engine in args.engines:
+        r = bench(engine, args)
+        print(f"{engine:<8} {r['idle_open']:>8} {r['idle_failed']:>7} {r['idle_open_s']:>7.1f} "
+              f"{r['requests_per_s']:>9.0f} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f} {r['active_errors']:>7} "
+              f"{r['rss_mb_load']:>7.0f} {r['threads']:>8} {r['fds']:>6}")
+
+
+if __name__ == '__main__':
+    main()
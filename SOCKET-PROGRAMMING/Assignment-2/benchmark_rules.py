@@ -0,0 +1,146 @@
+"""
+Benchmark for FirewallCore.evaluate_connection at 10, 1k and 100k rules.
+
+Compares three ways of finding the first matching rule:
+  legacy    - the original FirewallRule.matches, parsing addresses per call
+  linear    - a walk over the rules using the pre-parsed fields
+  compiled  - CompiledRuleTable (port/protocol buckets + prefix tables)
+  cached    - FirewallCore.evaluate_connection with its verdict cache, for
+              clients that reconnect (--repeat distinct addresses)
+
+The rule sets look like threat-feed blocklists: mostly single addresses
+and /24s, some /16s, a few port or protocol specific rules, and a final
+ALLOW for everything else.
+
+Usage:
+    python benchmark_rules.py [--rules 10 1000 100000] [--lookups 20000]
+"""
+
+import argparse
+import ipaddress
+import random
+import time
+
+from firewall_core import CompiledRuleTable, FirewallCore, FirewallRule
+
+PORT = 8000
+
+
+class LegacyRule(FirewallRule):
+    """FirewallRule.matches as originally written."""
+
+    def matches(self, client_ip, server_port, protocol='TCP'):
+        if self.src_ip and self.src_ip != '*':
+            if '/' in self.src_ip:
+                if ipaddress.ip_address(client_ip) not in ipaddress.ip_network(self.src_ip):
+                    return False
+            elif self.src_ip != client_ip:
+                return False
+        if self.dst_port and self.dst_port != '*':
+            if int(self.dst_port) != int(server_port):
+                return False
+        if self.protocol and self.protocol != '*':
+            if self.protocol != protocol.upper():
+                return False
+        return True
+
+
+def random_ip(rng):
+    return f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+
+
+def build_rules(count, rng):
+    specs = []
+    for _ in range(count - 1):
+        kind = rng.random()
+        ip = random_ip(rng)
+        if kind < 0.6:
+            src = ip
+        elif kind < 0.9:
+            src = str(ipaddress.ip_network(ip + '/24', strict=False))
+        else:
+            src = str(ipaddress.ip_network(ip + '/16', strict=False))
+        port = rng.choice(['*'] * 8 + [PORT, 22])
+        protocol = rng.choice(['*'] * 8 + ['TCP', 'UDP'])
+        specs.append(('DENY', src, port, protocol))
+    specs.append(('ALLOW', '*', '*', '*'))
+    return specs
+
+
+def build_lookups(specs, count, rng):
+    """Source addresses to evaluate; half of them fall inside a DENY rule."""
+    blocked = [ipaddress.ip_network(src) for _, src, _, _ in specs if src != '*']
+    ips = []
+    for _ in range(count):
+        if blocked and rng.random() < 0.5:
+            network = rng.choice(blocked)
+            ips.append(str(network.network_address + rng.randrange(network.num_addresses)))
+        else:
+            ips.append(random_ip(rng))
+    return ips
+
+
+def first_match(rules, ip):
+    for rule in rules:
+        if rule.matches(ip, PORT, 'TCP'):
+            return rule.action
+    return 'ALLOW'
+
+
+def timed(fn, ips, budget=2.0):
+    """Lookups per second, stopping early once `budget` seconds are spent."""
+    started = time.perf_counter()
+    done = 0
+    results = []
+    for ip in ips:
+        results.append(fn(ip))
+        done += 1
+        if done % 16 == 0 and time.perf_counter() - started > budget:
+            break
+    return done / (time.perf_counter() - started), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rules', type=int, nargs='+', default=[10, 1000, 100000])
+    parser.add_argument('--lookups', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=1000, help="distinct clients for the cached run")
+    args = parser.parse_args()
+
+    print(f"{'rules':>8} {'engine':<9} {'build ms':>9} {'lookups/s':>11}")
+    for count in args.rules:
+        rng = random.Random(count)
+        specs = build_rules(count, rng)
+        ips = build_lookups(specs, args.lookups, rng)
+
+        legacy = [LegacyRule(*spec) for spec in specs]
+        linear = [FirewallRule(*spec) for spec in specs]
+        started = time.perf_counter()
+        table = CompiledRuleTable(linear)
+        build_ms = (time.perf_counter() - started) * 1000
+
+        def compiled(ip):
+            rule = table.lookup(ip, PORT, 'TCP')
+            return rule.action if rule else 'ALLOW'
+
+        reference = None
+        for name, fn, build in (('legacy', lambda ip: first_match(legacy, ip), 0.0),
+                                ('linear', lambda ip: first_match(linear, ip), 0.0),
+                                ('compiled', compiled, build_ms)):
+            rate, results = timed(fn, ips)
+            print(f"{count:>8} {name:<9} {build:>9.1f} {rate:>11.0f}")
+            if reference is None:
+                reference = results
+            elif results[:len(reference)] != reference[:len(results)]:
+                print("  !! verdicts differ from legacy")
+
+        core = FirewallCore()
+        core.rules = linear
+        core.rebuild()
+        repeat = [ips[i % args.repeat] for i in range(len(ips))]
+        rate, _ = timed(lambda ip: core.evaluate_connection(ip, PORT, 'TCP'), repeat)
+        print(f"{count:>8} {'cached':<9} {build_ms:>9.1f} {rate:>11.0f}   hit rate {core.verdicts.stats()['hit_rate']:.0%}")
+
+
+if __name__ == '__main__':
+    main()
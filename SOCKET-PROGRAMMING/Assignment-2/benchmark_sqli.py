@@ -0,0 +1,144 @@
+"""
+Throughput benchmark for SQL injection inspection (MB/s).
+
+Compares four engines on 4 KB chunks, the size proxy_data reads:
+  legacy   - decode to str, then the original nine patterns one by one
+  merged   - the patterns merged into one alternation with named groups
+  matcher  - app_filter.AppLayerFilter.inspect (invalid UTF-8 dropped, then the linear
+             patterns one by one, each behind its own anchor prefilter)
+  stream   - app_filter.StreamInspector (matcher + overlap carried between chunks)
+
+Usage:
+    python benchmark_sqli.py [--size-mb 2]
+"""
+
+import argparse
+import os
+import random
+import re
+import time
+
+from app_filter import AppLayerFilter
+
+CHUNK = 4096
+
+# The patterns as originally shipped in config.py
+LEGACY_PATTERNS = [
+    r"(\%27)|(\')",
+    r"(\-\-)",
+    r"(\%23)|(#)",
+    r"((\%3D)|(=))[^\n]*((\%27)|(\')|(\-\-)|(\%3B)|(;))",
+    r"\w*((\%27)|(\'))(\s*)((\%6F)|o|(\%4F))((\%72)|r|(\%52))",
+    r"((\%27)|(\'))union",
+    r"exec(\s|\+)+(s|x)p\w+",
+    r"UNION(\s|\+)+SELECT",
+    r"DROP(\s|\+)+TABLE",
+]
+
+
+class LegacyEngine:
+    def __init__(self):
+        self.regexes = [re.compile(p, re.IGNORECASE) for p in LEGACY_PATTERNS]
+
+    def search(self, data):
+        content = data.decode('utf-8', errors='ignore')
+        for i, regex in enumerate(self.regexes):
+            if regex.search(content):
+                return i
+        return None
+
+
+class MergedEngine:
+    def __init__(self):
+        merged = '|'.join(f'(?P<r{i}>{p})' for i, p in enumerate(LEGACY_PATTERNS))
+        self.regex = re.compile(merged.encode(), re.IGNORECASE)
+
+    def search(self, data):
+        match = self.regex.search(data)
+        return int(match.lastgroup[1:]) if match else None
+
+
+class MatcherEngine:
+    def __init__(self):
+        self.filter = AppLayerFilter()
+
+    def search(self, data):
+        rule = self.filter.inspect(data)
+        return rule.index if rule else None
+
+
+class StreamEngine:
+    def __init__(self):
+        self.filter = AppLayerFilter()
+        self.stream = self.filter.new_stream()
+
+    def search(self, data):
+        rule = self.stream.feed(data)
+        if rule is not None:
+            # Start a new connection after a hit
+            self.stream = self.filter.new_stream()
+            return rule.index
+        return None
+
+
+def build_corpora(size):
+    rng = random.Random(42)
+    words = [b'GET', b'POST', b'/calc', b'HTTP/1.1', b'Host:', b'localhost', b'Accept:', b'text/plain',
+             b'expr=3%2B4', b'scale=10', b'sqrt(16)', b'2^8', b'(1+2)*3', b'result', b'Content-Length:', b'42']
+
+    def text(n):
+        out = bytearray()
+        while len(out) < n:
+            line = b' '.join(rng.choice(words) for _ in range(rng.randint(3, 12)))
+            out += line + b'\r\n'
+        return bytes(out[:n])
+
+    benign = text(size)
+    malicious = bytearray(benign)
+    # One injection every 64 KB
+    for pos in range(CHUNK, size, 65536):
+        malicious[pos:pos + 30] = b"id=1 UNION SELECT password -- "
+    return {
+        'benign-text': benign,
+        'benign-binary': os.urandom(size),
+        'malicious': bytes(malicious),
+        'many-equals': (b'a=b&c=d&' * (size // 8))[:size],
+    }
+
+
+def run(engine, data):
+    chunks = [data[i:i + CHUNK] for i in range(0, len(data), CHUNK)]
+    started = time.perf_counter()
+    verdicts = [engine.search(chunk) for chunk in chunks]
+    elapsed = time.perf_counter() - started
+    return len(data) / elapsed / 1e6, verdicts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=float, default=2.0)
+    parser.add_argument('--skip-legacy-on', nargs='*', default=['many-equals'],
+                        help="corpora too slow for the backtracking engines (default: many-equals)")
+    args = parser.parse_args()
+
+    engines = {'legacy': LegacyEngine(), 'merged': MergedEngine(), 'matcher': MatcherEngine(), 'stream': StreamEngine()}
+    corpora = build_corpora(int(args.size_mb * 1024 * 1024))
+
+    print(f"{'corpus':<15} {'engine':<8} {'MB/s':>9} {'flagged':>8}")
+    for corpus, data in corpora.items():
+        reference = None
+        for name, engine in engines.items():
+            if name in ('legacy', 'merged') and corpus in args.skip_legacy_on:
+                print(f"{corpus:<15} {name:<8} {'skipped':>9}")
+                continue
+            rate, verdicts = run(engine, data)
+            flagged = sum(v is not None for v in verdicts)
+            print(f"{corpus:<15} {name:<8} {rate:>9.1f} {flagged:>8}")
+            if name == 'legacy':
+                reference = verdicts
+            elif name == 'matcher' and reference is not None and verdicts != reference:
+                print("  !! matcher verdicts differ from legacy")
+
+
+if __name__ == '__main__':
+    main()
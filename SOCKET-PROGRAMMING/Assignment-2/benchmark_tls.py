@@ -0,0 +1,144 @@
+"""
+Benchmark: TLS handshakes per second at the firewall, full and resumed.
+
+For each engine and certificate type the script generates a self-signed
+certificate (RSA-2048 or ECDSA P-256), starts an echo backend and the
+firewall in separate processes, then for --duration seconds per mode
+connects, completes the handshake, sends one byte through the firewall
+and waits for the echo, then disconnects, back to back:
+  full    - every connection performs a full handshake
+  resumed - every connection offers the session of the previous one
+It reports connections per second, their latency, the share of
+connections the firewall actually resumed, and the firewall's CPU time
+per connection.
+
+Usage:
+    python benchmark_tls.py [--engines asyncio threads] [--keys rsa ecdsa] [--tls 1.3] [--duration 5]
+
+Connections are made one at a time, so the rate is the inverse of a
+connection's latency, which includes the client's own handshake work on
+the same machine; CPU time per connection is the firewall's cost alone.
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import ssl
+import tempfile
+import time
+
+import config
+import generate_certs
+from benchmark_concurrency import BENCH_FIREWALL_PORT, run_backend, run_firewall, wait_for_port, percentile
+
+OP_TIMEOUT = 5  # Seconds before a connection counts as failed
+TLS_VERSIONS = {'1.2': ssl.TLSVersion.TLSv1_2, '1.3': ssl.TLSVersion.TLSv1_3}
+
+
+def client_context(tls_version):
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    context.minimum_version = context.maximum_version = TLS_VERSIONS[tls_version]
+    return context
+
+
+def cpu_seconds(pid):
+    """CPU time used by a process so far (Linux)."""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def connect_once(context, session):
+    """
+    One connection through the firewall.
+    Returns:
+        ssl.SSLSession: the session to resume next time, and whether this one was resumed.
+    """
+    with socket.create_connection(('127.0.0.1', BENCH_FIREWALL_PORT), timeout=OP_TIMEOUT) as raw:
+        # Like browsers: otherwise the byte after a TLS 1.2 abbreviated
+        # handshake waits for the firewall's delayed ACK of the Finished
+        raw.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with context.wrap_socket(raw, server_hostname='localhost', session=session) as tls:
+            tls.sendall(b'x')
+            # The echo also carries the TLS 1.3 tickets, read with it
+            if tls.recv(1) != b'x':
+                raise ConnectionError("no echo")
+            return tls.session, tls.session_reused
+
+
+def run_mode(firewall_pid, context, resume, duration):
+    latencies = []
+    resumed = errors = 0
+    session = None
+    cpu_before = cpu_seconds(firewall_pid)
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            new_session, reused = connect_once(context, session if resume else None)
+        except (OSError, ssl.SSLError):
+            errors += 1
+            session = None
+            continue
+        latencies.append(time.perf_counter() - started)
+        resumed += reused
+        session = new_session
+    cpu = cpu_seconds(firewall_pid) - cpu_before
+    latencies.sort()
+    return {
+        'per_s': len(latencies) / duration,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'resumed_pct': 100 * resumed / len(latencies) if latencies else 0,
+        'cpu_us': 1e6 * cpu / len(latencies) if latencies else 0,
+        'errors': errors,
+    }
+
+
+def bench(engine, key_type, args, workdir):
+    config.CERT_FILE = os.path.join(workdir, f'{key_type}.crt')
+    config.KEY_FILE = os.path.join(workdir, f'{key_type}.key')
+    if not os.path.exists(config.CERT_FILE):
+        generate_certs.generate_self_signed_cert(key_type, config.CERT_FILE, config.KEY_FILE)
+    config.ENABLE_SSL = True
+
+    ctx = multiprocessing.get_context('fork')
+    backend = ctx.Process(target=run_backend, daemon=True)
+    backend.start()
+    firewall = ctx.Process(target=run_firewall, args=(engine,), daemon=True)
+    firewall.start()
+    try:
+        wait_for_port(BENCH_FIREWALL_PORT)
+        context = client_context(args.tls)
+        return {mode: run_mode(firewall.pid, context, mode == 'resumed', args.duration) for mode in ('full', 'resumed')}
+    finally:
+        for process in (firewall, backend):
+            process.terminate()
+            process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--engines', nargs='+', choices=['asyncio', 'threads'], default=['asyncio', 'threads'])
+    parser.add_argument('--keys', nargs='+', choices=['rsa', 'ecdsa'], default=['rsa', 'ecdsa'])
+    parser.add_argument('--tls', choices=sorted(TLS_VERSIONS), default='1.3', help="protocol version to negotiate")
+    parser.add_argument('--duration', type=float, default=5.0, help="seconds per mode")
+    args = parser.parse_args()
+    config.METRICS_PORT = None
+
+    print(f"CPU cores: {os.cpu_count()}, TLS {args.tls}, {args.duration:g}s per mode, "
+          f"session resumption {'on' if config.TLS_SESSION_RESUMPTION else 'off'}")
+    print(f"{'engine':<8} {'key':<6} {'mode':<8} {'conn/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'resumed %':>10} {'CPU us/conn':>12} {'errors':>7}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for engine in args.engines:
+            for key_type in args.keys:
+                for mode, r in bench(engine, key_type, args, workdir).items():
+                    print(f"{engine:<8} {key_type:<6} {mode:<8} {r['per_s']:>8.0f} {r['p50_ms']:>8.2f} "
+                          f"{r['p99_ms']:>8.2f} {r['resumed_pct']:>10.0f} {r['cpu_us']:>12.0f} {r['errors']:>7}")
+
+
+if __name__ == '__main__':
+    main()
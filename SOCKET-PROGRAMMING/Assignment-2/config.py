@@ -7,27 +7,106 @@ FIREWALL_PORT = 8000
 BACKEND_HOST = '127.0.0.1'
 BACKEND_PORT = 9000
 
+# Server engine
+SERVER_ENGINE = 'asyncio'  # 'asyncio' (one event loop, no per-connection threads) or 'threads' (thread per connection)
+LISTEN_BACKLOG = 1024  # Pending connections the kernel queues before accept()
+FORWARD_BUFFER_SIZE = 4096  # Bytes per read when proxying
+BACKEND_CONNECT_TIMEOUT = 5  # Seconds (asyncio engine)
+SSL_HANDSHAKE_TIMEOUT = 10  # Seconds a client may take to finish the TLS handshake
+
+# Inspection worker pool (asyncio engine)
+INSPECT_POOL = 'process'  # 'process' (parallel with the loop) or 'thread'
+INSPECT_WORKERS = None  # None = one per CPU core
+INSPECT_MAX_PENDING = 64  # Chunks in flight; further connections wait (stop reading) until one finishes
+INSPECT_INLINE_BYTES = 512  # Smaller chunks are inspected on the loop; handing them off costs more
+
 # Security
 ENABLE_SSL = True
 CERT_FILE = 'server.crt'
 KEY_FILE = 'server.key'
+TLS_SESSION_RESUMPTION = True  # Returning clients may resume with a ticket instead of a full handshake (False: no tickets; OpenSSL's TLS 1.2 session-ID cache cannot be turned off from Python)
+TLS_SESSION_TICKETS = 2  # TLS 1.3 tickets sent after a full handshake; each resumption uses one
+
+# Concurrent connection limits (see connection_guard.py; None turns a limit off)
+MAX_CONNECTIONS_PER_IP = 32  # Open connections one IP may hold (threads engine: three threads each)
+MAX_CONNECTIONS = 10000  # Global budget of open connections
+FAIR_SHARE_THRESHOLD = 0.8  # Above this share of the budget, IPs holding their equal share are refused
+IDLE_TIMEOUT = 300  # Seconds without data in either direction before a connection is closed
+REQUEST_TIMEOUT = 30  # Seconds a client has to send its first bytes, TLS handshake included (and longest request exempt from MIN_TRANSFER_RATE)
+MIN_TRANSFER_RATE = 100  # Bytes/s a request arriving for longer than REQUEST_TIMEOUT must average (slowloris)
+TIMER_TICK = 0.1  # Resolution of connection deadlines (seconds)
+TIMER_SLOTS = 2048  # Slots in the deadline timer wheel
+
+# Bandwidth shaping per source IP, shared by all of its connections (see bandwidth.py; None turns a direction off)
+MAX_UPLOAD_RATE_PER_IP = 12500000  # Bytes/s one IP may send to the backend (100 Mbit/s; keep far above MIN_TRANSFER_RATE)
+MAX_DOWNLOAD_RATE_PER_IP = 12500000  # Bytes/s the backend may send to one IP (100 Mbit/s)
+BANDWIDTH_BURST = 1048576  # Bytes an IP may move at full speed before its rate applies
+THROUGHPUT_REPORT_INTERVAL = 60  # Seconds between log lines with total throughput and the busiest IPs
+
+# Policy file (rules, default action, SQLi patterns); see policy.py for the format
+POLICY_FILE = 'firewall_policy.json'
+POLICY_POLL_INTERVAL = 1  # Seconds between checks for changes (0 = reload on SIGHUP only)
+
+# Firewall rule decisions
+VERDICT_CACHE_SIZE = 65536  # (ip, port, protocol) verdicts remembered; 0 disables the cache
 
 # SQL Injection Patterns
+# Matched case-insensitively against raw payload bytes. Written without
+# capturing groups and without unbounded backtracking so each one runs as a
+# single fast scan.
 SQLI_PATTERNS = [
-    r"(\%27)|(\')",          # Single quote
-    r"(\-\-)",               # Comment
-    r"(\%23)|(#)",           # Comment
-    r"((\%3D)|(=))[^\n]*((\%27)|(\')|(\-\-)|(\%3B)|(;))", # Meta-characters with =
-    r"\w*((\%27)|(\'))(\s*)((\%6F)|o|(\%4F))((\%72)|r|(\%52))", # ' or '
-    r"((\%27)|(\'))union",   # ' union
-    r"exec(\s|\+)+(s|x)p\w+", # exec sp_
-    r"UNION(\s|\+)+SELECT",  # UNION SELECT
-    r"DROP(\s|\+)+TABLE",    # DROP TABLE
+    r"%27|'",                # Single quote
+    r"--",                   # Comment
+    r"%23|#",                # Comment
+    r"(?:%3D|=)(?:[^\n=%]|%(?!3D))*(?:%27|'|--|%3B|;)", # Meta-characters with = (linear form of "=[^\n]*(...)")
+    r"(?:%27|')\s*(?:%6F|o|%4F)(?:%72|r|%52)", # ' or '
+    r"(?:%27|')union",       # ' union
+    r"exec(?:\s|\+)+(?:s|x)p\w+", # exec sp_
+    r"UNION(?:\s|\+)+SELECT", # UNION SELECT
+    r"DROP(?:\s|\+)+TABLE",  # DROP TABLE
+]
+
+# Literal anchors for each pattern above (lowercase). Every match of a
+# pattern starts with one of its anchors, so payloads without any anchor
+# are not scanned. None = scan every payload from the start.
+SQLI_ANCHORS = [
+    ["'", "%27"],
+    ["--"],
+    ["#", "%23"],
+    ["=", "%3d"],
+    ["'", "%27"],
+    ["'union", "%27union"],
+    ["exec"],
+    ["union"],
+    ["drop"],
 ]
 
+# Streaming inspection (payloads split across recv() calls)
+SQLI_STREAM_OVERLAP = 64  # Bytes carried into the next chunk; longer than any match once whitespace runs are collapsed
+SQLI_LINE_OPENERS = ["=", "%3d"]  # The "=" pattern can span a whole line: remember if one of these is open on it
+
 # ARP Monitoring
 ARP_CHECK_INTERVAL = 10  # Seconds
-EXPECTED_GATEWAY_MAC = "00:11:22:33:44:55" # Example MAC for simulation
+ARP_BACKEND = 'auto'  # 'procfs' (/proc/net/arp), 'command' (arp -a) or 'auto' (procfs where available)
+ARP_NEIGHBOR_EVENTS = True  # Linux: also react to rtnetlink neighbour events between polls
+# The gateway's real MAC, e.g. "00:11:22:33:44:55". None = gateway check off: a wrong
+# value flags the real gateway, and behind NAT or a port-forward every client comes from it
+EXPECTED_GATEWAY_MAC = None
+ARP_GATEWAY_IP = None  # None = the default route's gateway (from /proc/net/route)
+ARP_HISTORY_SIZE = 8  # MAC changes remembered per IP
+ARP_FLAP_WINDOW = 60  # Seconds
+ARP_FLAP_LIMIT = 3  # MAC changes of one IP within ARP_FLAP_WINDOW that count as flapping
+ARP_DUPLICATE_MAC_LIMIT = 4  # Most IPs one MAC may answer for
+ARP_BLOCK_SPOOFED = True  # Deny connections from IPs with an ARP verdict (False = alert only)
+
+# Metrics
+# Prometheus text format at http://METRICS_HOST:METRICS_PORT/metrics (None = off)
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9101
 
 # Logging
 LOG_FILE = 'firewall.log'
+LOG_QUEUE_SIZE = 10000  # Records buffered before new ones are dropped
+LOG_BATCH_SIZE = 256  # Max records written per flush
+LOG_FLUSH_INTERVAL = 0.05  # Seconds a batch may wait to fill before being written
+BLOCK_SUMMARY_INTERVAL = 1  # Seconds between "IP denied N times" summary lines
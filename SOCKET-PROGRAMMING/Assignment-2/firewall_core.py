@@ -1,6 +1,30 @@
 
 import logging
 import ipaddress
+import socket
+import threading
+from collections import OrderedDict
+import config
+import common_path  # Shared modules, see common_path.py
+from connection_guard import ConnectionGuard
+from bandwidth import BandwidthShaper
+
+ANY = '*'
+
+def parse_address(ip):
+    """
+    Parse an IP address string.
+    Returns:
+        tuple: (version, integer value), or (None, None) if it is not an IP.
+    """
+    try:
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+    except (OSError, TypeError):
+        pass
+    try:
+        return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big')
+    except (OSError, TypeError):
+        return None, None
 
 class FirewallRule:
     def __init__(self, action, src_ip=None, dst_port=None, protocol='TCP'):
@@ -9,30 +33,190 @@ class FirewallRule:
         self.dst_port = dst_port
         self.protocol = protocol.upper()
 
+        # Parsed once here instead of on every connection
+        self.port = None if not dst_port or dst_port == ANY else int(dst_port)
+        self.protocol_key = self.protocol if self.protocol and self.protocol != ANY else ANY
+        self.network = None  # (version, prefix length, first address, last address)
+        if src_ip and src_ip != ANY:
+            try:
+                network = ipaddress.ip_network(src_ip, strict=False)
+                first = int(network.network_address)
+                self.network = (network.version, network.prefixlen, first, first + network.num_addresses - 1)
+            except ValueError:
+                # Not an address: compared as a plain string
+                pass
+
     def matches(self, client_ip, server_port, protocol='TCP'):
-        if self.src_ip and self.src_ip != '*':
-            # Handle CIDR or single IP
-            if '/' in self.src_ip:
-                if ipaddress.ip_address(client_ip) not in ipaddress.ip_network(self.src_ip):
+        if self.src_ip and self.src_ip != ANY:
+            if self.network is None:
+                if self.src_ip != client_ip:
                     return False
-            elif self.src_ip != client_ip:
-                return False
-        
-        if self.dst_port and self.dst_port != '*':
-            if int(self.dst_port) != int(server_port):
-                return False
-
-        if self.protocol and self.protocol != '*':
-            if self.protocol != protocol.upper():
-                return False
-        
+            else:
+                version, value = parse_address(client_ip)
+                _, _, first, last = self.network
+                if version != self.network[0] or not first <= value <= last:
+                    return False
+
+        if self.port is not None and self.port != int(server_port):
+            return False
+
+        if self.protocol_key != ANY and self.protocol_key != protocol.upper():
+            return False
+
         return True
 
+class PrefixIndex:
+    """
+    Source address index for the rules of one (protocol, port) bucket.
+
+    A prefix trie flattened to one hash table per prefix length: a rule for
+    10.1.0.0/16 is stored under key 10.1 in the /16 table. An address is
+    looked up by truncating it to each length present, so the cost depends
+    on the number of distinct prefix lengths (at most 33 for IPv4), not on
+    the number of rules. Only the lowest rule order is kept per prefix,
+    since the first matching rule wins.
+    """
+
+    def __init__(self):
+        self.wildcard = None # Order of the first rule matching any source
+        self.literals = {} # Non-address src_ip strings -> order
+        self.tables = {4: {}, 6: {}} # version -> {prefix length: {prefix: order}}
+        self.levels = {4: [], 6: []} # version -> [(lowest order, host bits, table)]
+
+    def add(self, order, rule):
+        # Rules arrive in order, so the first one stored per key is the lowest
+        if rule.network is not None:
+            version, length, first, _ = rule.network
+            host_bits = (32 if version == 4 else 128) - length
+            self.tables[version].setdefault(length, {}).setdefault(first >> host_bits, order)
+        elif rule.src_ip and rule.src_ip != ANY:
+            self.literals.setdefault(rule.src_ip, order)
+        elif self.wildcard is None:
+            self.wildcard = order
+
+    def finish(self):
+        for version, tables in self.tables.items():
+            bits = 32 if version == 4 else 128
+            self.levels[version] = sorted(
+                (min(table.values()), bits - length, table) for length, table in tables.items()
+            )
+
+    def first_match(self, version, value, client_ip, best=None):
+        """
+        Returns:
+            int: lowest order of a rule matching the source that is below best, else best.
+        """
+        if self.wildcard is not None and (best is None or self.wildcard < best):
+            best = self.wildcard
+        if self.literals:
+            order = self.literals.get(client_ip)
+            if order is not None and (best is None or order < best):
+                best = order
+        if version is not None:
+            for lowest, host_bits, table in self.levels[version]:
+                if best is not None and lowest >= best:
+                    break # Levels are sorted; nothing further can win
+                order = table.get(value >> host_bits)
+                if order is not None and (best is None or order < best):
+                    best = order
+        return best
+
+class CompiledRuleTable:
+    """
+    Rules compiled for lookup: bucketed by (protocol, port), each bucket
+    indexed by source prefix. Gives the same answer as walking the rule
+    list and taking the first match, without touching every rule.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.buckets = {}
+        for order, rule in enumerate(self.rules):
+            key = (rule.protocol_key, rule.port if rule.port is not None else ANY)
+            self.buckets.setdefault(key, PrefixIndex()).add(order, rule)
+        for index in self.buckets.values():
+            index.finish()
+
+    def lookup(self, client_ip, server_port, protocol='TCP'):
+        """
+        Returns:
+            FirewallRule: the first rule matching the connection, or None.
+        """
+        version, value = parse_address(client_ip)
+        protocol = protocol.upper()
+        port = int(server_port)
+        best = None
+        for key in ((protocol, port), (protocol, ANY), (ANY, port), (ANY, ANY)):
+            index = self.buckets.get(key)
+            if index is not None:
+                best = index.first_match(version, value, client_ip, best)
+        return self.rules[best] if best is not None else None
+
+class VerdictCache:
+    """
+    Bounded LRU of recent decisions keyed by (ip, port, protocol).
+
+    Each entry is stamped with the rule generation it was computed under;
+    bumping the generation makes every entry stale at once, without
+    walking or clearing the cache.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock() # The threaded engine evaluates concurrently
+
+        # Stats for reporting
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, generation):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == generation:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, key, verdict, generation):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (generation, verdict)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
 class FirewallCore:
     def __init__(self):
         self.rules = []
         # Default policy
-        self.default_action = 'ALLOW' 
+        self.default_action = 'ALLOW'
+        # Compiled from self.rules; rebuilt after the rules change
+        self.table = None
+        # Bumped on every rule change; cached verdicts from older generations are ignored
+        self.generation = 0
+        self.verdicts = VerdictCache(config.VERDICT_CACHE_SIZE)
+        # Serialises rule changes with compiling (off the cached path)
+        self.rules_lock = threading.Lock()
+        # Sources the ARP monitor flagged. Replaced whole, never mutated,
+        # so the connection path reads it without a lock
+        self.arp_blocked = frozenset()
+        # Open connections per source IP, idle and slow-request timeouts
+        self.connections = ConnectionGuard('mathbc')
+        # Per-IP bandwidth limits for the forwarding loops
+        self.bandwidth = BandwidthShaper('mathbc')
         self.load_default_rules()
 
     def load_default_rules(self):
@@ -43,16 +227,72 @@ class FirewallCore:
         self.add_rule('ALLOW', src_ip='*')
 
     def add_rule(self, action, src_ip='*', dst_port='*', protocol='*'):
-        self.rules.append(FirewallRule(action, src_ip, dst_port, protocol))
+        rule = FirewallRule(action, src_ip, dst_port, protocol)
+        with self.rules_lock:
+            self.rules.append(rule)
+            # Compiled lazily, so adding many rules costs one rebuild
+            self.table = None
+            self.generation += 1
+
+    def replace_rules(self, rules, default_action=None):
+        """
+        Install a new rule list. It is compiled before the lock is taken,
+        so evaluations carry on with the old table until the swap.
+        """
+        rules = list(rules)
+        table = CompiledRuleTable(rules)
+        with self.rules_lock:
+            self.rules = rules
+            if default_action is not None:
+                self.default_action = default_action.upper()
+            self.table = table
+            self.generation += 1
+
+    def rebuild(self):
+        """
+        Compile the current rules, swap the new table in and invalidate
+        cached verdicts. Call after editing `rules` or `default_action`
+        directly.
+        Returns:
+            CompiledRuleTable: the table now in use.
+        """
+        with self.rules_lock:
+            table = CompiledRuleTable(self.rules)
+            self.table = table
+            self.generation += 1
+        return table
+
+    def set_arp_blocked(self, ips):
+        """Deny every connection from `ips`, replacing the previous set."""
+        self.arp_blocked = frozenset(ips)
 
     def evaluate_connection(self, client_ip, server_port, protocol='TCP'):
         """
-        Evaluate connection against rules.
+        Evaluate connection against rules. Sources with an ARP verdict are
+        denied before the rules (and the verdict cache) are consulted.
         Returns: 'ALLOW' or 'DENY'
         """
-        for rule in self.rules:
-            if rule.matches(client_ip, server_port, protocol):
-                logging.info(f"Rule Matched: Action={rule.action} for {client_ip}:{protocol}")
-                return rule.action
-        
-        return self.default_action
+        if client_ip in self.arp_blocked:
+            return 'DENY'
+        key = (client_ip, server_port, protocol)
+        # Read before the table: a rule change in between leaves the new
+        # verdict stamped with the old generation, so it is never served
+        generation = self.generation
+        verdict = self.verdicts.get(key, generation)
+        if verdict is not None:
+            return verdict
+
+        table = self.table
+        if table is None:
+            with self.rules_lock:
+                if self.table is None:
+                    self.table = CompiledRuleTable(self.rules)
+                table = self.table
+        rule = table.lookup(client_ip, server_port, protocol)
+        if rule is None:
+            verdict = self.default_action
+        else:
+            logging.debug("Rule Matched: Action=%s for %s:%s", rule.action, client_ip, protocol)
+            verdict = rule.action
+        self.verdicts.put(key, verdict, generation)
+        return verdict
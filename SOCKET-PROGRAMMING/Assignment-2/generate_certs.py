@@ -2,15 +2,27 @@
 from cryptography import x509
 from cryptography.x509.oid import NameOID
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
 from cryptography.hazmat.primitives import serialization
+import argparse
 import datetime
 
-def generate_self_signed_cert():
-    key = rsa.generate_private_key(
-        public_exponent=65537,
-        key_size=2048,
-    )
+def generate_private_key(key_type):
+    """
+    RSA-2048, or ECDSA on P-256. A full handshake signs with this key, and
+    a P-256 signature costs the server a fraction of an RSA-2048 one.
+    """
+    if key_type == 'ecdsa':
+        return ec.generate_private_key(ec.SECP256R1())
+    if key_type == 'rsa':
+        return rsa.generate_private_key(
+            public_exponent=65537,
+            key_size=2048,
+        )
+    raise ValueError(f"Unknown key type '{key_type}' (use 'rsa' or 'ecdsa')")
+
+def generate_self_signed_cert(key_type='rsa', cert_file='server.crt', key_file='server.key'):
+    key = generate_private_key(key_type)
     subject = issuer = x509.Name([
         x509.NameAttribute(NameOID.COUNTRY_NAME, u"IN"),
         x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, u"Tamil Nadu"),
@@ -37,7 +49,7 @@ def generate_self_signed_cert():
     ).sign(key, hashes.SHA256())
 
     # Write our key to disk for safe keeping
-    with open("server.key", "wb") as f:
+    with open(key_file, "wb") as f:
         f.write(key.private_bytes(
             encoding=serialization.Encoding.PEM,
             format=serialization.PrivateFormat.TraditionalOpenSSL,
@@ -45,12 +57,18 @@ def generate_self_signed_cert():
         ))
 
     # Write our certificate out to disk.
-    with open("server.crt", "wb") as f:
+    with open(cert_file, "wb") as f:
         f.write(cert.public_bytes(serialization.Encoding.PEM))
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a self-signed certificate for localhost")
+    parser.add_argument('--key-type', choices=['rsa', 'ecdsa'], default='rsa',
+                        help="rsa: RSA-2048; ecdsa: P-256, much cheaper full handshakes")
+    parser.add_argument('--cert', default='server.crt')
+    parser.add_argument('--key', default='server.key')
+    args = parser.parse_args()
     try:
-        generate_self_signed_cert()
+        generate_self_signed_cert(args.key_type, args.cert, args.key)
         print("Certificates generated successfully.")
     except Exception as e:
         print(f"Error generating certs: {e}")
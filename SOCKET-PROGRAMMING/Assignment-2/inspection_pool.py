@@ -0,0 +1,138 @@
+"""
+Bounded worker pool for SQL injection inspection in the asyncio engine.
+
+Regex matching is CPU work that would otherwise run on the event loop and
+delay every other connection. Chunks larger than `inline_bytes` are sent
+to a pool instead:
+  process - a ProcessPoolExecutor; inspection runs in parallel with the loop.
+            Its workers are started by start(), not by the first chunk
+            offloaded, so where they are forked no other thread has
+            started yet except the log writer, which log_pipeline
+            restarts in each child.
+  thread  - a ThreadPoolExecutor; keeps the loop responsive (the GIL is
+            shared, so there is no extra CPU)
+Small chunks are cheaper to inspect than to hand off, so they stay inline.
+
+At most `max_pending` chunks are in flight. Further callers wait for a
+slot, which stops their connection reading: backpressure instead of an
+unbounded queue.
+
+A StreamInspector's only state is its tail (and the pattern set it
+started with), so a process worker is sent (patterns, tail, chunk) and
+returns (rule index, new tail). Workers compile each pattern set once.
+"""
+
+import asyncio
+import concurrent.futures
+import os
+import time
+
+import config
+from app_filter import SQLiMatcher, StreamInspector, record_inspection
+
+# Matchers compiled in a process pool worker, by SQLiMatcher.spec
+_worker_matchers = {}
+
+
+def inspect_in_worker(spec, tail, data):
+    matcher = _worker_matchers.get(spec)
+    if matcher is None:
+        matcher = _worker_matchers[spec] = SQLiMatcher(*spec)
+    stream = StreamInspector(matcher, config.SQLI_STREAM_OVERLAP, config.SQLI_LINE_OPENERS)
+    stream.tail = tail
+    rule = stream.feed(data)
+    return (rule.index if rule is not None else None), stream.tail
+
+
+class InspectionPool:
+    def __init__(self, app_filter, kind='process', workers=None, max_pending=64, inline_bytes=512):
+        self.app_filter = app_filter
+        self.kind = kind
+        self.workers = workers or os.cpu_count() or 1
+        self.inline_bytes = inline_bytes
+        self.max_pending = max_pending
+        self.slots = None
+        self.executor = None
+
+        # Stats for reporting
+        self.inline_chunks = 0
+        self.offloaded_chunks = 0
+        self.waits = 0
+
+    def start(self):
+        # Created here so it belongs to the running loop
+        self.slots = asyncio.Semaphore(self.max_pending)
+        if self.kind == 'process':
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+            # A forking executor starts every worker on its first job. Left
+            # to the first offloaded chunk, the forks would copy the locks
+            # of whatever threads are running by then, in any state.
+            self.executor.submit(os.getpid).result()
+        elif self.kind == 'thread':
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix='inspect')
+        else:
+            raise ValueError(f"Unknown inspection pool kind: {self.kind!r} (use 'process' or 'thread')")
+
+    async def inspect(self, stream, data):
+        """
+        Inspect the next chunk of a stream, off the loop if it is large.
+        Returns:
+            SQLiRule: the rule that fired, or None if the stream is clean so far.
+        """
+        if self.executor is None or len(data) <= self.inline_bytes:
+            self.inline_chunks += 1
+            return stream.feed(data)
+
+        if self.slots.locked():
+            self.waits += 1
+        async with self.slots:
+            self.offloaded_chunks += 1
+            loop = asyncio.get_running_loop()
+            if self.kind == 'thread':
+                # Only this connection's task touches the stream; it waits here
+                return await loop.run_in_executor(self.executor, stream.feed, data)
+            index, stream.tail = await loop.run_in_executor(
+                self.executor, inspect_in_worker, stream.matcher.spec, stream.tail, data
+            )
+            stream.bytes_inspected += len(data)
+            return stream.matcher.rules[index] if index is not None else None
+
+    async def check_payload(self, stream, data):
+        """
+        Async counterpart of AppLayerFilter.check_payload. The time recorded
+        for an offloaded chunk includes waiting for a worker.
+        Returns:
+            bool: True if safe, False if malicious pattern detected.
+        """
+        started = time.perf_counter()
+        try:
+            rule = await self.inspect(stream, data)
+        except Exception as e:
+            self.app_filter.log_error(e)
+            return True
+        record_inspection(time.perf_counter() - started, len(data))
+        return self.app_filter.verdict(rule)
+
+    def stats(self):
+        return {
+            'kind': self.kind,
+            'workers': self.workers,
+            'inline_chunks': self.inline_chunks,
+            'offloaded_chunks': self.offloaded_chunks,
+            'waits': self.waits,
+        }
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+def create_inspection_pool(app_filter):
+    return InspectionPool(
+        app_filter,
+        kind=config.INSPECT_POOL,
+        workers=config.INSPECT_WORKERS,
+        max_pending=config.INSPECT_MAX_PENDING,
+        inline_bytes=config.INSPECT_INLINE_BYTES,
+    )
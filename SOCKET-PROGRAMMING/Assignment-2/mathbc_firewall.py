@@ -1,49 +1,197 @@
 
+import argparse
+import asyncio
 import logging
+import signal
 import socket
+import ssl
 import threading
+import time
 import sys
 import config
 from firewall_core import FirewallCore
 from app_filter import AppLayerFilter
 from arp_monitor import ARPMonitor
 import security_utils
+import common_path  # Shared modules, see common_path.py
+from log_pipeline import setup_logging, BlockSummary
+from inspection_pool import create_inspection_pool
+from policy import create_policy_watcher
+from metrics import registry, start_metrics_server, serve_metrics_in_thread
 
-# Setup logging
-logging.basicConfig(
-    filename=config.LOG_FILE,
+# Setup logging (file + stdout, written in batches by a background thread)
+setup_logging(
+    config.LOG_FILE,
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
+    console=True,
+    queue_size=config.LOG_QUEUE_SIZE,
+    batch_size=config.LOG_BATCH_SIZE,
+    flush_interval=config.LOG_FLUSH_INTERVAL,
 )
-# Also log to stdout
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-logging.getLogger('').addHandler(console)
+
+# Hot-path metrics (SQLi inspection is measured in app_filter)
+ALLOWED = registry.counter('mathbc_connections_total', "Connections checked against the firewall rules", verdict='allow')
+DENIED = registry.counter('mathbc_connections_total', "Connections checked against the firewall rules", verdict='deny')
+CLOSED = registry.counter('mathbc_connections_closed_total', "Allowed connections that have ended")
+RULE_SECONDS = registry.histogram('mathbc_rule_evaluation_seconds', "Time to evaluate the firewall rules for a connection",
+                                  buckets=(0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.001, 0.01))
+BACKEND_CONNECT_SECONDS = registry.histogram('mathbc_backend_connect_seconds', "Time to connect to the backend")
+TLS_HANDSHAKES = {
+    resumed: registry.counter('mathbc_tls_handshakes_total', "Completed TLS handshakes, full or resumed",
+                              resumed=str(resumed).lower())
+    for resumed in (False, True)
+}
+TLS_HANDSHAKE_FAILURES = registry.counter('mathbc_tls_handshake_failures_total', "TLS handshakes that failed or timed out")
+TLS_HANDSHAKE_SECONDS = registry.histogram('mathbc_tls_handshake_seconds', "Time to complete the TLS handshake")
+# Python 3.11+: the asyncio engine upgrades to TLS after the rules, like the threads engine
+LATE_TLS = hasattr(asyncio.StreamWriter, 'start_tls')
+FORWARDED = {
+    True: registry.counter('mathbc_forwarded_bytes_total', "Bytes proxied between clients and the backend",
+                           direction='client_to_backend'),
+    False: registry.counter('mathbc_forwarded_bytes_total', "Bytes proxied between clients and the backend",
+                            direction='backend_to_client'),
+}
+
+def shutdown_sockets(sockets):
+    """Wake the threads blocked on these sockets: their recv() returns b''."""
+    for sock in sockets:
+        try:
+            # The plain socket method, also on an SSLSocket: the TLS layer
+            # belongs to the thread reading it
+            socket.socket.shutdown(sock, socket.SHUT_RDWR)
+        except OSError:
+            pass
 
 class MathBCFirewall:
     def __init__(self):
         self.firewall_core = FirewallCore()
         self.app_filter = AppLayerFilter()
-        self.arp_monitor = ARPMonitor()
-    
-    def handle_client(self, client_socket, addr):
-        client_ip = addr[0]
-        logging.info(f"New connection from {client_ip}:{addr[1]}")
+        # Spoofing verdicts are denied through firewall_core.arp_blocked
+        self.arp_monitor = ARPMonitor(firewall_core=self.firewall_core)
+        # Set by start/start_async when ENABLE_SSL and the certificate loads
+        self.ssl_context = None
+        # Denied connections are summarised per IP rather than logged one line each
+        self.denied_summary = BlockSummary("Connections DENIED by Firewall Rule", config.BLOCK_SUMMARY_INTERVAL)
+        # Created by start_async (asyncio engine only)
+        self.inspection_pool = None
+        # Rules and patterns from config.POLICY_FILE, reloaded while running
+        self.policy_watcher = create_policy_watcher(self.firewall_core, self.app_filter)
+        self.last_throughput_report = time.monotonic()
 
-        # 1. Network Layer Filtering
+    def admit(self, client_ip, abort):
+        """
+        Apply the firewall rules and the concurrent connection limits to a
+        new connection. `abort` closes it if it later times out.
+        Returns:
+            TrackedConnection: if allowed; release it when the connection
+            ends. None if denied.
+        """
+        started = time.perf_counter()
         decision = self.firewall_core.evaluate_connection(client_ip, config.FIREWALL_PORT)
+        RULE_SECONDS.observe(time.perf_counter() - started)
         if decision == 'DENY':
-            logging.warning(f"Connection DENIED by Firewall Rule for {client_ip}")
+            DENIED.inc()
+            self.denied_summary.note(client_ip)
+            return None
+        # Refusals are counted and summarised by the guard
+        tracked = self.firewall_core.connections.open(client_ip, abort)
+        if tracked is None:
+            DENIED.inc()
+            return None
+        ALLOWED.inc()
+        return tracked
+
+    def load_ssl_context(self):
+        if config.ENABLE_SSL:
+            self.ssl_context = security_utils.create_server_ssl_context()
+            if self.ssl_context:
+                logging.info("SSL/TLS Enabled on Firewall Entry (session resumption %s).",
+                             "on" if config.TLS_SESSION_RESUMPTION else "off")
+            else:
+                logging.warning("SSL Configuration failed, falling back to plain TCP.")
+
+    def tls_handshake(self, client_socket, client_ip, sockets):
+        """
+        Runs the TLS handshake on this connection's thread, so a slow or
+        silent client holds up nobody else; it gets SSL_HANDSHAKE_TIMEOUT.
+        The wrapped socket replaces the plain one in `sockets` before the
+        handshake starts (wrapping detaches the plain socket), so the
+        connection guard can still abort it.
+        Returns:
+            ssl.SSLSocket: the wrapped socket, or None if the handshake failed.
+        """
+        started = time.perf_counter()
+        # OpenSSL writes each handshake record on its own; without this
+        # Nagle holds the later ones for the client's delayed ACK (~40 ms).
+        # asyncio transports set it on every connection already
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client_socket.settimeout(config.SSL_HANDSHAKE_TIMEOUT)
+        try:
+            tls_socket = self.ssl_context.wrap_socket(client_socket, server_side=True, do_handshake_on_connect=False)
+            sockets[0] = tls_socket
+            tls_socket.do_handshake()
+        except (ssl.SSLError, OSError) as e:
+            TLS_HANDSHAKE_FAILURES.inc()
+            logging.info("TLS handshake with %s failed: %s", client_ip, e)
+            sockets[0].close()
+            return None
+        tls_socket.settimeout(None)
+        TLS_HANDSHAKE_SECONDS.observe(time.perf_counter() - started)
+        TLS_HANDSHAKES[tls_socket.session_reused].inc()
+        return tls_socket
+
+    def register_gauges(self):
+        """Gauges read at scrape time."""
+        verdicts = self.firewall_core.verdicts
+        registry.gauge('mathbc_connections_active', "Allowed connections currently open",
+                       lambda: ALLOWED.value - CLOSED.value)
+        registry.gauge('mathbc_tracked_ips', "(ip, port, protocol) verdicts in the cache", lambda: len(verdicts.entries))
+        registry.gauge('mathbc_verdict_cache_hit_ratio', "Share of rule evaluations answered by the verdict cache",
+                       lambda: verdicts.stats()['hit_rate'])
+        registry.gauge('mathbc_rules', "Firewall rules loaded", lambda: len(self.firewall_core.rules))
+        registry.gauge('mathbc_arp_blocked_ips', "Source IPs denied for ARP spoofing",
+                       lambda: len(self.firewall_core.arp_blocked))
+        registry.gauge('mathbc_shaped_ips', "IPs with per-IP bandwidth state (open connections or refilling buckets)",
+                       lambda: len(self.firewall_core.bandwidth.ips))
+
+    def handle_client(self, client_socket, addr):
+        client_ip = addr[0]
+        logging.info("New connection from %s:%s", client_ip, addr[1])
+
+        # Shut down if the connection guard times the connection out
+        sockets = [client_socket]
+
+        # 1. Network Layer Filtering (before the handshake: denied clients cost no crypto)
+        tracked = self.admit(client_ip, lambda: shutdown_sockets(sockets))
+        if tracked is None:
             client_socket.close()
             return
 
+        shaped = self.firewall_core.bandwidth.open(client_ip)
+        try:
+            self.proxy_connection(client_socket, client_ip, tracked, shaped, sockets)
+        finally:
+            self.firewall_core.bandwidth.release(shaped)
+            self.firewall_core.connections.release(tracked)
+            CLOSED.inc()
+
+    def proxy_connection(self, client_socket, client_ip, tracked, shaped, sockets):
+        if self.ssl_context:
+            client_socket = self.tls_handshake(client_socket, client_ip, sockets)
+            if client_socket is None:
+                return
+
         # 2. Connect to Backend
+        backend_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sockets.append(backend_socket)
         try:
-            backend_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            started = time.perf_counter()
             backend_socket.connect((config.BACKEND_HOST, config.BACKEND_PORT))
+            BACKEND_CONNECT_SECONDS.observe(time.perf_counter() - started)
         except Exception as e:
-            logging.error(f"Failed to connect to backend: {e}")
+            logging.error("Failed to connect to backend: %s", e)
             client_socket.close()
+            backend_socket.close()
             return
 
         # 3. Two-way Proxy with App Layer Inspection (for Client -> Server)
@@ -52,11 +200,11 @@ class MathBCFirewall:
         # Threads to handle bidirectional forwarding
         client_to_server = threading.Thread(
             target=self.proxy_data, 
-            args=(client_socket, backend_socket, True)
+            args=(client_socket, backend_socket, True, tracked.client_data, shaped.client_data)
         )
         server_to_client = threading.Thread(
             target=self.proxy_data, 
-            args=(backend_socket, client_socket, False)
+            args=(backend_socket, client_socket, False, tracked.backend_data, shaped.backend_data)
         )
         
         client_to_server.start()
@@ -68,23 +216,33 @@ class MathBCFirewall:
         client_socket.close()
         backend_socket.close()
 
-    def proxy_data(self, src, dst, is_client_to_server):
+    def proxy_data(self, src, dst, is_client_to_server, activity, throttle):
+        # Scanning state carried across reads, so a pattern split between
+        # two segments is still caught. Over the IP's bandwidth, the thread
+        # sleeps before its next recv() and TCP flow control holds the sender
+        stream = self.app_filter.new_stream() if is_client_to_server else None
+        forwarded = FORWARDED[is_client_to_server]
         try:
             while True:
-                data = src.recv(4096)
+                data = src.recv(config.FORWARD_BUFFER_SIZE)
                 if not data:
                     break
+                activity(len(data))
                 
                 # 4. App Layer Filtering (SQL Injection) 
                 # Inspect data coming FROM client
                 if is_client_to_server:
-                    if not self.app_filter.check_payload(data):
+                    if not self.app_filter.check_payload(data, stream):
                         # Block malicious payload
                         logging.warning("Dropping malicious packet (SQL Injection).")
                         # We can choose to close connection or just plain drop packet
                         break # Close connection
                 
                 dst.sendall(data)
+                forwarded.inc(len(data))
+                delay = throttle(len(data))
+                if delay:
+                    time.sleep(delay)
         except Exception as e:
             # Connection reset or similar
             pass
@@ -94,27 +252,57 @@ class MathBCFirewall:
             except:
                 pass
             src.close()
+            # One side is done: wake the other direction's thread too,
+            # or it waits on a peer that may never close
+            shutdown_sockets([dst])
+
+    def sweep(self):
+        """
+        Abort idle and slow connections, drop the bandwidth state of IPs that
+        have left, and log the throughput every THROUGHPUT_REPORT_INTERVAL.
+        """
+        self.firewall_core.connections.sweep()
+        self.firewall_core.bandwidth.sweep()
+        now = time.monotonic()
+        if now - self.last_throughput_report >= config.THROUGHPUT_REPORT_INTERVAL:
+            self.last_throughput_report = now
+            bandwidth = self.firewall_core.bandwidth.stats()
+            busiest = ', '.join(f"{ip} {up / 1000:.1f}/{down / 1000:.1f}" for ip, (up, down) in bandwidth['top'])
+            logging.info("Throughput: %.1f KB/s to the backend, %.1f KB/s to clients; busiest IPs (KB/s up/down): %s",
+                         bandwidth['total'][0] / 1000, bandwidth['total'][1] / 1000, busiest or 'none')
+
+    def sweep_connections(self, stop):
+        """Threads engine: sweep every tick until `stop` is set."""
+        while not stop.wait(config.TIMER_TICK):
+            self.sweep()
 
     def start(self):
         # Start ARP Monitor
         self.arp_monitor.start()
+        self.policy_watcher.start()
+        sweeper_stop = threading.Event()
+        threading.Thread(target=self.sweep_connections, args=(sweeper_stop,), daemon=True).start()
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.policy_watcher.request_reload())
+        if config.METRICS_PORT is not None:
+            # No event loop in this engine: the endpoint gets a thread of its own
+            self.register_gauges()
+            try:
+                serve_metrics_in_thread(config.METRICS_HOST, config.METRICS_PORT)
+            except OSError as e:
+                logging.error("Metrics endpoint on %s:%s not started: %s", config.METRICS_HOST, config.METRICS_PORT, e)
         
         # Start Proxy Server
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.bind((config.FIREWALL_HOST, config.FIREWALL_PORT))
-        server_socket.listen(10)
-        
-        logging.info(f"MathBC Firewall listening on {config.FIREWALL_HOST}:{config.FIREWALL_PORT}")
-        
-        # Warp with SSL if enabled
-        if config.ENABLE_SSL:
-            context = security_utils.create_server_ssl_context()
-            if context:
-                logging.info("SSL/TLS Enabled on Firewall Entry.")
-                server_socket = context.wrap_socket(server_socket, server_side=True)
-            else:
-                logging.warning("SSL Configuration failed, falling back to plain TCP or exiting.")
+        server_socket.listen(config.LISTEN_BACKLOG)
         
+        logging.info("MathBC Firewall listening on %s:%s", config.FIREWALL_HOST, config.FIREWALL_PORT)
+
+        # The listening socket stays plain: each handshake runs in its
+        # connection's thread (tls_handshake), never inside accept()
+        self.load_ssl_context()
+
         try:
             while True:
                 client_sock, addr = server_socket.accept()
@@ -123,9 +311,167 @@ class MathBCFirewall:
         except KeyboardInterrupt:
             logging.info("Stopping Firewall...")
         finally:
+            sweeper_stop.set()
             self.arp_monitor.stop()
+            self.policy_watcher.stop()
             server_socket.close()
+            logging.info("Verdict cache: %s", self.firewall_core.verdicts.stats())
+
+    # --- asyncio engine: same checks, no threads per connection ---
+
+    async def handle_client_async(self, client_reader, client_writer):
+        peername = client_writer.get_extra_info('peername')
+        client_ip = peername[0] if peername else 'unknown'
+        logging.info("New connection from %s:%s", client_ip, peername[1] if peername else '?')
+
+        # 1. Network Layer Filtering (the transport is looked up when the
+        # guard aborts: start_tls replaces it)
+        tracked = self.admit(client_ip, lambda: client_writer.transport.abort())
+        if tracked is None:
+            client_writer.close()
+            return
+
+        shaped = self.firewall_core.bandwidth.open(client_ip)
+        try:
+            await self.proxy_connection_async(client_reader, client_writer, client_ip, tracked, shaped)
+        finally:
+            self.firewall_core.bandwidth.release(shaped)
+            self.firewall_core.connections.release(tracked)
+            CLOSED.inc()
+
+    async def proxy_connection_async(self, client_reader, client_writer, client_ip, tracked, shaped):
+        if self.ssl_context and LATE_TLS:
+            started = time.perf_counter()
+            try:
+                await client_writer.start_tls(self.ssl_context, ssl_handshake_timeout=config.SSL_HANDSHAKE_TIMEOUT)
+            except (ssl.SSLError, OSError, asyncio.TimeoutError) as e:
+                TLS_HANDSHAKE_FAILURES.inc()
+                logging.info("TLS handshake with %s failed: %s", client_ip, e)
+                client_writer.close()
+                return
+            TLS_HANDSHAKE_SECONDS.observe(time.perf_counter() - started)
+        ssl_object = client_writer.get_extra_info('ssl_object')
+        if ssl_object is not None:
+            TLS_HANDSHAKES[ssl_object.session_reused].inc()
+
+        # 2. Connect to Backend
+        try:
+            started = time.perf_counter()
+            backend_reader, backend_writer = await asyncio.wait_for(
+                asyncio.open_connection(config.BACKEND_HOST, config.BACKEND_PORT),
+                config.BACKEND_CONNECT_TIMEOUT
+            )
+            BACKEND_CONNECT_SECONDS.observe(time.perf_counter() - started)
+        except (OSError, asyncio.TimeoutError) as e:
+            logging.error("Failed to connect to backend: %s", e)
+            client_writer.close()
+            return
+
+        # 3. Two-way Proxy with App Layer Inspection (for Client -> Server)
+        client_to_server = asyncio.create_task(
+            self.proxy_stream(client_reader, backend_writer, True, tracked.client_data, shaped.client_data))
+        server_to_client = asyncio.create_task(
+            self.proxy_stream(backend_reader, client_writer, False, tracked.backend_data, shaped.backend_data))
+        done, pending = await asyncio.wait(
+            [client_to_server, server_to_client],
+            return_when=asyncio.FIRST_COMPLETED
+        )
+        for task in pending:
+            task.cancel()
+        client_writer.close()
+        backend_writer.close()
+
+    async def proxy_stream(self, reader, writer, is_client_to_server, activity, throttle):
+        stream = self.app_filter.new_stream() if is_client_to_server else None
+        forwarded = FORWARDED[is_client_to_server]
+        try:
+            while True:
+                data = await reader.read(config.FORWARD_BUFFER_SIZE)
+                if not data:
+                    break
+                activity(len(data))
+
+                # 4. App Layer Filtering (SQL Injection), large chunks off the loop
+                if stream is not None:
+                    if not await self.inspection_pool.check_payload(stream, data):
+                        logging.warning("Dropping malicious packet (SQL Injection).")
+                        break # Close connection
+
+                writer.write(data)
+                forwarded.inc(len(data))
+                await writer.drain()
+                # Over the IP's bandwidth: read nothing until it is paid back
+                delay = throttle(len(data))
+                if delay:
+                    await asyncio.sleep(delay)
+        except (OSError, asyncio.IncompleteReadError):
+            # Connection reset or similar
+            pass
+        finally:
+            writer.close()
+
+    async def sweep_connections_async(self):
+        """Asyncio engine: sweep every tick."""
+        while True:
+            await asyncio.sleep(config.TIMER_TICK)
+            self.sweep()
+
+    async def start_async(self):
+        # Pool first: start() forks its worker processes before the ARP
+        # and policy threads start
+        self.inspection_pool = create_inspection_pool(self.app_filter)
+        self.inspection_pool.start()
+        self.arp_monitor.start()
+        self.policy_watcher.start()
+        sweeper = asyncio.create_task(self.sweep_connections_async())
+        if hasattr(signal, 'SIGHUP'):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.policy_watcher.request_reload)
+
+        self.load_ssl_context()
+        # The TLS handshake runs per connection on the loop, not in accept().
+        # With LATE_TLS the handler starts it after the firewall rules;
+        # otherwise the server does, before the handler runs
+        early_ssl = self.ssl_context if not LATE_TLS else None
+        server = await asyncio.start_server(
+            self.handle_client_async, config.FIREWALL_HOST, config.FIREWALL_PORT,
+            ssl=early_ssl,
+            ssl_handshake_timeout=config.SSL_HANDSHAKE_TIMEOUT if early_ssl else None,
+            backlog=config.LISTEN_BACKLOG
+        )
+        logging.info("MathBC Firewall listening on %s:%s (asyncio engine, %s inspection pool)",
+                     config.FIREWALL_HOST, config.FIREWALL_PORT, self.inspection_pool.kind)
+        metrics_server = None
+        if config.METRICS_PORT is not None:
+            # Scrapes are served by this loop, between connections
+            self.register_gauges()
+            try:
+                metrics_server = await start_metrics_server(config.METRICS_HOST, config.METRICS_PORT)
+            except OSError as e:
+                logging.error("Metrics endpoint on %s:%s not started: %s", config.METRICS_HOST, config.METRICS_PORT, e)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            sweeper.cancel()
+            if metrics_server:
+                metrics_server.close()
+            self.arp_monitor.stop()
+            self.policy_watcher.stop()
+            logging.info("Inspection pool: %s", self.inspection_pool.stats())
+            logging.info("Verdict cache: %s", self.firewall_core.verdicts.stats())
+            self.inspection_pool.close()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MathBC firewall (SSL reverse proxy)")
+    parser.add_argument('--engine', choices=['asyncio', 'threads'], default=config.SERVER_ENGINE,
+                        help="asyncio: event loop with an inspection pool; threads: thread per connection")
+    args = parser.parse_args()
+
     fw = MathBCFirewall()
-    fw.start()
+    if args.engine == 'asyncio':
+        try:
+            asyncio.run(fw.start_async())
+        except KeyboardInterrupt:
+            logging.info("Stopping Firewall...")
+    else:
+        fw.start()
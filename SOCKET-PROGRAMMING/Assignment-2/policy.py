@@ -0,0 +1,227 @@
+"""
+Firewall policy loaded from a JSON file and reloaded without a restart.
+
+File format (every key optional):
+
+    {
+      "default_action": "ALLOW",
+      "rules": [
+        {"action": "DENY", "src_ip": "192.168.1.100"},
+        {"action": "DENY", "src_ip": "10.0.0.0/8", "dst_port": 8000, "protocol": "TCP"},
+        {"action": "ALLOW", "src_ip": "*"}
+      ],
+      "sqli_patterns": [
+        {"pattern": "UNION(?:\\s|\\+)+SELECT", "anchors": ["union"]}
+      ]
+    }
+
+Missing keys fall back to the built-in policy: FirewallCore's default
+rules and action, and the patterns in config.py.
+
+A reload (on SIGHUP or when the file changes) parses and compiles the new
+rule table and pattern set on the watcher thread, and only then swaps
+each in with a single assignment. Open connections are not touched, and neither is any
+other firewall state. A file that fails to load is logged and the
+current policy stays in force.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import config
+from app_filter import SQLiMatcher
+from firewall_core import FirewallRule
+
+RULE_KEYS = {'action', 'src_ip', 'dst_port', 'protocol'}
+ACTIONS = {'ALLOW', 'DENY'}
+
+
+class Policy:
+    def __init__(self, default_action=None, rules=None, sqli_patterns=None, sqli_anchors=None):
+        self.default_action = default_action
+        self.rules = rules
+        self.sqli_patterns = sqli_patterns
+        self.sqli_anchors = sqli_anchors
+
+
+def parse_port(value, position):
+    if value == '*' or (isinstance(value, str) and value.isdigit()):
+        value = int(value) if value != '*' else value
+    if value != '*' and (not isinstance(value, int) or isinstance(value, bool) or not 0 <= value <= 65535):
+        raise ValueError(f"rule {position}: dst_port must be a port number or '*'")
+    return value
+
+
+def parse_rule(entry, position):
+    if not isinstance(entry, dict) or 'action' not in entry:
+        raise ValueError(f"rule {position}: expected an object with an 'action'")
+    unknown = set(entry) - RULE_KEYS
+    if unknown:
+        raise ValueError(f"rule {position}: unknown keys {sorted(unknown)}")
+    if not isinstance(entry['action'], str) or entry['action'].upper() not in ACTIONS:
+        raise ValueError(f"rule {position}: action must be ALLOW or DENY")
+    for key in ('src_ip', 'protocol'):
+        if not isinstance(entry.get(key, '*'), str):
+            raise ValueError(f"rule {position}: {key} must be a string")
+    return FirewallRule(
+        entry['action'],
+        entry.get('src_ip', '*'),
+        parse_port(entry.get('dst_port', '*'), position),
+        entry.get('protocol', '*'),
+    )
+
+
+def parse_anchors(anchors, position):
+    if anchors is None:
+        return None
+    if not isinstance(anchors, list) or not all(isinstance(a, str) and a for a in anchors):
+        raise ValueError(f"sqli pattern {position}: anchors must be a list of non-empty strings")
+    return anchors
+
+
+def load_policy(path):
+    """
+    Read and validate a policy file.
+    Returns:
+        Policy: the parsed policy (rules parsed, not yet compiled).
+    Raises:
+        OSError, ValueError: if the file cannot be read or is invalid.
+        (An invalid regex raises re.error when the patterns are compiled.)
+    """
+    with open(path) as f:
+        try:
+            data = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"invalid JSON: {e}")
+    if not isinstance(data, dict):
+        raise ValueError("expected a JSON object")
+
+    policy = Policy()
+    if 'default_action' in data:
+        if not isinstance(data['default_action'], str) or data['default_action'].upper() not in ACTIONS:
+            raise ValueError("default_action must be ALLOW or DENY")
+        policy.default_action = data['default_action'].upper()
+    for key in ('rules', 'sqli_patterns'):
+        if key in data and not isinstance(data[key], list):
+            raise ValueError(f"{key} must be a list")
+    if 'rules' in data:
+        policy.rules = [parse_rule(entry, i) for i, entry in enumerate(data['rules'])]
+    if 'sqli_patterns' in data:
+        policy.sqli_patterns = []
+        policy.sqli_anchors = []
+        for i, entry in enumerate(data['sqli_patterns']):
+            if isinstance(entry, str):
+                entry = {'pattern': entry}
+            if not isinstance(entry, dict) or not isinstance(entry.get('pattern'), str):
+                raise ValueError(f"sqli pattern {i}: expected a string or an object with a 'pattern'")
+            policy.sqli_patterns.append(entry['pattern'])
+            policy.sqli_anchors.append(parse_anchors(entry.get('anchors'), i))
+    return policy
+
+
+class PolicyWatcher:
+    """
+    Background thread that reloads the policy file when it changes (polled
+    every `poll_interval` seconds; 0 = only on request) or when
+    request_reload() is called, e.g. from a SIGHUP handler.
+    """
+
+    def __init__(self, path, firewall_core, app_filter, poll_interval=1.0):
+        self.path = path
+        self.firewall_core = firewall_core
+        self.app_filter = app_filter
+        self.poll_interval = poll_interval
+        self.wakeup = threading.Event()
+        self.running = False
+        self.signature = None
+
+        # What a file without "rules" / "default_action" falls back to
+        self.builtin_rules = list(firewall_core.rules)
+        self.builtin_default_action = firewall_core.default_action
+
+        # Stats for reporting
+        self.reloads = 0
+        self.failures = 0
+        self.last_reload_ms = None
+
+    def file_signature(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        # Inode too: an editor or `mv` replaces the file rather than rewriting it
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def reload(self):
+        """
+        Load the file and swap the new policy in.
+        Returns:
+            bool: True if the policy was applied.
+        """
+        started = time.perf_counter()
+        self.signature = self.file_signature()
+        try:
+            policy = load_policy(self.path)
+            if policy.sqli_patterns is not None:
+                patterns, anchors = policy.sqli_patterns, policy.sqli_anchors
+            else:
+                patterns, anchors = config.SQLI_PATTERNS, config.SQLI_ANCHORS
+            # Everything that can fail is built before either half is
+            # swapped in, so a bad file never leaves one half applied
+            matcher = SQLiMatcher(patterns, anchors)
+            self.firewall_core.replace_rules(
+                policy.rules if policy.rules is not None else self.builtin_rules,
+                policy.default_action or self.builtin_default_action
+            )
+            self.app_filter.matcher = matcher
+        except (OSError, ValueError, re.error) as e:
+            self.failures += 1
+            logging.error("Policy reload from %s failed, keeping the current policy: %s", self.path, e)
+            return False
+
+        self.reloads += 1
+        self.last_reload_ms = (time.perf_counter() - started) * 1000
+        logging.info("Policy loaded from %s in %.1f ms: %d rules, %d SQLi patterns (generation %d)",
+                     self.path, self.last_reload_ms, len(self.firewall_core.rules),
+                     len(self.app_filter.matcher.rules), self.firewall_core.generation)
+        return True
+
+    def request_reload(self):
+        """Ask the watcher thread to reload now. Safe to call from a signal handler."""
+        self.wakeup.set()
+
+    def watch_loop(self):
+        while self.running:
+            requested = self.wakeup.wait(self.poll_interval or None)
+            self.wakeup.clear()
+            if not self.running:
+                break
+            if requested or self.file_signature() != self.signature:
+                self.reload()
+
+    def start(self):
+        self.running = True
+        t = threading.Thread(target=self.watch_loop, name='policy-watcher')
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+
+def create_policy_watcher(firewall_core, app_filter):
+    """
+    Watcher for config.POLICY_FILE. The file is loaded once now if it
+    exists; otherwise the built-in policy stays until it appears.
+    """
+    watcher = PolicyWatcher(config.POLICY_FILE, firewall_core, app_filter, config.POLICY_POLL_INTERVAL)
+    if os.path.exists(config.POLICY_FILE):
+        watcher.reload()
+    else:
+        logging.info("No policy file at %s, using built-in rules", config.POLICY_FILE)
+    return watcher
@@ -7,6 +7,13 @@ import os
 def create_server_ssl_context():
     """
     Creates an SSL context for the server (Firewall acting as SSL termination).
+
+    With TLS_SESSION_RESUMPTION a returning client can skip the full
+    handshake (and the certificate's signature): TLS 1.3 clients present
+    one of the TLS_SESSION_TICKETS tickets sent after their first
+    handshake, TLS 1.2 clients a session ticket or cached session ID.
+    Turning it off only stops the tickets: Python has no way to disable
+    OpenSSL's session-ID cache, so TLS 1.2 clients may still resume.
     """
     if not os.path.exists(config.CERT_FILE) or not os.path.exists(config.KEY_FILE):
         logging.error("Certificate files not found. SSL cannot be enabled.")
@@ -15,6 +22,11 @@ def create_server_ssl_context():
     try:
         context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
         context.load_cert_chain(certfile=config.CERT_FILE, keyfile=config.KEY_FILE)
+        if config.TLS_SESSION_RESUMPTION:
+            context.num_tickets = config.TLS_SESSION_TICKETS
+        else:
+            context.num_tickets = 0
+            context.options |= ssl.OP_NO_TICKET
         return context
     except Exception as e:
         logging.error(f"Failed to create SSL context: {e}")
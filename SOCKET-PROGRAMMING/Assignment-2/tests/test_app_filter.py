@@ -0,0 +1,115 @@
+import unittest
+import random
+import sys
+import os
+
+# Add parent directory to path so we can import app_filter
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app_filter import WIDE_SPACES, AppLayerFilter
+from benchmark_sqli import LegacyEngine
+
+class TestAppLayerFilter(unittest.TestCase):
+    def setUp(self):
+        self.filter = AppLayerFilter()
+
+    def test_benign_payloads(self):
+        for payload in [b"3+3", b"sqrt(16)\n", b"GET /calc?expr=2 HTTP/1.1\r\n", b"\x00\xff\x10binary"]:
+            self.assertTrue(self.filter.check_payload(payload), payload)
+
+    def test_malicious_payloads(self):
+        for payload in [b"' OR 1=1", b"id=1 UNION SELECT password", b"1; DROP TABLE users",
+                        b"x%27%20or%201", b"exec  sp_who", b"name=admin;"]:
+            self.assertFalse(self.filter.check_payload(payload), payload)
+
+    def test_reports_rule(self):
+        rule = self.filter.inspect(bytearray(b"a union  select b"))
+        self.assertIsNotNone(rule)
+        self.assertIn("UNION", rule.pattern)
+
+    def test_text_whitespace_separates_keywords(self):
+        # The patterns' \s used to run on decoded text, where it also matched these
+        for space in ['\x1c', '\x1d', '\x1e', '\x1f', '\x85', '\xa0', '\u2003', '\u3000']:
+            payload = f"1 UNION{space}SELECT password".encode()
+            self.assertFalse(self.filter.check_payload(payload), payload)
+            self.assertFalse(self.filter.check_payload(f"x'{space}or 1".encode()), space)
+        self.assertTrue(self.filter.check_payload(b"UNION\xa0SELECT"))  # Not UTF-8: no space
+
+    def test_invalid_utf8_bytes_are_dropped(self):
+        # As decoding with errors='ignore' did, and as the backend still does
+        for payload in [b"-\xff-", b"DROP \xffTABLE", b"1 UNI\xc0ON SELECT x", b"x'\x80 or 1"]:
+            self.assertFalse(self.filter.check_payload(payload), payload)
+
+    def test_same_rule_as_legacy_patterns(self):
+        legacy = LegacyEngine()
+        rng = random.Random(7)
+        tokens = [b'=', b'%3D', b'%3d', b"'", b'%27', b'--', b';', b'%3B', b'a', b' ', b'\n', b'o',
+                  b'R', b'%', b'3', b'D', b'union', b' SELECT', b'exec', b' sp_x', b'drop', b' table', b'#',
+                  b'\x1c', b'\x1f', b'\t', '\u2003'.encode(), '\xa0'.encode(), b'\xa0', b'\xe2\x80', b'\xff']
+        for _ in range(20000):
+            payload = b''.join(rng.choice(tokens) for _ in range(rng.randint(0, 10)))
+            rule = self.filter.inspect(payload)
+            self.assertEqual(rule.index if rule else None, legacy.search(payload), payload)
+
+class TestStreamInspector(unittest.TestCase):
+    def setUp(self):
+        self.filter = AppLayerFilter()
+
+    def feed_all(self, chunks):
+        stream = self.filter.new_stream()
+        for chunk in chunks:
+            rule = stream.feed(chunk)
+            if rule is not None:
+                return rule
+        return None
+
+    def test_pattern_split_at_every_offset(self):
+        payload = b"id=1 UNION SELECT password"
+        for cut in range(1, len(payload)):
+            self.assertIsNotNone(self.feed_all([payload[:cut], payload[cut:]]), cut)
+
+    def test_characters_and_invalid_bytes_split_across_chunks(self):
+        self.assertIsNotNone(self.feed_all([b"1 UNION\xe2\x80", b"\x83SELECT x"]))
+        self.assertIsNotNone(self.feed_all([b"1 UNION\xe3", b"\x80\x80SELECT x"]))
+        self.assertIsNotNone(self.feed_all([b"1; DROP\xe2", b" TABLE users"]))
+        self.assertIsNotNone(self.feed_all([b"-\xff", b"-"]))
+
+    def test_long_runs_and_lines_across_chunks(self):
+        filler = b"x" * 10000
+        self.assertIsNotNone(self.feed_all([b"a UNION", b" " * 10000, b"\t SELECT b"]))
+        self.assertIsNotNone(self.feed_all([b"name=", filler, filler, b"admin;"]))
+        self.assertIsNone(self.feed_all([b"name=", filler, b"\n", b"admin;"]))
+        self.assertIsNone(self.feed_all([b"a;", filler[:40], b"b=c", b"d"]))
+        self.assertIsNone(self.feed_all([filler[:100] + b";=" + b"y" * 62, b"z"]))
+
+    def test_unicode_space_runs_across_chunks(self):
+        nbsp, em = '\xa0'.encode(), '\u2003'.encode()
+        self.assertIsNotNone(self.feed_all([b"1; DROP" + nbsp * 40, b"TABLE users"]))
+        self.assertIsNotNone(self.feed_all([b"a UNION" + (em + b" ") * 30, em * 30 + b"SELECT b"]))
+        # Cut inside the last space of the run
+        self.assertIsNotNone(self.feed_all([b"a UNION" + em * 40 + em[:1], em[1:] + b"SELECT b"]))
+
+    def test_wide_spaces_are_what_text_patterns_call_space(self):
+        expected = {chr(c).encode() for c in range(0x80, sys.maxunicode + 1) if chr(c).isspace()}
+        self.assertEqual(set(WIDE_SPACES), expected)
+
+    def test_tail_stays_bounded(self):
+        stream = self.filter.new_stream()
+        for chunk in [b"=" + b" " * 4095, b"x" * 4096, b"\n+ + +" * 600, '\u3000 '.encode() * 1000]:
+            self.assertIsNone(stream.feed(chunk))
+            self.assertLessEqual(len(stream.tail), 2 * stream.overlap + 3)
+
+    def test_same_verdict_as_whole_payload(self):
+        rng = random.Random(11)
+        tokens = [b'=', b'%3D', b"'", b'%27', b'-', b';', b'%3', b'B', b'a', b' ' * 70, b' ', b'\n', b'+',
+                  b'o', b'R', b'%', b'un', b'ion', b'sel', b'ect', b'exec', b'sp_x', b'drop', b'table', b'x' * 70,
+                  '\xa0'.encode() * 40, '\u3000'.encode()]
+        for _ in range(5000):
+            payload = b''.join(rng.choice(tokens) for _ in range(rng.randint(0, 12)))
+            cuts = sorted(rng.sample(range(len(payload) + 1), min(len(payload) + 1, rng.randint(1, 6))))
+            chunks = [payload[i:j] for i, j in zip([0] + cuts, cuts + [len(payload)])]
+            whole = self.filter.inspect(payload) is not None
+            self.assertEqual(self.feed_all(chunks) is not None, whole, chunks)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,200 @@
+import os
+import socket
+import sys
+import tempfile
+import time
+import unittest
+
+# Add parent directory to path so we can import arp_monitor
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import arp_monitor
+import config
+from arp_monitor import ARPMonitor, MacHistory, parse_neighbor_messages, parse_proc_arp_line
+from firewall_core import FirewallCore
+
+HEADER = "IP address       HW type     Flags       HW address            Mask     Device\n"
+
+def arp_line(ip, mac, flags='0x2'):
+    return f"{ip:<16} 0x1         {flags:<11} {mac}     *        eth0\n"
+
+def neighbor_message(ip, mac, msg_type=arp_monitor.RTM_NEWNEIGH, state=0x02):
+    """An rtnetlink RTM_NEWNEIGH message as the kernel sends it."""
+    attrs = b''
+    for attr_type, value in ((arp_monitor.NDA_DST, socket.inet_aton(ip)),
+                             (arp_monitor.NDA_LLADDR, bytes.fromhex(mac.replace(':', '')))):
+        attr = arp_monitor.RTATTR.pack(arp_monitor.RTATTR.size + len(value), attr_type) + value
+        attrs += attr + b'\0' * (arp_monitor.align(len(attr)) - len(attr))
+    body = arp_monitor.NDMSG.pack(socket.AF_INET, 2, state, 0, 1) + attrs
+    return arp_monitor.NLMSG_HEADER.pack(arp_monitor.NLMSG_HEADER.size + len(body), msg_type, 0, 0, 0) + body
+
+class TestARPMonitor(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def write_table(self, lines):
+        with open(self.path, 'w') as f:
+            f.write(HEADER + ''.join(lines))
+
+    def test_proc_line_parsing(self):
+        self.assertEqual(parse_proc_arp_line(arp_line('10.0.0.1', 'aa:bb:cc:dd:ee:ff')),
+                         ('10.0.0.1', 'aa:bb:cc:dd:ee:ff'))
+        # Incomplete entries have no MAC yet
+        self.assertIsNone(parse_proc_arp_line(arp_line('10.0.0.2', '00:00:00:00:00:00', flags='0x0')))
+        self.assertIsNone(parse_proc_arp_line('garbage'))
+
+    def test_only_changed_entries_are_reported(self):
+        monitor = ARPMonitor(backend='procfs', proc_path=self.path)
+        self.write_table([arp_line('10.0.0.1', 'aa:aa:aa:aa:aa:01'), arp_line('10.0.0.2', 'aa:aa:aa:aa:aa:02')])
+        self.assertEqual(len(monitor.changed_entries()), 2)
+        self.assertEqual(monitor.changed_entries(), [])
+
+        self.write_table([arp_line('10.0.0.1', 'aa:aa:aa:aa:aa:01'), arp_line('10.0.0.2', 'bb:bb:bb:bb:bb:02'),
+                          arp_line('10.0.0.3', 'aa:aa:aa:aa:aa:03')])
+        self.assertEqual(sorted(monitor.changed_entries()),
+                         [('10.0.0.2', 'bb:bb:bb:bb:bb:02'), ('10.0.0.3', 'aa:aa:aa:aa:aa:03')])
+        self.assertEqual(monitor.get_arp_table()[0], ('10.0.0.1', 'aa:aa:aa:aa:aa:01'))
+
+    def test_entries_leaving_the_table_are_forgotten(self):
+        monitor = ARPMonitor(backend='procfs', proc_path=self.path)
+        shared = 'aa:aa:aa:aa:aa:01'
+        self.write_table([arp_line('10.0.0.1', shared), arp_line('10.0.0.2', shared),
+                          arp_line('10.0.0.3', 'aa:aa:aa:aa:aa:03')])
+        monitor.detect_conflicts(monitor.changed_entries())
+        self.assertEqual(monitor.mac_counts[shared.upper()], 2)
+
+        # One expires, one fails to resolve
+        self.write_table([arp_line('10.0.0.2', shared), arp_line('10.0.0.3', '00:00:00:00:00:00', flags='0x0')])
+        self.assertEqual(monitor.changed_entries(), [('10.0.0.1', None), ('10.0.0.3', None)])
+        monitor.detect_conflicts([('10.0.0.1', None), ('10.0.0.3', None)])
+        self.assertEqual(monitor.known_macs, {'10.0.0.2': shared.upper()})
+        self.assertEqual(monitor.mac_counts, {shared.upper(): 1})
+
+        # A deletion event, then a full re-check after lost events
+        monitor.detect_conflicts(parse_neighbor_messages(
+            neighbor_message('10.0.0.2', shared, msg_type=arp_monitor.RTM_DELNEIGH)))
+        self.assertEqual((monitor.known_macs, monitor.mac_counts), ({}, {}))
+        monitor.known_macs['10.0.0.9'] = 'AA:AA:AA:AA:AA:09'
+        monitor.mac_counts['AA:AA:AA:AA:AA:09'] = 1
+        monitor.seen_lines = frozenset()
+        monitor.detect_conflicts(monitor.changed_entries())
+        self.assertEqual(monitor.known_macs, {'10.0.0.2': shared.upper()})
+        self.assertEqual(monitor.mac_counts, {shared.upper(): 1})
+
+    def test_mac_change_raises_alert(self):
+        monitor = ARPMonitor(backend='procfs', proc_path=self.path)
+        self.write_table([arp_line('10.0.0.1', 'aa:aa:aa:aa:aa:01')])
+        monitor.detect_conflicts(monitor.changed_entries())
+        self.write_table([arp_line('10.0.0.1', 'aa:aa:aa:aa:aa:99')])
+        with self.assertLogs(level='WARNING') as logs:
+            monitor.detect_conflicts(monitor.changed_entries())
+        self.assertIn('ARP SPOOFING ALERT: IP 10.0.0.1', logs.output[0])
+        self.assertEqual(monitor.known_macs['10.0.0.1'], 'AA:AA:AA:AA:AA:99')
+
+    def test_large_table_polls_quickly(self):
+        lines = [arp_line(f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}', f'02:00:00:{i >> 16 & 255:02x}:{i >> 8 & 255:02x}:{i & 255:02x}')
+                 for i in range(100000)]
+        self.write_table(lines)
+        monitor = ARPMonitor(backend='procfs', proc_path=self.path)
+        started = time.perf_counter()
+        monitor.detect_conflicts(monitor.changed_entries())
+        first = time.perf_counter() - started
+        self.assertEqual(len(monitor.known_macs), 100000)
+
+        lines[500] = arp_line('10.0.1.244', '02:ff:ff:ff:ff:ff')
+        self.write_table(lines)
+        started = time.perf_counter()
+        with self.assertLogs(level='WARNING'):
+            monitor.detect_conflicts(monitor.changed_entries())
+        again = time.perf_counter() - started
+        # ARP_CHECK_INTERVAL is 10 seconds
+        self.assertLess(first, 2.0)
+        self.assertLess(again, 1.0)
+
+    def test_neighbor_event_parsing(self):
+        data = (neighbor_message('192.0.2.7', '02:00:00:00:00:07')
+                + neighbor_message('192.0.2.8', '02:00:00:00:00:08', state=arp_monitor.NUD_FAILED)
+                + neighbor_message('192.0.2.9', '02:00:00:00:00:09', msg_type=arp_monitor.RTM_DELNEIGH)
+                + neighbor_message('192.0.2.10', '00:00:00:00:00:00', state=arp_monitor.NUD_INCOMPLETE))
+        # Failed and deleted entries are gone; one still resolving is not news yet
+        self.assertEqual(parse_neighbor_messages(data),
+                         [('192.0.2.7', '02:00:00:00:00:07'), ('192.0.2.8', None), ('192.0.2.9', None)])
+        self.assertEqual(parse_neighbor_messages(data[:10]), [])
+
+class TestSpoofDetection(unittest.TestCase):
+    def setUp(self):
+        self.core = FirewallCore()
+        self.monitor = ARPMonitor(backend='procfs', firewall_core=self.core, gateway_ip='10.0.0.1')
+
+    def test_history_ring_keeps_latest_changes(self):
+        history = MacHistory(3)
+        for i in range(5):
+            history.record(i, float(i))
+        self.assertEqual([when for when, _ in history.recent()], [2.0, 3.0, 4.0])
+        self.assertEqual(history.recent()[-1][1], '00:00:00:00:00:04')
+        self.assertEqual(history.changes_since(3.0), 2)
+        self.assertEqual(history.latest, 4.0)
+
+    def test_flapping_ip_is_denied_until_it_settles(self):
+        self.monitor.detect_conflicts([('10.0.0.9', 'aa:aa:aa:aa:aa:01')], now=0)
+        with self.assertLogs(level='WARNING') as logs:
+            for i in range(config.ARP_FLAP_LIMIT):
+                self.monitor.detect_conflicts([('10.0.0.9', f'aa:aa:aa:aa:aa:0{i % 2 + 2}')], now=i + 1)
+        self.assertIn('ARP VERDICT: denying 10.0.0.9', logs.output[-1])
+        self.assertEqual(self.core.evaluate_connection('10.0.0.9', 8000), 'DENY')
+        self.assertEqual(self.core.evaluate_connection('10.0.0.10', 8000), 'ALLOW')
+
+        # No further changes: the verdict expires with the window
+        self.monitor.detect_conflicts([], now=config.ARP_FLAP_WINDOW + 10)
+        self.assertEqual(self.core.arp_blocked, frozenset())
+        self.assertEqual(self.core.evaluate_connection('10.0.0.9', 8000), 'ALLOW')
+
+    def test_duplicate_mac_denies_every_ip_using_it(self):
+        shared = 'bb:bb:bb:bb:bb:bb'
+        ips = [f'10.0.1.{i}' for i in range(config.ARP_DUPLICATE_MAC_LIMIT + 1)]
+        self.monitor.detect_conflicts([(ip, shared) for ip in ips[:-1]], now=0)
+        self.assertEqual(self.core.arp_blocked, frozenset())
+        with self.assertLogs(level='WARNING'):
+            self.monitor.detect_conflicts([(ips[-1], shared)], now=1)
+        self.assertEqual(self.core.arp_blocked, frozenset(ips))
+
+        # One of them moves to its own MAC: the rest is within the limit again
+        with self.assertLogs(level='WARNING'):
+            self.monitor.detect_conflicts([(ips[0], 'bb:bb:bb:bb:bb:01')], now=2)
+        self.assertEqual(self.core.arp_blocked, frozenset())
+
+    def test_departed_ip_history_is_dropped_after_the_window(self):
+        self.monitor.detect_conflicts([('10.0.0.9', 'aa:aa:aa:aa:aa:01')], now=0)
+        with self.assertLogs(level='WARNING'):
+            self.monitor.detect_conflicts([('10.0.0.9', 'aa:aa:aa:aa:aa:02')], now=1)
+        self.monitor.detect_conflicts([('10.0.0.9', None)], now=2)
+        self.assertIn('10.0.0.9', self.monitor.history)
+        self.monitor.detect_conflicts([], now=config.ARP_FLAP_WINDOW + 10)
+        self.assertEqual(self.monitor.history, {})
+
+    def test_gateway_impostor_is_denied(self):
+        expected = self.monitor.gateway_mac = '00:11:22:33:44:55'
+        self.monitor.detect_conflicts([('10.0.0.1', expected), ('10.0.0.66', 'cc:cc:cc:cc:cc:66')], now=0)
+        self.assertEqual(self.core.arp_blocked, frozenset())
+        with self.assertLogs(level='WARNING') as logs:
+            self.monitor.detect_conflicts([('10.0.0.1', 'cc:cc:cc:cc:cc:66')], now=1)
+        self.assertTrue(any('expected' in line for line in logs.output))
+        self.assertEqual(self.core.arp_blocked, frozenset({'10.0.0.1', '10.0.0.66'}))
+
+    def test_alert_only_mode(self):
+        config.ARP_BLOCK_SPOOFED = False
+        try:
+            with self.assertLogs(level='WARNING'):
+                for i in range(config.ARP_FLAP_LIMIT + 1):
+                    self.monitor.detect_conflicts([('10.0.0.1', f'cc:cc:cc:cc:cc:6{i % 2}')], now=i)
+        finally:
+            config.ARP_BLOCK_SPOOFED = True
+        self.assertIn('10.0.0.1', self.monitor.verdicts)
+        self.assertEqual(self.core.arp_blocked, frozenset())
+
+if __name__ == '__main__':
+    unittest.main()
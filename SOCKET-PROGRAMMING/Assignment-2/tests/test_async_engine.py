@@ -0,0 +1,275 @@
+import asyncio
+import multiprocessing
+import os
+import socket
+import ssl
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+# Add parent directory to path so we can import the firewall modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from app_filter import AppLayerFilter
+import common_path  # Shared modules, see common_path.py
+from bandwidth import BandwidthShaper
+from log_pipeline import stop_logging
+from inspection_pool import InspectionPool
+
+# Keep test runs from writing a log file into the source tree
+config.LOG_FILE = os.devnull
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+async def echo(reader, writer):
+    while data := await reader.read(4096):
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+class TestInspectionPool(unittest.TestCase):
+    def test_offloaded_verdicts_match_inline(self):
+        app_filter = AppLayerFilter()
+        chunks = [b"a" * 600 + b" UNI", b"ON SELECT" + b"b" * 600]
+
+        async def run(kind):
+            pool = InspectionPool(app_filter, kind=kind, workers=2, inline_bytes=512)
+            pool.start()
+            try:
+                stream = app_filter.new_stream()
+                verdicts = [await pool.check_payload(stream, chunk) for chunk in chunks]
+                return verdicts, pool.stats()
+            finally:
+                pool.close()
+
+        for kind in ('thread', 'process'):
+            with self.subTest(kind=kind):
+                verdicts, stats = asyncio.run(run(kind))
+                self.assertEqual(verdicts, [True, False])
+                self.assertEqual(stats['offloaded_chunks'], 2)
+
+    @unittest.skipUnless(multiprocessing.get_start_method() == 'fork', "workers start on demand without fork")
+    def test_process_workers_are_forked_by_start(self):
+        async def run():
+            pool = InspectionPool(AppLayerFilter(), kind='process', workers=2)
+            before = len(multiprocessing.active_children())
+            pool.start()
+            try:
+                # Before any chunk is offloaded
+                return len(multiprocessing.active_children()) - before
+            finally:
+                pool.close()
+
+        self.assertEqual(asyncio.run(run()), 2)
+
+def configure(test, **values):
+    """Override config values until `test` ends."""
+    patcher = mock.patch.multiple(config, **values)
+    patcher.start()
+    test.addCleanup(patcher.stop)
+
+class TestAsyncEngine(unittest.TestCase):
+    def setUp(self):
+        configure(self, ENABLE_SSL=False, FIREWALL_HOST='127.0.0.1', FIREWALL_PORT=free_port(),
+                  BACKEND_PORT=free_port(), INSPECT_POOL='thread', ARP_CHECK_INTERVAL=3600, METRICS_PORT=None)
+
+    def test_proxies_and_blocks_split_injection(self):
+        import mathbc_firewall
+
+        async def run():
+            backend = await asyncio.start_server(echo, '127.0.0.1', config.BACKEND_PORT)
+            fw = mathbc_firewall.MathBCFirewall()
+            server_task = asyncio.create_task(fw.start_async())
+            for _ in range(50):
+                try:
+                    reader, writer = await asyncio.open_connection('127.0.0.1', config.FIREWALL_PORT)
+                    break
+                except OSError:
+                    await asyncio.sleep(0.05)
+            try:
+                writer.write(b"3+3\n")
+                self.assertEqual(await asyncio.wait_for(reader.readexactly(4), 5), b"3+3\n")
+
+                # Pattern split over two writes: the connection is closed
+                writer.write(b"1 UNI")
+                await writer.drain()
+                await asyncio.sleep(0.1)
+                writer.write(b"ON SELECT x")
+                received = await asyncio.wait_for(reader.read(), 5)
+                self.assertEqual(received, b"1 UNI")
+                writer.close()
+            finally:
+                server_task.cancel()
+                backend.close()
+                await asyncio.gather(server_task, return_exceptions=True)
+
+        asyncio.run(run())
+
+    def test_metrics_endpoint(self):
+        import mathbc_firewall
+        from app_filter import DETECTIONS
+        configure(self, METRICS_PORT=free_port())
+
+        async def scrape():
+            reader, writer = await asyncio.open_connection('127.0.0.1', config.METRICS_PORT)
+            writer.write(b"GET /metrics HTTP/1.0\r\n\r\n")
+            response = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            lines = response.decode().split('\r\n\r\n', 1)[1].splitlines()
+            return dict(line.rsplit(' ', 1) for line in lines if not line.startswith('#'))
+
+        async def run():
+            backend = await asyncio.start_server(echo, '127.0.0.1', config.BACKEND_PORT)
+            fw = mathbc_firewall.MathBCFirewall()
+            server_task = asyncio.create_task(fw.start_async())
+            await asyncio.sleep(0.2)
+            try:
+                before = await scrape()
+                reader, writer = await asyncio.open_connection('127.0.0.1', config.FIREWALL_PORT)
+                writer.write(b"3+3\n")
+                await asyncio.wait_for(reader.readexactly(4), 5)
+                writer.write(b"' OR 1=1\n")
+                await asyncio.wait_for(reader.read(), 5)
+                writer.close()
+                await asyncio.sleep(0.1)
+                after = await scrape()
+            finally:
+                server_task.cancel()
+                backend.close()
+                await asyncio.gather(server_task, return_exceptions=True)
+            return before, after
+
+        before, after = asyncio.run(run())
+        delta = lambda name: float(after[name]) - float(before.get(name, 0))
+        self.assertEqual(delta('mathbc_connections_total{verdict="allow"}'), 1)
+        self.assertEqual(delta('mathbc_forwarded_bytes_total{direction="client_to_backend"}'), 4)
+        self.assertEqual(delta('mathbc_forwarded_bytes_total{direction="backend_to_client"}'), 4)
+        self.assertEqual(delta('mathbc_sqli_detections_total'), 1)
+        self.assertEqual(delta('mathbc_rule_evaluation_seconds_count'), 1)
+        self.assertEqual(delta('mathbc_sqli_inspection_seconds_per_kb_count'), 2)
+        self.assertEqual(delta('mathbc_backend_connect_seconds_count'), 1)
+        self.assertEqual(after['mathbc_connections_active'], '0')
+        self.assertEqual(DETECTIONS.value, float(after['mathbc_sqli_detections_total']))
+
+    def test_connection_limits(self):
+        import mathbc_firewall
+
+        async def run():
+            backend = await asyncio.start_server(echo, '127.0.0.1', config.BACKEND_PORT)
+            fw = mathbc_firewall.MathBCFirewall()
+            guard = fw.firewall_core.connections
+            guard.max_per_ip = 2
+            guard.request_timeout = 0.3
+            server_task = asyncio.create_task(fw.start_async())
+            await asyncio.sleep(0.2)
+            try:
+                silent_reader, silent_writer = await asyncio.open_connection('127.0.0.1', config.FIREWALL_PORT)
+                reader, writer = await asyncio.open_connection('127.0.0.1', config.FIREWALL_PORT)
+                writer.write(b"3+3\n")
+                self.assertEqual(await asyncio.wait_for(reader.readexactly(4), 5), b"3+3\n")
+
+                refused_reader, refused_writer = await asyncio.open_connection('127.0.0.1', config.FIREWALL_PORT)
+                self.assertEqual(await asyncio.wait_for(refused_reader.read(), 5), b"")
+                refused_writer.close()
+
+                # Sent nothing within the request timeout
+                self.assertEqual(await asyncio.wait_for(silent_reader.read(), 5), b"")
+                silent_writer.close()
+                await asyncio.sleep(0.1)
+                open_after_timeout = guard.total
+                writer.close()
+                await asyncio.sleep(0.1)
+            finally:
+                server_task.cancel()
+                backend.close()
+                await asyncio.gather(server_task, return_exceptions=True)
+            return open_after_timeout, guard.total
+
+        self.assertEqual(asyncio.run(run()), (1, 0))
+
+    def test_bandwidth_limit(self):
+        import mathbc_firewall
+        payload = b"1+1\n" * 25000
+
+        async def run():
+            backend = await asyncio.start_server(echo, '127.0.0.1', config.BACKEND_PORT)
+            fw = mathbc_firewall.MathBCFirewall()
+            fw.firewall_core.bandwidth = BandwidthShaper('mathbc', upload_rate=0, download_rate=200000, burst=16384)
+            server_task = asyncio.create_task(fw.start_async())
+            await asyncio.sleep(0.2)
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', config.FIREWALL_PORT)
+                started = time.monotonic()
+                writer.write(payload)
+                received = await asyncio.wait_for(reader.readexactly(len(payload)), 10)
+                elapsed = time.monotonic() - started
+                writer.close()
+                await asyncio.sleep(0.1)
+            finally:
+                server_task.cancel()
+                backend.close()
+                await asyncio.gather(server_task, return_exceptions=True)
+            return received, elapsed, fw.firewall_core.bandwidth.stats()
+
+        received, elapsed, stats = asyncio.run(run())
+        self.assertEqual(received, payload)
+        # Echoed back at the download rate once the burst is spent
+        self.assertGreater(elapsed, (len(payload) - 16384) / 200000 - 0.05)
+        self.assertEqual(stats['top'][0][0], '127.0.0.1')
+
+    def test_tls_sessions_resume(self):
+        try:
+            import generate_certs
+        except ImportError:
+            self.skipTest("cryptography is not installed")
+        import mathbc_firewall
+        certs = tempfile.TemporaryDirectory()
+        self.addCleanup(certs.cleanup)
+        configure(self, CERT_FILE=os.path.join(certs.name, 'server.crt'),
+                  KEY_FILE=os.path.join(certs.name, 'server.key'), ENABLE_SSL=True)
+        generate_certs.generate_self_signed_cert('ecdsa', config.CERT_FILE, config.KEY_FILE)
+
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+
+        def connect(session):
+            with socket.create_connection(('127.0.0.1', config.FIREWALL_PORT), timeout=5) as raw:
+                with context.wrap_socket(raw, server_hostname='localhost', session=session) as tls:
+                    tls.sendall(b"3+3\n")
+                    self.assertEqual(tls.recv(4), b"3+3\n")
+                    return tls.session, tls.session_reused
+
+        async def run():
+            backend = await asyncio.start_server(echo, '127.0.0.1', config.BACKEND_PORT)
+            fw = mathbc_firewall.MathBCFirewall()
+            server_task = asyncio.create_task(fw.start_async())
+            await asyncio.sleep(0.2)
+            try:
+                session, first = await asyncio.to_thread(connect, None)
+                _, second = await asyncio.to_thread(connect, session)
+            finally:
+                server_task.cancel()
+                backend.close()
+                await asyncio.gather(server_task, return_exceptions=True)
+            return first, second
+
+        full = mathbc_firewall.TLS_HANDSHAKES[False].value
+        resumed = mathbc_firewall.TLS_HANDSHAKES[True].value
+        self.assertEqual(asyncio.run(run()), (False, True))
+        self.assertEqual(mathbc_firewall.TLS_HANDSHAKES[False].value - full, 1)
+        self.assertEqual(mathbc_firewall.TLS_HANDSHAKES[True].value - resumed, 1)
+
+def tearDownModule():
+    # Drain the logging pipeline before the test runner closes its streams
+    stop_logging()
+
+
+if __name__ == "__main__":
+    unittest.main()
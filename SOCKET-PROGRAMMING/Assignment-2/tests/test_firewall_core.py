@@ -0,0 +1,86 @@
+import random
+import sys
+import os
+import unittest
+
+# Add parent directory to path so we can import firewall_core
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from firewall_core import FirewallCore, FirewallRule, CompiledRuleTable
+from benchmark_rules import LegacyRule
+
+class TestFirewallCore(unittest.TestCase):
+    def setUp(self):
+        self.core = FirewallCore()
+
+    def test_default_rules(self):
+        self.assertEqual(self.core.evaluate_connection('192.168.1.100', 8000), 'DENY')
+        self.assertEqual(self.core.evaluate_connection('192.168.1.101', 8000), 'ALLOW')
+
+    def test_first_match_wins(self):
+        core = FirewallCore()
+        core.rules = []
+        core.add_rule('ALLOW', src_ip='10.0.0.5')
+        core.add_rule('DENY', src_ip='10.0.0.0/8')
+        core.add_rule('DENY', src_ip='*', dst_port=22)
+        core.add_rule('DENY', src_ip='2001:db8::/32', protocol='udp')
+        core.default_action = 'ALLOW'
+        self.assertEqual(core.evaluate_connection('10.0.0.5', 8000), 'ALLOW')
+        self.assertEqual(core.evaluate_connection('10.9.9.9', 8000), 'DENY')
+        self.assertEqual(core.evaluate_connection('11.0.0.1', 22), 'DENY')
+        self.assertEqual(core.evaluate_connection('11.0.0.1', 8000), 'ALLOW')
+        self.assertEqual(core.evaluate_connection('2001:db8::1', 53, 'UDP'), 'DENY')
+        self.assertEqual(core.evaluate_connection('2001:db8::1', 53, 'TCP'), 'ALLOW')
+        self.assertEqual(core.evaluate_connection('unknown', 8000), 'ALLOW')
+
+    def test_rule_changes_rebuild_table(self):
+        self.assertEqual(self.core.evaluate_connection('172.16.0.1', 8000), 'ALLOW')
+        # Direct edits to the list need an explicit rebuild
+        self.core.rules.insert(0, FirewallRule('DENY', '172.16.0.0/12', '*', '*'))
+        self.core.rebuild()
+        self.assertEqual(self.core.evaluate_connection('172.16.0.1', 8000), 'DENY')
+        # add_rule invalidates the table itself
+        self.core.rules = []
+        self.core.add_rule('DENY', src_ip='8.8.8.8')
+        self.assertEqual(self.core.evaluate_connection('8.8.8.8', 8000), 'DENY')
+        self.assertEqual(self.core.evaluate_connection('8.8.4.4', 8000), 'ALLOW')
+
+    def test_verdict_cache(self):
+        for _ in range(3):
+            self.assertEqual(self.core.evaluate_connection('192.168.1.100', 8000), 'DENY')
+        stats = self.core.verdicts.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+
+        # A rule change invalidates every cached verdict at once
+        self.core.rules = []
+        self.core.add_rule('ALLOW', src_ip='192.168.1.100')
+        self.assertEqual(self.core.evaluate_connection('192.168.1.100', 8000), 'ALLOW')
+        self.core.default_action = 'DENY'
+        self.core.rebuild()
+        self.assertEqual(self.core.evaluate_connection('10.0.0.1', 8000), 'DENY')
+
+    def test_verdict_cache_is_bounded(self):
+        self.core.verdicts.max_entries = 100
+        for i in range(1000):
+            self.core.evaluate_connection(f'10.0.{i // 256}.{i % 256}', 8000)
+        self.assertEqual(self.core.verdicts.stats()['entries'], 100)
+
+    def test_same_verdict_as_original_rules(self):
+        rng = random.Random(3)
+        prefixes = ['10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24', '10.1.2.3', '10.1.2.3/32', '0.0.0.0/0', '*',
+                    '::/0', '2001:db8::/32', '2001:db8::1', 'localhost']
+        ips = ['10.1.2.3', '10.1.2.4', '10.1.9.9', '10.200.0.1', '11.0.0.1', '2001:db8::1', '2001:db9::1']
+        for _ in range(300):
+            specs = [(rng.choice(['ALLOW', 'DENY']), rng.choice(prefixes), rng.choice(['*', 80, '8000']),
+                      rng.choice(['*', 'TCP', 'udp'])) for _ in range(rng.randint(0, 12))]
+            table = CompiledRuleTable([FirewallRule(*spec) for spec in specs])
+            legacy = [LegacyRule(*spec) for spec in specs]
+            for ip in ips:
+                for port in (80, 8000):
+                    for protocol in ('TCP', 'UDP'):
+                        rule = table.lookup(ip, port, protocol)
+                        expected = next((i for i, r in enumerate(legacy) if r.matches(ip, port, protocol)), None)
+                        self.assertEqual(table.rules.index(rule) if rule else None, expected, (specs, ip, port, protocol))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+# Add parent directory to path so we can import the firewall modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from app_filter import AppLayerFilter
+from firewall_core import FirewallCore
+from policy import PolicyWatcher, load_policy
+import common_path  # Shared modules, see common_path.py
+from log_pipeline import stop_logging
+from test_async_engine import configure, echo, free_port
+
+# Keep test runs from writing a log file into the source tree
+config.LOG_FILE = os.devnull
+
+def write_policy(path, policy):
+    # Write then rename, as an editor or deploy script would
+    with open(path + '.tmp', 'w') as f:
+        json.dump(policy, f)
+    os.replace(path + '.tmp', path)
+
+class TestPolicyFile(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'policy.json')
+        self.core = FirewallCore()
+        self.filter = AppLayerFilter()
+        self.watcher = PolicyWatcher(self.path, self.core, self.filter, poll_interval=0)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_invalid_files_are_rejected(self):
+        for content in ['{', '[]', '{"rules": [{"action": "MAYBE"}]}', '{"rules": [{"action": "DENY", "port": 1}]}',
+                        '{"default_action": "DROP"}', '{"sqli_patterns": [{"anchors": ["x"]}]}',
+                        # Wrong types
+                        '{"rules": [{"action": "DENY", "protocol": 6}]}', '{"rules": [{"action": 1}]}',
+                        '{"rules": [{"action": "DENY", "src_ip": 5}]}', '{"rules": [{"action": "DENY", "dst_port": true}]}',
+                        '{"rules": [{"action": "DENY", "dst_port": 70000}]}', '{"rules": {"action": "DENY"}}',
+                        '{"default_action": 0}', '{"sqli_patterns": 5}', '{"sqli_patterns": "union"}',
+                        '{"sqli_patterns": [{"pattern": "x", "anchors": [5]}]}',
+                        '{"sqli_patterns": [{"pattern": "x", "anchors": "union"}]}']:
+            with open(self.path, 'w') as f:
+                f.write(content)
+            with self.assertRaises(ValueError, msg=content):
+                load_policy(self.path)
+
+    def test_reload_swaps_rules_and_patterns(self):
+        write_policy(self.path, {
+            'default_action': 'DENY',
+            'rules': [{'action': 'ALLOW', 'src_ip': '10.0.0.0/8', 'dst_port': 8000}],
+            'sqli_patterns': [{'pattern': 'sleep\\(', 'anchors': ['sleep(']}],
+        })
+        self.assertTrue(self.watcher.reload())
+        self.assertEqual(self.core.evaluate_connection('10.1.1.1', 8000), 'ALLOW')
+        self.assertEqual(self.core.evaluate_connection('10.1.1.1', 22), 'DENY')
+        self.assertFalse(self.filter.check_payload(b"1 and SLEEP(5)"))
+        self.assertTrue(self.filter.check_payload(b"' OR 1=1"))
+
+        # A broken file leaves the policy in force
+        with open(self.path, 'w') as f:
+            f.write('{"sqli_patterns": ["("]}')
+        self.assertFalse(self.watcher.reload())
+        self.assertEqual(self.core.evaluate_connection('10.1.1.1', 22), 'DENY')
+        self.assertFalse(self.filter.check_payload(b"sleep(1)"))
+
+        # Valid rules with a pattern that does not compile: neither half is applied
+        write_policy(self.path, {'rules': [{'action': 'ALLOW', 'src_ip': '*'}], 'sqli_patterns': ['(']})
+        self.assertFalse(self.watcher.reload())
+        self.assertEqual(self.core.evaluate_connection('10.1.1.1', 22), 'DENY')
+        for content in ['{"rules": [{"action": "DENY", "protocol": 6}]}', '{"sqli_patterns": 5}']:
+            with open(self.path, 'w') as f:
+                f.write(content)
+            self.assertFalse(self.watcher.reload(), content)
+        self.assertEqual(self.watcher.failures, 4)
+
+        # Keys left out fall back to the built-in policy
+        write_policy(self.path, {})
+        self.assertTrue(self.watcher.reload())
+        self.assertEqual(self.core.evaluate_connection('192.168.1.100', 8000), 'DENY')
+        self.assertEqual(self.core.evaluate_connection('10.1.1.1', 22), 'ALLOW')
+        self.assertFalse(self.filter.check_payload(b"' OR 1=1"))
+
+class TestLiveReload(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        configure(self, POLICY_FILE=os.path.join(self.dir.name, 'policy.json'), POLICY_POLL_INTERVAL=0.05,
+                  ENABLE_SSL=False, FIREWALL_HOST='127.0.0.1', FIREWALL_PORT=free_port(),
+                  BACKEND_PORT=free_port(), INSPECT_POOL='thread', ARP_CHECK_INTERVAL=3600, METRICS_PORT=None)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_reload_keeps_live_connections(self):
+        import mathbc_firewall
+        write_policy(config.POLICY_FILE, {'rules': [{'action': 'ALLOW', 'src_ip': '*'}]})
+
+        async def roundtrip(reader, writer, data):
+            writer.write(data)
+            return await asyncio.wait_for(reader.read(100), 5)
+
+        async def run():
+            backend = await asyncio.start_server(echo, '127.0.0.1', config.BACKEND_PORT)
+            fw = mathbc_firewall.MathBCFirewall()
+            server_task = asyncio.create_task(fw.start_async())
+            await asyncio.sleep(0.2)
+            try:
+                live = [await asyncio.open_connection('127.0.0.1', config.FIREWALL_PORT) for _ in range(20)]
+                for reader, writer in live:
+                    self.assertEqual(await roundtrip(reader, writer, b"1+1"), b"1+1")
+
+                # Deny localhost; the file watcher picks the change up
+                write_policy(config.POLICY_FILE, {'rules': [{'action': 'DENY', 'src_ip': '127.0.0.0/8'}]})
+                changed = time.perf_counter()
+                while fw.firewall_core.evaluate_connection('127.0.0.1', config.FIREWALL_PORT) != 'DENY':
+                    await asyncio.sleep(0.01)
+                    self.assertLess(time.perf_counter() - changed, 2, "reload not picked up")
+                self.assertLess(fw.policy_watcher.last_reload_ms, 100)
+
+                # New connections are denied, every open one still works
+                reader, writer = await asyncio.open_connection('127.0.0.1', config.FIREWALL_PORT)
+                try:
+                    self.assertEqual(await roundtrip(reader, writer, b"2+2"), b"")
+                except ConnectionResetError:
+                    pass # Closed before our write arrived
+                for reader, writer in live:
+                    self.assertEqual(await roundtrip(reader, writer, b"3+3"), b"3+3")
+                    writer.close()
+            finally:
+                server_task.cancel()
+                backend.close()
+                await asyncio.gather(server_task, return_exceptions=True)
+
+        asyncio.run(run())
+
+def tearDownModule():
+    # Drain the logging pipeline before the test runner closes its streams
+    stop_logging()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,300 @@
+"""
+Benchmark: the chat server's engines with many connected users.
+
+For each engine the script starts the server in a separate process, then
+  1. connects --clients users, each of which sends JOIN and then reads
+     everything the server sends it,
+  2. has --senders of them post timestamped messages at --rate messages
+     per second in total, for --duration seconds,
+and reports messages/sec accepted and delivered, delivery latency
+percentiles, the server's CPU time per delivered message, how many
+messages its send calls carried on average (write coalescing), and its
+memory (per connected client) and thread count.
+
+The load runs on the same machine. On few cores the server competes with
+this script for CPU, and a thread-per-client server gets a larger share
+from the scheduler; CPU time per delivery compares the engines' cost
+independently of that.
+
+Usage:
+    python benchmark_chat.py [--engines asyncio threads] [--clients 2000] [--rate 200] [--protocol framed]
+
+--coalesce-delay overrides server.COALESCE_DELAY. With --protocol legacy
+the users speak the unframed text protocol, whose messages are never
+coalesced. When the
+server falls behind, messages it reads together are merged, and the
+delivered percentage shows how many were lost that way.
+
+Every join is announced to every user, so connecting N clients costs the
+server N*N/2 deliveries before the measurement starts.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import re
+import resource
+import signal
+import socket
+import sys
+import time
+
+import protocol
+import server
+
+BENCH_PORT = 19999
+OP_TIMEOUT = 10  # Seconds before a connect counts as failed
+STAMP = re.compile(rb'MSG\|[^|]*\|@(\d+\.\d+)@')
+ENCODERS = {
+    'framed': protocol.encode_frame,
+    'legacy': lambda msg_type, *args: protocol.encode_message(msg_type, *args).encode(),
+}
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def run_server(engine, coalesce_delay, stats_pipe):
+    raise_fd_limit()
+    # One line per message would dominate the measurement
+    sys.stdout = open(os.devnull, 'w')
+    server.HOST = '127.0.0.1'
+    server.PORT = BENCH_PORT
+    fanout = server.async_fanout if engine == 'asyncio' else server.fanout
+    fanout.coalesce_delay = coalesce_delay
+    # SIGUSR1: send the fan-out counters to the benchmark
+    signal.signal(signal.SIGUSR1, lambda signum, frame: stats_pipe.send(fanout.stats()))
+    if engine == 'asyncio':
+        asyncio.run(server.start_server_async())
+    else:
+        server.start_server()
+
+
+def process_stats(pid):
+    """RSS (MB), threads and CPU seconds used of a process (Linux)."""
+    stats = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    stats['rss_mb'] = int(line.split()[1]) / 1024
+                elif line.startswith('Threads:'):
+                    stats['threads'] = int(line.split()[1])
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        stats['cpu_s'] = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except OSError:
+        pass
+    return stats
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Port {port} did not come up")
+
+
+class User:
+    """A connected client that counts what it receives."""
+
+    def __init__(self, reader, writer, framed):
+        self.reader = reader
+        self.writer = writer
+        self.messages = 0
+        self.latencies = []
+        self.last_data = time.monotonic()
+        self.tail = b''
+        self.decoder = protocol.FrameDecoder() if framed else None
+        self.task = asyncio.create_task(self.receive())
+
+    async def receive(self):
+        try:
+            while data := await self.reader.read(65536):
+                now = time.time()
+                self.last_data = time.monotonic()
+                if self.decoder is not None:
+                    self.count_frames(data, now)
+                else:
+                    self.count_text(data, now)
+        except ConnectionError:
+            pass
+
+    def count_frames(self, data, now):
+        self.decoder.feed(data)
+        for msg_type, params in self.decoder:
+            if msg_type == protocol.TYPE_MSG:
+                self.messages += 1
+                if len(params) >= 2 and params[1].startswith('@'):
+                    self.latencies.append(now - float(params[1].strip('@')))
+
+    def count_text(self, data, now):
+        # Reads do not line up with messages: keep a short tail so
+        # a message split over two reads is counted once
+        window = self.tail + data
+        self.messages += window.count(b'MSG|') - self.tail.count(b'MSG|')
+        for match in STAMP.finditer(window):
+            if match.end() > len(self.tail):
+                self.latencies.append(now - float(match.group(1)))
+        self.tail = window[-64:]
+
+
+async def connect_users(count, framed, parallel=100):
+    users = []
+    failures = 0
+    sem = asyncio.Semaphore(parallel)
+
+    async def one(i):
+        nonlocal failures
+        async with sem:
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', BENCH_PORT), OP_TIMEOUT)
+            except (OSError, asyncio.TimeoutError):
+                failures += 1
+                return
+            writer.write(ENCODERS['framed' if framed else 'legacy'](protocol.TYPE_JOIN, f'bench{i}'))
+            users.append(User(reader, writer, framed))
+
+    await asyncio.gather(*(one(i) for i in range(count)))
+    return users, failures
+
+
+async def wait_quiet(users, quiet=1.0, timeout=600):
+    """Wait until no user has received anything for `quiet` seconds."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        await asyncio.sleep(quiet / 4)
+        if time.monotonic() - max(user.last_data for user in users) >= quiet:
+            return
+
+
+async def send_messages(senders, rate, duration, encoder):
+    interval = len(senders) / rate
+    sent = 0
+    deadline = time.monotonic() + duration
+
+    async def one(user):
+        nonlocal sent
+        next_send = time.monotonic()
+        while next_send < deadline:
+            user.writer.write(encoder(protocol.TYPE_MSG, f'@{time.time():.6f}@'))
+            sent += 1
+            next_send += interval
+            await asyncio.sleep(max(0, next_send - time.monotonic()))
+
+    await asyncio.gather(*(one(user) for user in senders))
+    return sent
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def fanout_stats(server_pid, stats_pipe):
+    os.kill(server_pid, signal.SIGUSR1)
+    if not stats_pipe.poll(OP_TIMEOUT):
+        return {}
+    return stats_pipe.recv()
+
+
+async def measure(server_pid, stats_pipe, args):
+    before = process_stats(server_pid)
+    started = time.monotonic()
+    users, failures = await connect_users(args.clients, args.protocol == 'framed')
+    await wait_quiet(users)
+    join_time = time.monotonic() - started
+    connected = process_stats(server_pid)
+    sends_before = fanout_stats(server_pid, stats_pipe)
+
+    for user in users:
+        user.messages = 0
+        user.latencies.clear()
+    started = time.monotonic()
+    sent = await send_messages(users[:args.senders], args.rate, args.duration, ENCODERS[args.protocol])
+    await wait_quiet(users)
+    elapsed = time.monotonic() - started
+    under_load = process_stats(server_pid)
+    sends_after = fanout_stats(server_pid, stats_pipe)
+
+    for user in users:
+        user.writer.close()
+        user.task.cancel()
+    delivered = sum(user.messages for user in users)
+    cpu = under_load.get('cpu_s', 0) - connected.get('cpu_s', 0)
+    sends = {key: sends_after.get(key, 0) - sends_before.get(key, 0) for key in ('messages_sent', 'send_calls')}
+    latencies = sorted(latency for user in users for latency in user.latencies)
+    rss_growth = connected.get('rss_mb', 0) - before.get('rss_mb', 0)
+    return {
+        'connected': len(users),
+        'failed': failures,
+        'join_s': join_time,
+        'sent_per_s': sent / args.duration,
+        'delivered_per_s': delivered / elapsed,
+        'delivered_pct': 100 * delivered / (sent * (len(users) - 1)) if sent and len(users) > 1 else 0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'cpu_us_per_delivery': 1e6 * cpu / delivered if delivered else 0,
+        'messages_per_send': sends['messages_sent'] / sends['send_calls'] if sends['send_calls'] else 0,
+        'rss_mb': under_load.get('rss_mb', 0),
+        'kb_per_client': 1024 * rss_growth / len(users) if users else 0,
+        'threads': connected.get('threads', 0),
+    }
+
+
+def bench(engine, args):
+    ctx = multiprocessing.get_context('fork')
+    stats_pipe, server_end = ctx.Pipe()
+    chat_server = ctx.Process(target=run_server, args=(engine, args.coalesce_delay, server_end), daemon=True)
+    chat_server.start()
+    wait_for_port(BENCH_PORT)
+    # The probe connection above is a client too; let the server forget it
+    time.sleep(0.5)
+    try:
+        return asyncio.run(measure(chat_server.pid, stats_pipe, args))
+    finally:
+        chat_server.terminate()
+        chat_server.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--engines', nargs='+', choices=['asyncio', 'threads'], default=['asyncio', 'threads'])
+    parser.add_argument('--clients', type=int, default=2000, help="users connected and joined")
+    parser.add_argument('--senders', type=int, default=20, help="users that post messages")
+    parser.add_argument('--rate', type=float, default=20, help="messages per second, all senders together")
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--protocol', choices=['framed', 'legacy'], default='framed', help="wire format the users speak")
+    parser.add_argument('--coalesce-delay', type=float, default=server.COALESCE_DELAY,
+                        help="seconds the server lets messages gather before a send")
+    args = parser.parse_args()
+
+    limit = raise_fd_limit()
+    needed = args.clients + 100
+    if limit < needed:
+        sys.exit(f"Need about {needed} file descriptors per process, limit is {limit}: lower --clients")
+
+    print(f"CPU cores: {os.cpu_count()}, {args.clients} clients ({args.protocol}), {args.senders} senders, "
+          f"{args.rate:g} messages/s for {args.duration:g}s, coalesce delay {1000 * args.coalesce_delay:g} ms")
+    header = (f"{'engine':<8} {'clients':>8} {'failed':>7} {'join s':>7} {'sent/s':>8} {'deliv/s':>9} "
+              f"{'deliv %':>8} {'p50 ms':>8} {'p99 ms':>8} {'CPU us/deliv':>13} {'msgs/send':>10} {'RSS MB':>7} {'KB/client':>10} {'threads':>8}")
+    print(header)
+    for engine in args.engines:
+        r = bench(engine, args)
+        print(f"{engine:<8} {r['connected']:>8} {r['failed']:>7} {r['join_s']:>7.1f} {r['sent_per_s']:>8.0f} "
+              f"{r['delivered_per_s']:>9.0f} {r['delivered_pct']:>8.1f} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f} "
+              f"{r['cpu_us_per_delivery']:>13.1f} {r['messages_per_send']:>10.1f} {r['rss_mb']:>7.0f} {r['kb_per_client']:>10.1f} {r['threads']:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -8,46 +8,69 @@ import protocol
 DEFAULT_HOST = '127.0.0.1'
 DEFAULT_PORT = 9999
 
-def listen_for_messages(sock):
+def show_message(msg_type, params):
+    if msg_type == protocol.TYPE_MSG:
+        # MSG|username|content
+        if len(params) >= 2:
+            sender = params[0]
+            content = params[1]
+            print(f"\r[{sender}]: {content}")
+            print("> ", end="", flush=True) # Restore prompt
+        else:
+            print(f"\r[MSG] {params}")
+            print("> ", end="", flush=True)
+
+    elif msg_type == protocol.TYPE_INFO:
+        # INFO|content
+        if params:
+            print(f"\r[INFO] {params[0]}")
+            print("> ", end="", flush=True)
+
+    elif msg_type == protocol.TYPE_ERROR:
+        if params:
+            print(f"\r[ERROR] {params[0]}")
+            print("> ", end="", flush=True)
+
+    elif msg_type == protocol.TYPE_JOIN:
+        pass # The server accepted frames (see join())
+
+    else:
+        # Raw fallback
+        print(f"\r{protocol.encode_message(msg_type, *params)}")
+        print("> ", end="", flush=True)
+
+def join(sock, username):
+    """
+    Sends JOIN offering frames and waits for the server's first reply,
+    which shows whether it accepted them (see protocol.py).
+    Returns:
+        protocol.Codec: the format to use from now on, or None if the
+        server closed the connection.
+    """
+    sock.sendall(protocol.encode_message(protocol.TYPE_JOIN, username, protocol.FRAMING_OFFER).encode('utf-8'))
+    data = sock.recv(4096)
+    if not data:
+        return None
+    codec = protocol.Codec(protocol.is_framed(data))
+    for msg_type, params in codec.messages(data):
+        show_message(msg_type, params)
+    return codec
+
+def listen_for_messages(sock, codec):
     """
     Thread function to listen for incoming messages from the server.
+    With frames a read may hold several messages, or part of one; the
+    decoder keeps the rest for the next read.
     """
     while True:
         try:
-            data = sock.recv(1024)
+            data = sock.recv(4096)
             if not data:
                 print("\n[!] Disconnected from server.")
                 break # Server closed connection
-            
-            message_str = data.decode('utf-8')
-            msg_type, params = protocol.decode_message(message_str)
-
-            if msg_type == protocol.TYPE_MSG:
-                # MSG|username|content
-                if len(params) >= 2:
-                    sender = params[0]
-                    content = params[1]
-                    print(f"\r[{sender}]: {content}")
-                    print("> ", end="", flush=True) # Restore prompt
-                else:
-                    print(f"\r[MSG] {params}")
-                    print("> ", end="", flush=True)
-
-            elif msg_type == protocol.TYPE_INFO:
-                # INFO|content
-                if params:
-                    print(f"\r[INFO] {params[0]}")
-                    print("> ", end="", flush=True)
-
-            elif msg_type == protocol.TYPE_ERROR:
-                if params:
-                    print(f"\r[ERROR] {params[0]}")
-                    print("> ", end="", flush=True)
-            
-            else:
-                # Raw fallback
-                print(f"\r{message_str}")
-                print("> ", end="", flush=True)
+
+            for msg_type, params in codec.messages(data):
+                show_message(msg_type, params)
 
         except ConnectionAbortedError:
             break
@@ -80,12 +103,19 @@ def start_client():
 
     # User Setup
     username = input("Enter your username: ")
-    # Send JOIN
-    join_msg = protocol.encode_message(protocol.TYPE_JOIN, username)
-    client_sock.sendall(join_msg.encode('utf-8'))
+    # Send JOIN, and use frames if the server accepts them
+    try:
+        codec = join(client_sock, username)
+    except Exception as e:
+        print(f"[!] Unable to join: {e}")
+        codec = None
+    if codec is None:
+        print("[!] Disconnected from server.")
+        client_sock.close()
+        return
 
     # Start listener thread
-    listen_thread = threading.Thread(target=listen_for_messages, args=(client_sock,))
+    listen_thread = threading.Thread(target=listen_for_messages, args=(client_sock, codec))
     listen_thread.daemon = True
     listen_thread.start()
 
@@ -97,16 +127,14 @@ def start_client():
         while True:
             msg = input("> ")
             if msg.lower() == '/quit':
-                leave_msg = protocol.encode_message(protocol.TYPE_LEAVE, username)
-                client_sock.sendall(leave_msg.encode('utf-8'))
+                client_sock.sendall(codec.encode(protocol.TYPE_LEAVE, username))
                 break
             
             # Send MSG
             # Note: Protocol expects MSG|content
             # Client doesn't need to send username in MSG, server knows it from socket
             if msg.strip():
-                chat_packet = protocol.encode_message(protocol.TYPE_MSG, msg)
-                client_sock.sendall(chat_packet.encode('utf-8'))
+                client_sock.sendall(codec.encode(protocol.TYPE_MSG, msg))
                 
     except KeyboardInterrupt:
         print("\n[*] Exiting...")
@@ -17,6 +17,7 @@ class ChatClientGUI:
         self.port = port
         self.sock = None
         self.username = None
+        self.codec = None # Wire format, settled by the JOIN
         self.running = True
 
         self.setup_ui()
@@ -61,38 +62,40 @@ class ChatClientGUI:
             if not self.username:
                 self.username = "Guest"
             
-            # Send Join
-            join_msg = protocol.encode_message(protocol.TYPE_JOIN, self.username)
-            self.sock.sendall(join_msg.encode('utf-8'))
+            # Send Join offering frames; the first reply shows whether the server accepted them
+            self.sock.sendall(protocol.encode_message(protocol.TYPE_JOIN, self.username, protocol.FRAMING_OFFER).encode('utf-8'))
+            data = self.sock.recv(4096)
+            if not data:
+                raise ConnectionError("the server closed the connection")
+            self.codec = protocol.Codec(protocol.is_framed(data))
 
             # Start listening thread
-            threading.Thread(target=self.listen_loop, daemon=True).start()
+            threading.Thread(target=self.listen_loop, args=(data,), daemon=True).start()
 
         except Exception as e:
             messagebox.showerror("Connection Error", f"Could not connect to server: {e}")
             self.master.destroy()
 
-    def listen_loop(self):
+    def listen_loop(self, data):
         while self.running:
             try:
-                data = self.sock.recv(1024)
+                # With frames a read may hold several messages, or part of one
+                for msg_type, params in self.codec.messages(data):
+                    if msg_type == protocol.TYPE_MSG:
+                        if len(params) >= 2:
+                            sender, content = params[0], params[1]
+                            self.display_chat_message(sender, content)
+                    elif msg_type == protocol.TYPE_INFO:
+                        if params:
+                            self.display_message(f"[INFO] {params[0]}", "info")
+                    elif msg_type == protocol.TYPE_ERROR:
+                        if params:
+                            self.display_message(f"[ERROR] {params[0]}", "error")
+
+                data = self.sock.recv(4096)
                 if not data:
                     self.display_message("Disconnected from server.", "error")
                     break
-                
-                message_str = data.decode('utf-8')
-                msg_type, params = protocol.decode_message(message_str)
-                
-                if msg_type == protocol.TYPE_MSG:
-                    if len(params) >= 2:
-                        sender, content = params[0], params[1]
-                        self.display_chat_message(sender, content)
-                elif msg_type == protocol.TYPE_INFO:
-                    if params:
-                        self.display_message(f"[INFO] {params[0]}", "info")
-                elif msg_type == protocol.TYPE_ERROR:
-                     if params:
-                        self.display_message(f"[ERROR] {params[0]}", "error")
 
             except Exception:
                 break
@@ -121,8 +124,7 @@ class ChatClientGUI:
         
         try:
             # Send to server
-            packet = protocol.encode_message(protocol.TYPE_MSG, msg)
-            self.sock.sendall(packet.encode('utf-8'))
+            self.sock.sendall(self.codec.encode(protocol.TYPE_MSG, msg))
             
             # Clear input
             self.msg_entry.delete(0, tk.END)
@@ -138,7 +140,7 @@ class ChatClientGUI:
         self.running = False
         try:
             if self.sock:
-                self.sock.sendall(protocol.encode_message(protocol.TYPE_LEAVE).encode('utf-8'))
+                self.sock.sendall(self.codec.encode(protocol.TYPE_LEAVE))
                 self.sock.close()
         except:
             pass
@@ -0,0 +1,381 @@
+"""
+Broadcast fan-out for the chat server.
+
+A broadcast never waits for a client. The message is encoded once, and the
+same bytes object is appended to a bounded outbox for each recipient. A
+single writer thread drains the outboxes with non-blocking sends. When a
+client's kernel buffer is full, its socket waits in a selector until it is
+writable again; the other clients are not held up. So the time to deliver
+a message does not depend on the slowest client.
+
+A client that lets more than `max_pending` bytes pile up in its outbox is a
+slow consumer. The policy decides what happens to it:
+  disconnect - the connection is shut down (its handler then cleans up)
+  drop       - new messages are discarded for that client until it catches up
+
+Only the writer thread sends on, or closes, a registered socket. Handlers
+call remove() instead of closing their socket, so a file descriptor is
+never reused while the selector still holds it.
+
+Writes are coalesced. Once a message is queued, the writer waits up to
+`coalesce_delay` for more, then sends everything an outbox holds, up to
+`max_batch_bytes`, with one sendmsg() call. In a busy room one syscall
+then carries many messages to a client instead of one each. Messages
+sent with coalesce=False (clients of the legacy text protocol, which
+read one message per recv()) still go out one per call.
+
+TransportFanOut applies the same policy and batching in the asyncio
+engine, where each client's transport already is a non-blocking outbox.
+"""
+
+import asyncio
+import itertools
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+
+# Send without blocking even though the handler threads use blocking recv().
+# Windows has no MSG_DONTWAIT; there a send to a client whose buffer is full
+# still blocks the writer until that client reads.
+SEND_FLAGS = getattr(socket, 'MSG_DONTWAIT', 0)
+
+POLICIES = ('disconnect', 'drop')
+
+# Most buffers one sendmsg() accepts (IOV_MAX on Linux)
+MAX_BATCH_BUFFERS = 1024
+
+
+def send_batch(sock, buffers):
+    """
+    Send a list of buffers with one call, without blocking.
+    Returns:
+        int: bytes sent.
+    """
+    if hasattr(sock, 'sendmsg'):
+        return sock.sendmsg(buffers, [], SEND_FLAGS)
+    return sock.send(b''.join(buffers), SEND_FLAGS)  # Windows has no sendmsg()
+
+
+class Outbox:
+    def __init__(self, sock):
+        self.sock = sock
+        self.queue = deque()  # Encoded messages, oldest first
+        self.offset = 0  # Bytes of queue[0] already sent
+        self.pending = 0  # Bytes queued and not yet sent
+        self.waiting = False  # Registered in the selector for writability
+        self.slow = False  # Over the limit with the 'disconnect' policy
+        self.shut_down = False
+        self.removed = False
+        self.dropped = 0
+        self.coalesce = True  # False: one message per send
+
+
+class FanOut:
+    def __init__(self, max_pending=256 * 1024, policy='disconnect', coalesce_delay=0.002, max_batch_bytes=64 * 1024):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow client policy '{policy}' (use 'disconnect' or 'drop')")
+        self.max_pending = max_pending
+        self.policy = policy
+        self.coalesce_delay = coalesce_delay
+        self.max_batch_bytes = max_batch_bytes
+        self.outboxes = {}  # socket -> Outbox
+        self.ready = set()  # Outboxes the writer should look at
+        self.ready_since = 0.0  # When the first of them became ready
+        self.lock = threading.Lock()
+        self.selector = selectors.DefaultSelector()
+        # Wakes the writer out of select() when there is new work
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+        self.thread = None
+
+        # Stats for reporting
+        self.messages_sent = 0
+        self.messages_dropped = 0
+        self.slow_disconnects = 0
+        self.send_calls = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='fanout', daemon=True)
+        self.thread.start()
+
+    def add(self, sock):
+        with self.lock:
+            self.outboxes[sock] = Outbox(sock)
+
+    def remove(self, sock):
+        """Stop sending to `sock` and close it (on the writer thread)."""
+        with self.lock:
+            outbox = self.outboxes.pop(sock, None)
+            if outbox is None:
+                return
+            outbox.removed = True
+            wake = self.mark_ready(outbox)
+        if wake:
+            self.wake()
+
+    def send(self, sock, data, coalesce=True):
+        """Queue `data` for one client."""
+        self.send_many([sock], data, coalesce)
+
+    def send_many(self, socks, data, coalesce=True):
+        """
+        Queue the same encoded message for every socket in `socks`.
+        With coalesce=False each message to these clients is sent on its own.
+        """
+        wake = False
+        with self.lock:
+            for sock in socks:
+                outbox = self.outboxes.get(sock)
+                if outbox is not None:
+                    outbox.coalesce = coalesce
+                    wake |= self.enqueue(outbox, data)
+        if wake:
+            self.wake()
+
+    def mark_ready(self, outbox):
+        """
+        Hand an outbox to the writer (lock held).
+        Returns:
+            bool: True if the writer was idle and must be woken.
+        """
+        idle = not self.ready
+        if idle:
+            self.ready_since = time.monotonic()
+        self.ready.add(outbox)
+        return idle
+
+    def enqueue(self, outbox, data):
+        """
+        Apply the slow-consumer policy and queue `data` (lock held).
+        Returns:
+            bool: True if the writer must be woken.
+        """
+        if outbox.slow:
+            return False
+        if outbox.pending + len(data) > self.max_pending:
+            if self.policy == 'drop':
+                outbox.dropped += 1
+                self.messages_dropped += 1
+                return False
+            # Disconnect: forget what it has not read, let the writer shut it down
+            outbox.slow = True
+            outbox.queue.clear()
+            outbox.pending = outbox.offset = 0
+            return self.mark_ready(outbox)
+        outbox.queue.append(data)
+        outbox.pending += len(data)
+        if outbox.waiting:
+            return False  # Flushed when its socket is writable again
+        return self.mark_ready(outbox)
+
+    def wake(self):
+        try:
+            self.wake_w.send(b'\0')
+        except BlockingIOError:
+            pass  # Already plenty of wake-ups pending
+
+    def run(self):
+        timeout = None
+        while True:
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is self.wake_r:
+                    try:
+                        while self.wake_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self.flush(key.data)
+            with self.lock:
+                # Let messages gather for up to coalesce_delay after the first
+                timeout = self.ready_since + self.coalesce_delay - time.monotonic() if self.ready else None
+                if timeout is not None and timeout > 0:
+                    continue
+                timeout = None
+                ready, self.ready = self.ready, set()
+            for outbox in ready:
+                self.flush(outbox)
+
+    def flush(self, outbox):
+        """Send as much of an outbox as the socket takes without blocking."""
+        if outbox.removed or outbox.slow:
+            self.close(outbox)
+            return
+        while True:
+            with self.lock:
+                if not outbox.queue:
+                    # Under the lock, so a message queued now sees waiting=False
+                    self.set_waiting(outbox, False)
+                    return
+                buffers = self.next_batch(outbox)
+            try:
+                sent = send_batch(outbox.sock, buffers)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                # Connection is gone; its handler sees that on recv() and removes it
+                with self.lock:
+                    outbox.queue.clear()
+                    outbox.pending = outbox.offset = 0
+                    self.set_waiting(outbox, False)
+                return
+            with self.lock:
+                if outbox.slow:
+                    return  # Its queue was cleared meanwhile; already in ready
+                self.send_calls += 1
+                self.consume(outbox, sent)
+                if sent == sum(len(buffer) for buffer in buffers):
+                    continue
+                # Socket buffer is full: resume when it drains
+                self.set_waiting(outbox, True)
+                return
+
+    def next_batch(self, outbox):
+        """The queued messages the next send carries (lock held)."""
+        buffers = [memoryview(outbox.queue[0])[outbox.offset:]]
+        if not outbox.coalesce:
+            return buffers
+        size = len(buffers[0])
+        for data in itertools.islice(outbox.queue, 1, MAX_BATCH_BUFFERS):
+            if size + len(data) > self.max_batch_bytes:
+                break
+            buffers.append(data)
+            size += len(data)
+        return buffers
+
+    def consume(self, outbox, sent):
+        """Drop `sent` bytes from the front of an outbox (lock held)."""
+        outbox.pending -= sent
+        sent += outbox.offset
+        while outbox.queue and sent >= len(outbox.queue[0]):
+            sent -= len(outbox.queue.popleft())
+            self.messages_sent += 1
+        outbox.offset = sent
+
+    def set_waiting(self, outbox, enabled):
+        if enabled and not outbox.waiting:
+            self.selector.register(outbox.sock, selectors.EVENT_WRITE, outbox)
+        elif not enabled and outbox.waiting:
+            self.selector.unregister(outbox.sock)
+        outbox.waiting = enabled
+
+    def close(self, outbox):
+        self.set_waiting(outbox, False)
+        if outbox.removed:
+            outbox.sock.close()
+        elif not outbox.shut_down:
+            # The handler's recv() then returns and it calls remove()
+            outbox.shut_down = True
+            self.slow_disconnects += 1
+            try:
+                peer = outbox.sock.getpeername()
+            except OSError:
+                peer = '?'
+            print(f"[!] Disconnecting slow client {peer}: more than {self.max_pending} bytes unread")
+            try:
+                outbox.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                'clients': len(self.outboxes),
+                'messages_sent': self.messages_sent,
+                'messages_dropped': self.messages_dropped,
+                'slow_disconnects': self.slow_disconnects,
+                'send_calls': self.send_calls,
+                'syscalls_saved': self.messages_sent - self.send_calls,
+                'pending_bytes': sum(outbox.pending for outbox in self.outboxes.values()),
+            }
+
+
+class TransportFanOut:
+    """
+    Slow-consumer policy and write coalescing for asyncio transports.
+    transport.write() never blocks: what the socket does not take is
+    buffered by the transport, and get_write_buffer_size() is how far
+    behind the client is.
+
+    Coalesced messages wait in a per-transport batch. One loop callback,
+    `coalesce_delay` after the first, hands every batch to its transport
+    with a single writelines(), and a batch that reaches `max_batch_bytes`
+    is written at once.
+    """
+
+    def __init__(self, max_pending=256 * 1024, policy='disconnect', coalesce_delay=0.002, max_batch_bytes=64 * 1024):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow client policy '{policy}' (use 'disconnect' or 'drop')")
+        self.max_pending = max_pending
+        self.policy = policy
+        self.coalesce_delay = coalesce_delay
+        self.max_batch_bytes = max_batch_bytes
+        self.batches = {}  # transport -> [messages, bytes]
+        self.flush_handle = None
+
+        # Stats for reporting
+        self.messages_sent = 0
+        self.messages_dropped = 0
+        self.slow_disconnects = 0
+        self.send_calls = 0
+
+    def send_many(self, transports, data, coalesce=True):
+        """
+        Write the same encoded message to every transport in `transports`.
+        With coalesce=False it is written to each of them on its own.
+        """
+        for transport in transports:
+            if transport.is_closing():
+                continue
+            batch = self.batches.get(transport)
+            batched = batch[1] if batch else 0
+            if transport.get_write_buffer_size() + batched + len(data) > self.max_pending:
+                if self.policy == 'drop':
+                    self.messages_dropped += 1
+                    continue
+                self.slow_disconnects += 1
+                print(f"[!] Disconnecting slow client {transport.get_extra_info('peername')}: "
+                      f"more than {self.max_pending} bytes unread")
+                self.batches.pop(transport, None)
+                # abort(): close() would wait to flush what the client is not reading
+                transport.abort()
+                continue
+            if not coalesce:
+                transport.write(data)
+                self.messages_sent += 1
+                self.send_calls += 1
+                continue
+            if batch is None:
+                batch = self.batches[transport] = [[], 0]
+            batch[0].append(data)
+            batch[1] += len(data)
+            if batch[1] >= self.max_batch_bytes:
+                self.flush(transport)
+        if self.batches and self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.coalesce_delay, self.flush_all)
+
+    def flush(self, transport):
+        messages, _ = self.batches.pop(transport)
+        if transport.is_closing():
+            return
+        transport.writelines(messages)
+        self.messages_sent += len(messages)
+        self.send_calls += 1
+
+    def flush_all(self):
+        self.flush_handle = None
+        for transport in list(self.batches):
+            self.flush(transport)
+
+    def stats(self):
+        return {
+            'messages_sent': self.messages_sent,
+            'messages_dropped': self.messages_dropped,
+            'slow_disconnects': self.slow_disconnects,
+            'send_calls': self.send_calls,
+            'syscalls_saved': self.messages_sent - self.send_calls,
+        }
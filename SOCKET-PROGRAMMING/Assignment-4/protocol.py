@@ -2,8 +2,35 @@
 """
 Shared protocol definition for the Chat Server.
 Defines message types and helper functions for encoding/decoding.
+
+Two wire formats:
+  legacy - `TYPE|arg1|arg2` text, one message per send. The receiver
+           assumes one recv() is one message, so messages that TCP
+           delivers together are glued, long ones are split, and a `|`
+           inside chat content shifts the fields.
+  framed - every message is a frame: a 4-byte big-endian payload length,
+           then the payload, which is the type and each argument as a
+           2-byte big-endian length followed by that many bytes of UTF-8.
+           No character is special, so any text survives.
+
+The format is negotiated at JOIN. A client that can use frames sends a
+text JOIN that offers them, `JOIN|username|FRAMED`. A server that speaks
+frames acknowledges with a JOIN frame carrying the name it assigned,
+and both sides use frames from then on. A server that only
+knows the text format reads the offer as an extra argument, joins the
+user and answers in text; the client sees that the first reply is not a
+frame and stays on text. A client waits for that first reply before it
+sends anything else, so the offer is never glued to the next message.
+
+A client that knows the server frames may also send its JOIN directly as
+a frame. A frame length is below MAX_FRAME_SIZE (16 MB at most), so the
+first byte of a frame is always 0, while a text JOIN starts with 'J'.
+A legacy client that sends a plain JOIN stays on text. The server
+answers each client in that client's format.
 """
 
+import struct
+
 # Separator used in messages
 SEPARATOR = "|"
 
@@ -14,6 +41,18 @@ TYPE_LEAVE = "LEAVE"
 TYPE_INFO = "INFO"   # Server notifications (e.g., user joined)
 TYPE_ERROR = "ERROR" # Error messages
 
+# Last JOIN argument of a client that can switch to frames
+FRAMING_OFFER = "FRAMED"
+
+# Framed format
+FRAME_HEADER = struct.Struct('!I') # Payload length
+FIELD_HEADER = struct.Struct('!H') # Length of one field in the payload
+MAX_FIELD_SIZE = 0xFFFF # Longest field a field header can describe
+MAX_FRAME_SIZE = 64 * 1024 # Longer frames are a protocol error (and keep the first byte 0)
+
+class ProtocolError(ValueError):
+    """The peer sent something that is not a valid frame."""
+
 def encode_message(msg_type, *args):
     """
     Encodes arguments into a protocol message string.
@@ -35,3 +74,118 @@ def decode_message(message_str):
     msg_type = parts[0]
     params = parts[1:] if len(parts) > 1 else []
     return msg_type, params
+
+def is_framed(data):
+    """True if `data`, the first bytes a client sent, start a frame."""
+    return data[:1] == b'\0'
+
+def encode_frame(msg_type, *args):
+    """
+    Encodes a message as one frame.
+    Returns:
+        bytes: length header and payload.
+    Raises:
+        ProtocolError: if a field is longer than a field header can hold.
+    """
+    parts = []
+    for field in (msg_type,) + args:
+        data = field.encode('utf-8')
+        if len(data) > MAX_FIELD_SIZE:
+            raise ProtocolError(f"Field of {len(data)} bytes (limit {MAX_FIELD_SIZE})")
+        parts += (FIELD_HEADER.pack(len(data)), data)
+    payload = b''.join(parts)
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+def encode(framed, msg_type, *args):
+    """A message in the framed or the legacy format, as bytes."""
+    if framed:
+        return encode_frame(msg_type, *args)
+    return encode_message(msg_type, *args).encode('utf-8')
+
+def decode_frame(payload):
+    """
+    Decodes a frame payload (any bytes-like object) into (type, params_list).
+    Raises:
+        ProtocolError: if a field runs past the end of the payload.
+        UnicodeDecodeError: if a field is not UTF-8.
+    """
+    fields = []
+    pos = 0
+    while pos < len(payload):
+        if len(payload) - pos < FIELD_HEADER.size:
+            raise ProtocolError("Truncated field header")
+        (length,) = FIELD_HEADER.unpack_from(payload, pos)
+        pos += FIELD_HEADER.size
+        if pos + length > len(payload):
+            raise ProtocolError(f"Field of {length} bytes runs past the end of the frame")
+        fields.append(str(payload[pos:pos + length], 'utf-8'))
+        pos += length
+    if not fields:
+        raise ProtocolError("Empty frame")
+    return fields[0], fields[1:]
+
+class FrameDecoder:
+    """
+    Incremental decoder for the framed format. Received bytes are
+    appended to one bytearray, and messages are decoded straight from it
+    through a memoryview, so a frame is never copied into bytes of its own.
+    The consumed prefix is removed once per batch, not once per frame.
+    A partial frame stays buffered until the rest of it arrives.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data):
+        self.buffer += data
+
+    def __iter__(self):
+        """
+        Yields (type, params_list) for every complete frame buffered.
+        Raises:
+            ProtocolError: if a frame is longer than max_frame_size or
+                its fields do not fill it exactly.
+            UnicodeDecodeError: if a field is not UTF-8.
+        """
+        buffer = self.buffer
+        pos = 0
+        try:
+            with memoryview(buffer) as view:
+                while len(buffer) - pos >= FRAME_HEADER.size:
+                    (length,) = FRAME_HEADER.unpack_from(buffer, pos)
+                    if length > self.max_frame_size:
+                        raise ProtocolError(f"Frame of {length} bytes (limit {self.max_frame_size})")
+                    start = pos + FRAME_HEADER.size
+                    if start + length > len(buffer):
+                        break
+                    pos = start + length
+                    yield decode_frame(view[start:pos])
+        finally:
+            # The view is released by now, so the buffer can shrink
+            del buffer[:pos]
+
+class Codec:
+    """
+    Encodes and decodes the messages of one connection in the format it
+    uses. In the legacy format one read is one message.
+    """
+
+    def __init__(self, framed):
+        self.framed = framed
+        self.decoder = FrameDecoder() if framed else None
+
+    def encode(self, msg_type, *args):
+        return encode(self.framed, msg_type, *args)
+
+    def messages(self, data):
+        """
+        Yields (type, params_list) for each complete message in `data`.
+        Raises:
+            ProtocolError: if a frame is oversized or malformed.
+        """
+        if self.framed:
+            self.decoder.feed(data)
+            yield from self.decoder
+        else:
+            yield decode_message(data.decode('utf-8'))
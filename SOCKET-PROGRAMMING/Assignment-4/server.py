@@ -1,126 +1,282 @@
-
+import argparse
+import asyncio
 import socket
 import threading
 import sys
 import protocol
+from fanout import FanOut, TransportFanOut
 
 # Configuration
 HOST = '0.0.0.0'
 PORT = 9999
+SERVER_ENGINE = 'asyncio' # 'asyncio' (one event loop for every client) or 'threads' (thread per client)
+LISTEN_BACKLOG = 1024 # Pending connections queued by the kernel (a burst of joins)
+MAX_PENDING_BYTES = 256 * 1024 # Unread bytes a client may fall behind by
+SLOW_CLIENT_POLICY = 'disconnect' # 'disconnect' or 'drop' (skip messages until it catches up)
+READ_BUFFER_LIMIT = 8192 # asyncio engine: bytes buffered from a client before reading from it pauses
+COALESCE_DELAY = 0.002 # Seconds a message may wait so it can share a send with the next ones
+MAX_BATCH_BYTES = 64 * 1024 # Most bytes sent to one client in one call
 
 # Global state
-clients = {} # mapping: socket -> username
+clients = {} # mapping: socket -> ThreadedConnection
 clients_lock = threading.Lock()
 
-def broadcast(message_str, exclude_socket=None):
+# Every write to a client goes through its outbox (see fanout.py)
+fanout = FanOut(MAX_PENDING_BYTES, SLOW_CLIENT_POLICY, COALESCE_DELAY, MAX_BATCH_BYTES)
+
+def encode_for(recipients, msg_type, *args):
+    """
+    Groups recipients by wire format and encodes the message once per group.
+    Returns:
+        list: (encoded bytes, [recipient, ...], framed) tuples. Only frames
+        may be coalesced: a legacy client reads one message per recv().
+    """
+    groups = {False: [], True: []}
+    for key, conn in recipients:
+        groups[conn.framed].append(key)
+    return [(protocol.encode(framed, msg_type, *args), keys, framed) for framed, keys in groups.items() if keys]
+
+class Connection:
+    """
+    One client, in either engine. The first bytes it sends decide its wire
+    format: a framed JOIN switches it to frames, anything else is legacy
+    text, where one read is one message. A text JOIN that offers frames
+    switches it to frames once the server has acknowledged (see protocol.py).
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.username = None
+        self.codec = None # Unknown until the first read
+
+    @property
+    def framed(self):
+        return self.codec is not None and self.codec.framed
+
+    def messages(self, data):
+        """
+        Yields (type, params) for each complete message in `data`.
+        Raises:
+            protocol.ProtocolError: if a framed client sends an oversized or malformed frame.
+        """
+        if self.codec is None:
+            self.codec = protocol.Codec(protocol.is_framed(data))
+        yield from self.codec.messages(data)
+
+    def use_frames(self):
+        """Switch a legacy client that offered frames to them."""
+        self.codec = protocol.Codec(True)
+
+    def reply(self, msg_type, *args):
+        """Sends a message to this client only."""
+        self.send(self.codec.encode(msg_type, *args))
+
+def handle_message(conn, msg_type, params):
     """
-    Sends a raw message string to all connected clients.
+    Apply one protocol message from a client. Shared by both engines;
+    `conn` is a ThreadedConnection or an AsyncConnection.
+    Returns:
+        bool: False once the client has sent LEAVE.
     """
-    with clients_lock:
-        for client_sock in clients:
-            if client_sock != exclude_socket:
-                try:
-                    client_sock.sendall(message_str.encode('utf-8'))
-                except Exception as e:
-                    print(f"[!] Error broadcasting to a client: {e}")
-                    # We could remove the client here, but handle_client loop deals with it usually.
+    if msg_type == protocol.TYPE_JOIN:
+        # Client wants to join: JOIN|username, or JOIN|username|FRAMED
+        if params:
+            username = params[0]
+            # Check if empty
+            if not username:
+                username = f"User-{conn.address[1]}"
+            if params[1:] == [protocol.FRAMING_OFFER] and not conn.framed:
+                # A framed client keeps its decoder, and whatever it has buffered
+                conn.use_frames()
+            if conn.framed:
+                # Acknowledges frames before anything else is sent in them
+                conn.reply(protocol.TYPE_JOIN, username)
+            conn.join(username)
+
+            print(f"[*] User '{username}' joined from {conn.address}")
+
+            # Notify everyone
+            conn.broadcast(protocol.TYPE_INFO, f"{username} has joined the chat.")
+        else:
+            # Invalid JOIN
+            conn.reply(protocol.TYPE_ERROR, "Invalid JOIN format.")
+
+    elif msg_type == protocol.TYPE_MSG:
+        # Client sent a message: MSG|content
+        if not conn.username:
+            conn.reply(protocol.TYPE_ERROR, "You must JOIN first.")
+            return True
+
+        if params:
+            content = params[0]
+            # Broadcast: MSG|username|content
+            # We reconstruct it closer to the prompt requirement: MSG|<username>|<message>
+            conn.broadcast(protocol.TYPE_MSG, conn.username, content, include_self=False)
+            print(f"[{conn.username}]: {content}")
+
+    elif msg_type == protocol.TYPE_LEAVE:
+        print(f"[-] {conn.username} sent LEAVE.")
+        return False # Stop reading and clean up
+
+    else:
+        print(f"[!] Unknown message type from {conn.address}: {msg_type}")
+    return True
+
+def announce_leave(conn):
+    if conn.username:
+        print(f"[-] User '{conn.username}' disconnected.")
+        conn.broadcast(protocol.TYPE_INFO, f"{conn.username} has left the chat.")
+
+# --- threads engine: one thread per client ---
+
+class ThreadedConnection(Connection):
+    def __init__(self, sock, address):
+        super().__init__(address)
+        self.sock = sock
+
+    def join(self, username):
+        self.username = username
+        with clients_lock:
+            clients[self.sock] = self
+
+    def send(self, data):
+        fanout.send(self.sock, data, coalesce=self.framed)
+
+    def broadcast(self, msg_type, *args, include_self=True):
+        """
+        Sends a message to all joined clients.
+        Only queues it: a slow client never delays the sender or the others.
+        """
+        with clients_lock:
+            recipients = [(sock, conn) for sock, conn in clients.items() if include_self or sock is not self.sock]
+        for data, socks, framed in encode_for(recipients, msg_type, *args):
+            fanout.send_many(socks, data, coalesce=framed)
 
 def handle_client(client_socket, client_address):
     print(f"[+] New connection from {client_address}")
-    username = None
+    conn = ThreadedConnection(client_socket, client_address)
+    fanout.add(client_socket)
 
     try:
         while True:
             data = client_socket.recv(1024)
             if not data:
                 break
-            
-            message_str = data.decode('utf-8')
-            msg_type, params = protocol.decode_message(message_str)
-
-            if msg_type == protocol.TYPE_JOIN:
-                # Client wants to join: JOIN|username
-                if params:
-                    username = params[0]
-                    # Check if empty
-                    if not username:
-                        username = f"User-{client_address[1]}"
-                    
-                    with clients_lock:
-                        clients[client_socket] = username
-                    
-                    print(f"[*] User '{username}' joined from {client_address}")
-                    
-                    # Notify everyone
-                    welcome_msg = protocol.encode_message(protocol.TYPE_INFO, f"{username} has joined the chat.")
-                    broadcast(welcome_msg)
-                else:
-                    # Invalid JOIN
-                    err = protocol.encode_message(protocol.TYPE_ERROR, "Invalid JOIN format.")
-                    client_socket.sendall(err.encode('utf-8'))
-
-            elif msg_type == protocol.TYPE_MSG:
-                # Client sent a message: MSG|content
-                if not username:
-                    err = protocol.encode_message(protocol.TYPE_ERROR, "You must JOIN first.")
-                    client_socket.sendall(err.encode('utf-8'))
-                    continue
-                
-                if params:
-                    content = params[0]
-                    # Broadcast: MSG|username|content
-                    # We reconstruct it closer to the prompt requirement: MSG|<username>|<message>
-                    broadcast_msg = protocol.encode_message(protocol.TYPE_MSG, username, content)
-                    broadcast(broadcast_msg, exclude_socket=client_socket)
-                    print(f"[{username}]: {content}")
-
-            elif msg_type == protocol.TYPE_LEAVE:
-                print(f"[-] {username} sent LEAVE.")
-                break # Break loop to cleanup
-
-            else:
-                print(f"[!] Unknown message type from {client_address}: {message_str}")
+            if not all(handle_message(conn, msg_type, params) for msg_type, params in conn.messages(data)):
+                break
 
     except ConnectionResetError:
         print(f"[!] Connection reset by {client_address}")
     except Exception as e:
         print(f"[!] Error handling client {client_address}: {e}")
     finally:
-        # Cleanup
-        client_socket.close()
+        # Cleanup (the fan-out writer closes the socket)
         with clients_lock:
             if client_socket in clients:
                 del clients[client_socket]
-        
-        if username:
-            print(f"[-] User '{username}' disconnected.")
-            leave_msg = protocol.encode_message(protocol.TYPE_INFO, f"{username} has left the chat.")
-            broadcast(leave_msg)
+        fanout.remove(client_socket)
+        announce_leave(conn)
 
 def start_server():
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     # Reuse address to avoid 'Address already in use' errors on restart
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    
+
     try:
         server.bind((HOST, PORT))
-        server.listen(5)
+        server.listen(LISTEN_BACKLOG)
+        fanout.start()
         print(f"[*] Chat Server started on {HOST}:{PORT}")
         print("[*] Waiting for connections...")
-        
+
         while True:
             client_sock, addr = server.accept()
             # Start a thread for this client
             t = threading.Thread(target=handle_client, args=(client_sock, addr))
             t.daemon = True # Allow server to exit even if threads are running
             t.start()
-            
+
     except KeyboardInterrupt:
         print("\n[*] Server stopping...")
     except Exception as e:
         print(f"[!] Server Error: {e}")
     finally:
         server.close()
+        print(f"[*] Fan-out: {fanout.stats()}")
+
+# --- asyncio engine: every client on one event loop, no threads ---
+
+# Only touched from the event loop, so no lock is needed
+async_clients = {} # mapping: transport -> AsyncConnection
+async_fanout = TransportFanOut(MAX_PENDING_BYTES, SLOW_CLIENT_POLICY, COALESCE_DELAY, MAX_BATCH_BYTES)
+
+class AsyncConnection(Connection):
+    def __init__(self, transport, address):
+        super().__init__(address)
+        self.transport = transport
+
+    def join(self, username):
+        self.username = username
+        async_clients[self.transport] = self
+
+    def send(self, data):
+        async_fanout.send_many([self.transport], data, coalesce=self.framed)
+
+    def broadcast(self, msg_type, *args, include_self=True):
+        recipients = [(t, conn) for t, conn in async_clients.items() if include_self or t is not self.transport]
+        for data, transports, framed in encode_for(recipients, msg_type, *args):
+            async_fanout.send_many(transports, data, coalesce=framed)
+
+async def handle_client_async(reader, writer):
+    client_address = writer.get_extra_info('peername')
+    print(f"[+] New connection from {client_address}")
+    conn = AsyncConnection(writer.transport, client_address)
+
+    try:
+        while True:
+            data = await reader.read(1024)
+            if not data:
+                break
+            if not all(handle_message(conn, msg_type, params) for msg_type, params in conn.messages(data)):
+                break
+
+    except ConnectionError:
+        # Reset, or a broadcast to this client failed (the reader reports it)
+        print(f"[!] Connection reset by {client_address}")
+    except Exception as e:
+        print(f"[!] Error handling client {client_address}: {e}")
+    finally:
+        async_clients.pop(writer.transport, None)
+        writer.close()
+        announce_leave(conn)
+
+async def start_server_async():
+    # `limit` bounds what the reader buffers per client; MAX_PENDING_BYTES bounds the write side
+    server = await asyncio.start_server(
+        handle_client_async, HOST, PORT, backlog=LISTEN_BACKLOG, limit=READ_BUFFER_LIMIT
+    )
+    print(f"[*] Chat Server started on {HOST}:{PORT} (asyncio engine)")
+    print("[*] Waiting for connections...")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        print(f"[*] Fan-out: {async_fanout.stats()}")
 
 if __name__ == "__main__":
-    start_server()
+    parser = argparse.ArgumentParser(description="Multi-client chat server")
+    parser.add_argument('--engine', choices=['asyncio', 'threads'], default=SERVER_ENGINE,
+                        help="asyncio: one event loop for all clients; threads: thread per client")
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--backlog', type=int, default=LISTEN_BACKLOG, help="pending connections queued by the kernel")
+    args = parser.parse_args()
+    PORT = args.port
+    LISTEN_BACKLOG = args.backlog
+
+    if args.engine == 'asyncio':
+        try:
+            asyncio.run(start_server_async())
+        except KeyboardInterrupt:
+            print("\n[*] Server stopping...")
+    else:
+        start_server()
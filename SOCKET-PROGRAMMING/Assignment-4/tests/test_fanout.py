@@ -0,0 +1,265 @@
+import asyncio
+import os
+import socket
+import sys
+import time
+import unittest
+
+# Add parent directory to path so we can import the chat modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fanout import MAX_BATCH_BUFFERS, FanOut, TransportFanOut, send_batch
+
+def recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+class FakeTransport:
+    """Records what TransportFanOut writes; `buffered` is what it has not sent yet."""
+
+    def __init__(self, buffered=0):
+        self.buffered = buffered
+        self.writes = []  # One list of messages per write call
+        self.aborted = False
+
+    def is_closing(self):
+        return self.aborted
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+    def get_extra_info(self, name):
+        return ('127.0.0.1', 40000)
+
+    def write(self, data):
+        self.writes.append([data])
+
+    def writelines(self, messages):
+        self.writes.append(list(messages))
+
+    def abort(self):
+        self.aborted = True
+
+class SocketWithoutSendmsg:
+    """Like a socket on Windows, which has no sendmsg()."""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data, flags=0):
+        self.sent.append(data)
+        return len(data)
+
+class FanOutTestCase(unittest.TestCase):
+    def fanout(self, **kwargs):
+        """A FanOut whose writer the test drives by calling flush()."""
+        fanout = FanOut(**kwargs)
+        self.addCleanup(fanout.wake_w.close)
+        self.addCleanup(fanout.wake_r.close)
+        self.addCleanup(fanout.selector.close)
+        return fanout
+
+    def client(self, fanout):
+        """A socket registered with `fanout`, and the peer that reads from it."""
+        sock, peer = socket.socketpair()
+        peer.settimeout(5)
+        self.addCleanup(sock.close)
+        self.addCleanup(peer.close)
+        fanout.add(sock)
+        return sock, peer
+
+class TestSlowClientPolicy(FanOutTestCase):
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            FanOut(policy='block')
+
+    def test_drop_skips_messages_until_the_client_catches_up(self):
+        fanout = self.fanout(max_pending=250, policy='drop')
+        sock, peer = self.client(fanout)
+        for i in range(3):
+            fanout.send(sock, bytes([i]) * 100)
+        stats = fanout.stats()
+        self.assertEqual(stats['messages_dropped'], 1)
+        self.assertEqual(stats['pending_bytes'], 200)
+
+        fanout.flush(fanout.outboxes[sock])
+        self.assertEqual(recv_exactly(peer, 200), b'\0' * 100 + b'\1' * 100)
+
+        # Caught up: new messages are queued again
+        fanout.send(sock, b'x' * 100)
+        stats = fanout.stats()
+        self.assertEqual(stats['messages_dropped'], 1)
+        self.assertEqual(stats['pending_bytes'], 100)
+
+    def test_disconnect_shuts_the_slow_client_down(self):
+        fanout = self.fanout(max_pending=250, policy='disconnect')
+        sock, peer = self.client(fanout)
+        for _ in range(4):
+            fanout.send(sock, b'x' * 100)
+        outbox = fanout.outboxes[sock]
+        self.assertTrue(outbox.slow)
+        self.assertEqual(fanout.stats()['pending_bytes'], 0)
+
+        # The writer shuts the socket down; the client reads EOF, not the backlog
+        fanout.flush(outbox)
+        self.assertEqual(peer.recv(4096), b'')
+        self.assertEqual(fanout.stats()['slow_disconnects'], 1)
+        self.assertEqual(fanout.stats()['messages_sent'], 0)
+
+        # The handler removes it and the writer closes it
+        fanout.remove(sock)
+        fanout.flush(outbox)
+        self.assertEqual(sock.fileno(), -1)
+
+    def test_full_socket_does_not_hold_up_others(self):
+        fanout = self.fanout(max_pending=64 * 1024 * 1024)
+        slow, _ = self.client(fanout)
+        fast, fast_peer = self.client(fanout)
+        slow.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        for _ in range(256):
+            fanout.send(slow, b'x' * 4096)
+
+        # Sends what fits and waits for the socket to drain, without blocking
+        fanout.flush(fanout.outboxes[slow])
+        self.assertTrue(fanout.outboxes[slow].waiting)
+        self.assertGreater(fanout.stats()['pending_bytes'], 0)
+
+        fanout.send(fast, b'hello')
+        fanout.flush(fanout.outboxes[fast])
+        self.assertEqual(recv_exactly(fast_peer, 5), b'hello')
+
+    def test_writer_thread_delivers_to_every_client(self):
+        fanout = FanOut()
+        fanout.start()
+        clients = [self.client(fanout) for _ in range(3)]
+        fanout.send_many([sock for sock, _ in clients], b'broadcast')
+        for _, peer in clients:
+            self.assertEqual(recv_exactly(peer, 9), b'broadcast')
+
+class TestCoalescing(FanOutTestCase):
+    def test_one_send_carries_at_most_max_batch_bytes(self):
+        fanout = self.fanout(max_batch_bytes=250)
+        sock, peer = self.client(fanout)
+        for i in range(5):
+            fanout.send(sock, bytes([i]) * 100)
+        fanout.flush(fanout.outboxes[sock])
+        self.assertEqual(recv_exactly(peer, 500), b''.join(bytes([i]) * 100 for i in range(5)))
+        stats = fanout.stats()
+        self.assertEqual(stats['send_calls'], 3)  # 2 + 2 + 1 messages
+        self.assertEqual(stats['messages_sent'], 5)
+        self.assertEqual(stats['syscalls_saved'], 2)
+
+    def test_one_send_carries_at_most_max_batch_buffers(self):
+        fanout = self.fanout(max_batch_bytes=1 << 30)
+        sock, _ = self.client(fanout)
+        for _ in range(MAX_BATCH_BUFFERS + 10):
+            fanout.send(sock, b'x')
+        with fanout.lock:
+            self.assertEqual(len(fanout.next_batch(fanout.outboxes[sock])), MAX_BATCH_BUFFERS)
+
+    def test_uncoalesced_messages_go_out_one_per_send(self):
+        fanout = self.fanout()
+        sock, peer = self.client(fanout)
+        for _ in range(3):
+            fanout.send(sock, b'JOIN|x', coalesce=False)
+        fanout.flush(fanout.outboxes[sock])
+        self.assertEqual(recv_exactly(peer, 18), b'JOIN|x' * 3)
+        self.assertEqual(fanout.stats()['send_calls'], 3)
+
+    def test_messages_wait_at_most_the_coalesce_delay(self):
+        fanout = FanOut(coalesce_delay=0.05)
+        fanout.start()
+        sock, peer = self.client(fanout)
+        started = time.monotonic()
+        fanout.send(sock, b'first')
+        fanout.send(sock, b'second')
+        self.assertEqual(recv_exactly(peer, 11), b'firstsecond')
+        elapsed = time.monotonic() - started
+        self.assertGreaterEqual(elapsed, 0.045)
+        self.assertLess(elapsed, 1.0)
+        # Both went out in one send
+        deadline = time.monotonic() + 5
+        while fanout.stats()['messages_sent'] < 2 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(fanout.stats()['send_calls'], 1)
+
+    def test_send_batch_without_sendmsg(self):
+        sock = SocketWithoutSendmsg()
+        self.assertEqual(send_batch(sock, [b'ab', memoryview(b'cd')]), 4)
+        self.assertEqual(sock.sent, [b'abcd'])
+
+class TestTransportCoalescing(unittest.TestCase):
+    def test_batch_is_written_once_after_the_delay(self):
+        fanout = TransportFanOut(coalesce_delay=0.01)
+        transports = [FakeTransport(), FakeTransport()]
+
+        async def send():
+            fanout.send_many(transports, b'one')
+            fanout.send_many(transports, b'two')
+            self.assertEqual([t.writes for t in transports], [[], []])
+            await asyncio.sleep(0.05)
+
+        asyncio.run(send())
+        self.assertEqual([t.writes for t in transports], [[[b'one', b'two']]] * 2)
+        self.assertEqual(fanout.stats()['send_calls'], 2)
+        self.assertEqual(fanout.stats()['syscalls_saved'], 2)
+
+    def test_full_batch_is_written_at_once(self):
+        fanout = TransportFanOut(coalesce_delay=60, max_batch_bytes=200)
+        transport = FakeTransport()
+
+        async def send():
+            fanout.send_many([transport], b'x' * 100)
+            self.assertEqual(transport.writes, [])
+            fanout.send_many([transport], b'y' * 100)
+            self.assertEqual(transport.writes, [[b'x' * 100, b'y' * 100]])
+            fanout.flush_handle.cancel()
+
+        asyncio.run(send())
+
+    def test_uncoalesced_message_is_written_at_once(self):
+        fanout = TransportFanOut()
+        transport = FakeTransport()
+        fanout.send_many([transport], b'JOIN|x', coalesce=False)
+        self.assertEqual(transport.writes, [[b'JOIN|x']])
+        self.assertEqual(fanout.stats()['send_calls'], 1)
+
+class TestTransportSlowClientPolicy(unittest.TestCase):
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            TransportFanOut(policy='block')
+
+    def test_drop_skips_messages_for_a_client_that_is_behind(self):
+        fanout = TransportFanOut(max_pending=250, policy='drop')
+        slow, fast = FakeTransport(buffered=200), FakeTransport()
+        fanout.send_many([slow, fast], b'x' * 100, coalesce=False)
+        self.assertEqual(slow.writes, [])
+        self.assertEqual(fast.writes, [[b'x' * 100]])
+        self.assertFalse(slow.aborted)
+        self.assertEqual(fanout.stats()['messages_dropped'], 1)
+
+        # Caught up: written again
+        slow.buffered = 0
+        fanout.send_many([slow], b'y' * 100, coalesce=False)
+        self.assertEqual(slow.writes, [[b'y' * 100]])
+
+    def test_disconnect_aborts_a_client_that_is_behind(self):
+        fanout = TransportFanOut(max_pending=250, policy='disconnect')
+        slow = FakeTransport(buffered=200)
+
+        async def send():
+            fanout.send_many([slow], b'x' * 100)
+            fanout.send_many([slow], b'x' * 100)
+
+        asyncio.run(send())
+        self.assertTrue(slow.aborted)
+        self.assertEqual(slow.writes, [])
+        self.assertEqual(fanout.stats()['slow_disconnects'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
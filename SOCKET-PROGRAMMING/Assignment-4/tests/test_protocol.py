@@ -0,0 +1,91 @@
+import os
+import sys
+import unittest
+
+# Add parent directory to path so we can import the chat modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import protocol
+
+class TestFrames(unittest.TestCase):
+    def test_any_text_survives(self):
+        content = "a|b\x1fc\nd é\U0001f600"
+        frame = protocol.encode_frame(protocol.TYPE_MSG, "bob", content)
+        (length,) = protocol.FRAME_HEADER.unpack_from(frame)
+        self.assertEqual(length, len(frame) - protocol.FRAME_HEADER.size)
+        self.assertEqual(protocol.decode_frame(frame[protocol.FRAME_HEADER.size:]),
+                         (protocol.TYPE_MSG, ["bob", content]))
+
+    def test_empty_fields(self):
+        frame = protocol.encode_frame(protocol.TYPE_INFO, "", "")
+        self.assertEqual(protocol.decode_frame(frame[protocol.FRAME_HEADER.size:]), (protocol.TYPE_INFO, ["", ""]))
+        frame = protocol.encode_frame(protocol.TYPE_LEAVE)
+        self.assertEqual(protocol.decode_frame(frame[protocol.FRAME_HEADER.size:]), (protocol.TYPE_LEAVE, []))
+
+    def test_field_too_long_to_encode(self):
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.encode_frame(protocol.TYPE_MSG, "x" * (protocol.MAX_FIELD_SIZE + 1))
+
+    def test_malformed_payloads(self):
+        for payload in (b"", b"\x00", b"\x00\x05MSG", b"\x00\x03MSG\x00"):
+            with self.subTest(payload=payload):
+                with self.assertRaises(protocol.ProtocolError):
+                    protocol.decode_frame(payload)
+
+    def test_first_byte_tells_the_formats_apart(self):
+        self.assertTrue(protocol.is_framed(protocol.encode_frame(protocol.TYPE_JOIN, "bob")))
+        self.assertFalse(protocol.is_framed(b"JOIN|bob"))
+
+class TestFrameDecoder(unittest.TestCase):
+    def test_partial_frame_waits_for_the_rest(self):
+        frame = protocol.encode_frame(protocol.TYPE_MSG, "bob", "hello")
+        decoder = protocol.FrameDecoder()
+        for i in range(len(frame) - 1):
+            decoder.feed(frame[i:i + 1])
+            self.assertEqual(list(decoder), [])
+        decoder.feed(frame[-1:])
+        self.assertEqual(list(decoder), [(protocol.TYPE_MSG, ["bob", "hello"])])
+        self.assertEqual(len(decoder.buffer), 0)
+
+    def test_several_frames_in_one_read(self):
+        frames = [protocol.encode_frame(protocol.TYPE_MSG, "bob", str(i)) for i in range(5)]
+        data = b"".join(frames)
+        decoder = protocol.FrameDecoder()
+        decoder.feed(data + frames[0][:3])
+        self.assertEqual([params[1] for _, params in decoder], ["0", "1", "2", "3", "4"])
+        # The partial frame is kept for the next read
+        self.assertEqual(bytes(decoder.buffer), frames[0][:3])
+        decoder.feed(frames[0][3:])
+        self.assertEqual(list(decoder), [(protocol.TYPE_MSG, ["bob", "0"])])
+
+    def test_oversized_frame_is_rejected_from_its_header(self):
+        decoder = protocol.FrameDecoder(max_frame_size=16)
+        decoder.feed(protocol.FRAME_HEADER.pack(17))
+        with self.assertRaises(protocol.ProtocolError):
+            list(decoder)
+
+    def test_frames_before_an_oversized_one_are_kept(self):
+        decoder = protocol.FrameDecoder(max_frame_size=16)
+        decoder.feed(protocol.encode_frame(protocol.TYPE_LEAVE) + protocol.FRAME_HEADER.pack(1000))
+        messages = []
+        with self.assertRaises(protocol.ProtocolError):
+            for message in decoder:
+                messages.append(message)
+        self.assertEqual(messages, [(protocol.TYPE_LEAVE, [])])
+
+class TestCodec(unittest.TestCase):
+    def test_legacy_read_is_one_message(self):
+        codec = protocol.Codec(False)
+        self.assertEqual(codec.encode(protocol.TYPE_MSG, "bob", "hi"), b"MSG|bob|hi")
+        self.assertEqual(list(codec.messages(b"INFO|bob has joined the chat.")),
+                         [(protocol.TYPE_INFO, ["bob has joined the chat."])])
+
+    def test_framed_round_trip(self):
+        codec = protocol.Codec(True)
+        data = codec.encode(protocol.TYPE_MSG, "bob", "a|b") + codec.encode(protocol.TYPE_LEAVE)
+        self.assertEqual(list(codec.messages(data[:5])), [])
+        self.assertEqual(list(codec.messages(data[5:])),
+                         [(protocol.TYPE_MSG, ["bob", "a|b"]), (protocol.TYPE_LEAVE, [])])
+
+if __name__ == '__main__':
+    unittest.main()
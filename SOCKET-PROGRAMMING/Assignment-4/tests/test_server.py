@@ -0,0 +1,195 @@
+import asyncio
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+from collections import deque
+
+# Add parent directory to path so we can import the chat modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import protocol
+import server
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_engine(target):
+    """Run a server engine on a thread of its own. Returns the port it listens on."""
+    server.HOST = '127.0.0.1'
+    server.PORT = port = free_port()
+    threading.Thread(target=target, daemon=True).start()
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            socket.create_connection((server.HOST, port), timeout=1).close()
+            return port
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+class ChatClient:
+    """
+    A user that joins like client.py does, offering frames, or like an
+    older client that only speaks text.
+    """
+
+    def __init__(self, port, username, offer_frames=True):
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        args = (username, protocol.FRAMING_OFFER) if offer_frames else (username,)
+        self.sock.sendall(protocol.encode_message(protocol.TYPE_JOIN, *args).encode('utf-8'))
+        data = self.sock.recv(4096)
+        self.codec = protocol.Codec(protocol.is_framed(data))
+        self.pending = deque(self.codec.messages(data))
+
+    def send(self, msg_type, *args):
+        self.sock.sendall(self.codec.encode(msg_type, *args))
+
+    def receive(self):
+        """The next message, in order. Raises EOFError once the server has closed."""
+        while not self.pending:
+            data = self.sock.recv(4096)
+            if not data:
+                raise EOFError
+            self.pending.extend(self.codec.messages(data))
+        return self.pending.popleft()
+
+    def close(self):
+        self.sock.close()
+
+class RecordingConnection(server.Connection):
+    """A Connection that records what the server sends instead of sending it."""
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 40000))
+        self.sent = []
+        self.broadcasts = []
+
+    def join(self, username):
+        self.username = username
+
+    def send(self, data):
+        self.sent.append(data)
+
+    def broadcast(self, msg_type, *args, include_self=True):
+        self.broadcasts.append((msg_type, list(args)))
+
+    def handle(self, data):
+        return [server.handle_message(self, msg_type, params) for msg_type, params in self.messages(data)]
+
+class TestWireFormatDetection(unittest.TestCase):
+    def test_framed_join_selects_frames(self):
+        conn = RecordingConnection()
+        join = protocol.encode_frame(protocol.TYPE_JOIN, 'alice')
+        msg = protocol.encode_frame(protocol.TYPE_MSG, 'a|b')
+        self.assertEqual(list(conn.messages(join + msg[:3])), [(protocol.TYPE_JOIN, ['alice'])])
+        self.assertTrue(conn.framed)
+        self.assertEqual(list(conn.messages(msg[3:])), [(protocol.TYPE_MSG, ['a|b'])])
+        conn.reply(protocol.TYPE_ERROR, 'no')
+        self.assertEqual(conn.sent, [protocol.encode_frame(protocol.TYPE_ERROR, 'no')])
+
+    def test_text_join_stays_on_text(self):
+        conn = RecordingConnection()
+        self.assertEqual(conn.handle(b'JOIN|carol'), [True])
+        self.assertFalse(conn.framed)
+        self.assertEqual(conn.sent, [])
+        self.assertEqual(conn.broadcasts, [(protocol.TYPE_INFO, ['carol has joined the chat.'])])
+        # One read is one message
+        self.assertEqual(list(conn.messages(b'MSG|hi')), [(protocol.TYPE_MSG, ['hi'])])
+        conn.reply(protocol.TYPE_ERROR, 'no')
+        self.assertEqual(conn.sent, [b'ERROR|no'])
+
+    def test_text_join_offering_frames_is_acknowledged_in_frames(self):
+        conn = RecordingConnection()
+        self.assertEqual(conn.handle(b'JOIN||FRAMED'), [True])
+        self.assertTrue(conn.framed)
+        # The assigned name, in the first frame sent
+        self.assertEqual(conn.sent, [protocol.encode_frame(protocol.TYPE_JOIN, 'User-40000')])
+        self.assertEqual(conn.handle(protocol.encode_frame(protocol.TYPE_LEAVE)), [False])
+
+    def test_framed_join_offering_frames_keeps_the_partial_frame(self):
+        conn = RecordingConnection()
+        join = protocol.encode_frame(protocol.TYPE_JOIN, 'bob', protocol.FRAMING_OFFER)
+        msg = protocol.encode_frame(protocol.TYPE_MSG, 'hi')
+        self.assertEqual(conn.handle(join + msg[:5]), [True])
+        self.assertEqual(conn.handle(msg[5:]), [True])
+        self.assertEqual(conn.broadcasts[-1], (protocol.TYPE_MSG, ['bob', 'hi']))
+
+    def test_offer_with_a_name_containing_the_separator_stays_on_text(self):
+        conn = RecordingConnection()
+        conn.handle(b'JOIN|a|b|FRAMED')
+        self.assertFalse(conn.framed)
+        self.assertEqual(conn.username, 'a')
+
+    def test_oversized_frame(self):
+        conn = RecordingConnection()
+        with self.assertRaises(protocol.ProtocolError):
+            conn.handle(protocol.FRAME_HEADER.pack(protocol.MAX_FRAME_SIZE + 1))
+
+class EngineRoundTrip:
+    """JOIN, MSG and LEAVE through a running engine (set up by the subclass)."""
+
+    port = None
+
+    def join(self, username, offer_frames=True):
+        client = ChatClient(self.port, username, offer_frames)
+        self.addCleanup(client.close)
+        return client
+
+    def test_join_msg_leave(self):
+        alice = self.join('alice')
+        self.assertTrue(alice.codec.framed)
+        self.assertEqual(alice.receive(), (protocol.TYPE_JOIN, ['alice']))
+        self.assertEqual(alice.receive(), (protocol.TYPE_INFO, ['alice has joined the chat.']))
+
+        carol = self.join('carol', offer_frames=False)
+        self.assertFalse(carol.codec.framed)
+        self.assertEqual(carol.receive(), (protocol.TYPE_INFO, ['carol has joined the chat.']))
+        self.assertEqual(alice.receive(), (protocol.TYPE_INFO, ['carol has joined the chat.']))
+
+        bob = self.join('bob')
+        self.assertEqual(bob.receive(), (protocol.TYPE_JOIN, ['bob']))
+        self.assertEqual(bob.receive(), (protocol.TYPE_INFO, ['bob has joined the chat.']))
+        for user in (alice, carol):
+            self.assertEqual(user.receive(), (protocol.TYPE_INFO, ['bob has joined the chat.']))
+
+        bob.send(protocol.TYPE_MSG, 'a|b')
+        self.assertEqual(alice.receive(), (protocol.TYPE_MSG, ['bob', 'a|b']))
+        # Legacy clients still see content cut at a `|`
+        self.assertEqual(carol.receive(), (protocol.TYPE_MSG, ['bob', 'a', 'b']))
+
+        carol.send(protocol.TYPE_MSG, 'hi')
+        for user in (alice, bob):
+            self.assertEqual(user.receive(), (protocol.TYPE_MSG, ['carol', 'hi']))
+
+        bob.send(protocol.TYPE_LEAVE)
+        with self.assertRaises(EOFError):
+            bob.receive()
+        for user in (alice, carol):
+            self.assertEqual(user.receive(), (protocol.TYPE_INFO, ['bob has left the chat.']))
+
+    def test_msg_before_join(self):
+        sock = socket.create_connection(('127.0.0.1', self.port), timeout=5)
+        self.addCleanup(sock.close)
+        sock.sendall(protocol.encode_frame(protocol.TYPE_MSG, 'hi'))
+        decoder = protocol.FrameDecoder()
+        decoder.feed(sock.recv(4096))
+        self.assertEqual(list(decoder), [(protocol.TYPE_ERROR, ['You must JOIN first.'])])
+
+class TestThreadsEngine(EngineRoundTrip, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.port = start_engine(server.start_server)
+
+class TestAsyncioEngine(EngineRoundTrip, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.port = start_engine(lambda: asyncio.run(server.start_server_async()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,226 @@
+"""
+Per-IP bandwidth shaping for the proxy's forwarding loops.
+
+Each source IP gets a token bucket per direction, shared by all of its
+open connections: client_to_backend refills at MAX_UPLOAD_RATE_PER_IP
+bytes/s and backend_to_client at MAX_DOWNLOAD_RATE_PER_IP, and each holds
+at most BANDWIDTH_BURST bytes.
+
+A forwarding loop reports every chunk it forwards and is told how long to
+wait before reading the next one. The chunk itself goes out at once and
+the bucket goes into debt. While the loop waits it reads nothing, so the
+socket's receive buffer fills up and TCP flow control slows the sender
+down: a connection over its rate holds one chunk in memory, not a backlog.
+
+When an IP's last connection closes its buckets are kept until they have
+refilled, so reconnecting does not buy a fresh burst. The shaper also
+counts the bytes forwarded per IP and in total for the throughput report.
+The buckets can come from a store shared between processes instead, so
+forked workers draw on one set of buckets per IP.
+"""
+
+import threading
+import time
+
+import config
+from metrics import registry
+from timer_wheel import TimerWheel
+
+DIRECTIONS = ('client_to_backend', 'backend_to_client')
+CLIENT_TO_BACKEND, BACKEND_TO_CLIENT = 0, 1
+
+
+class TokenBucket:
+    """
+    `rate` bytes/s, holding at most `burst`. A chunk larger than the
+    tokens left still goes through; the balance goes negative and the
+    sender waits until it is paid back.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, nbytes, now):
+        """
+        Returns:
+            float: seconds until the balance is back to zero (0.0 if it is not negative).
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - nbytes
+        self.updated = now
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def refilled_at(self):
+        """When the bucket holds `burst` tokens again."""
+        return self.updated + (self.burst - self.tokens) / self.rate
+
+
+class ShapedIP:
+    """
+    Buckets and byte counts of one source IP. The proxy calls client_data
+    and backend_data for every chunk it forwards, and waits as many
+    seconds as they return before reading the next one.
+    """
+
+    __slots__ = ('ip', 'shaper', 'buckets', 'bytes', 'reported', 'connections')
+
+    def __init__(self, ip, shaper, buckets):
+        self.ip = ip
+        self.shaper = shaper
+        self.buckets = buckets  # One per direction, None where there is no limit
+        self.bytes = [0, 0]
+        self.reported = [0, 0]  # self.bytes at the last stats() call
+        self.connections = 0
+
+    def client_data(self, nbytes):
+        return self.shaper.take(self, CLIENT_TO_BACKEND, nbytes)
+
+    def backend_data(self, nbytes):
+        return self.shaper.take(self, BACKEND_TO_CLIENT, nbytes)
+
+
+class BandwidthShaper:
+    def __init__(self, metric_prefix, upload_rate=None, download_rate=None, burst=None, clock=time.monotonic,
+                 store=None):
+        """
+        Rates default to the values in config.py, where None turns shaping
+        of that direction off (0 does here); bytes are counted either way.
+        With a `store`, an IP's buckets come from
+        store.open_buckets(ip, rates, burst, now) and are handed back with
+        store.close_buckets(ip, buckets) once dropped here. Metrics are
+        registered as <metric_prefix>_throttled_*.
+        """
+        self.rates = (
+            config.MAX_UPLOAD_RATE_PER_IP if upload_rate is None else upload_rate,
+            config.MAX_DOWNLOAD_RATE_PER_IP if download_rate is None else download_rate,
+        )
+        self.burst = config.BANDWIDTH_BURST if burst is None else burst
+        self.clock = clock
+        self.store = store
+
+        # IPs with open connections, or whose buckets are still refilling
+        self.ips = {}
+        self.bytes = [0, 0]  # Forwarded in total, including IPs since removed
+        self.reported = [0, 0]
+        self.last_report = clock()
+        # Engines that proxy on threads report from many threads
+        self.lock = threading.Lock()
+        # Departed IPs, due to be dropped once their buckets are full
+        self.timers = TimerWheel(config.TIMER_TICK, config.TIMER_SLOTS)
+        self.timers.advance(self.clock())
+
+        self.throttled = [
+            registry.counter(f'{metric_prefix}_throttled_total',
+                             "Pauses in reading imposed by the per-IP bandwidth limits", direction=direction)
+            for direction in DIRECTIONS
+        ]
+        self.throttled_seconds = [
+            registry.counter(f'{metric_prefix}_throttled_seconds_total',
+                             "Time connections spent paused by the per-IP bandwidth limits", direction=direction)
+            for direction in DIRECTIONS
+        ]
+
+    def open(self, ip):
+        """
+        A connection from `ip` starts forwarding.
+        Returns:
+            ShapedIP: the IP's buckets, shared with its other connections;
+            release it when the connection ends.
+        """
+        with self.lock:
+            shaped = self.ips.get(ip)
+            if shaped is None:
+                now = self.clock()
+                if self.store is not None:
+                    buckets = self.store.open_buckets(ip, self.rates, self.burst, now)
+                else:
+                    buckets = [TokenBucket(rate, self.burst, now) if rate else None for rate in self.rates]
+                shaped = self.ips[ip] = ShapedIP(ip, self, buckets)
+            elif not shaped.connections:
+                self.timers.cancel(shaped)
+            shaped.connections += 1
+        return shaped
+
+    def release(self, shaped):
+        """The connection has ended (call exactly once per open())."""
+        with self.lock:
+            shaped.connections -= 1
+            if shaped.connections:
+                return
+            refilled_at = max((bucket.refilled_at() for bucket in shaped.buckets if bucket is not None),
+                              default=0)
+            if refilled_at > self.clock():
+                self.timers.schedule(shaped, refilled_at)
+            else:
+                self.drop(shaped)
+
+    def drop(self, shaped):
+        """Forget an IP without connections (lock held)."""
+        del self.ips[shaped.ip]
+        if self.store is not None:
+            self.store.close_buckets(shaped.ip, shaped.buckets)
+
+    def take(self, shaped, direction, nbytes):
+        """
+        Count `nbytes` forwarded by `shaped` in `direction`.
+        Returns:
+            float: seconds to wait before reading more in that direction.
+        """
+        bucket = shaped.buckets[direction]
+        with self.lock:
+            shaped.bytes[direction] += nbytes
+            self.bytes[direction] += nbytes
+            if bucket is None:
+                return 0.0
+            delay = bucket.take(nbytes, self.clock())
+        if delay:
+            self.throttled[direction].inc()
+            self.throttled_seconds[direction].inc(delay)
+        return delay
+
+    def sweep(self, now=None):
+        """
+        Drop the IPs without connections whose buckets have refilled.
+        Returns:
+            int: Number of IPs dropped.
+        """
+        if now is None:
+            now = self.clock()
+        removed = 0
+        with self.lock:
+            for shaped in self.timers.advance(now):
+                if not shaped.connections:
+                    self.drop(shaped)
+                    removed += 1
+        return removed
+
+    def stats(self, top=5):
+        """
+        Throughput since the previous call, in bytes/s per direction: in
+        total, and for the `top` busiest IPs among those still tracked.
+        Returns:
+            dict: 'total' (rates) and 'top' (list of (ip, rates)).
+        """
+        now = self.clock()
+        with self.lock:
+            elapsed = max(now - self.last_report, 1e-9)
+            total = [(new - old) / elapsed for new, old in zip(self.bytes, self.reported)]
+            self.reported = list(self.bytes)
+            self.last_report = now
+            busiest = []
+            for shaped in self.ips.values():
+                moved = [new - old for new, old in zip(shaped.bytes, shaped.reported)]
+                shaped.reported = list(shaped.bytes)
+                if moved[0] or moved[1]:
+                    busiest.append((moved[0] + moved[1], shaped.ip, [m / elapsed for m in moved]))
+        busiest.sort(reverse=True)
+        return {
+            'total': total,
+            'top': [(ip, rates) for _, ip, rates in busiest[:top]],
+        }
@@ -0,0 +1,264 @@
+"""
+Concurrent connection limits and slowloris protection.
+
+The rate limiter counts connection arrivals; a client that opens a few
+dozen connections and then trickles bytes through them stays under any
+arrival rate while holding a backend socket per connection. The
+ConnectionGuard tracks the connections that are open instead:
+
+- admission: at most MAX_CONNECTIONS_PER_IP open connections per source
+  IP, and MAX_CONNECTIONS in total. Once FAIR_SHARE_THRESHOLD of the
+  budget is in use, an IP that already holds its equal share
+  (MAX_CONNECTIONS / IPs with open connections) is refused, so the rest
+  of the budget goes to IPs holding fewer.
+- timeouts: a connection with no data in either direction for
+  IDLE_TIMEOUT seconds is closed. A client must send its first bytes
+  within REQUEST_TIMEOUT of connecting. A request (client bytes not yet
+  answered by the backend) that keeps arriving for longer than
+  REQUEST_TIMEOUT must average MIN_TRANSFER_RATE bytes/s, or the
+  connection is closed. A slow backend is not held against the client:
+  the rate is measured up to the client's last byte.
+
+Deadlines live in a TimerWheel advanced by sweep(), so the per-read cost
+is a few attribute writes. The open connection counts live in a
+ConnectionCounts, or in anything with the same methods: forked workers
+share theirs through shared memory so the limits hold across processes.
+"""
+
+import math
+import threading
+import time
+
+import config
+from log_pipeline import BlockSummary
+from metrics import registry
+from timer_wheel import TimerWheel
+
+REJECT_REASONS = ('per_ip', 'budget', 'fair_share')
+CLOSE_REASONS = ('idle', 'request_timeout', 'too_slow')
+
+# Seconds between rate checks while a request is arriving
+RECHECK_INTERVAL = 1.0
+
+
+class TrackedConnection:
+    """
+    Activity of one open connection. The proxy calls client_data and
+    backend_data for every chunk it forwards.
+    """
+
+    __slots__ = ('ip', 'abort', 'clock', 'opened', 'last_active',
+                 'request_started', 'request_bytes', 'last_request_data')
+
+    def __init__(self, ip, abort, clock):
+        now = clock()
+        self.ip = ip
+        self.abort = abort
+        self.clock = clock
+        self.opened = now
+        self.last_active = now
+        # The first request is timed from the connection's start
+        self.request_started = now
+        self.request_bytes = 0
+        self.last_request_data = now
+
+    def client_data(self, nbytes):
+        now = self.clock()
+        self.last_active = now
+        if self.request_started is None:
+            self.request_started = now
+            self.request_bytes = 0
+        self.request_bytes += nbytes
+        self.last_request_data = now
+
+    def backend_data(self, nbytes):
+        # The backend answered: whatever the client sent was a request
+        self.last_active = self.clock()
+        self.request_started = None
+
+
+class ConnectionCounts:
+    """Open connections per source IP and in total, for one process."""
+
+    def __init__(self):
+        # IPs with no open connections are removed
+        self.per_ip = {}
+        self.total = 0
+        # Engines that proxy on threads open and release from many threads
+        self.lock = threading.Lock()
+
+    def acquire(self, ip, refusal):
+        """
+        Count a connection from `ip`, unless refusal(held, total, ips)
+        names a limit that refuses it.
+        Returns:
+            str: the refusing limit, or None if the connection was counted.
+        """
+        with self.lock:
+            held = self.per_ip.get(ip, 0)
+            reason = refusal(held, self.total, len(self.per_ip))
+            if reason is None:
+                self.per_ip[ip] = held + 1
+                self.total += 1
+        return reason
+
+    def release(self, ip):
+        with self.lock:
+            held = self.per_ip[ip] - 1
+            if held:
+                self.per_ip[ip] = held
+            else:
+                del self.per_ip[ip]
+            self.total -= 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'open_connections': self.total,
+                'ips': len(self.per_ip),
+                'largest_per_ip': max(self.per_ip.values(), default=0),
+            }
+
+
+class ConnectionGuard:
+    def __init__(self, metric_prefix, max_per_ip=None, max_total=None, fair_share_threshold=None,
+                 idle_timeout=None, request_timeout=None, min_transfer_rate=None, clock=time.monotonic,
+                 counts=None):
+        """
+        Limits default to the values in config.py, where None turns a
+        limit off (0 does here). `counts` defaults to a ConnectionCounts
+        of this process's own. Metrics are registered as
+        <metric_prefix>_connections_*.
+        """
+        self.max_per_ip = config.MAX_CONNECTIONS_PER_IP if max_per_ip is None else max_per_ip
+        self.max_total = config.MAX_CONNECTIONS if max_total is None else max_total
+        self.fair_share_threshold = config.FAIR_SHARE_THRESHOLD if fair_share_threshold is None else fair_share_threshold
+        self.idle_timeout = config.IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+        self.request_timeout = config.REQUEST_TIMEOUT if request_timeout is None else request_timeout
+        self.min_transfer_rate = config.MIN_TRANSFER_RATE if min_transfer_rate is None else min_transfer_rate
+        self.clock = clock
+
+        self.counts = ConnectionCounts() if counts is None else counts
+        # Engines that proxy on threads schedule and cancel timers from many threads
+        self.lock = threading.Lock()
+        self.timers = TimerWheel(config.TIMER_TICK, config.TIMER_SLOTS)
+        self.timers.advance(self.clock())
+
+        self.rejected = {
+            reason: registry.counter(f'{metric_prefix}_connections_limited_total',
+                                     "Connections refused by the concurrent connection limits", reason=reason)
+            for reason in REJECT_REASONS
+        }
+        self.timed_out = {
+            reason: registry.counter(f'{metric_prefix}_connections_timed_out_total',
+                                     "Connections closed as idle or too slow", reason=reason)
+            for reason in CLOSE_REASONS
+        }
+        self.rejected_summary = BlockSummary("Connections over the connection limits", config.BLOCK_SUMMARY_INTERVAL)
+        self.closed_summary = BlockSummary("Connections closed as idle or too slow", config.BLOCK_SUMMARY_INTERVAL)
+
+    def open(self, ip, abort):
+        """
+        Admit a new connection from `ip`. `abort` is called (on the thread
+        running sweep) if the connection later times out.
+        Returns:
+            TrackedConnection: to report activity on and release when the
+            connection ends, or None if a limit refuses it.
+        """
+        reason = self.counts.acquire(ip, self.refusal)
+        if reason is not None:
+            self.rejected[reason].inc()
+            self.rejected_summary.note(ip)
+            return None
+        conn = TrackedConnection(ip, abort, self.clock)
+        _, check_at = self.check(conn, conn.opened)
+        if check_at != math.inf:
+            with self.lock:
+                self.timers.schedule(conn, check_at)
+        return conn
+
+    def refusal(self, held, total, ips):
+        """
+        Which limit, if any, refuses another connection from an IP that
+        holds `held` of the `total` open connections, spread over `ips` IPs.
+        """
+        if self.max_per_ip and held >= self.max_per_ip:
+            return 'per_ip'
+        if self.max_total:
+            if total >= self.max_total:
+                return 'budget'
+            if held and self.fair_share_threshold is not None \
+                    and total >= self.fair_share_threshold * self.max_total:
+                if held >= self.max_total / ips:
+                    return 'fair_share'
+        return None
+
+    @property
+    def total(self):
+        """Open connections counted against the limits."""
+        return self.counts.total
+
+    def release(self, conn):
+        """The connection has ended (call exactly once per open() that returned one)."""
+        with self.lock:
+            self.timers.cancel(conn)
+        self.counts.release(conn.ip)
+
+    def check(self, conn, now):
+        """
+        Returns:
+            tuple: (reason, None) if the connection must be closed, else
+            (None, time of its next check).
+        """
+        check_at = math.inf
+        if self.idle_timeout:
+            idle_at = conn.last_active + self.idle_timeout
+            if now >= idle_at:
+                return 'idle', None
+            check_at = idle_at
+        if self.request_timeout and conn.request_started is not None:
+            due = conn.request_started + self.request_timeout
+            if conn.request_bytes == 0:
+                if now >= due:
+                    return 'request_timeout', None
+                check_at = min(check_at, due)
+            else:
+                span = conn.last_request_data - conn.request_started
+                if self.min_transfer_rate and span >= self.request_timeout \
+                        and conn.request_bytes < self.min_transfer_rate * span:
+                    return 'too_slow', None
+                check_at = min(check_at, max(due, now + RECHECK_INTERVAL))
+        return None, check_at
+
+    def sweep(self, now=None):
+        """
+        Check the connections whose deadline has come and abort those that
+        are idle or too slow. A connection's timer is not moved when data
+        arrives; when it fires the connection is checked and the timer is
+        re-armed for its next deadline.
+        Returns:
+            list: (TrackedConnection, reason) for each connection aborted.
+        """
+        if now is None:
+            now = self.clock()
+        expired = []
+        with self.lock:
+            for conn in self.timers.advance(now):
+                reason, check_at = self.check(conn, now)
+                if reason is not None:
+                    expired.append((conn, reason))
+                elif check_at != math.inf:
+                    self.timers.schedule(conn, check_at)
+
+        # Aborting runs the engines' close paths, which call release()
+        for conn, reason in expired:
+            self.timed_out[reason].inc()
+            self.closed_summary.note(conn.ip)
+            conn.abort()
+        for summary in (self.rejected_summary, self.closed_summary):
+            if summary.counts and now - summary.last_flush >= summary.interval:
+                summary.flush()
+        return expired
+
+    def stats(self):
+        return self.counts.stats()
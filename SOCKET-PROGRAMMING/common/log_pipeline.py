@@ -0,0 +1,217 @@
+"""
+Queue-backed logging so the proxy hot path never waits on disk I/O.
+
+Records are handed to a background thread through a bounded queue
+(QueueHandler/QueueListener style). The thread drains whatever is queued,
+writes the batch and flushes each handler once per batch instead of once
+per line. Messages are formatted on the background thread, so callers
+should use lazy %-style arguments: `logging.info("Blocked %s", ip)`.
+
+Floods of identical events are collapsed by BlockSummary into one
+"blocked N times" line per IP per interval.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_DATEFMT = '%Y-%m-%d %H:%M:%S'
+
+_STOP = object()
+
+# (queue handler, listener) pairs added by setup_logging, removed by stop_logging
+_listeners = []
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueue records without formatting them and never block the caller.
+    When the queue is full the record is dropped and counted.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting happens on the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchingQueueListener:
+    """
+    Background thread writing queued records to stream handlers in batches.
+    """
+
+    def __init__(self, log_queue, handlers, batch_size=256, flush_interval=0.05):
+        self.queue = log_queue
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.thread = None
+
+        # Stats for reporting
+        self.records_written = 0
+        self.batches_written = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.monitor, name='log-pipeline', daemon=True)
+        self.thread.start()
+
+    def restart_after_fork(self, queue_handler):
+        """
+        The writer thread does not survive fork(). Give the child a fresh
+        queue (the old one's locks may be held) and its own writer thread.
+        """
+        if self.thread is None:
+            return
+        self.queue = queue.Queue(maxsize=self.queue.maxsize)
+        queue_handler.queue = self.queue
+        self.start()
+
+    def stop(self):
+        """Write everything still queued, then stop the thread."""
+        if self.thread is None:
+            return
+        self.queue.put(_STOP)
+        self.thread.join()
+        self.thread = None
+
+    def monitor(self):
+        stopping = False
+        while not stopping:
+            record = self.queue.get()
+            if record is _STOP:
+                break
+            batch = [record]
+
+            # Give a burst a moment to accumulate, then take all of it
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    record = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is _STOP:
+                    stopping = True
+                    break
+                batch.append(record)
+
+            self.write_batch(batch)
+
+    def write_batch(self, batch):
+        for handler in self.handlers:
+            lines = []
+            for record in batch:
+                if record.levelno >= handler.level and handler.filter(record):
+                    try:
+                        lines.append(handler.format(record) + handler.terminator)
+                    except Exception:
+                        handler.handleError(record)
+            if not lines:
+                continue
+            handler.acquire()
+            try:
+                handler.stream.write(''.join(lines))
+                handler.flush()
+            except Exception:
+                handler.handleError(batch[0])
+            finally:
+                handler.release()
+        self.records_written += len(batch)
+        self.batches_written += 1
+
+
+class BlockSummary:
+    """
+    Aggregate repeated block events per IP and log one summary line per
+    interval instead of one line per dropped connection.
+    """
+
+    def __init__(self, reason, interval=1.0, level=logging.WARNING):
+        self.reason = reason
+        self.interval = interval
+        self.level = level
+        self.counts = {}
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+
+    def note(self, ip):
+        with self.lock:
+            self.counts[ip] = self.counts.get(ip, 0) + 1
+        if time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Emit the summary lines for the interval that just ended."""
+        now = time.monotonic()
+        with self.lock:
+            counts, self.counts = self.counts, {}
+            elapsed = now - self.last_flush
+            self.last_flush = now
+        if not logging.getLogger().isEnabledFor(self.level):
+            return
+        for ip, count in counts.items():
+            logging.log(self.level, "%s: %s blocked %d times in last %.1fs", self.reason, ip, count, elapsed)
+
+
+def setup_logging(log_file, level=logging.INFO, console=False,
+                  queue_size=10000, batch_size=256, flush_interval=0.05):
+    """
+    Route the root logger through a queue to a batching writer thread.
+    Returns:
+        tuple: (LazyQueueHandler, BatchingQueueListener)
+    """
+    formatter = logging.Formatter(LOG_FORMAT, LOG_DATEFMT)
+    handlers = []
+
+    file_handler = logging.FileHandler(log_file)
+    file_handler.setFormatter(formatter)
+    handlers.append(file_handler)
+
+    if console:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(formatter)
+        handlers.append(console_handler)
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = LazyQueueHandler(log_queue)
+    listener = BatchingQueueListener(log_queue, handlers, batch_size, flush_interval)
+    listener.start()
+    _listeners.append((queue_handler, listener))
+    atexit.register(listener.stop)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=lambda: listener.restart_after_fork(queue_handler))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+    return queue_handler, listener
+
+
+def stop_logging():
+    """
+    Flush and stop every pipeline (for processes that skip atexit, and for
+    tests). Each writer thread is drained and joined before its handlers
+    are closed, so no batch is ever written to a closed stream. Records
+    logged afterwards fall back to logging's last-resort handler.
+    """
+    root = logging.getLogger()
+    while _listeners:
+        queue_handler, listener = _listeners.pop()
+        listener.stop()
+        root.removeHandler(queue_handler)
+        for handler in listener.handlers:
+            handler.close()
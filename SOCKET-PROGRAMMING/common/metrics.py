@@ -0,0 +1,269 @@
+"""
+In-process metrics with a Prometheus text endpoint.
+
+Updating a metric on the hot path takes no lock. Every thread that
+updates a metric gets its own cell (a small list of numbers) through a
+threading.local, so inc() and observe() are an attribute lookup and an
+addition. Only a scrape does real work: it sums the cells of every
+thread under the metric's lock. Cells of threads that have exited are
+folded into a retired total, so a thread-per-connection server does not
+accumulate them.
+
+Gauges are read from a function at scrape time (e.g. the size of a
+table), so keeping them up to date costs nothing.
+
+start_metrics_server() serves GET /metrics in the text exposition format
+(version 0.0.4) from the caller's asyncio loop; serve_metrics_in_thread()
+runs it on a loop of its own for servers that have no event loop.
+"""
+
+import asyncio
+import bisect
+import logging
+import math
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; from 100us (loopback) to 10s (a backend that is struggling)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # (thread, cell) for each thread that has updated this metric
+        self.cells = []
+        self.retired = self.new_cell()
+
+    def new_cell(self):
+        return [0]
+
+    def cell(self):
+        """The calling thread's cell, created on its first update."""
+        try:
+            return self.local.cell
+        except AttributeError:
+            cell = self.local.cell = self.new_cell()
+            with self.lock:
+                self.cells.append((threading.current_thread(), cell))
+            return cell
+
+    def collect(self):
+        """
+        Sum of every thread's updates.
+        Returns:
+            list: the summed cell.
+        """
+        with self.lock:
+            live = []
+            for thread, cell in self.cells:
+                if thread.is_alive():
+                    live.append((thread, cell))
+                else:
+                    for i, value in enumerate(cell):
+                        self.retired[i] += value
+            self.cells = live
+            total = list(self.retired)
+            for _, cell in live:
+                for i, value in enumerate(cell):
+                    total[i] += value
+        return total
+
+    def samples(self):
+        """(suffix, extra labels, value) for each line of the exposition."""
+        return [('', {}, self.collect()[0])]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1):
+        try:
+            self.local.cell[0] += amount
+        except AttributeError:
+            self.cell()[0] += amount
+
+    @property
+    def value(self):
+        return self.collect()[0]
+
+
+class Histogram(Metric):
+    """
+    Cumulative buckets as Prometheus expects them. A cell holds one count
+    per bucket (the last one is +Inf) followed by the sum of observations.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels, buckets=LATENCY_BUCKETS):
+        self.bounds = sorted(buckets)
+        super().__init__(name, help, labels)
+
+    def new_cell(self):
+        return [0] * (len(self.bounds) + 1) + [0.0]
+
+    def observe(self, value):
+        try:
+            cell = self.local.cell
+        except AttributeError:
+            cell = self.cell()
+        cell[bisect.bisect_left(self.bounds, value)] += 1
+        cell[-1] += value
+
+    @property
+    def count(self):
+        return sum(self.collect()[:-1])
+
+    def samples(self):
+        cell = self.collect()
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + [math.inf], cell):
+            cumulative += count
+            samples.append(('_bucket', {'le': format_value(float(bound))}, cumulative))
+        samples.append(('_sum', {}, cell[-1]))
+        samples.append(('_count', {}, cumulative))
+        return samples
+
+
+class Gauge(Metric):
+    """A value read from `fn` at scrape time."""
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels, fn):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    @property
+    def value(self):
+        return self.fn()
+
+    def samples(self):
+        return [('', {}, self.fn())]
+
+
+class Registry:
+    """
+    Named metrics. Asking for a metric that already exists (same name and
+    labels) returns it, so modules can declare the metrics they update
+    without sharing a definitions file. Registering a gauge again
+    replaces its function.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get(self, cls, name, help, labels, *args):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = self.metrics[key] = cls(name, help, labels, *args)
+            elif metric.kind != cls.kind:
+                raise ValueError(f"metric {name} is already registered as a {metric.kind}")
+        return metric
+
+    def counter(self, name, help, **labels):
+        return self.get(Counter, name, help, labels)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        return self.get(Histogram, name, help, labels, buckets)
+
+    def gauge(self, name, help, fn, **labels):
+        gauge = self.get(Gauge, name, help, labels, fn)
+        gauge.fn = fn
+        return gauge
+
+    def render(self):
+        """The text exposition of every metric, grouped by name."""
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda m: m.name)
+        lines = []
+        previous = None
+        for metric in metrics:
+            if metric.name != previous:
+                previous = metric.name
+                lines.append(f'# HELP {metric.name} {metric.help}')
+                lines.append(f'# TYPE {metric.name} {metric.kind}')
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                logging.error("Failed to read metric %s: %s", metric.name, e)
+                continue
+            for suffix, extra, value in samples:
+                labels = dict(metric.labels, **extra)
+                lines.append(f'{metric.name}{suffix}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of this process
+registry = Registry()
+
+
+async def handle_scrape(registry, reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+        method, path = request.split(b' ', 2)[:2]
+        if method != b'GET':
+            status, body = '405 Method Not Allowed', b''
+        elif path.split(b'?')[0] in (b'/metrics', b'/'):
+            status, body = '200 OK', registry.render().encode()
+        else:
+            status, body = '404 Not Found', b''
+        writer.write(f'HTTP/1.0 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n'
+                     f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+    except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host, port, registry=registry):
+    """
+    Serve the registry over HTTP on the running loop.
+    Returns:
+        asyncio.Server: close it to stop serving.
+    """
+    server = await asyncio.start_server(lambda r, w: handle_scrape(registry, r, w), host, port)
+    logging.info("Metrics available at http://%s:%s/metrics", host, server.sockets[0].getsockname()[1])
+    return server
+
+
+def serve_metrics_in_thread(host, port, registry=registry):
+    """
+    Serve the registry from a daemon thread with its own event loop.
+    Returns:
+        int: the bound port.
+    Raises:
+        OSError: if the port cannot be bound.
+    """
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(start_metrics_server(host, port, registry))
+    threading.Thread(target=loop.run_forever, name='metrics', daemon=True).start()
+    return server.sockets[0].getsockname()[1]
@@ -0,0 +1,68 @@
+"""
+Hashed timing wheel used to expire blocks, idle IPs and connection deadlines.
+
+Time is cut into ticks of `tick` seconds and a timer lives in the slot of
+the first tick at or after its deadline (modulo the number of slots).
+Advancing the wheel visits only the slots for the ticks that have passed,
+so scheduling, cancelling and expiring a timer are all O(1). A timer
+further away than one revolution (tick * slots seconds) stays in its
+slot and is passed over once per revolution until it is due.
+
+Timers never fire early and fire at most one tick late (plus however late
+advance() is called).
+"""
+
+
+class TimerWheel:
+    def __init__(self, tick=0.1, slots=2048):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]
+        # key -> index of the slot holding its timer
+        self.where = {}
+        # Last tick processed; set by the first advance()
+        self.current = None
+
+    def __len__(self):
+        return len(self.where)
+
+    def schedule(self, key, deadline):
+        """Set the timer for `key`, replacing any it already has."""
+        if self.current is None:
+            raise RuntimeError("advance() the wheel to the current time before scheduling")
+        self.cancel(key)
+        tick = max(int(deadline // self.tick) + 1, self.current + 1)
+        index = tick % len(self.slots)
+        self.slots[index][key] = deadline
+        self.where[key] = index
+
+    def cancel(self, key):
+        index = self.where.pop(key, None)
+        if index is not None:
+            del self.slots[index][key]
+
+    def advance(self, now):
+        """
+        Move the wheel forward to `now`.
+        Returns:
+            list: Keys whose deadline has passed; their timers are removed.
+        """
+        target = int(now // self.tick)
+        if self.current is None:
+            self.current = target
+            return []
+        if target <= self.current:
+            return []
+
+        expired = []
+        steps = min(target - self.current, len(self.slots))
+        for tick in range(self.current + 1, self.current + 1 + steps):
+            slot = self.slots[tick % len(self.slots)]
+            if not slot:
+                continue
+            due = [key for key, deadline in slot.items() if deadline <= now]
+            for key in due:
+                del slot[key]
+                del self.where[key]
+            expired.extend(due)
+        self.current = target
+        return expired